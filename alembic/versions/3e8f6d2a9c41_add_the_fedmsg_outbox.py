@@ -0,0 +1,35 @@
+"""
+Add the fedmsg outbox.
+
+Fedmsgs are written to this table in the transaction they are about, and published from it
+afterwards.
+
+Revision ID: 3e8f6d2a9c41
+Revises: 9b5a3c1e7d20
+Create Date: 2017-08-25 14:03:51.270418
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8f6d2a9c41'
+down_revision = '9b5a3c1e7d20'
+
+
+def upgrade():
+    """Create the fedmsg_outbox table."""
+    op.create_table(
+        'fedmsg_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('topic', sa.UnicodeText(), nullable=False),
+        sa.Column('body', sa.UnicodeText(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    """Drop the fedmsg_outbox table."""
+    op.drop_table('fedmsg_outbox')
@@ -0,0 +1,44 @@
+"""
+Add the full text search indexes of updates, bugs, packages and builds.
+
+The trigram indexes need the pg_trgm extension, which only a superuser can create. Have a DBA run
+"CREATE EXTENSION pg_trgm" in Bodhi's database before this migration, or the trigram indexes are
+skipped and searches of the short identifier columns are not indexed.
+
+Revision ID: 4f2e7c9d1b3a
+Revises: d8c3b1f5a7e2
+Create Date: 2017-08-23 16:12:40.127593
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2e7c9d1b3a'
+down_revision = 'd8c3b1f5a7e2'
+
+TRIGRAM_INDEXES = (
+    ('ix_updates_title_trgm', 'updates', 'title'),
+    ('ix_updates_alias_trgm', 'updates', 'alias'),
+    ('ix_bugs_title_trgm', 'bugs', 'title'),
+    ('ix_packages_name_trgm', 'packages', 'name'),
+    ('ix_builds_nvr_trgm', 'builds', 'nvr'),
+)
+
+
+def upgrade():
+    """Create the search indexes, and the trigram ones if pg_trgm is installed."""
+    has_trigrams = op.get_bind().execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first() is not None
+    if has_trigrams:
+        for index, table, column in TRIGRAM_INDEXES:
+            op.execute('CREATE INDEX {0} ON {1} USING gin ({2} gin_trgm_ops)'.format(
+                index, table, column))
+    op.execute("CREATE INDEX ix_updates_notes_tsv ON updates "
+               "USING gin (to_tsvector('english', coalesce(updates.notes, '')))")
+
+
+def downgrade():
+    """Drop the search indexes, leaving the trigram extension in place."""
+    for index, table, column in TRIGRAM_INDEXES:
+        op.execute('DROP INDEX IF EXISTS {0}'.format(index))
+    op.execute('DROP INDEX ix_updates_notes_tsv')
@@ -0,0 +1,40 @@
+"""
+Add the mail outbox.
+
+E-mails are written to this table in the transaction they are about, and sent from it afterwards.
+
+Revision ID: 9b5a3c1e7d20
+Revises: 4f2e7c9d1b3a
+Create Date: 2017-08-24 10:27:03.518204
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b5a3c1e7d20'
+down_revision = '4f2e7c9d1b3a'
+
+
+def upgrade():
+    """Create the mail_outbox table."""
+    op.create_table(
+        'mail_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('from_addr', sa.UnicodeText(), nullable=False),
+        sa.Column('recipients', sa.UnicodeText(), nullable=False),
+        sa.Column('subject', sa.UnicodeText(), nullable=False),
+        sa.Column('body', sa.UnicodeText(), nullable=False),
+        sa.Column('headers', sa.UnicodeText(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_mail_outbox_next_attempt'), 'mail_outbox', ['next_attempt'],
+                    unique=False)
+
+
+def downgrade():
+    """Drop the mail_outbox table."""
+    op.drop_index(op.f('ix_mail_outbox_next_attempt'), table_name='mail_outbox')
+    op.drop_table('mail_outbox')
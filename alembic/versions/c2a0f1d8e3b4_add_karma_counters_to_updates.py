@@ -0,0 +1,88 @@
+"""Add karma counters to the updates table.
+
+Revision ID: c2a0f1d8e3b4
+Revises: 95ce24bed77a
+Create Date: 2017-08-21 14:02:11.318842
+"""
+from collections import defaultdict
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2a0f1d8e3b4'
+down_revision = '95ce24bed77a'
+
+# The default admin_groups of Bodhi when this migration was written. Deployments that configure
+# other admin groups pass them with: alembic -x admin_groups="group1 group2" upgrade head
+ADMIN_GROUPS = ('proventesters', 'security_respons', 'bodhiadmin', 'sysadmin-main')
+
+
+def upgrade():
+    """
+    Add the karma counter columns to the updates table and compute them from the comments.
+
+    The counters are computed the same way the Update.karma, Update.num_admin_approvals and
+    Update.comments_since_karma_reset properties used to compute them on every access. The admin
+    groups are ADMIN_GROUPS, unless the admin_groups -x argument is given.
+    """
+    op.add_column('updates', sa.Column('positive_karma', sa.Integer(), server_default='0',
+                                       nullable=False))
+    op.add_column('updates', sa.Column('negative_karma', sa.Integer(), server_default='0',
+                                       nullable=False))
+    op.add_column('updates', sa.Column('num_admin_approvals', sa.Integer(), server_default='0',
+                                       nullable=False))
+    op.add_column('updates', sa.Column('date_karma_reset', sa.DateTime(), nullable=True))
+
+    bind = op.get_bind()
+    admin_groups = context.get_x_argument(as_dictionary=True).get('admin_groups')
+    admin_groups = admin_groups.split() if admin_groups else ADMIN_GROUPS
+    admins = set(
+        user_id for user_id, group in bind.execute(
+            "SELECT user_group_table.user_id, groups.name FROM user_group_table "
+            "JOIN groups ON groups.id = user_group_table.group_id")
+        if group in admin_groups)
+
+    comments = defaultdict(list)
+    for row in bind.execute(
+            "SELECT comments.update_id, comments.karma, comments.anonymous, comments.text, "
+            "comments.timestamp, comments.user_id, users.name FROM comments "
+            "JOIN users ON users.id = comments.user_id "
+            "WHERE comments.update_id IS NOT NULL ORDER BY comments.timestamp"):
+        comments[row[0]].append(row[1:])
+
+    updates = sa.sql.table(
+        'updates', sa.sql.column('id', sa.Integer), sa.sql.column('positive_karma', sa.Integer),
+        sa.sql.column('negative_karma', sa.Integer),
+        sa.sql.column('num_admin_approvals', sa.Integer),
+        sa.sql.column('date_karma_reset', sa.DateTime))
+    for update_id, update_comments in comments.items():
+        num_admin_approvals = len([
+            c for c in update_comments if c[0] == 1 and c[4] in admins])
+        positive_karma = negative_karma = 0
+        date_karma_reset = None
+        users_counted = set()
+        for karma, anonymous, text, timestamp, user_id, user in reversed(update_comments):
+            if user == u'bodhi' and ('New build' in text or 'Removed build' in text):
+                date_karma_reset = timestamp
+                break
+            if karma and not anonymous and user not in users_counted:
+                users_counted.add(user)
+                if karma > 0:
+                    positive_karma += karma
+                else:
+                    negative_karma += karma
+        op.execute(updates.update().where(updates.c.id == update_id).values({
+            'positive_karma': positive_karma, 'negative_karma': negative_karma,
+            'num_admin_approvals': num_admin_approvals, 'date_karma_reset': date_karma_reset}))
+
+
+def downgrade():
+    """
+    Drop the karma counter columns from the updates table.
+    """
+    op.drop_column('updates', 'date_karma_reset')
+    op.drop_column('updates', 'num_admin_approvals')
+    op.drop_column('updates', 'negative_karma')
+    op.drop_column('updates', 'positive_karma')
@@ -0,0 +1,30 @@
+"""
+Index the comment timestamps and the override submission dates.
+
+The comment and override lists are ordered by these columns, so their cursors can seek to the
+next page through these indexes.
+
+Revision ID: d8c3b1f5a7e2
+Revises: c2a0f1d8e3b4
+Create Date: 2017-08-22 09:41:27.604315
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8c3b1f5a7e2'
+down_revision = 'c2a0f1d8e3b4'
+
+
+def upgrade():
+    """Create the indexes."""
+    op.create_index(op.f('ix_comments_timestamp'), 'comments', ['timestamp'], unique=False)
+    op.create_index(op.f('ix_buildroot_overrides_submission_date'), 'buildroot_overrides',
+                    ['submission_date'], unique=False)
+
+
+def downgrade():
+    """Drop the indexes."""
+    op.drop_index(op.f('ix_buildroot_overrides_submission_date'),
+                  table_name='buildroot_overrides')
+    op.drop_index(op.f('ix_comments_timestamp'), table_name='comments')
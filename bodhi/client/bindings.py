@@ -248,6 +248,10 @@ class BodhiClient(OpenIdBaseClient):
         :kwarg rows_per_page: Limit the results to a certain number of rows per
                     page (min:1 max: 100 default: 20)
         :kwarg page: Return a specific page of results
+        :kwarg cursor: Return the page after the one whose ``next_cursor`` this is,
+            instead of a numbered page
+        :kwarg total: A boolean to count the matching updates. Defaults to True
+            unless a cursor is given.
 
         """
         # bodhi1 compat
@@ -13,14 +13,17 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 from collections import defaultdict
+import hashlib
 import logging
 
 from cornice.validators import DEFAULT_FILTERS
 from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
 from munch import munchify
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.exceptions import HTTPForbidden
 from pyramid.renderers import JSONP
 from sqlalchemy import engine_from_config, event
@@ -71,9 +74,16 @@ def get_db_session_for_request(request=None):
 
 
 def get_cacheregion(request):
-    region = make_region()
-    region.configure_from_config(bodhi_config, "dogpile.cache.")
-    return region
+    """
+    Return the process-wide cache region, for use with its ``cache_on_arguments()`` decorator.
+
+    Args:
+        request (pyramid.request): The current request.
+
+    Returns:
+        dogpile.cache.region.CacheRegion: The :data:`cache_region`.
+    """
+    return cache_region
 
 
 def get_user(request):
@@ -96,6 +106,16 @@ def get_koji(request):
     return buildsys.get_session()
 
 
+def release_koji_sessions(event):
+    """
+    Hand the Koji sessions used while serving a request back to the session pool.
+
+    Args:
+        event (pyramid.events.NewRequest): The event for the request that is being served.
+    """
+    event.request.add_finished_callback(lambda request: buildsys.release_session())
+
+
 def get_buildinfo(request):
     """
     A per-request cache populated by the validators and shared with the views
@@ -109,6 +129,108 @@ def get_releases(request):
     return Release.all_releases(request.db)
 
 
+#
+# Caching
+#
+
+def cache_key(namespace, *args):
+    """
+    Return the key that values for the given namespace and arguments are cached under.
+
+    The arguments are hashed so that the key is safe to use with any backend (memcached does not
+    allow spaces, for example), and the current generation of the namespace is part of the key so
+    that :func:`invalidate_cache` can drop every value in a namespace at once, even in a backend
+    that is shared with other processes.
+
+    Args:
+        namespace (basestring): The namespace the value belongs to, such as "home".
+        args (list): The arguments the cached value was computed from.
+
+    Returns:
+        str: The cache key.
+    """
+    generation = cache_region.get(_generation_key(namespace), ignore_expiration=True)
+    if generation is NO_VALUE:
+        generation = 0
+    digest = hashlib.sha1(u' '.join(unicode(arg) for arg in args).encode('utf-8')).hexdigest()
+    return 'bodhi:%s:%d:%s' % (namespace, generation, digest)
+
+
+def invalidate_cache(*namespaces):
+    """
+    Forget every value cached in the given namespaces.
+
+    This does nothing if the cache region has not been configured, which is the case in the
+    processes that never call :func:`configure_cache_region`.
+
+    Args:
+        namespaces (list): The names of the namespaces to invalidate.
+    """
+    if not cache_region.is_configured:
+        return
+    for namespace in namespaces:
+        key = _generation_key(namespace)
+        generation = cache_region.get(key, ignore_expiration=True)
+        cache_region.set(key, 1 if generation is NO_VALUE else generation + 1)
+
+
+def _cache_key_generator(namespace, fn, to_str=unicode):
+    """
+    Generate cache keys for the functions decorated with the region's ``cache_on_arguments()``.
+
+    Args:
+        namespace (basestring or None): The namespace given to ``cache_on_arguments()``. If it is
+            None, the module and name of the decorated function are used instead.
+        fn (callable): The decorated function.
+        to_str (callable): Unused, but part of the key generator signature expected by dogpile.
+
+    Returns:
+        callable: A function that returns the cache key for the arguments it is given.
+    """
+    if namespace is None:
+        namespace = '%s.%s' % (fn.__module__, fn.__name__)
+
+    def generate_key(*args):
+        """Return the cache key for the given arguments."""
+        return cache_key(namespace, *args)
+
+    return generate_key
+
+
+def _generation_key(namespace):
+    """
+    Return the key that the current generation of the given namespace is stored under.
+
+    Args:
+        namespace (basestring): The name of the namespace.
+
+    Returns:
+        str: The key of the generation counter.
+    """
+    return 'bodhi:%s:generation' % namespace
+
+
+def configure_cache_region(settings):
+    """
+    Configure the process-wide :data:`cache_region` with the given settings.
+
+    Any backend that was previously configured is replaced.
+
+    Args:
+        settings (dict): The Bodhi server configuration, which holds the ``dogpile.cache.*``
+            settings.
+    """
+    settings = dict(settings)
+    settings['dogpile.cache.replace_existing_backend'] = True
+    cache_region.configure_from_config(settings, 'dogpile.cache.')
+
+
+#: The dogpile.cache region that is shared by every request served by this process. It is configured
+#: by :func:`main` and by the fedmsg consumers, and cached values are namespaced so that several
+#: processes may share a backend.
+cache_region = make_region(function_key_generator=_cache_key_generator)
+
+
 #
 # Cornice filters
 #
@@ -181,6 +303,7 @@ def main(global_config, testing=None, session=None, **settings):
     buildsys.setup_buildsystem(bodhi_config)
 
     # Sessions & Caching
+    configure_cache_region(bodhi_config)
     from pyramid.session import SignedCookieSessionFactory
     session_factory = SignedCookieSessionFactory(bodhi_config['session.secret'])
 
@@ -211,6 +334,7 @@ def main(global_config, testing=None, session=None, **settings):
 
     config.add_request_method(get_user, 'user', reify=True)
     config.add_request_method(get_koji, 'koji', reify=True)
+    config.add_subscriber(release_koji_sessions, NewRequest)
     config.add_request_method(get_cacheregion, 'cache', reify=True)
     config.add_request_method(get_buildinfo, 'buildinfo', reify=True)
     config.add_request_method(get_releases, 'releases', reify=True)
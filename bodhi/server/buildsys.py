@@ -12,18 +12,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-from threading import Lock
+from threading import Lock, local
 import logging
 import time
 from functools import wraps
 
 import koji
 
+from bodhi.server import stats
+
 
 log = logging.getLogger('bodhi')
 _buildsystem = None
 # URL of the koji hub
 _koji_hub = None
+# The pool of authenticated Koji sessions, only used with the koji buildsystem
+_koji_session_pool = None
 
 
 def multicall_enabled(func):
@@ -228,6 +232,7 @@ class DevBuildsys(Buildsystem):
 
         return data
 
+    @multicall_enabled
     def listBuildRPMs(self, id, *args, **kw):
         rpms = [{'arch': 'src',
                  'build_id': 6475,
@@ -260,6 +265,7 @@ class DevBuildsys(Buildsystem):
         rpms += DevBuildsys.__rpms__
         return rpms
 
+    @multicall_enabled
     def listTags(self, build, *args, **kw):
         if 'el5' in build:
             result = [
@@ -329,6 +335,7 @@ class DevBuildsys(Buildsystem):
                 'perm': None, 'id': 246, 'arches': None,
                 'maven_include_all': False, 'perm_id': None}
 
+    @multicall_enabled
     def getRPMHeaders(self, rpmID, headers):
         if rpmID == 'raise-exception.src':
             raise Exception
@@ -374,6 +381,15 @@ class DevBuildsys(Buildsystem):
             }
 
 
+class CountingClientSession(koji.ClientSession):
+    """A Koji session that counts its calls, so the masher can report them for each stage."""
+
+    def _callMethod(self, name, *args, **kwargs):
+        """Count the call for the calling thread, and make it."""
+        stats.count('koji_calls')
+        return super(CountingClientSession, self)._callMethod(name, *args, **kwargs)
+
+
 def koji_login(config):
     """ Login to Koji and return the session """
 
@@ -386,7 +402,7 @@ def koji_login(config):
         'anon_retry': True,
     }
 
-    koji_client = koji.ClientSession(_koji_hub, koji_options)
+    koji_client = CountingClientSession(_koji_hub, koji_options)
     if not koji_client.krb_login(**get_krb_conf(config)):
         log.error('Koji krb_login failed')
     return koji_client
@@ -407,23 +423,195 @@ def get_krb_conf(config):
     return args
 
 
+class KojiSessionPool(object):
+    """
+    A thread-safe pool of authenticated Koji sessions.
+
+    Sessions are checked out per thread: the first call to :meth:`get` in a thread takes a warm
+    session from the pool (or logs in a new one if the pool is empty), and subsequent calls in that
+    thread reuse it until :meth:`release` hands it back. A session that is in the middle of building
+    a multicall is never handed out again, so nested callers get a second session instead of
+    appending their calls to someone else's multicall.
+
+    Sessions that have not been verified for ``check_interval`` seconds are health checked with
+    ``getLoggedInUser()`` before they are used, and are replaced with a fresh login if their ticket
+    has expired.
+
+    Attributes:
+        size (int): The maximum number of idle sessions kept warm in the pool. Threads are never
+            blocked when the pool is empty; extra sessions are logged in on demand and logged out
+            when they are released to a full pool.
+        check_interval (int): How many seconds a session may go without a health check.
+    """
+
+    def __init__(self, login, size=8, check_interval=300):
+        """
+        Initialize the pool.
+
+        Args:
+            login (callable): A callable that returns a new authenticated koji.ClientSession.
+            size (int): The maximum number of idle sessions to keep in the pool.
+            check_interval (int): How many seconds a session may go without a health check.
+        """
+        self._login = login
+        self.size = size
+        self.check_interval = check_interval
+        self._lock = Lock()
+        # Sessions are handed out lock-free, but logging in is serialized as it is without a pool.
+        self._login_lock = Lock()
+        # A list of (session, time of last successful health check) tuples.
+        self._idle = []
+        self._local = local()
+
+    def get(self):
+        """
+        Return a Koji session for the calling thread.
+
+        Returns:
+            koji.ClientSession: An authenticated session that is not currently building a
+                multicall.
+        """
+        checked_out = self._checked_out()
+        for i, (session, checked) in enumerate(checked_out):
+            if getattr(session, 'multicall', False):
+                continue
+            if time.time() - checked >= self.check_interval:
+                if not self._is_healthy(session):
+                    self._logout(session)
+                    session = self._new_session()
+                checked_out[i] = (session, time.time())
+            return session
+
+        session, checked = self._checkout()
+        checked_out.append((session, checked))
+        return session
+
+    def release(self):
+        """Hand all of the calling thread's sessions back to the pool."""
+        checked_out = self._checked_out()
+        self._local.sessions = []
+        for session, checked in checked_out:
+            # Don't leak a half-built multicall to the next thread that uses this session.
+            session.multicall = False
+            if hasattr(session, '_calls'):
+                session._calls = []
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((session, checked))
+                    continue
+            self._logout(session)
+
+    def clear(self):
+        """Log out and forget every idle session in the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, checked in idle:
+            self._logout(session)
+
+    def _checked_out(self):
+        """
+        Return the list of sessions held by the calling thread.
+
+        Returns:
+            list: A list of (session, time of last successful health check) tuples.
+        """
+        if not hasattr(self._local, 'sessions'):
+            self._local.sessions = []
+        return self._local.sessions
+
+    def _checkout(self):
+        """
+        Take a healthy session out of the pool, or log in a new one if there are none.
+
+        Returns:
+            tuple: A (session, time of last successful health check) tuple.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session, checked = self._idle.pop()
+            if time.time() - checked < self.check_interval:
+                return session, checked
+            if self._is_healthy(session):
+                return session, time.time()
+            self._logout(session)
+
+        return self._new_session(), time.time()
+
+    def _new_session(self):
+        """
+        Log in a new Koji session, one thread at a time.
+
+        Returns:
+            koji.ClientSession: The new authenticated session.
+        """
+        with self._login_lock:
+            return self._login()
+
+    @staticmethod
+    def _is_healthy(session):
+        """
+        Return whether the given session is still logged in to Koji.
+
+        Args:
+            session (koji.ClientSession): The session to check.
+        Returns:
+            bool: True if the session is still authenticated, False otherwise.
+        """
+        try:
+            return bool(session.getLoggedInUser())
+        except Exception:
+            log.warning('Koji session failed its health check, logging in again', exc_info=True)
+            return False
+
+    @staticmethod
+    def _logout(session):
+        """
+        Log the given session out of Koji, ignoring any errors.
+
+        Args:
+            session (koji.ClientSession): The session to log out.
+        """
+        try:
+            session.logout()
+        except Exception:
+            log.debug('Unable to log out of Koji session', exc_info=True)
+
+
 def get_session():
-    """ Get a new buildsystem instance """
+    """ Get a buildsystem instance, reusing a pooled Koji session if possible """
     global _buildsystem, _buildsystem_login_lock
     if _buildsystem is None:
         raise RuntimeError('Buildsys needs to be setup')
+    if _koji_session_pool is not None:
+        return _koji_session_pool.get()
     with _buildsystem_login_lock:
         return _buildsystem()
 
 
+def release_session():
+    """
+    Hand the calling thread's Koji sessions back to the session pool.
+
+    This should be called when a unit of work (a web request or a masher thread) is done with Koji.
+    It is a no-op when the buildsystem is not pooled.
+    """
+    if _koji_session_pool is not None:
+        _koji_session_pool.release()
+
+
 def teardown_buildsystem():
-    global _buildsystem
+    global _buildsystem, _koji_session_pool
     _buildsystem = None
+    if _koji_session_pool is not None:
+        _koji_session_pool.clear()
+        _koji_session_pool = None
     DevBuildsys.clear()
 
 
 def setup_buildsystem(settings):
-    global _buildsystem, _koji_hub, _buildsystem_login_lock
+    global _buildsystem, _koji_hub, _buildsystem_login_lock, _koji_session_pool
     if _buildsystem:
         return
 
@@ -439,6 +627,9 @@ def setup_buildsystem(settings):
             return koji_login(config=settings)
 
         _buildsystem = get_koji_login
+        _koji_session_pool = KojiSessionPool(
+            get_koji_login, size=settings.get('koji_session_pool.size', 8),
+            check_interval=settings.get('koji_session_pool.check_interval', 300))
     elif buildsys in ('dev', 'dummy', None):
         log.debug('Using DevBuildsys')
         _buildsystem = DevBuildsys
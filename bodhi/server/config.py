@@ -248,6 +248,18 @@ class BodhiConfig(dict):
     loaded = False
 
     _defaults = {
+        'acl_cache.negative_ttl': {
+            'value': 60,
+            'validator': int},
+        'acl_cache.stale_ttl': {
+            'value': 3600,
+            'validator': int},
+        'acl_cache.ttl': {
+            'value': 300,
+            'validator': int},
+        'acl_cache.workers': {
+            'value': 8,
+            'validator': int},
         'acl_system': {
             'value': 'dummy',
             'validator': unicode},
@@ -388,6 +400,18 @@ class BodhiConfig(dict):
         'fedmsg_enabled': {
             'value': False,
             'validator': _validate_bool},
+        'fedmsg_full_payloads': {
+            'value': False,
+            'validator': _validate_bool},
+        'fedmsg_outbox.batch_size': {
+            'value': 100,
+            'validator': int},
+        'fedmsg_outbox.max_attempts': {
+            'value': 10,
+            'validator': int},
+        'fedmsg_outbox.retry_delay': {
+            'value': 10,
+            'validator': int},
         'file_url': {
             'value': 'https://download.fedoraproject.org/pub/fedora/linux/updates',
             'validator': unicode},
@@ -407,6 +431,12 @@ class BodhiConfig(dict):
         'koji_hub': {
             'value': 'https://koji.stg.fedoraproject.org/kojihub',
             'validator': str},
+        'koji_session_pool.check_interval': {
+            'value': 300,
+            'validator': int},
+        'koji_session_pool.size': {
+            'value': 8,
+            'validator': int},
         'krb_ccache': {
             'value': None,
             'validator': _validate_none_or(str)},
@@ -422,6 +452,15 @@ class BodhiConfig(dict):
         'libravatar_enabled': {
             'value': True,
             'validator': _validate_bool},
+        'mail_outbox.batch_size': {
+            'value': 100,
+            'validator': int},
+        'mail_outbox.max_attempts': {
+            'value': 10,
+            'validator': int},
+        'mail_outbox.retry_delay': {
+            'value': 60,
+            'validator': int},
         'mako.directories': {
             'value': 'bodhi:server/templates',
             'validator': unicode},
@@ -434,15 +473,33 @@ class BodhiConfig(dict):
         'mash_dir': {
             'value': None,
             'validator': _validate_none_or(_validate_path)},
+        'mash_progress_interval': {
+            'value': 30,
+            'validator': int},
         'mash_stage_dir': {
             'value': None,
             'validator': _validate_none_or(_validate_path)},
+        'max_concurrent_mashes': {
+            'value': 8,
+            'validator': int},
         'max_update_length_for_ui': {
             'value': 30,
             'validator': int},
         'message_id_email_domain': {
             'value': 'admin.fedoraproject.org',
             'validator': unicode},
+        'mirror_sync.max_interval': {
+            'value': 300,
+            'validator': int},
+        'mirror_sync.min_interval': {
+            'value': 30,
+            'validator': int},
+        'mirror_sync.timeout': {
+            'value': 60,
+            'validator': int},
+        'mirror_sync.workers': {
+            'value': 8,
+            'validator': int},
         'not_yet_tested_epel_msg': {
             'value': (
                 'This update has not yet met the minimum testing requirements defined in the '
@@ -488,6 +545,12 @@ class BodhiConfig(dict):
         'resultsdb_api_url': {
             'value': 'https://taskotron.fedoraproject.org/resultsdb_api/',
             'validator': unicode},
+        'rpm_header_cache.dir': {
+            'value': None,
+            'validator': _validate_none_or(unicode)},
+        'rpm_header_cache.size': {
+            'value': 256,
+            'validator': int},
         'session.secret': {
             'value': 'CHANGEME',
             'validator': _validate_secret},
@@ -547,9 +610,24 @@ class BodhiConfig(dict):
         'test_gating.url': {
             'value': '',
             'validator': unicode},
+        'updateinfo_koji_chunk_size': {
+            'value': 100,
+            'validator': int},
+        'updateinfo_koji_threads': {
+            'value': 4,
+            'validator': int},
         'updateinfo_rights': {
             'value': 'Copyright (C) {} Red Hat, Inc. and others.'.format(datetime.now().year),
             'validator': unicode},
+        'updates_handler.request_workers': {
+            'value': 8,
+            'validator': int},
+        'updates_handler.visibility_timeout': {
+            'value': 30,
+            'validator': int},
+        'updates_handler.workers': {
+            'value': 4,
+            'validator': int},
         'wiki_url': {
             'value': 'https://fedoraproject.org/w/api.php',
             'validator': unicode},
@@ -21,12 +21,15 @@ mashed.
 
 import copy
 import functools
+import glob
 import hashlib
 import json
 import os
+import Queue
+import shutil
+import tempfile
 import threading
 import time
-import urllib2
 from collections import defaultdict
 from datetime import datetime
 
@@ -36,12 +39,13 @@ from pyramid.paster import get_appsettings
 from sqlalchemy import engine_from_config
 import fedmsg.consumers
 
-from bodhi.server import bugs, log, buildsys, notifications, mail, util
+from bodhi.server import (bugs, configure_cache_region, log, buildsys, notifications, mail,
+                          mirrors, stats, util)
 from bodhi.server.config import config
 from bodhi.server.exceptions import BodhiException
 from bodhi.server.metadata import ExtendedMetadata
 from bodhi.server.models import (Update, UpdateRequest, UpdateType, Release,
-                                 UpdateStatus, ReleaseState, Base)
+                                 UpdateStatus, ReleaseState, ContentType, Base)
 from bodhi.server.util import sorted_updates, sanity_check_repodata, transactional_session_maker
 
 
@@ -58,8 +62,7 @@ def checkpoint(method):
             if retval is not None:
                 raise ValueError("checkpointed functions may not return stuff")
             # if it didn't raise an exception, mark the checkpoint
-            self.state[key] = True
-            self.save_state()
+            self.journal('checkpoint', key)
         else:
             # cool!  we don't need to do anything, since we ran last time
             pass
@@ -68,6 +71,15 @@ def checkpoint(method):
     return wrapper
 
 
+def stage(method):
+    """ A decorator for recording the work done by a stage of the mash in its stats. """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.measure(method.__name__, method, self, *args, **kwargs)
+    return wrapper
+
+
 class Masher(fedmsg.consumers.FedmsgConsumer):
     """The Bodhi Masher.
 
@@ -127,6 +139,8 @@ Once mash is done:
 
         buildsys.setup_buildsystem(config)
         bugs.set_bugtracker()
+        # The pushes change the statuses of updates, which the web application caches counts of.
+        configure_cache_region(config)
         self.mash_dir = mash_dir
         prefix = hub.config.get('topic_prefix')
         env = hub.config.get('environment')
@@ -151,32 +165,36 @@ Once mash is done:
         self.work(msg)
 
     def prioritize_updates(self, releases):
-        """Return 2 batches of repos: important, and normal.
+        """Return the repos of the push, in the order in which they should be mashed.
+
+        Repos that contain a security update come first, then repos that contain a critical path
+        update. Within those, stable repos come before testing repos.
 
-        At the moment an important repo is one that contains a security update.
+        Args:
+            releases (dict): The updates of the push, as returned by organize_updates().
+        Returns:
+            list: (release, request, update_titles) tuples, the most important first.
         """
-        important, normal = [], []
+        repos = []
         for release in releases:
             for request, updates in releases[release].items():
                 update_titles = [update.title for update in updates]
-                for update in updates:
-                    if update.type is UpdateType.security:
-                        important.append((release, request, update_titles))
-                        self.log.info('%s %s contains a security update' % (
-                            release, request))
-                        break
-                else:
-                    normal.append((release, request, update_titles))
-        return important, normal
+                security = any([u.type is UpdateType.security for u in updates])
+                critpath = any([bool(u.critpath) for u in updates])
+                if security:
+                    self.log.info('%s %s contains a security update' % (release, request))
+                key = (not security, not critpath, request != 'stable', release)
+                repos.append((key, (release, request, update_titles)))
+        return [repo for priority, repo in sorted(repos)]
 
     def work(self, msg):
         """Begin the push process.
 
         Here we organize & prioritize the updates, and fire off separate
-        threads for each reop tag being mashed.
+        threads for each repo tag being mashed.
 
         If there are any security updates in the push, then those repositories
-        will be executed before all others.
+        will be started before all others.
         """
         body = msg['body']['msg']
         resume = body.get('resume', False)
@@ -185,32 +203,62 @@ Once mash is done:
 
         with self.db_factory() as session:
             releases = self.organize_updates(session, body)
-            batches = self.prioritize_updates(releases)
+            repos = self.prioritize_updates(releases)
 
-        results = []
-        # Important repos first, then normal
-        for batch in batches:
-            # Stable first, then testing
-            for req in ('stable', 'testing'):
-                threads = []
-                for release, request, updates in batch:
-                    if request == req:
-                        self.log.info('Starting thread for %s %s for %d updates',
-                                      release, request, len(updates))
-                        thread = MasherThread(release, request, updates, agent,
-                                              self.log, self.db_factory,
-                                              self.mash_dir, resume)
-                        threads.append(thread)
-                        thread.start()
-                for thread in threads:
-                    thread.join()
-                    for result in thread.results():
-                        results.append(result)
+        results = self.schedule(repos, agent, resume)
 
         self.log.info('Push complete!  Summary follows:')
         for result in results:
             self.log.info(result)
 
+    def schedule(self, repos, agent, resume):
+        """Run a MasherThread for each of the given repos, and return their results.
+
+        Up to max_concurrent_mashes threads run at once. Whenever one of them is done, the most
+        important repo that is ready is started, so a slow repo only holds up the repos that
+        depend on it: a release's testing repo waits for its stable repo, since the stable push
+        moves builds out of the testing tag and the testing atomic trees are composed from both.
+
+        Args:
+            repos (list): (release, request, update_titles) tuples, the most important first.
+            agent (basestring): The user who started the push.
+            resume (bool): Whether the push is being resumed.
+        Returns:
+            list: The results of the threads, in the order in which they were done.
+        """
+        max_threads = max(config.get('max_concurrent_mashes'), 1)
+        stable = set([release for release, request, updates in repos if request == 'stable'])
+        pending = list(repos)
+        running = {}
+        done = set()
+        finished = Queue.Queue()
+        comps = CompsPreparer(os.path.join(self.mash_dir, 'comps'))
+        results = []
+        while pending or running:
+            for repo in list(pending):
+                if len(running) >= max_threads:
+                    break
+                release, request, updates = repo
+                if request == 'testing' and release in stable and release not in done:
+                    continue
+                pending.remove(repo)
+                self.log.info('Starting thread for %s %s for %d updates',
+                              release, request, len(updates))
+                thread = MasherThread(release, request, updates, agent,
+                                      self.log, self.db_factory,
+                                      self.mash_dir, resume, finished, comps)
+                running[thread] = repo
+                thread.start()
+
+            thread = finished.get()
+            thread.join()
+            release, request, updates = running.pop(thread)
+            if request == 'stable':
+                done.add(release)
+            for result in thread.results():
+                results.append(result)
+        return results
+
     def organize_updates(self, session, body):
         # {Release: {UpdateRequest: [Update,]}}
         releases = defaultdict(lambda: defaultdict(list))
@@ -232,8 +280,11 @@ Once mash is done:
 class MasherThread(threading.Thread):
 
     def __init__(self, release, request, updates, agent,
-                 log, db_factory, mash_dir, resume=False):
+                 log, db_factory, mash_dir, resume=False, finished=None, comps=None):
         super(MasherThread, self).__init__()
+        self.finished = finished
+        self.comps = comps
+        self.comps_dir = config.get('comps_dir')
         self.db_factory = db_factory
         self.log = log
         self.agent = agent
@@ -249,7 +300,8 @@ class MasherThread(threading.Thread):
         self.testing_digest = {}
         self.state = {
             'updates': updates,
-            'completed_repos': []
+            'completed_repos': [],
+            'stats': []
         }
         self.success = False
 
@@ -261,12 +313,46 @@ class MasherThread(threading.Thread):
                 self.db = None
         except:
             self.log.exception('MasherThread failed. Transaction rolled back.')
+        finally:
+            buildsys.release_session()
+            if self.finished is not None:
+                self.finished.put(self)
 
     def results(self):
         attrs = ['name', 'success']
         yield "  name:  %(name)-20s  success:  %(success)s" % dict(
             zip(attrs, [getattr(self, attr, 'Undefined') for attr in attrs])
         )
+        for record in self.state.get('stats', []):
+            yield ("    %(stage)-34s %(seconds)9.3fs  koji calls: %(koji_calls)5d  "
+                   "db queries: %(db_queries)6d  bytes written: %(bytes_written)s" % record)
+
+    def measure(self, name, func, *args, **kwargs):
+        """
+        Call the given function as a stage of the mash, and record the work it did in the stats.
+
+        The stats are a list of dictionaries in the state, one for each stage in the order in which
+        they ran, with the stage's name, wall time, Koji calls, database queries and bytes
+        written. A stage that runs again when the push is resumed replaces its previous stats.
+
+        Args:
+            name (basestring): The name of the stage.
+            func (callable): The function that performs the stage.
+            args (tuple): The positional arguments to pass to func.
+            kwargs (dict): The keyword arguments to pass to func.
+        Returns:
+            object: What func returned.
+        """
+        timer = stats.Timer()
+        try:
+            with timer:
+                return func(*args, **kwargs)
+        finally:
+            record = timer.as_dict()
+            record['stage'] = name
+            self.log.info('%s took %0.2fs', name, timer.seconds)
+            self.state['stats'] = [
+                r for r in self.state.get('stats', []) if r['stage'] != name] + [record]
 
     def work(self):
         self.release = self.db.query(Release)\
@@ -300,8 +386,8 @@ class MasherThread(threading.Thread):
         try:
             if self.resume:
                 self.load_state()
-            else:
-                self.save_state()
+            # Start with a compacted state, without the journal of a previous attempt
+            self.save_state()
 
             self.load_updates()
             self.verify_updates()
@@ -321,6 +407,7 @@ class MasherThread(threading.Thread):
                 mash_thread = self.mash()
 
             # Things we can do while we're mashing
+            self.prefetch_rpm_headers()
             self.complete_requests()
             self.generate_testing_digest()
 
@@ -329,8 +416,8 @@ class MasherThread(threading.Thread):
 
                 self.wait_for_mash(mash_thread)
 
-                uinfo.insert_updateinfo()
-                uinfo.cache_repodata()
+                self.measure('insert_updateinfo', uinfo.insert_updateinfo)
+                self.measure('cache_repodata', uinfo.cache_repodata)
 
             # Compose OSTrees from our freshly mashed repos
             if config.get('compose_atomic_trees'):
@@ -372,6 +459,7 @@ class MasherThread(threading.Thread):
         finally:
             self.finish(self.success)
 
+    @stage
     def load_updates(self):
         self.log.debug('Loading updates')
         updates = []
@@ -384,6 +472,7 @@ class MasherThread(threading.Thread):
                             self.state['updates'])
         self.updates = updates
 
+    @stage
     def unlock_updates(self):
         self.log.debug('Unlocking updates')
         for update in self.updates:
@@ -391,6 +480,7 @@ class MasherThread(threading.Thread):
             update.date_locked = None
         self.db.flush()
 
+    @stage
     def check_all_karma_thresholds(self):
         """
         If we just pushed testing updates see if any of them now meet either of
@@ -405,6 +495,7 @@ class MasherThread(threading.Thread):
                 except BodhiException:
                     self.log.exception('Problem checking karma thresholds')
 
+    @stage
     def obsolete_older_updates(self):
         """
         Obsolete any older updates that may still be lying around.
@@ -413,6 +504,7 @@ class MasherThread(threading.Thread):
         for update in self.updates:
             update.obsolete_older_updates(self.db)
 
+    @stage
     def verify_updates(self):
         for update in list(self.updates):
             if update.request is not self.request:
@@ -427,6 +519,7 @@ class MasherThread(threading.Thread):
                 self.eject_from_mash(update, reason)
                 continue
 
+    @stage
     def perform_gating(self):
         self.log.debug('Performing gating.')
         for update in list(self.updates):
@@ -477,6 +570,7 @@ class MasherThread(threading.Thread):
             self.log.info('Creating %s' % self.mash_dir)
             os.makedirs(self.mash_dir)
         self.mash_lock = os.path.join(self.mash_dir, 'MASHING-%s' % self.id)
+        self.mash_journal = os.path.join(self.mash_dir, 'JOURNAL-%s' % self.id)
         if os.path.exists(self.mash_lock) and not self.resume:
             self.log.error('Trying to do a fresh push and masher lock already '
                            'exists: %s' % self.mash_lock)
@@ -484,18 +578,40 @@ class MasherThread(threading.Thread):
 
     def save_state(self):
         """
-        Save the state of this push so it can be resumed later if necessary
+        Save the state of this push so it can be resumed later if necessary.
+
+        The whole state is written to the masher lock, which replaces the lock atomically, and
+        then the journal is removed since the lock now contains all of its changes.
         """
-        with file(self.mash_lock, 'w') as lock:
+        tmp = os.path.join(self.mash_dir, '.MASHING-%s.tmp' % self.id)
+        with file(tmp, 'w') as lock:
             json.dump(self.state, lock)
+            lock.flush()
+            os.fsync(lock.fileno())
+        os.rename(tmp, self.mash_lock)
+        if os.path.exists(self.mash_journal):
+            os.remove(self.mash_journal)
         self.log.info('Masher lock saved: %s', self.mash_lock)
 
     def load_state(self):
         """
-        Load the state of this push so it can be resumed later if necessary
+        Load the state of this push so it can be resumed later if necessary.
+
+        The state is read from the masher lock, and the changes in the journal are applied to it.
         """
         with file(self.mash_lock) as lock:
             self.state = json.load(lock)
+        if os.path.exists(self.mash_journal):
+            with file(self.mash_journal) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The masher stopped while it was appending this entry
+                        self.log.warn('Ignoring a partial entry at the end of %s',
+                                      self.mash_journal)
+                        break
+                    self._apply(entry)
         self.log.info('Masher state loaded from %s', self.mash_lock)
         self.log.info(self.state)
         for path in self.state['completed_repos']:
@@ -508,16 +624,73 @@ class MasherThread(threading.Thread):
 
     def remove_state(self):
         self.log.info('Removing state: %s', self.mash_lock)
+        if os.path.exists(self.mash_journal):
+            os.remove(self.mash_journal)
         os.remove(self.mash_lock)
 
+    def journal(self, op, key, value=None):
+        """
+        Change the state of this push, and append the change to the journal.
+
+        The entry is synced to disk before this returns, so a resumed push skips exactly the work
+        that was journaled before the masher stopped, without rewriting the whole state each time.
+
+        Args:
+            op (str): 'checkpoint' to mark the stage named key as done, 'done' to mark value as done
+                by the stage named key, or 'add' to add value to the state's list named key.
+            key (str): The name of the stage or of the list.
+            value (object): The item or value of the change, which must be serializable to JSON.
+        """
+        entry = {'op': op, 'key': key, 'value': value}
+        self._apply(entry)
+        with file(self.mash_journal, 'a') as journal:
+            journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _apply(self, entry):
+        """
+        Apply a journal entry to the state. Applying an entry more than once has no more effect.
+
+        Args:
+            entry (dict): The entry, as created by journal().
+        """
+        if entry['op'] == 'checkpoint':
+            self.state[entry['key']] = True
+            return
+        if entry['op'] == 'done':
+            items = self.state.setdefault('done', {}).setdefault(entry['key'], [])
+        else:
+            items = self.state.setdefault(entry['key'], [])
+        if entry['value'] not in items:
+            items.append(entry['value'])
+
+    def is_done(self, stage, item):
+        """
+        Return whether the given stage journaled that it is done with the given item.
+
+        Args:
+            stage (str): The name of the stage.
+            item (basestring): The item, such as the title of an update.
+        Returns:
+            bool: True if the stage was done with the item in a previous attempt of the push.
+        """
+        return item in self.state.get('done', {}).get(stage, [])
+
     def finish(self, success):
         self.log.info('Thread(%s) finished.  Success: %r' % (self.id, success))
+        notifications.publish(
+            topic="mashtask.stats",
+            msg=dict(repo=self.id, stats=self.state.get('stats', []), agent=self.agent),
+            force=True,
+        )
         notifications.publish(
             topic="mashtask.complete",
             msg=dict(success=success, repo=self.id, agent=self.agent),
             force=True,
         )
 
+    @stage
     def update_security_bugs(self):
         """Update the bug titles for security updates"""
         self.log.info('Updating bug titles for security updates')
@@ -527,6 +700,7 @@ class MasherThread(threading.Thread):
                     bug.update_details()
 
     @checkpoint
+    @stage
     def determine_and_perform_tag_actions(self):
         self._determine_tag_actions()
         self._perform_tag_actions()
@@ -596,6 +770,7 @@ class MasherThread(threading.Thread):
                 if failed_tasks:
                     raise Exception("Failed to move builds: %s" % failed_tasks)
 
+    @stage
     def expire_buildroot_overrides(self):
         """ Expire any buildroot overrides that are in this push """
         for update in self.updates:
@@ -607,6 +782,7 @@ class MasherThread(threading.Thread):
                         except:
                             log.exception('Problem expiring override')
 
+    @stage
     def remove_pending_tags(self):
         """ Remove all pending tags from these updates """
         self.log.debug("Removing pending tags from builds")
@@ -623,34 +799,34 @@ class MasherThread(threading.Thread):
         self.log.debug('remove_pending_tags koji.multiCall result = %r',
                        result)
 
+    @stage
     def update_comps(self):
         """
         Update our comps git module and merge the latest translations so we can
         pass it to mash insert into the repodata.
+
+        The comps are only prepared by the first thread of the push, and the others use the same
+        snapshot of the comps files.
         """
         self.log.info("Updating comps")
-        comps_dir = config.get('comps_dir')
-        comps_url = config.get('comps_url')
-
-        if not os.path.exists(comps_dir):
-            util.cmd(['git', 'clone', comps_url, comps_dir], os.path.dirname(comps_dir))
-
-        util.cmd(['git', 'pull'], comps_dir)
-        util.cmd(['make'], comps_dir)
+        if self.comps is None:
+            self.comps = CompsPreparer(os.path.join(self.mash_dir, 'comps'))
+        self.comps_dir = self.comps.prepare(self.log)
 
+    @stage
     def mash(self):
         if self.path in self.state['completed_repos']:
             self.log.info('Skipping completed repo: %s', self.path)
             return
 
-        comps = os.path.join(config.get('comps_dir'), 'comps-%s.xml' %
-                             self.release.branch)
+        comps = os.path.join(self.comps_dir, 'comps-%s.xml' % self.release.branch)
         previous = os.path.join(config.get('mash_stage_dir'), self.id)
 
         mash_thread = MashThread(self.id, self.path, comps, previous, self.log)
         mash_thread.start()
         return mash_thread
 
+    @stage
     def wait_for_mash(self, mash_thread):
         if mash_thread is None:
             self.log.info('Not waiting for mash thread, as there was no mash')
@@ -658,11 +834,18 @@ class MasherThread(threading.Thread):
         self.log.debug('Waiting for mash thread to finish')
         mash_thread.join()
         if mash_thread.success:
-            self.state['completed_repos'].append(self.path)
-            self.save_state()
+            self.journal('add', 'completed_repos', self.path)
         else:
             raise Exception
 
+    @stage
+    def prefetch_rpm_headers(self):
+        """Fetch the RPM headers that the e-mails about the updates need, in a few Koji calls."""
+        nvrs = [build.nvr for update in self.updates if update.content_type is ContentType.rpm
+                for build in update.builds]
+        util.prefetch_rpm_headers(nvrs)
+
+    @stage
     def complete_requests(self):
         """Mark all the updates as pushed using Update.request_complete()."""
         self.log.info("Running post-request actions on updates")
@@ -687,6 +870,7 @@ class MasherThread(threading.Thread):
                 update, use_template='maillist_template')):
             self.testing_digest[prefix][update.builds[i].nvr] = subbody[1]
 
+    @stage
     def generate_testing_digest(self):
         self.log.info('Generating testing digest for %s' % self.release.name)
         for update in self.updates:
@@ -694,6 +878,7 @@ class MasherThread(threading.Thread):
                 self.add_to_digest(update)
         self.log.info('Testing digest generation for %s complete' % self.release.name)
 
+    @stage
     def generate_updateinfo(self):
         self.log.info('Generating updateinfo for %s' % self.release.name)
         uinfo = ExtendedMetadata(self.release, self.request,
@@ -701,6 +886,7 @@ class MasherThread(threading.Thread):
         self.log.info('Updateinfo generation for %s complete' % self.release.name)
         return uinfo
 
+    @stage
     def sanity_check_repo(self):
         """Sanity check our repo.
 
@@ -730,6 +916,7 @@ class MasherThread(threading.Thread):
 
         return True
 
+    @stage
     def stage_repo(self):
         """Symlink our updates repository into the staging directory"""
         stage_dir = config.get('mash_stage_dir')
@@ -742,8 +929,9 @@ class MasherThread(threading.Thread):
         self.log.info("Creating symlink: %s => %s" % (self.path, link))
         os.symlink(os.path.join(self.path, self.id), link)
 
+    @stage
     def wait_for_sync(self):
-        """Block until our repomd.xml hits the master mirror"""
+        """Block until the repomd.xml of all of our arches hit the master mirror"""
         self.log.info('Waiting for updates to hit the master mirror')
         notifications.publish(
             topic="mashtask.sync.wait",
@@ -751,38 +939,27 @@ class MasherThread(threading.Thread):
             force=True,
         )
         mash_path = os.path.join(self.path, self.id)
-        arch = os.listdir(mash_path)[0]
-
-        repomd = os.path.join(mash_path, arch, 'repodata', 'repomd.xml')
-        if not os.path.exists(repomd):
-            self.log.error('Cannot find local repomd: %s', repomd)
-            return
-
-        master_repomd_url = self._get_master_repomd_url(arch)
 
-        checksum = hashlib.sha1(file(repomd).read()).hexdigest()
-        while True:
-            try:
-                self.log.info('Polling %s' % master_repomd_url)
-                masterrepomd = urllib2.urlopen(master_repomd_url)
-            except (urllib2.URLError, urllib2.HTTPError):
-                self.log.exception('Error fetching repomd.xml')
-                time.sleep(200)
+        expected = {}
+        for arch in sorted(os.listdir(mash_path)):
+            repomd = os.path.join(mash_path, arch, 'repodata', 'repomd.xml')
+            if not os.path.exists(repomd):
+                self.log.error('Cannot find local repomd: %s', repomd)
                 continue
-            newsum = hashlib.sha1(masterrepomd.read()).hexdigest()
-            if newsum == checksum:
-                self.log.info("master repomd.xml matches!")
-                notifications.publish(
-                    topic="mashtask.sync.done",
-                    msg=dict(repo=self.id, agent=self.agent),
-                    force=True,
-                )
-                return
+            checksum = hashlib.sha1(file(repomd).read()).hexdigest()
+            expected[self._get_master_repomd_url(arch)] = checksum
+        if not expected:
+            return
 
-            self.log.debug("master repomd.xml doesn't match! %s != %s for %r",
-                           checksum, newsum, self.id)
-            time.sleep(200)
+        mirrors.get_poller().wait(expected)
+        self.log.info("master repomd.xml matches!")
+        notifications.publish(
+            topic="mashtask.sync.done",
+            msg=dict(repo=self.id, agent=self.agent),
+            force=True,
+        )
 
+    @stage
     def send_notifications(self):
         self.log.info('Sending notifications')
         try:
@@ -798,25 +975,39 @@ class MasherThread(threading.Thread):
             )
 
     @checkpoint
+    @stage
     def modify_bugs(self):
         self.log.info('Updating bugs')
         for update in self.updates:
+            if self.is_done('modify_bugs', update.title):
+                self.log.debug('Skipping the bugs of %s, which were modified already',
+                               update.title)
+                continue
             self.log.debug('Modifying bugs for %s', update.title)
             update.modify_bugs()
+            self.journal('done', 'modify_bugs', update.title)
 
+    @stage
     def status_comments(self):
         self.log.info('Commenting on updates')
         for update in self.updates:
             update.status_comment(self.db)
 
     @checkpoint
+    @stage
     def send_stable_announcements(self):
         self.log.info('Sending stable update announcements')
         for update in self.updates:
             if update.status is UpdateStatus.stable:
-                update.send_update_notice()
+                if self.is_done('send_stable_announcements', update.title):
+                    self.log.debug('Skipping the announcement of %s, which was sent already',
+                                   update.title)
+                    continue
+                update.send_update_notice(force=True)
+                self.journal('done', 'send_stable_announcements', update.title)
 
     @checkpoint
+    @stage
     def send_testing_digest(self):
         """Send digest mail to mailing lists"""
         self.log.info('Sending updates-testing digest')
@@ -825,6 +1016,9 @@ class MasherThread(threading.Thread):
         testhead = u'The following builds have been pushed to %s updates-testing\n\n'
 
         for prefix, content in self.testing_digest.iteritems():
+            if self.is_done('send_testing_digest', prefix):
+                self.log.debug('Skipping the %s digest, which was sent already', prefix)
+                continue
             release = self.db.query(Release).filter_by(long_name=prefix).one()
             test_list_key = '%s_test_announce_list' % (
                 release.id_prefix.lower().replace('-', '_'))
@@ -865,8 +1059,10 @@ class MasherThread(threading.Thread):
             for nvr in updlist:
                 maildata += u"\n" + self.testing_digest[prefix][nvr]
 
+            # The digest is journaled as sent, so it can't wait for the end of the transaction.
             mail.send_mail(config.get('bodhi_email'), test_list,
-                           '%s updates-testing report' % prefix, maildata)
+                           '%s updates-testing report' % prefix, maildata, force=True)
+            self.journal('done', 'send_testing_digest', prefix)
 
     def get_security_updates(self, release):
         release = self.db.query(Release).filter_by(long_name=release).one()
@@ -916,6 +1112,7 @@ class MasherThread(threading.Thread):
         return updates
 
     @checkpoint
+    @stage
     def compose_atomic_trees(self):
         """Compose Atomic OSTrees for each tag that we mashed."""
         composer = AtomicComposer()
@@ -997,6 +1194,106 @@ class MasherThread(threading.Thread):
         return master_repomd % (self.release.version, arch)
 
 
+class CompsPreparer(object):
+    """
+    Prepare the comps files for all of the MasherThreads of a push.
+
+    The comps git module is updated and built by the first thread that needs it, while the others
+    wait, and they all get the same snapshot of the built comps files. The snapshots are named after
+    the git HEAD they were built from, so make is skipped when HEAD hasn't changed since the last
+    push. The files of a snapshot are read-only, and are never changed once it is created.
+
+    Attributes:
+        snapshot_dir (basestring): The directory where the snapshots are kept.
+    """
+
+    def __init__(self, snapshot_dir):
+        """
+        Initialize the preparer.
+
+        Args:
+            snapshot_dir (basestring): The directory where the snapshots are kept.
+        """
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        self._path = None
+
+    def prepare(self, log):
+        """
+        Return the path to the comps files, preparing them if that wasn't done yet.
+
+        Args:
+            log (logging.Logger): The logger of the calling thread.
+        Returns:
+            basestring: The path to the snapshot of the comps files, or to the comps git module if
+                the snapshot could not be made.
+        """
+        with self._lock:
+            if self._path is None:
+                self._path = self._prepare(log)
+            return self._path
+
+    def _prepare(self, log):
+        """
+        Update the comps git module, and build and snapshot the comps files if they changed.
+
+        Args:
+            log (logging.Logger): The logger of the calling thread.
+        Returns:
+            basestring: The path to the snapshot of the comps files, or to the comps git module if
+                the snapshot could not be made.
+        """
+        comps_dir = config.get('comps_dir')
+        comps_url = config.get('comps_url')
+
+        if not os.path.exists(comps_dir):
+            util.cmd(['git', 'clone', comps_url, comps_dir], os.path.dirname(comps_dir))
+
+        util.cmd(['git', 'pull'], comps_dir)
+        out, err, returncode = util.cmd(['git', 'rev-parse', 'HEAD'], comps_dir)
+        head = out.strip()
+        if returncode != 0 or not head:
+            log.warn('Unable to find the git HEAD of %s, not snapshotting the comps', comps_dir)
+            util.cmd(['make'], comps_dir)
+            return comps_dir
+
+        snapshot = os.path.join(self.snapshot_dir, head)
+        if os.path.isdir(snapshot):
+            log.info('The comps of %s were built already, skipping make', head)
+        else:
+            out, err, returncode = util.cmd(['make'], comps_dir)
+            if returncode != 0:
+                log.error('Unable to build the comps of %s, not snapshotting them', head)
+                return comps_dir
+            self._snapshot(comps_dir, snapshot)
+
+        for name in os.listdir(self.snapshot_dir):
+            if name != head:
+                shutil.rmtree(os.path.join(self.snapshot_dir, name), ignore_errors=True)
+        return snapshot
+
+    def _snapshot(self, comps_dir, snapshot):
+        """
+        Copy the built comps files to a new, read-only snapshot.
+
+        The files are copied to a temporary directory which is then renamed, so an interrupted
+        snapshot is never used.
+
+        Args:
+            comps_dir (basestring): The comps git module.
+            snapshot (basestring): The path of the snapshot.
+        """
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        tmp = tempfile.mkdtemp(dir=self.snapshot_dir, prefix='.')
+        for path in glob.glob(os.path.join(comps_dir, 'comps-*.xml')):
+            target = os.path.join(tmp, os.path.basename(path))
+            shutil.copyfile(path, target)
+            os.chmod(target, 0o444)
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, snapshot)
+
+
 class MashThread(threading.Thread):
     """
     A Thread that performs the subprocess call to mash.
@@ -1026,6 +1323,8 @@ class MashThread(threading.Thread):
         self.tag = tag
         self.log = log
         self.success = False
+        self.lines = 0
+        self.last_progress = time.time()
         mash_cmd = 'mash -o {outputdir} -c {config} -f {compsfile} {tag}'
         mash_conf = config.get('mash_conf')
         if os.path.exists(previous):
@@ -1040,14 +1339,36 @@ class MashThread(threading.Thread):
         """Perform the mash in a subprocess."""
         start = time.time()
         self.log.info('Mashing %s', self.tag)
-        out, err, returncode = util.cmd(self.mash_cmd)
+        out, err, returncode = util.cmd(self.mash_cmd, progress=self.progress)
         self.log.info('Took %s seconds to mash %s', time.time() - start,
                       self.tag)
         if returncode != 0:
+            # util.cmd() logged the end of stderr already
             self.log.error('There was a problem running mash (%d)' % returncode)
             self.log.error(out)
-            self.log.error(err)
             raise Exception('mash failed')
         else:
             self.success = True
         return out, err, returncode
+
+    def progress(self, stream, line):
+        """
+        Count a line of mash's output, and publish the progress of the mash now and then.
+
+        A mashtask.progress message with the latest line is published at most once every
+        mash_progress_interval seconds, so the masher status page can follow the mash.
+
+        Args:
+            stream (str): The name of the stream the line was read from.
+            line (basestring): The line of output.
+        """
+        self.lines += 1
+        now = time.time()
+        if now - self.last_progress < config.get('mash_progress_interval'):
+            return
+        self.last_progress = now
+        notifications.publish(
+            topic="mashtask.progress",
+            msg=dict(repo=self.tag, lines=self.lines, line=line.rstrip('\n')),
+            force=True,
+        )
@@ -33,15 +33,22 @@ Now, update-submission breezes by those steps and simply tells the user "OK".
 A fedmsg message gets published when their update goes through, and *that*
 message gets received here and triggers us to do all that network-laden heavy
 lifting.
+
+The messages are handled by a pool of threads, so a burst of edits doesn't
+queue up behind the slowest update, and the Bugzilla and wiki requests for an
+update are made concurrently.
 """
 
+from multiprocessing.pool import ThreadPool
+import collections
 import logging
 import pprint
+import threading
 import time
 
 import fedmsg.consumers
 
-from bodhi.server import initialize_db, util, bugs as bug_module
+from bodhi.server import configure_cache_region, initialize_db, util, bugs as bug_module
 from bodhi.server.config import config
 from bodhi.server.exceptions import BodhiException
 from bodhi.server.models import Bug, Update, UpdateType
@@ -49,6 +56,10 @@ from bodhi.server.models import Bug, Update, UpdateType
 
 log = logging.getLogger('bodhi')
 
+# How many seconds to wait before looking for an update that isn't in the database yet the first
+# time. The wait doubles each time it isn't found.
+VISIBILITY_RETRY_DELAY = 0.1
+
 
 class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
     """
@@ -58,11 +69,19 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
     performs background tasks such as modifying Bugzilla issues (and loading information from
     Bugzilla so we can display it to the user) and looking up wiki test cases.
 
+    The messages are handed to a pool of worker threads. The messages about an update are handled
+    one at a time, in the order they were received, while the messages about different updates are
+    handled at once.
+
     Attributes:
         db_factory (bodhi.server.util.TransactionalSessionMaker): A context manager that yields a
             database session.
         handle_bugs (bool): If True, interact with Bugzilla. Else do not.
         topic (list): A list of strings that indicate which fedmsg topics this consumer listens to.
+        workers (int): How many messages to handle at once.
+        request_workers (int): How many Bugzilla and wiki requests to make at once.
+        visibility_timeout (float): How many seconds to wait for the update of a message to be
+            committed to the database.
     """
 
     config_key = 'updates_handler'
@@ -76,6 +95,7 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
                 It is used to look up the hub config.
         """
         initialize_db(config)
+        configure_cache_region(config)
         self.db_factory = util.transactional_session_maker()
 
         prefix = hub.config.get('topic_prefix')
@@ -91,32 +111,91 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
         else:
             bug_module.set_bugtracker()
 
+        self.workers = config.get('updates_handler.workers')
+        self.request_workers = config.get('updates_handler.request_workers')
+        self.visibility_timeout = config.get('updates_handler.visibility_timeout')
+        # The messages that are waiting for, or being handled by, a worker, by update alias
+        self._pending = {}
+        self._lock = threading.Lock()
+        # The pools are started with the first message, so they don't run in processes that don't
+        # consume any.
+        self._pool = None
+        self._request_pool = None
+
         super(UpdatesHandler, self).__init__(hub, *args, **kwargs)
         log.info('Bodhi updates handler listening on:\n'
                  '%s' % pprint.pformat(self.topic))
 
     def consume(self, message):
         """
-        Process the given message, updating relevant bugs and test cases.
+        Hand the given message to the worker pool, behind the earlier messages about its update.
 
         Args:
             message (munch.Munch): A fedmsg about a new or edited update.
         """
         msg = message['body']['msg']
-        topic = message['topic']
         alias = msg['update'].get('alias')
 
-        log.info("Updates Handler handling  %s, %s" % (alias, topic))
-
-        # Go to sleep for a second to try and avoid a race condition
-        # https://github.com/fedora-infra/bodhi/issues/458
-        time.sleep(1)
-
         if not alias:
             log.error("Update Handler got update with no "
                       "alias %s." % pprint.pformat(msg))
             return
 
+        with self._lock:
+            if alias in self._pending:
+                # A worker is handling the messages about this update, and will get to this one.
+                self._pending[alias].append(message)
+                return
+            self._pending[alias] = collections.deque([message])
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            self._pool.apply_async(self._work, (alias,))
+
+    def stop(self):
+        """Wait for the messages that were handed to the worker pool, and stop the consumer."""
+        for pool in (self._pool, self._request_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        super(UpdatesHandler, self).stop()
+
+    def _work(self, alias):
+        """
+        Handle the messages about the given update in order, until there are none left.
+
+        Args:
+            alias (basestring): The alias of the update.
+        """
+        while True:
+            with self._lock:
+                message = self._pending[alias][0]
+            try:
+                self.handle(message)
+            except Exception:
+                log.exception('Unable to handle %s about %s', message['topic'], alias)
+            with self._lock:
+                self._pending[alias].popleft()
+                if not self._pending[alias]:
+                    del self._pending[alias]
+                    return
+
+    def handle(self, message):
+        """
+        Process the given message, updating relevant bugs and test cases.
+
+        Args:
+            message (munch.Munch): A fedmsg about a new or edited update, which has an alias.
+        """
+        msg = message['body']['msg']
+        topic = message['topic']
+        alias = msg['update']['alias']
+
+        log.info("Updates Handler handling  %s, %s" % (alias, topic))
+
+        # The message may be received before the update is visible to this process
+        # https://github.com/fedora-infra/bodhi/issues/458
+        self.wait_until_visible(alias)
+
         with self.db_factory() as session:
             update = Update.get(alias, session)
             if not update:
@@ -132,22 +211,80 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
             else:
                 raise NotImplementedError("Should never get here.")
 
+            # The wiki is queried while the bugs are worked on.
+            test_cases = self.query_test_cases(update)
             self.work_on_bugs(session, update, bugs)
-            self.fetch_test_cases(session, update)
+            self.fetch_test_cases(session, update, test_cases)
 
         log.info("Updates Handler done with %s, %s" % (alias, topic))
 
-    def fetch_test_cases(self, session, update):
+    def wait_until_visible(self, alias):
         """
-        Query the wiki for test cases for each package on the given update.
+        Wait for the given update to be committed to the database.
+
+        The database is looked at again after VISIBILITY_RETRY_DELAY seconds, waiting twice as long
+        each time the update isn't found, until visibility_timeout seconds have passed.
+
+        Args:
+            alias (basestring): The alias of the update.
+        Raises:
+            BodhiException: If the update still isn't in the database after visibility_timeout
+                seconds.
+        """
+        deadline = time.time() + self.visibility_timeout
+        delay = VISIBILITY_RETRY_DELAY
+        while True:
+            with self.db_factory() as session:
+                if Update.get(alias, session) is not None:
+                    return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise BodhiException("Couldn't find alias %r in DB" % alias)
+            log.debug('%s is not in the database yet', alias)
+            time.sleep(min(delay, remaining))
+            delay *= 2
+
+    def _requests(self):
+        """
+        Return the pool that makes the Bugzilla and wiki requests, starting it if needed.
+
+        Returns:
+            multiprocessing.pool.ThreadPool: The pool.
+        """
+        with self._lock:
+            if self._request_pool is None:
+                self._request_pool = ThreadPool(self.request_workers)
+            return self._request_pool
+
+    def query_test_cases(self, update):
+        """
+        Start querying the wiki for the test cases of each package on the given update.
+
+        Args:
+            update (bodhi.server.models.Update): The update whose packages to query the test cases
+                of.
+        Returns:
+            multiprocessing.pool.AsyncResult: The result of the queries, which is a list of the
+                test case names of each build's package, in the order of the update's builds.
+        """
+        packages = [build.package for build in update.builds]
+        return self._requests().map_async(lambda package: package.query_test_cases(), packages)
+
+    def fetch_test_cases(self, session, update, test_cases=None):
+        """
+        Add the test cases in the wiki for each package on the given update.
 
         Args:
             session (sqlalchemy.orm.session.Session): A database session.
             update (bodhi.server.models.Update): The update's builds are iterated upon to find test
                 cases for their associated Packages..
+            test_cases (multiprocessing.pool.AsyncResult): The result of query_test_cases() for the
+                update, or None to query the wiki now.
         """
-        for build in update.builds:
-            build.package.fetch_test_cases(session)
+        if test_cases is None:
+            test_cases = self.query_test_cases(update)
+        for build, names in zip(update.builds, test_cases.get()):
+            build.package.add_test_cases(session, names)
 
     def work_on_bugs(self, session, update, bugs):
         """
@@ -157,6 +294,10 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
         details from Bugzilla, comment on the bug to let watchers know about the update, and mark
         the bug as MODIFIED. If the bug is a security issue, mark the update as a security update.
 
+        The bugs are retrieved at once, and then commented on and modified at once. Only the
+        requests are made from the request pool's threads, and the database is only used from the
+        calling thread.
+
         If handle_bugs is not True, return and do nothing.
 
         Args:
@@ -169,11 +310,13 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
             return
 
         log.info("Got %i bugs to sync for %r" % (len(bugs), update.alias))
-        for bug in bugs:
-            log.info("Getting RHBZ bug %r" % bug.bug_id)
-            try:
-                rhbz_bug = bug_module.bugtracker.getbug(bug.bug_id)
+        rhbz_bugs = self._requests().map(self._get_bug, [bug.bug_id for bug in bugs])
 
+        fetched = []
+        for bug, rhbz_bug in zip(bugs, rhbz_bugs):
+            if rhbz_bug is None:
+                continue
+            try:
                 log.info("Updating our details for %r" % bug.bug_id)
                 bug.update_details(rhbz_bug)
                 log.info("  Got title %r for %r" % (bug.title, bug.bug_id))
@@ -185,13 +328,44 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
                 if bug.security:
                     log.info("Setting our UpdateType to security.")
                     update.type = UpdateType.security
-
-                log.info("Commenting on %r" % bug.bug_id)
-                comment = config['initial_bug_msg'] % (
-                    update.title, update.release.long_name, update.abs_url())
-                bug.add_comment(update, comment)
-
-                log.info("Modifying %r" % bug.bug_id)
-                bug.modified(update)
             except Exception:
                 log.warning('Error occurred during updating single bug', exc_info=True)
+            else:
+                fetched.append(bug)
+
+        comment = config['initial_bug_msg'] % (
+            update.title, update.release.long_name, update.abs_url())
+        self._requests().map(lambda bug: self._modify_bug(update, bug, comment), fetched)
+
+    def _get_bug(self, bug_id):
+        """
+        Retrieve the given bug from Bugzilla.
+
+        Args:
+            bug_id (int): The id of the bug.
+        Returns:
+            bugzilla.bug.Bug: The bug, or None if it couldn't be retrieved.
+        """
+        log.info("Getting RHBZ bug %r" % bug_id)
+        try:
+            return bug_module.bugtracker.getbug(bug_id)
+        except Exception:
+            log.warning('Error occurred during updating single bug', exc_info=True)
+
+    def _modify_bug(self, update, bug, comment):
+        """
+        Comment on the given bug to let watchers know about the update, and mark it as MODIFIED.
+
+        Args:
+            update (bodhi.server.models.Update): The update that the bug is associated with.
+            bug (bodhi.server.models.Bug): The bug, whose details were updated from Bugzilla.
+            comment (basestring): The comment to add to the bug.
+        """
+        try:
+            log.info("Commenting on %r" % bug.bug_id)
+            bug.add_comment(update, comment)
+
+            log.info("Modifying %r" % bug.bug_id)
+            bug.modified(update)
+        except Exception:
+            log.warning('Error occurred during updating single bug', exc_info=True)
@@ -13,14 +13,22 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 from textwrap import wrap
+import json
 import smtplib
+import threading
 
 from kitchen.iterutils import iterate
 from kitchen.text.converters import to_unicode, to_bytes
+from sqlalchemy import event, func
 
-from bodhi.server import log
+from bodhi.server import log, Session
 from bodhi.server.config import config
-from bodhi.server.util import get_rpm_header
+from bodhi.server.util import Drainer, get_rpm_header
+
+
+# The outbox of this process, created by get_outbox()
+_outbox = None
+_outbox_lock = threading.Lock()
 
 
 #
@@ -425,50 +433,255 @@ def get_template(update, use_template='fedora_errata_template'):
     return templates
 
 
-def _send_mail(from_addr, to_addr, body):
-    """A lower level function to send emails with smtplib"""
-    smtp_server = config.get('smtp_server')
-    if not smtp_server:
-        log.info('Not sending email: No smtp_server defined')
-        return
-    smtp = None
+def _format_mail(from_addr, to_addr, subject, body_text, headers):
+    """
+    Return the given e-mail, as it is sent to the given recipient.
+
+    Args:
+        from_addr (basestring): The address the message is from.
+        to_addr (basestring): The recipient.
+        subject (basestring): The subject of the message.
+        body_text (basestring): The body of the message.
+        headers (dict): The extra headers of the message.
+    Returns:
+        str: The message.
+    """
+    msg = ['From: %s' % to_bytes(from_addr), 'To: %s' % to_bytes(to_addr)]
+    for key, value in headers.items():
+        msg.append('%s: %s' % (key, to_bytes(value)))
+    msg.append('X-Bodhi: %s' % to_bytes(config.get('default_email_domain')))
+    msg += ['Subject: %s' % to_bytes(subject), '', to_bytes(body_text)]
+    return to_bytes('\r\n'.join(msg))
+
+
+def _send_mail(smtp, from_addr, recipients, subject, body_text, headers):
+    """
+    Send the given e-mail to each of the given recipients over the given SMTP connection.
+
+    Each recipient that the message is sent to is removed from the recipients list, so that the
+    message isn't sent to them again if it has to be retried. Recipients that the server refuses
+    are only logged, and removed as well.
+
+    Args:
+        smtp (smtplib.SMTP): The connection to the SMTP server.
+        from_addr (basestring): The address the message is from.
+        recipients (list): The recipients that the message still has to be sent to.
+        subject (basestring): The subject of the message.
+        body_text (basestring): The body of the message.
+        headers (dict): The extra headers of the message.
+    """
+    while recipients:
+        to_addr = recipients[0]
+        body = _format_mail(from_addr, to_addr, subject, body_text, headers)
+        try:
+            smtp.sendmail(to_bytes(from_addr), [to_bytes(to_addr)], body)
+        except smtplib.SMTPRecipientsRefused as e:
+            log.warn('"recipient refused" for %r, %r' % (to_addr, e))
+        recipients.pop(0)
+
+
+def _quit(smtp):
+    """Close the given SMTP connection, ignoring errors."""
     try:
-        log.debug('Connecting to %s', smtp_server)
-        smtp = smtplib.SMTP(smtp_server)
-        smtp.sendmail(from_addr, [to_addr], body)
-    except smtplib.SMTPRecipientsRefused as e:
-        log.warn('"recipient refused" for %r, %r' % (to_addr, e))
-    except:
-        log.exception('Unable to send mail')
-    finally:
-        if smtp:
-            smtp.quit()
-
-
-def send_mail(from_addr, to_addr, subject, body_text, headers=None):
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+
+def send_mail(from_addr, to_addr, subject, body_text, headers=None, force=False):
+    """
+    Send an e-mail to one or more recipients.
+
+    By default, the message is written to the mail outbox in the current transaction, and the
+    :class:`Outbox` sends it once the transaction is committed. It is not sent at all if the
+    transaction is rolled back.
+
+    Specifying force=True by-passes that, and the message is sent immediately.
+
+    Args:
+        from_addr (basestring): The address the message is from, or None for the bodhi_email
+            setting.
+        to_addr (basestring or list): The recipient, or a list of recipients.
+        subject (basestring): The subject of the message.
+        body_text (basestring): The body of the message.
+        headers (dict): Extra headers for the message.
+        force (bool): Whether to send the message immediately.
+    """
     if not from_addr:
         from_addr = config.get('bodhi_email')
     if not from_addr:
         log.warn('Unable to send mail: bodhi_email not defined in the config')
         return
-    if to_addr in config.get('exclude_mail'):
+    recipients = [to_unicode(person) for person in iterate(to_addr)
+                  if person not in config.get('exclude_mail')]
+    if not recipients:
+        return
+    if not config.get('smtp_server'):
+        log.info('Not sending email: No smtp_server defined')
+        return
+
+    from_addr = to_unicode(from_addr)
+    subject = to_unicode(subject)
+    body_text = to_unicode(body_text)
+    headers = dict([(key, to_unicode(value)) for key, value in (headers or {}).items()])
+
+    log.info('Sending mail to %s: %s', u', '.join(recipients), subject)
+    if force:
+        smtp = None
+        try:
+            smtp = smtplib.SMTP(config.get('smtp_server'))
+            _send_mail(smtp, from_addr, recipients, subject, body_text, headers)
+        except Exception:
+            log.exception('Unable to send mail')
+        finally:
+            if smtp:
+                _quit(smtp)
         return
 
-    from_addr = to_bytes(from_addr)
-    to_addr = to_bytes(to_addr)
-    subject = to_bytes(subject)
-    body_text = to_bytes(body_text)
+    # Imported here to avoid a circular import with the models, which send mail.
+    from bodhi.server.models import OutboxMail
+    session = Session()
+    session.add(OutboxMail(from_addr=from_addr, recipients=json.dumps(recipients),
+                           subject=subject, body=body_text, headers=json.dumps(headers)))
+    # This tells wake_outbox_after_commit() to wake the Outbox up.
+    session.info['mail'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_outbox_after_commit(session):
+    """
+    An SQLAlchemy event listener to send the mail in the outbox after a database commit.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was committed.
+    """
+    if session.info.pop('mail', False):
+        get_outbox().wake()
 
-    msg = ['From: %s' % from_addr, 'To: %s' % to_addr]
-    if headers:
-        for key, value in headers.items():
-            msg.append('%s: %s' % (key, to_bytes(value)))
-    msg.append('X-Bodhi: %s' % to_bytes(config.get('default_email_domain')))
-    msg += ['Subject: %s' % subject, '', body_text]
-    body = to_bytes('\r\n'.join(msg))
 
-    log.info('Sending mail to %s: %s', to_addr, subject)
-    _send_mail(from_addr, to_addr, body)
+def get_outbox():
+    """
+    Return the Outbox of this process, creating it if needed.
+
+    Returns:
+        Outbox: The outbox, configured with the mail_outbox.* settings.
+    """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(
+                max_attempts=config.get('mail_outbox.max_attempts'),
+                retry_delay=config.get('mail_outbox.retry_delay'),
+                batch_size=config.get('mail_outbox.batch_size'))
+        return _outbox
+
+
+class Outbox(Drainer):
+    """
+    Send the mail in the mail outbox from a background thread.
+
+    The messages are sent over one SMTP connection per batch, as a :class:`Drainer` delivers
+    them.
+    """
+
+    thread_name = 'MailOutbox'
+    failure_message = 'Unable to send the mail in the outbox'
+
+    def _claim(self, now):
+        """
+        Claim the messages that are due, so that no other process sends them.
+
+        Args:
+            now (datetime.datetime): The current time.
+        Returns:
+            list: The claimed messages, as dictionaries.
+        """
+        # Imported here to avoid a circular import with the models, which send mail.
+        from bodhi.server.models import OutboxMail
+        messages = []
+        with self.db_factory() as db:
+            due = db.query(OutboxMail).filter(OutboxMail.next_attempt <= now)\
+                .order_by(OutboxMail.next_attempt, OutboxMail.id).limit(self.batch_size).all()
+            for mail in due:
+                # Only the process that moves next_attempt ahead gets the message.
+                claimed = db.query(OutboxMail)\
+                    .filter_by(id=mail.id, next_attempt=mail.next_attempt)\
+                    .update({'next_attempt': self._claimed_until(now)}, synchronize_session=False)
+                if claimed:
+                    messages.append({
+                        'id': mail.id, 'from_addr': mail.from_addr,
+                        'recipients': json.loads(mail.recipients), 'subject': mail.subject,
+                        'body': mail.body, 'headers': json.loads(mail.headers),
+                        'attempts': mail.attempts, 'sent': False})
+        return messages
+
+    def _deliver(self, messages):
+        """
+        Send the given messages over one SMTP connection, marking the ones that were sent.
+
+        Args:
+            messages (list): The messages that _claim() returned.
+        Returns:
+            int: How many of the messages were sent.
+        """
+        smtp = None
+        try:
+            for message in messages:
+                try:
+                    if smtp is None:
+                        smtp = smtplib.SMTP(config.get('smtp_server'))
+                    _send_mail(smtp, message['from_addr'], message['recipients'],
+                               message['subject'], message['body'], message['headers'])
+                    message['sent'] = True
+                except Exception:
+                    log.exception('Unable to send mail')
+                    # The connection is unusable after most errors, so start a new one.
+                    if smtp is not None:
+                        smtp.close()
+                        smtp = None
+        finally:
+            if smtp is not None:
+                _quit(smtp)
+        return len([m for m in messages if m['sent']])
+
+    def _finish(self, messages, delivered):
+        """
+        Remove the messages that were sent from the outbox, and schedule the others to be retried.
+
+        Args:
+            messages (list): The messages that _deliver() was given.
+            delivered (int): How many of them were sent.
+        """
+        from bodhi.server.models import OutboxMail
+        with self.db_factory() as db:
+            for message in messages:
+                mail = db.query(OutboxMail).get(message['id'])
+                if mail is None:
+                    continue
+                if message['sent']:
+                    db.delete(mail)
+                    continue
+                mail.attempts = message['attempts'] + 1
+                mail.recipients = json.dumps(message['recipients'])
+                next_attempt = self._retry_at(mail.attempts)
+                if next_attempt is None:
+                    log.error('Giving up on sending %r to %s after %d attempts', mail.subject,
+                              u', '.join(message['recipients']), mail.attempts)
+                    db.delete(mail)
+                    continue
+                mail.next_attempt = next_attempt
+
+    def _next_attempt(self, db):
+        """
+        Return when the next message of the outbox is due.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): The database session.
+        Returns:
+            datetime.datetime or None: The time, or None if the outbox is empty.
+        """
+        from bodhi.server.models import OutboxMail
+        return db.query(func.min(OutboxMail.next_attempt)).scalar()
 
 
 def send(to, msg_type, update, sender=None, agent=None):
@@ -501,11 +714,11 @@ def send(to, msg_type, update, sender=None, agent=None):
             headers["In-Reply-To"] = initial_message_id
 
     subject_template = u'[Fedora Update] %s[%s] %s'
-    for person in iterate(to):
-        subject = subject_template % (critpath, msg_type, update.beautify_title())
-        fields = MESSAGES[msg_type]['fields'](agent, update)
-        body = MESSAGES[msg_type]['body'] % fields
-        send_mail(sender, person, subject, body, headers=headers)
+    subject = subject_template % (critpath, msg_type, update.beautify_title())
+    fields = MESSAGES[msg_type]['fields'](agent, update)
+    body = MESSAGES[msg_type]['body'] % fields
+    # The message is the same for everyone, so it is queued once for all of the recipients.
+    send_mail(sender, list(iterate(to)), subject, body, headers=headers)
 
 
 def send_releng(subject, body):
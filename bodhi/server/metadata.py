@@ -11,22 +11,33 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from multiprocessing.pool import ThreadPool
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import tempfile
+import time
 
 from kitchen.text.converters import to_bytes
+from sqlalchemy.orm import joinedload, lazyload, subqueryload
 import createrepo_c as cr
 
-from bodhi.server.buildsys import get_session
+from bodhi.server.buildsys import get_session, release_session
 from bodhi.server.config import config
-from bodhi.server.models import RpmBuild, UpdateStatus, UpdateRequest, UpdateSuggestion
+from bodhi.server.models import (RpmBuild, Update, UpdateStatus, UpdateRequest,
+                                 UpdateSuggestion)
 
 
 __version__ = '2.0'
 log = logging.getLogger(__name__)
 
+#: The most builds or updates to look up with each database query. SQLite allows up to 999
+#: parameters per query.
+DB_CHUNK_SIZE = 500
+
 
 class ExtendedMetadata(object):
     """This class represents the updateinfo.xml yum metadata.
@@ -49,6 +60,8 @@ class ExtendedMetadata(object):
         self.db = db
         self.updates = set()
         self.builds = {}
+        # The RPMs of each build, by NVR, as fetched by _fetch_rpms()
+        self.rpms = {}
         self.missing_ids = []
         self._from = config.get('bodhi_email')
         self._fetch_updates()
@@ -63,20 +76,18 @@ class ExtendedMetadata(object):
             # compression, so use the lowest common denominator for now.
             self.comp_type = cr.BZ2
 
-        # Load from the cache if it exists
-        self.cached_repodata = os.path.join(self.repo, '..', self.tag +
-                                            '.repocache', 'repodata/')
-        if os.path.isfile(os.path.join(self.cached_repodata, 'repomd.xml')):
-            log.info('Loading cached updateinfo.xml')
+        # Load the notices of the previous push, importing them from the repodata it cached if
+        # they were cached by an older version of bodhi
+        cache = os.path.join(self.repo, '..', self.tag + '.repocache')
+        self.cached_repodata = os.path.join(cache, 'repodata/')
+        self.notices = NoticeStore(os.path.join(cache, 'notices'))
+        # The aliases of the notices of this updateinfo.xml, in order
+        self.aliases = []
+        if not self.notices.index and os.path.isfile(
+                os.path.join(self.cached_repodata, 'repomd.xml')):
+            log.info('Importing cached updateinfo.xml')
             self._load_cached_updateinfo()
-        else:
-            log.info("Generating new updateinfo.xml")
-            self.uinfo = cr.UpdateInfo()
-            for update in self.updates:
-                if update.alias:
-                    self.add_update(update)
-                else:
-                    self.missing_ids.append(update.title)
+        self._add_notices()
 
         if self.missing_ids:
             log.error("%d updates with missing ID: %r" % (
@@ -84,12 +95,12 @@ class ExtendedMetadata(object):
 
     def _load_cached_updateinfo(self):
         """
-        Load the cached updateinfo.xml from '../{tag}.repocache/repodata'
-        """
-        seen_ids = set()
-        from_cache = set()
-        existing_ids = set()
+        Import the notices of the cached updateinfo.xml from '../{tag}.repocache/repodata'.
 
+        Older versions of bodhi cached the whole repodata instead of the notices. The imported
+        notices are only used to keep old security notices, as they don't have the hashes of the
+        updates they were generated from.
+        """
         # Parse the updateinfo out of the repomd
         updateinfo = None
         repomd_xml = os.path.join(self.cached_repodata, 'repomd.xml')
@@ -107,84 +118,178 @@ class ExtendedMetadata(object):
         # Load the metadata with createrepo_c
         log.info('Loading cached updateinfo: %s', updateinfo)
         uinfo = cr.UpdateInfo(updateinfo)
+        for notice in uinfo.updates:
+            self.notices.put(notice.id, None, notice.type, _record_xml(notice))
+
+    def _add_notices(self):
+        """
+        Add the notices of our updates, and of the old security notices in the stable repo.
 
-        # Determine which updates are present in the cache
-        for update in uinfo.updates:
-            existing_ids.add(update.id)
+        The stored notices of the updates that haven't changed since the last push are reused as
+        they are, and new notices are only generated for the others.
+        """
+        seen_ids = set()
+        # The updates that need new notices, which are generated once all of their RPMs are fetched
+        to_add = []
 
-        # Generate metadata for any new builds
         for update in self.updates:
             seen_ids.add(update.alias)
             if not update.alias:
                 self.missing_ids.append(update.title)
-                continue
-            if update.alias in existing_ids:
-                notice = None
-                for value in uinfo.updates:
-                    if value.title == update.title:
-                        notice = value
-                        break
-                if not notice:
-                    log.warn('%s ID in cache but notice cannot be found', update.title)
-                    self.add_update(update)
-                    continue
-                if notice.updated_date:
-                    if notice.updated_date < update.date_modified:
-                        log.debug('Update modified, generating new notice: %s' % update.title)
-                        self.add_update(update)
-                    else:
-                        log.debug('Loading updated %s from cache' % update.title)
-                        from_cache.add(update.alias)
-                elif update.date_modified:
-                    log.debug('Update modified, generating new notice: %s' % update.title)
-                    self.add_update(update)
-                else:
-                    log.debug('Loading %s from cache' % update.title)
-                    from_cache.add(update.alias)
+            elif self.notices.has(update.alias, self._notice_hash(update)):
+                log.debug('Loading %s from cache' % update.title)
+                self.aliases.append(update.alias)
             else:
-                log.debug('Adding new update notice: %s' % update.title)
-                self.add_update(update)
+                log.debug('Generating new notice: %s' % update.title)
+                to_add.append(update)
+
+        self._fetch_rpms(to_add)
+        for update in to_add:
+            self.add_update(update)
+
+        # Keep all security notices in the stable repo
+        if self.request is not UpdateRequest.testing:
+            for alias in sorted(self.notices.index):
+                if alias not in seen_ids and self.notices.index[alias]['type'] == 'security':
+                    log.debug('Keeping existing security notice: %s', alias)
+                    self.aliases.append(alias)
+
+    @staticmethod
+    def _notice_hash(update):
+        """
+        Return a hash of the fields of the given update that its notice must be regenerated for.
 
-        # Add all relevant notices from the cache to this document
-        for notice in uinfo.updates:
-            if notice.id in from_cache:
-                log.debug('Keeping existing notice: %s', notice.title)
-                self.uinfo.append(notice)
-            else:
-                # Keep all security notices in the stable repo
-                if self.request is not UpdateRequest.testing:
-                    if notice.type == 'security':
-                        if notice.id not in seen_ids:
-                            log.debug('Keeping existing security notice: %s',
-                                      notice.title)
-                            self.uinfo.append(notice)
-                        else:
-                            log.debug('%s already added?', notice.title)
-                    else:
-                        log.debug('Purging cached stable notice %s', notice.title)
-                else:
-                    log.debug('Purging cached testing update %s', notice.title)
+        Args:
+            update (bodhi.server.models.Update): The update.
+        Returns:
+            str: The SHA-256 of the fields.
+        """
+        date_modified = update.date_modified
+        fields = [update.alias, update.status.value, update.type.value,
+                  date_modified and date_modified.strftime('%Y-%m-%d %H:%M:%S'),
+                  sorted(build.nvr for build in update.builds),
+                  sorted(bug.bug_id for bug in update.bugs),
+                  sorted(cve.cve_id for cve in update.cves)]
+        return hashlib.sha256(json.dumps(fields)).hexdigest()
 
     def _fetch_updates(self):
-        """Based on our given koji tag, populate a list of Update objects"""
+        """
+        Based on our given koji tag, populate a list of Update objects.
+
+        The builds are looked up with IN queries of up to DB_CHUNK_SIZE builds each, which only
+        select their NVRs and update IDs, and their updates are then loaded with just the
+        relationships that updateinfo.xml needs.
+        """
         log.debug("Fetching builds tagged with '%s'" % self.tag)
         kojiBuilds = get_session().listTagged(self.tag, latest=True)
-        nonexistent = []
         log.debug("%d builds found" % len(kojiBuilds))
         for build in kojiBuilds:
             self.builds[build['nvr']] = build
-            build_obj = self.db.query(RpmBuild).filter_by(nvr=unicode(build['nvr'])).first()
-            if build_obj:
-                if build_obj.update:
-                    self.updates.add(build_obj.update)
+
+        nvrs = [unicode(build['nvr']) for build in kojiBuilds]
+        found = set()
+        update_ids = set()
+        for chunk in _chunks(nvrs, DB_CHUNK_SIZE):
+            query = self.db.query(RpmBuild.nvr, RpmBuild.update_id).filter(RpmBuild.nvr.in_(chunk))
+            for nvr, update_id in query:
+                found.add(nvr)
+                if update_id is not None:
+                    update_ids.add(update_id)
                 else:
-                    log.warn('%s does not have a corresponding update' % build['nvr'])
-            else:
-                nonexistent.append(build['nvr'])
+                    log.warn('%s does not have a corresponding update' % nvr)
+
+        for chunk in _chunks(sorted(update_ids), DB_CHUNK_SIZE):
+            query = self.db.query(Update).filter(Update.id.in_(chunk)).options(
+                lazyload('*'), joinedload(Update.release),
+                subqueryload(Update.builds).lazyload('*'), subqueryload(Update.bugs),
+                subqueryload(Update.cves))
+            self.updates.update(query)
+
+        nonexistent = [nvr for nvr in nvrs if nvr not in found]
         if nonexistent:
             log.warning("Couldn't find the following koji builds tagged as "
                         "%s in bodhi: %s" % (self.tag, nonexistent))
 
+    def _fetch_rpms(self, updates):
+        """
+        Fetch the RPMs of the builds of the given updates from Koji, and store them in self.rpms.
+
+        Rather than asking Koji about each build in turn, the builds are fetched with multicalls of
+        up to ``updateinfo_koji_chunk_size`` builds each, and up to ``updateinfo_koji_threads`` of
+        these multicalls are made at once. Anything that the multicalls fail to fetch is left for
+        add_update() to fetch (and raise errors about) individually.
+
+        Args:
+            updates (list): The bodhi.server.models.Update objects whose RPMs will be needed.
+        """
+        nvrs = [build.nvr for update in updates for build in update.builds
+                if build.nvr not in self.rpms]
+        if not nvrs:
+            return
+
+        chunks = _chunks(nvrs, config.get('updateinfo_koji_chunk_size'))
+        threads = min(config.get('updateinfo_koji_threads'), len(chunks))
+        log.debug('Fetching the RPMs of %d builds with %d multicalls' % (len(nvrs), len(chunks)))
+
+        if threads > 1:
+            def fetch(chunk):
+                """Fetch the chunk with this thread's own Koji session, and hand it back."""
+                try:
+                    return self._fetch_rpms_chunk(chunk)
+                finally:
+                    release_session()
+
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(fetch, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._fetch_rpms_chunk(chunk) for chunk in chunks]
+
+        for rpms in results:
+            self.rpms.update(rpms)
+
+    def _fetch_rpms_chunk(self, nvrs):
+        """
+        Fetch the RPMs of the given builds from Koji with (at most) two multicalls.
+
+        The first multicall looks up the builds that are not in self.builds, and the second one
+        lists the RPMs of all of the builds.
+
+        Args:
+            nvrs (list): The NVRs of the builds.
+        Returns:
+            dict: The lists of RPMs that were fetched, by NVR.
+        """
+        koji = get_session()
+        builds = dict([(nvr, self.builds[nvr]) for nvr in nvrs if nvr in self.builds])
+        rpms = {}
+        try:
+            missing = [nvr for nvr in nvrs if nvr not in builds]
+            if missing:
+                koji.multicall = True
+                for nvr in missing:
+                    koji.getBuild(nvr)
+                # A successful multicall result is a single-element list, while a failed one is a
+                # fault dict.
+                for nvr, result in zip(missing, koji.multiCall()):
+                    if isinstance(result, list) and result[0]:
+                        builds[nvr] = result[0]
+
+            nvrs = [nvr for nvr in nvrs if nvr in builds]
+            koji.multicall = True
+            for nvr in nvrs:
+                koji.listBuildRPMs(builds[nvr]['id'])
+            for nvr, result in zip(nvrs, koji.multiCall()):
+                if isinstance(result, list):
+                    rpms[nvr] = result[0]
+        except Exception:
+            log.exception('Unable to fetch the RPMs of %r from Koji', nvrs)
+            koji.multicall = False
+        return rpms
+
     def add_update(self, update):
         """Generate the extended metadata for a given update"""
         rec = cr.UpdateRecord()
@@ -211,12 +316,14 @@ class ExtendedMetadata(object):
 
         koji = get_session()
         for build in update.builds:
-            try:
-                kojiBuild = self.builds[build.nvr]
-            except:
-                kojiBuild = koji.getBuild(build.nvr)
-
-            rpms = koji.listBuildRPMs(kojiBuild['id'])
+            rpms = self.rpms.get(build.nvr)
+            if rpms is None:
+                try:
+                    kojiBuild = self.builds[build.nvr]
+                except:
+                    kojiBuild = koji.getBuild(build.nvr)
+
+                rpms = koji.listBuildRPMs(kojiBuild['id'])
             for rpm in rpms:
                 pkg = cr.UpdateCollectionPackage()
                 pkg.name = rpm['name']
@@ -269,40 +376,224 @@ class ExtendedMetadata(object):
             rec.append_reference(ref)
 
         self.uinfo.append(rec)
+        self.notices.put(update.alias, self._notice_hash(update), rec.type, _record_xml(rec))
+        self.aliases.append(update.alias)
+
+    def xml_dump(self):
+        """
+        Return the XML of the updateinfo.xml, assembled from the stored notices.
+
+        Returns:
+            unicode: The XML document.
+        """
+        notices = u''.join(u'  %s\n' % self.notices.get(alias) for alias in self.aliases)
+        return u'<?xml version="1.0" encoding="UTF-8"?>\n<updates>\n%s</updates>\n' % notices
 
     def insert_updateinfo(self):
         fd, name = tempfile.mkstemp()
-        os.write(fd, self.uinfo.xml_dump().encode('utf-8'))
+        os.write(fd, self.xml_dump().encode('utf-8'))
         os.close(fd)
         self.modifyrepo(name)
         os.unlink(name)
 
     def modifyrepo(self, filename):
-        """Inject a file into the repodata for each architecture"""
-        for arch in os.listdir(self.repo_path):
-            repodata = os.path.join(self.repo_path, arch, 'repodata')
-            log.info('Inserting %s into %s', filename, repodata)
-            uinfo_xml = os.path.join(repodata, 'updateinfo.xml')
+        """
+        Inject a file into the repodata for each architecture.
+
+        The file is compressed and checksummed once, and the result is hard linked (or copied, if
+        it can't be linked) into the repodata of each architecture. The repomd.xml of the
+        architectures are then updated in parallel.
+
+        Args:
+            filename (basestring): The path of the updateinfo.xml to inject.
+        """
+        arches = os.listdir(self.repo_path)
+        workdir = tempfile.mkdtemp(dir=self.repo)
+        try:
+            start = time.time()
+            uinfo_xml = os.path.join(workdir, 'updateinfo.xml')
             shutil.copyfile(filename, uinfo_xml)
-            repomd_xml = os.path.join(repodata, 'repomd.xml')
-            repomd = cr.Repomd(repomd_xml)
             uinfo_rec = cr.RepomdRecord('updateinfo', uinfo_xml)
             uinfo_rec_comp = uinfo_rec.compress_and_fill(self.hash_type, self.comp_type)
             uinfo_rec_comp.rename_file()
             uinfo_rec_comp.type = 'updateinfo'
-            repomd.set_record(uinfo_rec_comp)
-            with file(repomd_xml, 'w') as repomd_file:
-                repomd_file.write(repomd.xml_dump())
-            os.unlink(uinfo_xml)
+            log.info('Compressed %s in %0.2fs', filename, time.time() - start)
+
+            def insert(arch):
+                """Link the compressed file into the arch's repodata, and add it to repomd.xml."""
+                start = time.time()
+                repodata = os.path.join(self.repo_path, arch, 'repodata')
+                log.info('Inserting %s into %s', filename, repodata)
+                target = os.path.join(repodata, os.path.basename(uinfo_rec_comp.location_real))
+                try:
+                    os.link(uinfo_rec_comp.location_real, target)
+                except OSError:
+                    shutil.copyfile(uinfo_rec_comp.location_real, target)
+                repomd_xml = os.path.join(repodata, 'repomd.xml')
+                repomd = cr.Repomd(repomd_xml)
+                repomd.set_record(uinfo_rec_comp.copy())
+                with file(repomd_xml, 'w') as repomd_file:
+                    repomd_file.write(repomd.xml_dump())
+                log.info('Inserted %s into %s in %0.2fs', filename, repodata, time.time() - start)
+
+            pool = ThreadPool(max(len(arches), 1))
+            try:
+                pool.map(insert, arches)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(workdir)
 
     def cache_repodata(self):
-        arch = os.listdir(self.repo_path)[0]  # Take the first arch
-        repodata = os.path.join(self.repo_path, arch, 'repodata')
-        if not os.path.isdir(repodata):
-            log.warning('Cannot find repodata to cache: %s' % repodata)
-            return
-        cache = self.cached_repodata
-        if os.path.isdir(cache):
-            shutil.rmtree(cache)
-        shutil.copytree(repodata, cache)
-        log.info('%s cached to %s' % (repodata, cache))
+        """Save the notices of this updateinfo.xml, so the next push can reuse them."""
+        self.notices.save(self.aliases)
+        if os.path.isdir(self.cached_repodata):
+            # The notices were imported from this copy of the repodata, which is no longer used.
+            shutil.rmtree(self.cached_repodata)
+        log.info('%d notices cached to %s' % (len(self.aliases), self.notices.path))
+
+
+class NoticeStore(object):
+    """
+    A persistent store of the updateinfo notices of a repository, keyed by update alias.
+
+    Each notice is stored as the XML of its <update> element, in a file named after the SHA-256 of
+    that XML. An index maps the aliases to these files and to the hashes of the updates the notices
+    were generated from, so the notices of the updates that haven't changed can be reused without
+    parsing any XML.
+
+    Attributes:
+        path (basestring): The directory of the store.
+        index (dict): The stored notices, by alias. Each is a dict with the ``hash`` of the update
+            it was generated from, its ``type``, and the name of the ``file`` that holds its XML.
+    """
+
+    def __init__(self, path):
+        """
+        Load the index of the store.
+
+        Args:
+            path (basestring): The directory of the store. It is created when notices are stored.
+        """
+        self.path = path
+        self.index = {}
+        # The XML of the notices that were stored since the store was loaded, by file name
+        self._unsaved = {}
+        index = os.path.join(path, 'index.json')
+        if os.path.isfile(index):
+            try:
+                with open(index) as index_file:
+                    self.index = json.load(index_file)
+            except ValueError:
+                log.exception('Ignoring the corrupt notice index %s', index)
+
+    def has(self, alias, hash):
+        """
+        Return whether the notice of the given alias was generated from the given hash.
+
+        Args:
+            alias (basestring): The alias of the update.
+            hash (basestring): The hash of the update, or None.
+        Returns:
+            bool: True if the stored notice can be reused, False otherwise.
+        """
+        notice = self.index.get(alias)
+        return (notice is not None and hash is not None and notice['hash'] == hash and
+                (notice['file'] in self._unsaved or
+                 os.path.isfile(os.path.join(self.path, notice['file']))))
+
+    def get(self, alias):
+        """
+        Return the XML of the notice of the given alias.
+
+        Args:
+            alias (basestring): The alias of the update.
+        Returns:
+            unicode: The XML of the notice's <update> element.
+        """
+        name = self.index[alias]['file']
+        if name in self._unsaved:
+            return self._unsaved[name].decode('utf-8')
+        with open(os.path.join(self.path, name)) as notice_file:
+            return notice_file.read().decode('utf-8')
+
+    def put(self, alias, hash, notice_type, xml):
+        """
+        Store the notice of the given alias.
+
+        The notice is kept in memory until the store is saved.
+
+        Args:
+            alias (basestring): The alias of the update.
+            hash (basestring): The hash of the update the notice was generated from, or None.
+            notice_type (basestring): The type of the notice.
+            xml (unicode): The XML of the notice's <update> element.
+        """
+        data = xml.encode('utf-8')
+        name = '%s.xml' % hashlib.sha256(data).hexdigest()
+        self._unsaved[name] = data
+        self.index[alias] = {'hash': hash, 'type': notice_type, 'file': name}
+
+    def save(self, aliases):
+        """
+        Write the notices of the given aliases and their index, and forget all the other notices.
+
+        Args:
+            aliases (list): The aliases of the notices to keep.
+        """
+        self.index = dict([(alias, self.index[alias]) for alias in aliases])
+        files = set([notice['file'] for notice in self.index.values()])
+        for name, data in self._unsaved.items():
+            if name in files and not os.path.isfile(os.path.join(self.path, name)):
+                self._write(os.path.join(self.path, name), data)
+        self._unsaved = {}
+        self._write(os.path.join(self.path, 'index.json'), json.dumps(self.index))
+        for name in os.listdir(self.path):
+            if name.endswith('.xml') and name not in files:
+                os.unlink(os.path.join(self.path, name))
+
+    def _write(self, filename, data):
+        """
+        Atomically write the given data to the given file of the store.
+
+        Args:
+            filename (basestring): The path of the file.
+            data (str): The data to write.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, name = tempfile.mkstemp(dir=self.path, prefix='.')
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(data)
+        os.rename(name, filename)
+
+
+def _chunks(items, size):
+    """
+    Split the given list into lists of the given size, except for the last one.
+
+    Args:
+        items (list): The list to split.
+        size (int): The size of the chunks.
+    Returns:
+        list: The chunks.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _record_xml(record):
+    """
+    Return the XML of the <update> element of the given updateinfo record.
+
+    Args:
+        record (createrepo_c.UpdateRecord): The record.
+    Returns:
+        unicode: The XML of the record.
+    """
+    uinfo = cr.UpdateInfo()
+    uinfo.append(record)
+    xml = uinfo.xml_dump()
+    if isinstance(xml, str):
+        xml = xml.decode('utf-8')
+    return xml[re.search(u'<update[\\s/>]', xml).start():xml.rindex(u'</updates>')].rstrip()
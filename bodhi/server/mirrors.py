@@ -0,0 +1,245 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Wait for mashed repositories to be synchronized to the master mirrors.
+
+A single :class:`MirrorPoller` is shared by all the masher threads. It polls every URL that any
+of them is waiting for from one background thread, checking the URLs that are due concurrently.
+Conditional requests (``If-None-Match`` and ``If-Modified-Since``) keep unchanged files from being
+downloaded again, and a URL whose file hasn't changed is polled less and less often.
+"""
+from multiprocessing.pool import ThreadPool
+import hashlib
+import logging
+import threading
+import time
+import urllib2
+
+from bodhi.server.config import config
+
+
+log = logging.getLogger(__name__)
+
+# The poller shared by the masher threads, created by get_poller()
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    """
+    Return the MirrorPoller shared by all the masher threads, creating it if needed.
+
+    Returns:
+        MirrorPoller: The poller, configured with the mirror_sync.* settings.
+    """
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = MirrorPoller(
+                min_interval=config.get('mirror_sync.min_interval'),
+                max_interval=config.get('mirror_sync.max_interval'),
+                timeout=config.get('mirror_sync.timeout'),
+                workers=config.get('mirror_sync.workers'))
+        return _poller
+
+
+class _Watch(object):
+    """
+    The polling state of a URL.
+
+    Attributes:
+        url (basestring): The URL being polled.
+        checksum (basestring): The SHA-1 of the file the URL served last, or None.
+        etag (basestring): The ETag of the file the URL served last, or None.
+        last_modified (basestring): The Last-Modified date of the file the URL served last, or
+            None.
+        interval (float): How many seconds to wait between the polls of the URL.
+        next_check (float): When the URL should be polled next, as a UNIX timestamp.
+    """
+
+    def __init__(self, url, interval):
+        """
+        Initialize the watch, so that the URL is polled right away.
+
+        Args:
+            url (basestring): The URL to poll.
+            interval (float): How many seconds to wait between the first polls of the URL.
+        """
+        self.url = url
+        self.checksum = None
+        self.etag = None
+        self.last_modified = None
+        self.interval = interval
+        self.next_check = 0
+
+
+class _Waiter(object):
+    """
+    A caller of MirrorPoller.wait().
+
+    Attributes:
+        expected (dict): The SHA-1 checksums the caller is waiting for, by URL.
+        event (threading.Event): Set when all of the URLs serve the expected files.
+    """
+
+    def __init__(self, expected):
+        """
+        Initialize the waiter.
+
+        Args:
+            expected (dict): The SHA-1 checksums the caller is waiting for, by URL.
+        """
+        self.expected = expected
+        self.event = threading.Event()
+
+
+class MirrorPoller(object):
+    """
+    Poll files on the master mirrors until they match the files that were mashed.
+
+    Attributes:
+        min_interval (float): How many seconds to wait between the polls of a URL whose file just
+            changed.
+        max_interval (float): The most seconds to wait between the polls of a URL. The interval is
+            doubled, up to this, each time a URL is polled and its file hasn't changed.
+        timeout (float): How many seconds to wait for a response from the mirror.
+        workers (int): How many URLs to poll at once.
+    """
+
+    def __init__(self, min_interval=30, max_interval=300, timeout=60, workers=8):
+        """
+        Initialize the poller. Its thread is started by wait().
+
+        Args:
+            min_interval (float): The shortest interval between the polls of a URL.
+            max_interval (float): The longest interval between the polls of a URL.
+            timeout (float): How many seconds to wait for a response from the mirror.
+            workers (int): How many URLs to poll at once.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.workers = workers
+        self._condition = threading.Condition()
+        self._watches = {}
+        self._waiters = []
+        self._thread = None
+
+    def wait(self, expected):
+        """
+        Block until each of the given URLs serves a file with the given SHA-1 checksum.
+
+        Args:
+            expected (dict): The SHA-1 hex digests of the files, by URL.
+        """
+        waiter = _Waiter(expected)
+        with self._condition:
+            # If other threads are already waiting for all of these URLs, their files may be the
+            # ones this thread is waiting for, and there's no reason to wait for the next poll.
+            known = all([url in self._watches for url in expected])
+            for url in expected:
+                if url not in self._watches:
+                    self._watches[url] = _Watch(url, self.min_interval)
+            if not (known and self._resolve(waiter)):
+                self._waiters.append(waiter)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='MirrorPoller')
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._condition.notify()
+
+        # Event.wait() without a timeout can't be interrupted on Python 2
+        while not waiter.event.is_set():
+            waiter.event.wait(60)
+
+    def _run(self):
+        """Poll the URLs as they are due, until no thread is waiting for any of them."""
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                with self._condition:
+                    if not self._waiters:
+                        self._watches = {}
+                        self._thread = None
+                        return
+                    now = time.time()
+                    due = [w for w in self._watches.values() if w.next_check <= now]
+                    if not due:
+                        next_check = min(w.next_check for w in self._watches.values())
+                        self._condition.wait(next_check - now)
+                        continue
+
+                pool.map(self._check, due)
+
+                with self._condition:
+                    self._waiters = [w for w in self._waiters if not self._resolve(w)]
+                    urls = set([url for w in self._waiters for url in w.expected])
+                    for url in self._watches.keys():
+                        if url not in urls:
+                            del self._watches[url]
+        finally:
+            pool.close()
+            pool.join()
+
+    def _resolve(self, waiter):
+        """
+        Wake the given waiter up if all of its URLs serve the files it is waiting for.
+
+        Args:
+            waiter (_Waiter): The waiter.
+        Returns:
+            bool: True if the waiter was woken up, False otherwise.
+        """
+        for url, checksum in waiter.expected.items():
+            if self._watches[url].checksum != checksum:
+                return False
+        waiter.event.set()
+        return True
+
+    def _check(self, watch):
+        """
+        Poll the URL of the given watch, and schedule its next poll.
+
+        Args:
+            watch (_Watch): The watch of the URL to poll.
+        """
+        request = urllib2.Request(watch.url)
+        if watch.etag:
+            request.add_header('If-None-Match', watch.etag)
+        if watch.last_modified:
+            request.add_header('If-Modified-Since', watch.last_modified)
+
+        changed = False
+        try:
+            log.info('Polling %s' % watch.url)
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            checksum = hashlib.sha1(response.read()).hexdigest()
+            headers = response.info()
+            watch.etag = headers.getheader('ETag')
+            watch.last_modified = headers.getheader('Last-Modified')
+            changed = checksum != watch.checksum
+            watch.checksum = checksum
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                log.debug('%s has not been modified' % watch.url)
+            else:
+                log.exception('Error fetching %s' % watch.url)
+        except Exception:
+            log.exception('Error fetching %s' % watch.url)
+
+        if changed:
+            watch.interval = self.min_interval
+        else:
+            watch.interval = min(watch.interval * 2, self.max_interval)
+        watch.next_check = time.time() + watch.interval
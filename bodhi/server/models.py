@@ -32,16 +32,20 @@ import uuid
 from pkgdb2client import PkgDB
 from simplemediawiki import MediaWiki
 from six.moves.urllib.parse import quote
-from sqlalchemy import (and_, Boolean, Column, DateTime, ForeignKey, Integer, or_, Table, Unicode,
-                        UnicodeText, UniqueConstraint)
+from sqlalchemy import (and_, Boolean, Column, DateTime, event, extract, ForeignKey, func, Integer,
+                        or_, Table, Unicode, UnicodeText, UniqueConstraint)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import class_mapper, relationship, backref, validates
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import (class_mapper, joinedload, lazyload, object_session, relationship,
+                            backref, subqueryload, validates)
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.session import Session as BaseSession
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.sql import text
 from sqlalchemy.types import SchemaType, TypeDecorator, Enum
 
-from bodhi.server import bugs, buildsys, log, mail, notifications, Session
+from bodhi.server import (bugs, buildsys, invalidate_cache, log, mail, notifications, search,
+                          Session)
 from bodhi.server.config import config
 from bodhi.server.exceptions import BodhiException, LockedUpdateException
 from bodhi.server.util import (
@@ -158,6 +162,170 @@ class DeclEnumType(SchemaType, TypeDecorator):
             t.impl.drop(bind=bind, checkfirst=checkfirst)
 
 
+#: The format that datetimes are serialized to JSON with.
+JSON_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+#: The version of the compact update schema of :meth:`Update.compact_json`, which is bumped when
+#: its fields change.
+UPDATE_MESSAGE_SCHEMA_VERSION = 1
+
+
+def _json_value(value):
+    """
+    Convert datetimes and EnumSymbols to the strings that represent them in JSON.
+
+    Args:
+        value (object): The value to convert.
+    Returns:
+        object: The converted value, or the value itself if it needs no conversion.
+    """
+    if isinstance(value, datetime):
+        return value.strftime(JSON_DATETIME_FORMAT)
+    if isinstance(value, EnumSymbol):
+        return unicode(value)
+    return value
+
+
+def _requested_fieldset(request):
+    """
+    Return the fields that the given request asked to include in or exclude from the JSON.
+
+    Args:
+        request (pyramid.request.Request or None): The current request.
+    Returns:
+        tuple: A 2-tuple of the ``fields`` and ``exclude`` query parameters, or of Nones if they
+            were not given.
+    """
+    validated = getattr(request, 'validated', None)
+    if not isinstance(validated, dict):
+        return None, None
+    return validated.get('fields'), validated.get('exclude')
+
+
+class JSONPlan(object):
+    """
+    The fields that :meth:`BodhiBase._to_json` serializes for a model class.
+
+    Finding the fields of a model requires walking its mapper, so plans are compiled once per model
+    class, set of already serialized classes (which decides the relationships that are followed)
+    and sparse fieldset, and then kept in the :attr:`registry`.
+
+    Attributes:
+        columns (list): A list of (key, convert) tuples for the column attributes to serialize,
+            where convert is None for the columns that need no conversion.
+        extras (tuple): The names of the extra attributes or methods to serialize.
+        relationships (list): The keys of the relationships to expand.
+        anonymity_map (dict): The fields to scrub when serializing anonymously.
+        registry (dict): The compiled plans, keyed by model class, the tuple of seen classes and
+            the sparse fieldset.
+        names (dict): The field names of each model class, as returned by :meth:`field_names`.
+    """
+    registry = {}
+    names = {}
+
+    def __init__(self, model, seen, fields=None, exclude=None):
+        """
+        Compile the plan for the given model class.
+
+        Args:
+            model (type): The model class to compile a plan for.
+            seen (tuple): The model classes whose relationships are not expanded.
+            fields (frozenset or None): If given, only these fields are serialized.
+            exclude (frozenset or None): If given, these fields are not serialized.
+        """
+        excluded_columns = getattr(model, '__exclude_columns__', [])
+        self.columns = []
+        self.relationships = []
+        for prop in class_mapper(model).iterate_properties:
+            if prop.key in excluded_columns or not self.wants(prop.key, fields, exclude):
+                continue
+            if type(prop) is RelationshipProperty:
+                if prop.mapper.class_ not in seen:
+                    self.relationships.append(prop.key)
+            elif not prop.key.startswith('_'):
+                self.columns.append((prop.key, self._converter(prop)))
+        self.extras = tuple(name for name in getattr(model, '__include_extras__', [])
+                            if self.wants(name, fields, exclude))
+        self.anonymity_map = dict(
+            (key1, key2) for key1, key2 in getattr(model, '__anonymity_map__', {}).items()
+            if self.wants(key1, fields, exclude))
+
+    @classmethod
+    def field_names(cls, model):
+        """
+        Return the names of all the fields that the plans for the given model class can serialize.
+
+        Args:
+            model (type): The model class to return the field names of.
+        Returns:
+            frozenset: The names of the columns, relationships and extras of the model.
+        """
+        try:
+            return cls.names[model]
+        except KeyError:
+            names = cls.names[model] = frozenset(
+                [prop.key for prop in class_mapper(model).iterate_properties] +
+                list(getattr(model, '__include_extras__', [])))
+            return names
+
+    @staticmethod
+    def wants(key, fields, exclude):
+        """
+        Return whether the given field belongs in the JSON for the given sparse fieldset.
+
+        Args:
+            key (basestring): The name of the field.
+            fields (iterable or None): If given, only these fields are serialized.
+            exclude (iterable or None): If given, these fields are not serialized.
+        Returns:
+            bool: True if the field should be serialized, False otherwise.
+        """
+        return (fields is None or key in fields) and (not exclude or key not in exclude)
+
+    @staticmethod
+    def _converter(prop):
+        """
+        Return the function that converts the values of the given attribute for JSON.
+
+        Args:
+            prop (sqlalchemy.orm.interfaces.MapperProperty): The attribute's mapper property.
+        Returns:
+            callable or None: The conversion function, or None if the values are used as they are.
+        """
+        columns = getattr(prop, 'columns', None)
+        if not columns:
+            return _json_value
+        if isinstance(columns[0].type, (DateTime, DeclEnumType)):
+            return _json_value
+        return None
+
+    @classmethod
+    def get(cls, model, seen, fields=None, exclude=None):
+        """
+        Return the plan for the given model class, compiling it if needed.
+
+        Args:
+            model (type): The model class to return the plan for.
+            seen (tuple): The model classes whose relationships are not expanded.
+            fields (frozenset or None): If given, only these fields are serialized.
+            exclude (frozenset or None): If given, these fields are not serialized.
+        Returns:
+            JSONPlan: The plan.
+        """
+        if fields is not None or exclude:
+            # Clients choose the sparse fieldset, so drop the names that aren't fields of the model
+            # to keep the number of plans bounded.
+            names = cls.field_names(model)
+            fields = fields & names if fields is not None else None
+            exclude = exclude & names or None if exclude else None
+        key = (model, seen, fields, exclude)
+        try:
+            return cls.registry[key]
+        except KeyError:
+            plan = cls.registry[key] = cls(model, seen, fields, exclude)
+            return plan
+
+
 class BodhiBase(object):
     """
     Base class for the SQLAlchemy model base class.
@@ -165,6 +333,8 @@ class BodhiBase(object):
     Attributes:
         __exclude_columns__ (tuple): A list of columns to exclude from JSON
         __include_extras__ (tuple): A list of methods or attrs to include in JSON
+        __json_dependencies__ (dict): Maps the JSON fields that are not columns or relationships
+            to the relationships they are computed from.
         __get_by__ (tuple): A list of columns that :meth:`.get` will query.
         id (int): An integer id that serves as the default primary key.
         query (sqlalchemy.orm.query.Query): a class property which produces a
@@ -172,6 +342,7 @@ class BodhiBase(object):
     """
     __exclude_columns__ = ('id',)
     __include_extras__ = tuple()
+    __json_dependencies__ = {}
     __get_by__ = ()
 
     id = Column(Integer, primary_key=True)
@@ -190,43 +361,47 @@ class BodhiBase(object):
     def __repr__(self):
         return '<{0} {1}>'.format(self.__class__.__name__, self.__json__())
 
-    def __json__(self, request=None, anonymize=False):
-        return self._to_json(self, request=request, anonymize=anonymize)
+    def __json__(self, request=None, anonymize=False, fields=None, exclude=None):
+        """
+        Return a JSON serializable dictionary representing this object.
+
+        Args:
+            request (pyramid.request.Request or None): The current request. Unless fields or exclude
+                are given, the sparse fieldset it requested with its ``fields`` and ``exclude``
+                parameters is used.
+            anonymize (bool): Whether to scrub the fields in the ``__anonymity_map__``.
+            fields (iterable or None): If given, only these fields are included.
+            exclude (iterable or None): If given, these fields are left out.
+        Returns:
+            dict: The JSON representation of this object.
+        """
+        if fields is None and exclude is None:
+            fields, exclude = _requested_fieldset(request)
+        return self._to_json(self, request=request, anonymize=anonymize, fields=fields,
+                             exclude=exclude)
 
     @classmethod
-    def _to_json(cls, obj, seen=None, request=None, anonymize=False):
-        if not seen:
-            seen = []
+    def _to_json(cls, obj, seen=None, request=None, anonymize=False, fields=None, exclude=None):
         if not obj:
             return
+        seen = tuple(seen) if seen else ()
+        fields = frozenset(fields) if fields is not None else None
+        exclude = frozenset(exclude) if exclude else None
 
-        exclude = getattr(obj, '__exclude_columns__', [])
-        properties = list(class_mapper(type(obj)).iterate_properties)
-        rels = [p.key for p in properties if type(p) is RelationshipProperty]
-        attrs = [p.key for p in properties if p.key not in rels]
-        d = dict([(attr, getattr(obj, attr)) for attr in attrs
-                  if attr not in exclude and not attr.startswith('_')])
+        plan = JSONPlan.get(type(obj), seen, fields, exclude)
+        d = {}
+        for key, convert in plan.columns:
+            value = getattr(obj, key)
+            d[key] = convert(value) if convert else value
 
-        extras = getattr(obj, '__include_extras__', [])
-        for name in extras:
+        for name in plan.extras:
             attribute = getattr(obj, name)
             if callable(attribute):
                 attribute = attribute(request)
-            d[name] = attribute
-
-        for attr in rels:
-            if attr in exclude:
-                continue
-            target = getattr(type(obj), attr).property.mapper.class_
-            if target in seen:
-                continue
-            d[attr] = cls._expand(obj, getattr(obj, attr), seen, request)
+            d[name] = _json_value(attribute)
 
-        for key, value in d.iteritems():
-            if isinstance(value, datetime):
-                d[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-            if isinstance(value, EnumSymbol):
-                d[key] = unicode(value)
+        for key in plan.relationships:
+            d[key] = cls._expand(obj, getattr(obj, key), seen, request)
 
         # If explicitly asked to, we will overwrite some fields if the
         # corresponding condition of each evaluates to True.
@@ -234,7 +409,7 @@ class BodhiBase(object):
         # authenticated FAS usernames in the 'author' field, but we want to
         # scrub out anonymous users' email addresses.
         if anonymize:
-            for key1, key2 in getattr(obj, '__anonymity_map__', {}).items():
+            for key1, key2 in plan.anonymity_map.items():
                 if getattr(obj, key2):
                     d[key1] = 'anonymous'
 
@@ -248,10 +423,47 @@ class BodhiBase(object):
         if hasattr(relation, '__iter__'):
             return [cls._expand(obj, item, seen, req) for item in relation]
         if type(relation) not in seen:
-            return cls._to_json(relation, seen + [type(obj)], req)
+            return cls._to_json(relation, seen + (type(obj),), req)
         else:
             return relation.id
 
+    @classmethod
+    def json_load_options(cls, fields=None, exclude=None):
+        """
+        Return the query options that load the relationships needed to serialize the given fields.
+
+        The relationships that are serialized, or that other serialized fields are computed from,
+        are eagerly loaded: collections with a second query that joins them to the page of results,
+        and other relationships with a join. The rest are only loaded if something accesses them.
+
+        Args:
+            fields (iterable or None): If given, only these fields will be serialized.
+            exclude (iterable or None): If given, these fields will not be serialized.
+        Returns:
+            list: A list of loader options, which is empty if neither fields nor exclude are given.
+        """
+        if fields is None and not exclude:
+            return []
+
+        needed = set()
+        for key, relationships in cls.__json_dependencies__.items():
+            if JSONPlan.wants(key, fields, exclude):
+                needed.update(relationships)
+
+        options = []
+        for prop in class_mapper(cls).iterate_properties:
+            if type(prop) is not RelationshipProperty or prop.lazy == 'dynamic':
+                continue
+            attribute = getattr(cls, prop.key)
+            if prop.key not in needed and (prop.key in cls.__exclude_columns__ or
+                                           not JSONPlan.wants(prop.key, fields, exclude)):
+                options.append(lazyload(attribute))
+            elif prop.uselist:
+                options.append(subqueryload(attribute))
+            else:
+                options.append(joinedload(attribute))
+        return options
+
     @classmethod
     def grid_columns(cls):
         columns = []
@@ -331,6 +543,8 @@ class BodhiBase(object):
 
 Base = declarative_base(cls=BodhiBase)
 metadata = Base.metadata
+# The search indexes aren't tables that SQLAlchemy knows about, so create them with the tables.
+event.listen(metadata, 'after_create', search.create_indexes)
 
 
 ##
@@ -664,8 +878,20 @@ class Package(Base):
 
     def fetch_test_cases(self, db):
         """ Get a list of test cases from the wiki """
+        self.add_test_cases(db, self.query_test_cases())
+
+    def query_test_cases(self):
+        """
+        Query the wiki for the names of this package's test cases.
+
+        This only makes requests to the wiki, so it can be called from another thread than the one
+        that uses the package's session.
+
+        Returns:
+            list: The names of the test cases, or None if querying the wiki is turned off.
+        """
         if not config.get('query_wiki_test_cases'):
-            return
+            return None
 
         start = datetime.utcnow()
         log.debug('Querying the wiki for test cases')
@@ -697,15 +923,26 @@ class Package(Base):
             log.debug('Found the following unit tests: %s', members)
             return members
 
-        for test in set(list_categorymembers(wiki, cat_page)):
+        test_cases = list(set(list_categorymembers(wiki, cat_page)))
+        log.debug('Finished querying for test cases in %s', datetime.utcnow() - start)
+        return test_cases
+
+    def add_test_cases(self, db, test_cases):
+        """
+        Add the given test cases to this package, unless they are in the database already.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): A database session.
+            test_cases (list): The names of the test cases, as returned by
+                :meth:`query_test_cases`, or None.
+        """
+        for test in test_cases or []:
             case = db.query(TestCase).filter_by(name=test).first()
             if not case:
                 case = TestCase(name=test, package=self)
                 db.add(case)
                 db.flush()
 
-        log.debug('Finished querying for test cases in %s', datetime.utcnow() - start)
-
     @validates('builds')
     def validate_builds(self, key, build):
         """
@@ -1047,6 +1284,14 @@ class Update(Base):
         date_stable (DateTime): The date the update was placed into the stable repository or
             ``None``.
         date_locked (DateTime): The date the update was locked or ``None``.
+        positive_karma (int): The sum of the positive karma given since the last karma reset,
+            counting only the most recent karma of each user.
+        negative_karma (int): The sum of the negative karma given since the last karma reset,
+            counting only the most recent karma of each user.
+        num_admin_approvals (int): The number of comments with a karma of 1 that were left by
+            members of the ``admin_groups``.
+        date_karma_reset (DateTime): The date of the most recent karma reset, which happens
+            whenever a build is added to or removed from the update, or ``None``.
         alias (unicode): The update alias (e.g. FEDORA-EPEL-2009-12345).
         old_updateid (unicode): The legacy update ID which has been deprecated.
         release_id (int): A foreign key to the releases ``id``.
@@ -1067,8 +1312,12 @@ class Update(Base):
             (e.g. 2 of 32 required tests failed).
     """
     __tablename__ = 'updates'
-    __exclude_columns__ = ('id', 'user_id', 'release_id', 'cves')
+    __exclude_columns__ = ('id', 'user_id', 'release_id', 'cves', 'positive_karma',
+                           'negative_karma', 'num_admin_approvals', 'date_karma_reset')
     __include_extras__ = ('meets_testing_requirements', 'url',)
+    __json_dependencies__ = {
+        'meets_testing_requirements': ('release',), 'submitter': ('user',),
+        'content_type': ('builds',), 'test_cases': ('builds',)}
     __get_by__ = ('title', 'alias')
 
     title = Column(UnicodeText, unique=True, default=None, index=True)
@@ -1108,6 +1357,12 @@ class Update(Base):
     date_stable = Column(DateTime)
     date_locked = Column(DateTime)
 
+    # Karma counters, maintained by _count_karma() as comments are added
+    positive_karma = Column(Integer, default=0, nullable=False)
+    negative_karma = Column(Integer, default=0, nullable=False)
+    num_admin_approvals = Column(Integer, default=0, nullable=False)
+    date_karma_reset = Column(DateTime)
+
     # eg: FEDORA-EPEL-2009-12345
     alias = Column(Unicode(32), unique=True, nullable=True)
 
@@ -1166,10 +1421,10 @@ class Update(Base):
         days = self.release.mandatory_days_in_testing
         return days if days else 0
 
-    @property
+    @hybrid_property
     def karma(self):
         """
-        Calculate and return the karma for the Update.
+        Return the karma for the Update.
 
         :return: The Update's current karma.
         :rtype:  int
@@ -1177,29 +1432,26 @@ class Update(Base):
         positive_karma, negative_karma = self._composite_karma
         return positive_karma + negative_karma
 
+    @karma.expression
+    def karma(cls):
+        """
+        Return an SQL expression for the karma of updates, so queries can filter and sort by it.
+
+        :return: The sum of the positive and negative karma columns.
+        :rtype:  sqlalchemy.sql.expression.ColumnElement
+        """
+        return cls.positive_karma + cls.negative_karma
+
     @property
     def _composite_karma(self):
         """
-        Calculate and return a 2-tuple of the sum of the positive karma comments, and the sum of the
-        negative karma comments. The total karma is simply the sum of the two elements of this
-        2-tuple.
+        Return a 2-tuple of the sum of the positive karma comments, and the sum of the negative
+        karma comments. The total karma is simply the sum of the two elements of this 2-tuple.
 
         :return: a 2-tuple of (positive_karma, negative_karma)
         :rtype:  tuple
         """
-        positive_karma = 0
-        negative_karma = 0
-        users_counted = set()
-        for comment in self.comments_since_karma_reset:
-            if comment.karma and not comment.anonymous and comment.user.name not in users_counted:
-                # Make sure we only count the last comment this user made
-                users_counted.add(comment.user.name)
-                if comment.karma > 0:
-                    positive_karma += comment.karma
-                else:
-                    negative_karma += comment.karma
-
-        return positive_karma, negative_karma
+        return self.positive_karma, self.negative_karma
 
     @property
     def comments_since_karma_reset(self):
@@ -1211,18 +1463,60 @@ class Update(Base):
         """
         # We want to traverse the comments in reverse order so we only consider
         # the most recent comments from any given user and only the comments
-        # since the most recent karma reset event.
+        # since the most recent karma reset event, which is the one that was
+        # posted at date_karma_reset.
         for comment in reversed(self.comments):
-            if (comment.user.name == u'bodhi' and
-                    ('New build' in comment.text or 'Removed build' in comment.text)):
-                # We only want to consider comments since the most recent karma
-                # reset, which happens whenever a build is added or removed
-                # from an Update. Since we are traversing the comments in
-                # reverse order, once we find one of these comments we can
-                # simply exit this loop.
+            if self.date_karma_reset is not None and comment.timestamp is not None and \
+                    comment.timestamp <= self.date_karma_reset:
                 break
             yield comment
 
+    def _count_karma(self, comment):
+        """
+        Update the karma counters of this update for a comment that is being added to it.
+
+        This is called for every comment appended to :attr:`comments`, which must be the most
+        recent comment of the update and must already have its user set. Comments whose user is
+        not known yet when they are appended are counted when they are flushed.
+
+        Args:
+            comment (Comment): The comment being added.
+        """
+        if comment.user.name == u'bodhi' and \
+                ('New build' in comment.text or 'Removed build' in comment.text):
+            # Adding or removing builds resets the karma.
+            if comment.timestamp is None:
+                comment.timestamp = datetime.utcnow()
+            self.date_karma_reset = comment.timestamp
+            self.positive_karma = 0
+            self.negative_karma = 0
+            return
+
+        if comment.karma == 1:
+            admin_groups = config.get('admin_groups')
+            if any(group.name in admin_groups for group in comment.user.groups):
+                self.num_admin_approvals += 1
+
+        if not comment.karma or comment.anonymous:
+            return
+
+        positive_karma, negative_karma = self._composite_karma
+        # Only the most recent karma of each user counts, so take back the previous one.
+        for previous in self.comments_since_karma_reset:
+            if previous is not comment and previous.karma and not previous.anonymous and \
+                    previous.user.name == comment.user.name:
+                if previous.karma > 0:
+                    positive_karma -= previous.karma
+                else:
+                    negative_karma -= previous.karma
+                break
+        if comment.karma > 0:
+            positive_karma += comment.karma
+        else:
+            negative_karma += comment.karma
+        self.positive_karma = positive_karma
+        self.negative_karma = negative_karma
+
     @staticmethod
     def contains_critpath_component(builds, release_name):
         """
@@ -1268,6 +1562,56 @@ class Update(Base):
         """
         return json.dumps(self.greenwave_subject)
 
+    @classmethod
+    def counts(cls, db, releases):
+        """
+        Count the updates of the given releases by status and type, using a single query.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): A database session.
+            releases (list): The names of the releases to count the updates of.
+        Returns:
+            dict: A dictionary mapping each release name to a dictionary that maps
+                (UpdateStatus, UpdateType) tuples to the number of updates with that status and
+                type. Combinations without any updates are not included.
+        """
+        counts = dict((release, {}) for release in releases)
+        if not releases:
+            return counts
+
+        query = db.query(Release.name, cls.status, cls.type, func.count(cls.id))\
+            .join(cls.release)\
+            .filter(Release.name.in_(releases))\
+            .group_by(Release.name, cls.status, cls.type)
+        for release, status, type_, count in query:
+            counts[release][(status, type_)] = count
+        return counts
+
+    @classmethod
+    def monthly_counts(cls, db, release):
+        """
+        Count the updates submitted to the given release per month and type, using a single query.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): A database session.
+            release (basestring): The name of the release to count the updates of.
+        Returns:
+            dict: A dictionary mapping update type descriptions to dictionaries that map months,
+                formatted as "YYYY/MM", to the number of updates of that type submitted that month.
+        """
+        year = extract('year', cls.date_submitted)
+        month = extract('month', cls.date_submitted)
+        query = db.query(cls.type, year, month, func.count(cls.id))\
+            .join(cls.release)\
+            .filter(Release.name == release)\
+            .filter(cls.date_submitted.isnot(None))\
+            .group_by(cls.type, year, month)
+
+        counts = defaultdict(dict)
+        for type_, year, month, count in query:
+            counts[type_.description]['%d/%02d' % (year, month)] = count
+        return dict(counts)
+
     @classmethod
     def new(cls, request, data):
         """ Create a new update """
@@ -1883,7 +2227,14 @@ class Update(Base):
         elif self.status is UpdateStatus.obsolete:
             self.comment(db, u'This update has been obsoleted.', author=u'bodhi')
 
-    def send_update_notice(self):
+    def send_update_notice(self, force=False):
+        """
+        Send the announcement of this update to the announcement list of its release.
+
+        Args:
+            force (bool): Whether to send the e-mail immediately, rather than once the current
+                transaction is committed.
+        """
         log.debug("Sending update notice for %s" % self.title)
         mailinglist = None
         sender = config.get('bodhi_email')
@@ -1907,7 +2258,7 @@ class Update(Base):
 
         if mailinglist:
             for subject, body in mail.get_template(self, templatetype):
-                mail.send_mail(sender, mailinglist, subject, body)
+                mail.send_mail(sender, mailinglist, subject, body, force=force)
                 notifications.publish(
                     topic='errata.publish',
                     msg=dict(subject=subject, body=body, update=self))
@@ -1931,6 +2282,30 @@ class Update(Base):
 
     url = abs_url
 
+    def compact_json(self):
+        """
+        Return the compact representation of this update, which fedmsgs describe it with.
+
+        Unlike :meth:`__json__`, this leaves out the comments, bugs and test cases, which make the
+        messages of busy updates grow to hundreds of kilobytes.
+
+        Returns:
+            dict: The update's alias, title, status, request, builds, submitter, karma and
+                release, and the ``schema_version`` of this representation.
+        """
+        return {
+            'schema_version': UPDATE_MESSAGE_SCHEMA_VERSION,
+            'alias': self.alias,
+            'title': self.title,
+            'status': _json_value(self.status),
+            'request': _json_value(self.request),
+            'builds': [{'nvr': build.nvr} for build in self.builds],
+            'user': {'name': self.user.name} if self.user else None,
+            'karma': self.karma,
+            'release': {'name': self.release.name, 'long_name': self.release.long_name,
+                        'version': self.release.version} if self.release else None,
+        }
+
     def __str__(self):
         """
         Return a string representation of this update.
@@ -2074,7 +2449,7 @@ class Update(Base):
 
         comment = Comment(
             text=text, anonymous=anonymous,
-            karma=karma, karma_critpath=karma_critpath)
+            karma=karma, karma_critpath=karma_critpath, timestamp=datetime.utcnow())
         session.add(comment)
 
         if anonymous:
@@ -2085,7 +2460,7 @@ class Update(Base):
             user = User(name=author)
             session.add(user)
 
-        user.comments.append(comment)
+        comment.user = user
         self.comments.append(comment)
         session.flush()
 
@@ -2521,20 +2896,6 @@ class Update(Base):
         else:
             return 0
 
-    @property
-    def num_admin_approvals(self):
-        """ Return the number of Releng/QA approvals of this update """
-        approvals = 0
-        for comment in self.comments:
-            if comment.karma != 1:
-                continue
-            admin_groups = config.get('admin_groups')
-            for group in comment.user.groups:
-                if group.name in admin_groups:
-                    approvals += 1
-                    break
-        return approvals
-
     @property
     def test_cases(self):
         tests = set()
@@ -2573,36 +2934,176 @@ class Update(Base):
                 'Unable to determine requested tag for %s.' % self.title)
         return tag
 
-    def __json__(self, request=None, anonymize=False):
+    def __json__(self, request=None, anonymize=False, fields=None, exclude=None):
+        """
+        Return a JSON serializable dictionary representing this update.
+
+        Args:
+            request (pyramid.request.Request or None): The current request.
+            anonymize (bool): Whether to scrub the fields in the ``__anonymity_map__``.
+            fields (iterable or None): If given, only these fields are included.
+            exclude (iterable or None): If given, these fields are left out.
+        Returns:
+            dict: The JSON representation of this update.
+        """
+        if fields is None and exclude is None:
+            fields, exclude = _requested_fieldset(request)
         result = super(Update, self).__json__(
-            request=request, anonymize=anonymize)
+            request=request, anonymize=anonymize, fields=fields, exclude=exclude)
+        wants = lambda key: JSONPlan.wants(key, fields, exclude)  # noqa: E731
         # Duplicate alias as updateid for backwards compat with bodhi1
-        result['updateid'] = result['alias']
+        if wants('updateid'):
+            result['updateid'] = self.alias
         # Also, put the update submitter's name in the same place we put
         # it for bodhi1 to make fedmsg.meta compat much more simple.
-        result['submitter'] = result['user']['name']
+        if wants('submitter'):
+            result['submitter'] = self.user.name
         # Include the karma total in the results
-        result['karma'] = self.karma
+        if wants('karma'):
+            result['karma'] = self.karma
         # Also, the Update content_type (derived from the builds content_types)
-        result['content_type'] = self.content_type.value if self.content_type else None
+        if wants('content_type'):
+            result['content_type'] = self.content_type.value if self.content_type else None
 
         # For https://github.com/fedora-infra/bodhi/issues/270, throw the JSON
         # of the test cases in our output as well but take extra care to
         # short-circuit some of the insane recursion for
         # https://github.com/fedora-infra/bodhi/issues/343
-        seen = [Package, TestCaseKarma]
-        result['test_cases'] = [
-            test._to_json(
-                obj=test,
-                seen=seen,
-                request=request,
-                anonymize=anonymize)
-            for test in self.full_test_cases
-        ]
+        if wants('test_cases'):
+            seen = [Package, TestCaseKarma]
+            result['test_cases'] = [
+                test._to_json(
+                    obj=test,
+                    seen=seen,
+                    request=request,
+                    anonymize=anonymize)
+                for test in self.full_test_cases
+            ]
 
         return result
 
 
+@event.listens_for(Update, 'init')
+def init_karma_counters(target, args, kwargs):
+    """
+    Start the karma counters of a new update at zero, so comments can be counted before a flush.
+
+    Args:
+        target (Update): The Update being created.
+        args (tuple): The positional arguments given to the constructor.
+        kwargs (dict): The keyword arguments given to the constructor.
+    """
+    target.positive_karma = 0
+    target.negative_karma = 0
+    target.num_admin_approvals = 0
+
+
+@event.listens_for(Update.comments, 'append')
+def count_comment_karma(target, value, initiator):
+    """
+    Update the karma counters of an update when a comment is added to it.
+
+    Args:
+        target (Update): The Update the comment is added to.
+        value (Comment): The comment being added.
+        initiator (sqlalchemy.orm.attributes.Event): The event that initiated the change.
+    """
+    if value.user is None:
+        # Comment(update=update, user=user) can add the comment before its user is set, so leave
+        # it to count_pending_comment_karma().
+        value._karma_pending = True
+        return
+    target._count_karma(value)
+
+
+@event.listens_for(BaseSession, 'before_flush')
+def count_pending_comment_karma(session, flush_context, instances):
+    """
+    Count the karma of the new comments whose user was not known when they were added.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session being flushed.
+        flush_context (sqlalchemy.orm.session.UOWTransaction): The state of the flush.
+        instances (list or None): The objects passed to flush(), if any.
+    """
+    pending = [obj for obj in session.new if isinstance(obj, Comment) and obj._karma_pending]
+    for comment in pending:
+        comment._karma_pending = False
+    pending = [c for c in pending if c.update is not None]
+    # The counters only hold if each comment is counted after the ones that precede it.
+    for comment in sorted(pending, key=lambda c: c.update.comments.index(c)):
+        if comment.user is None and comment.user_id is not None:
+            comment.user = session.query(User).get(comment.user_id)
+        if comment.user is not None:
+            comment.update._count_karma(comment)
+
+
+def invalidate_cache_on_commit(session, *namespaces):
+    """
+    Forget every value cached in the given namespaces once the given session commits.
+
+    Invalidating the cache any sooner would let another process cache the values that are still
+    in the database until then, and would be wrong if the transaction were rolled back.
+
+    Args:
+        session (sqlalchemy.orm.session.Session or None): The session holding the changes the
+            cached values are computed from. Nothing is invalidated if it is None.
+        namespaces (list): The names of the namespaces to invalidate.
+    """
+    if session is not None:
+        # This tells invalidate_caches_after_commit() which namespaces to invalidate.
+        session.info.setdefault('cache', set()).update(namespaces)
+
+
+@event.listens_for(BaseSession, 'after_commit')
+def invalidate_caches_after_commit(session):
+    """
+    An SQLAlchemy event listener to invalidate the cached values after a database commit.
+
+    Args:
+        session (sqlalchemy.orm.session.Session): The session that was committed.
+    """
+    namespaces = session.info.pop('cache', None)
+    if namespaces:
+        invalidate_cache(*sorted(namespaces))
+
+
+#: The cache namespaces holding values that are computed from the statuses and types of updates.
+UPDATE_COUNTS_CACHES = ('home', 'release_stats')
+
+
+@event.listens_for(Update.status, 'set')
+@event.listens_for(Update.type, 'set')
+def invalidate_update_counts_caches(target, value, oldvalue, initiator):
+    """
+    Forget the cached update counts when the status or the type of an update changes.
+
+    Updates that are not in a session yet are counted when they are inserted.
+
+    Args:
+        target (Update): The Update whose status or type is being set.
+        value (DeclEnum): The new value.
+        oldvalue (DeclEnum): The previous value.
+        initiator (sqlalchemy.orm.attributes.Event): The event that initiated the change.
+    """
+    if value != oldvalue:
+        invalidate_cache_on_commit(object_session(target), *UPDATE_COUNTS_CACHES)
+
+
+@event.listens_for(Update, 'after_insert')
+@event.listens_for(Update, 'after_delete')
+def invalidate_update_counts_caches_on_flush(mapper, connection, target):
+    """
+    Forget the cached update counts when an update is created or deleted.
+
+    Args:
+        mapper (sqlalchemy.orm.mapper.Mapper): The Update mapper.
+        connection (sqlalchemy.engine.Connection): The connection the flush is using.
+        target (Update): The Update that was created or deleted.
+    """
+    invalidate_cache_on_commit(object_session(target), *UPDATE_COUNTS_CACHES)
+
+
 # Used for many-to-many relationships between karma and a bug
 class BugKarma(Base):
     __tablename__ = 'comment_bug_assoc'
@@ -2632,15 +3133,18 @@ class TestCaseKarma(Base):
 class Comment(Base):
     __tablename__ = 'comments'
     __exclude_columns__ = tuple()
+    __json_dependencies__ = {'author': ('user',), 'update_title': ('update',)}
     __get_by__ = ('id',)
     # If 'anonymous' is true, then scrub the 'author' field in __json__(...)
     __anonymity_map__ = {'user': u'anonymous'}
+    # Set on comments that were added to an update before their user was known
+    _karma_pending = False
 
     karma = Column(Integer, default=0)
     karma_critpath = Column(Integer, default=0)
     text = Column(UnicodeText, nullable=False)
     anonymous = Column(Boolean, default=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
 
     update_id = Column(Integer, ForeignKey('updates.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
@@ -2664,22 +3168,39 @@ class Comment(Base):
 
         return filtered_feedbacks
 
-    def __json__(self, *args, **kwargs):
-        result = super(Comment, self).__json__(*args, **kwargs)
+    def __json__(self, request=None, anonymize=False, fields=None, exclude=None):
+        """
+        Return a JSON serializable dictionary representing this comment.
+
+        Args:
+            request (pyramid.request.Request or None): The current request.
+            anonymize (bool): Whether to scrub the fields in the ``__anonymity_map__``.
+            fields (iterable or None): If given, only these fields are included.
+            exclude (iterable or None): If given, these fields are left out.
+        Returns:
+            dict: The JSON representation of this comment.
+        """
+        if fields is None and exclude is None:
+            fields, exclude = _requested_fieldset(request)
+        result = super(Comment, self).__json__(
+            request=request, anonymize=anonymize, fields=fields, exclude=exclude)
         # Duplicate 'user' as 'author' just for backwards compat with bodhi1.
         # Things like fedmsg and fedbadges rely on this.
-        if not self.anonymous and result['user']:
-            result['author'] = result['user']['name']
-        else:
-            result['author'] = u'anonymous'
+        if JSONPlan.wants('author', fields, exclude):
+            if not self.anonymous and self.user:
+                result['author'] = self.user.name
+            else:
+                result['author'] = u'anonymous'
 
         # Similarly, duplicate the update's title as update_title.
-        result['update_title'] = result['update']['title']
+        if JSONPlan.wants('update_title', fields, exclude):
+            result['update_title'] = self.update.title
 
         # Updates used to have a karma column which would be included in result['update']. The
         # column was replaced with a property, so we need to include it here for backwards
         # compatibility.
-        result['update']['karma'] = self.update.karma
+        if 'update' in result:
+            result['update']['karma'] = self.update.karma
 
         return result
 
@@ -2873,13 +3394,14 @@ class BuildrootOverride(Base):
     """
     __tablename__ = 'buildroot_overrides'
     __include_extras__ = ('nvr',)
+    __json_dependencies__ = {'nvr': ('build',)}
     __get_by__ = ('build_id',)
 
     build_id = Column(Integer, ForeignKey('builds.id'), nullable=False)
     submitter_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     notes = Column(Unicode, nullable=False)
 
-    submission_date = Column(DateTime, default=datetime.utcnow, nullable=False)
+    submission_date = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     expiration_date = Column(DateTime, nullable=False)
     expired_date = Column(DateTime)
 
@@ -2985,6 +3507,35 @@ class BuildrootOverride(Base):
         )
 
 
+@event.listens_for(BuildrootOverride.expired_date, 'set')
+def invalidate_override_counts_cache(target, value, oldvalue, initiator):
+    """
+    Forget the cached release statistics, which count the active overrides, when one expires.
+
+    Args:
+        target (BuildrootOverride): The BuildrootOverride whose expiration date is being set.
+        value (datetime.datetime): The new expiration date.
+        oldvalue (datetime.datetime): The previous expiration date.
+        initiator (sqlalchemy.orm.attributes.Event): The event that initiated the change.
+    """
+    if value != oldvalue:
+        invalidate_cache_on_commit(object_session(target), 'release_stats')
+
+
+@event.listens_for(BuildrootOverride, 'after_insert')
+@event.listens_for(BuildrootOverride, 'after_delete')
+def invalidate_override_counts_cache_on_flush(mapper, connection, target):
+    """
+    Forget the cached release statistics when an override is created or deleted.
+
+    Args:
+        mapper (sqlalchemy.orm.mapper.Mapper): The BuildrootOverride mapper.
+        connection (sqlalchemy.engine.Connection): The connection the flush is using.
+        target (BuildrootOverride): The BuildrootOverride that was created or deleted.
+    """
+    invalidate_cache_on_commit(object_session(target), 'release_stats')
+
+
 class Stack(Base):
     """
     A Stack in bodhi represents a group of packages that are commonly pushed
@@ -3001,3 +3552,55 @@ class Stack(Base):
     # Many-to-many relationships
     groups = relationship("Group", secondary=stack_group_table, backref='stacks')
     users = relationship("User", secondary=stack_user_table, backref='stacks')
+
+
+class OutboxMail(Base):
+    """
+    An e-mail in the outbox, waiting to be sent by :class:`bodhi.server.mail.Outbox`.
+
+    The message is written in the transaction that it is about, so it is only sent if that
+    transaction is committed. The same message is sent to each of its recipients.
+
+    Attributes:
+        from_addr (unicode): The address the message is from.
+        recipients (unicode): The addresses the message still has to be sent to, as a JSON list.
+        subject (unicode): The subject of the message.
+        body (unicode): The body of the message.
+        headers (unicode): The extra headers of the message, as a JSON object.
+        created (DateTime): When the message was queued.
+        attempts (int): How many times sending the message has failed.
+        next_attempt (DateTime): When the message should be sent next.
+    """
+    __tablename__ = 'mail_outbox'
+
+    from_addr = Column(UnicodeText, nullable=False)
+    recipients = Column(UnicodeText, nullable=False)
+    subject = Column(UnicodeText, nullable=False)
+    body = Column(UnicodeText, nullable=False)
+    headers = Column(UnicodeText, nullable=False, default=u'{}')
+    created = Column(DateTime, default=datetime.utcnow, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class OutboxFedmsg(Base):
+    """
+    A fedmsg in the outbox, waiting to be published by :class:`bodhi.server.notifications.Relay`.
+
+    The message is written in the transaction that it is about, so it is only published if that
+    transaction is committed. The messages are published in the order of their ids.
+
+    Attributes:
+        topic (unicode): The topic of the message.
+        body (unicode): The message, serialized to JSON.
+        created (DateTime): When the message was queued.
+        attempts (int): How many times publishing the message has failed.
+        next_attempt (DateTime): When the message should be published next.
+    """
+    __tablename__ = 'fedmsg_outbox'
+
+    topic = Column(UnicodeText, nullable=False)
+    body = Column(UnicodeText, nullable=False)
+    created = Column(DateTime, default=datetime.utcnow, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -12,10 +12,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from datetime import datetime
 import collections
+import itertools
 import json
 import logging
 import socket
+import threading
 
 from sqlalchemy import event
 import fedmsg
@@ -23,18 +26,28 @@ import fedmsg.config
 import fedmsg.encoding
 
 from bodhi.server import Session
+from bodhi.server.util import ClaimConflict, Drainer
 import bodhi.server
 import bodhi.server.config
 
 
 _log = logging.getLogger(__name__)
 
+# The arguments of the last call to init(), which the relay's thread initializes fedmsg with
+_init_kwargs = {}
+
+# The relay of this process, created by get_relay()
+_relay = None
+_relay_lock = threading.Lock()
+
 
 def init(active=None, cert_prefix=None):
+    global _init_kwargs
     if not bodhi.server.config.config.get('fedmsg_enabled'):
         bodhi.server.log.warn("fedmsg disabled.  not initializing.")
         return
 
+    _init_kwargs = dict(active=active, cert_prefix=cert_prefix)
     fedmsg_config = fedmsg.config.load_config()
 
     # Only override config from disk if explicitly argued.
@@ -55,72 +68,258 @@ def init(active=None, cert_prefix=None):
 @event.listens_for(Session, 'after_commit')
 def send_fedmsgs_after_commit(session):
     """
-    An SQLAlchemy event listener to send fedmsgs after a database commit.
+    An SQLAlchemy event listener to publish the fedmsgs in the outbox after a database commit.
 
-    This relies on the session ``info`` dictionary being populated. At the moment,
-    this is done by calling the :func:`publish` function. In the future it should
-    be done automatically using SQLAlchemy listeners.
+    This relies on the session ``info`` dictionary being populated by the :func:`publish`
+    function.
 
     Args:
         session (sqlalchemy.orm.session.Session): The session that was committed.
     """
-    if 'fedmsg' in session.info:
-        _log.debug('Emitting all queued fedmsgs for %r', session)
-        # Initialize right before we try to publish, but only if we haven't
-        # initialized for this thread already.
-        if not fedmsg_is_initialized():
-            init()
-
-        for topic, messages in session.info['fedmsg'].items():
-            _log.debug('emitting %d fedmsgs to the "%s" topic queued by %r',
-                       len(messages), topic, session)
-            for msg in messages:
-                fedmsg.publish(topic=topic, msg=msg)
-                _log.debug('Emitted a fedmsg, %r, on the "%s" topic, queued by %r',
-                           msg, topic, session)
-            # Tidy up after ourselves so a second call to commit on this session won't
-            # send the same messages again.
-            del session.info['fedmsg'][topic]
+    # Tidy up after ourselves so a second call to commit on this session won't wake the relay up
+    # again.
+    if session.info.pop('fedmsg', False):
+        _log.debug('Relaying the fedmsgs queued by %r', session)
+        get_relay().wake()
 
 
 def publish(topic, msg, force=False):
     """ Publish a message to fedmsg.
 
-    By default, messages are not sent immediately, but are queued in a
-    transaction "data manager".  They will only get published after the
-    sqlalchemy transaction completes successfully and will not be published at
-    all if it fails, aborts, or rolls back.
+    By default, messages are not sent immediately, but are written to the
+    fedmsg outbox in the current transaction.  They will only get published,
+    by the :class:`Relay`, after the sqlalchemy transaction completes
+    successfully and will not be published at all if it fails, aborts, or
+    rolls back.
+
+    Specifying force=True to this function by-passes the transaction --
+    messages are handed to the relay immediately, which publishes them after
+    the messages that were committed before them.
 
-    Specifying force=True to this function by-passes that -- messages are sent
-    immediately.
+    The updates in the message are published in their compact representation,
+    unless the fedmsg_full_payloads setting is True.
     """
     if not bodhi.server.config.config.get('fedmsg_enabled'):
         _log.warn("fedmsg disabled.  not sending %r" % topic)
         return
 
-    # Initialize right before we try to publish, but only if we haven't
-    # initialized for this thread already.
-    if not fedmsg_is_initialized():
-        init()
+    if not bodhi.server.config.config.get('fedmsg_full_payloads'):
+        msg = compact(msg)
+
+    # The message is serialized once, now, since the SQLAlchemy objects in it may be expired by
+    # the time it is published.
+    body = unicode(fedmsg.encoding.dumps(msg))
 
     if force:
         _log.debug("fedmsg skipping transaction and sending %r" % topic)
-        fedmsg.publish(topic=topic, msg=msg)
+        get_relay().send(topic, body)
     else:
-        # We need to do this to ensure all the SQLAlchemy objects that could be in the messages
-        # are turned into JSON before the session is removed and expires the objects loaded with
-        # it. The JSON is decoded again because the fedmsg API doesn't state it accepts strings.
-        # An issue has been filed about this: https://github.com/fedora-infra/fedmsg/issues/407.
-        json_msg = fedmsg.encoding.dumps(msg)
-        msg_dict = json.loads(json_msg)
-        # This gives us the thread-local session which we'll use to stash the fedmsg.
+        # Imported here to avoid a circular import with the models, which publish messages.
+        from bodhi.server.models import OutboxFedmsg
+        # This gives us the thread-local session which we'll write the message with.
         # When commit is called on it, the :func:`send_fedmsgs_after_commit` is triggered.
         session = Session()
-        if 'fedmsg' not in session.info:
-            _log.debug('Adding a dictionary for fedmsg storage to %r', session)
-            session.info['fedmsg'] = collections.defaultdict(list)
-        session.info['fedmsg'][topic].append(msg_dict)
-        _log.debug('Enqueuing a fedmsg, %r, for topic "%s" on %r', msg_dict, topic, session)
+        session.add(OutboxFedmsg(topic=topic, body=body))
+        session.info['fedmsg'] = True
+        _log.debug('Enqueuing a fedmsg, %s, for topic "%s" on %r', body, topic, session)
+
+
+def compact(msg):
+    """
+    Return the given message with its updates in their compact representation.
+
+    The messages that describe an update only carry the fields that
+    :meth:`bodhi.server.models.Update.compact_json` returns, rather than the whole update with
+    its comments, bugs and test cases.
+
+    Args:
+        msg (dict): The message to publish.
+    Returns:
+        dict: The message, with its updates replaced by their compact representation.
+    """
+    return dict((key, value.compact_json() if hasattr(value, 'compact_json') else value)
+                for key, value in msg.items())
+
+
+def get_relay():
+    """
+    Return the Relay of this process, creating it if needed.
+
+    Returns:
+        Relay: The relay, configured with the fedmsg_outbox.* settings.
+    """
+    global _relay
+    with _relay_lock:
+        if _relay is None:
+            config = bodhi.server.config.config
+            _relay = Relay(
+                max_attempts=config.get('fedmsg_outbox.max_attempts'),
+                retry_delay=config.get('fedmsg_outbox.retry_delay'),
+                batch_size=config.get('fedmsg_outbox.batch_size'))
+        return _relay
+
+
+class Relay(Drainer):
+    """
+    Publish the fedmsgs of the outbox, in order, from a background thread.
+
+    The relay claims a batch of messages at the head of the outbox, publishes them, and deletes
+    the batch. A message is only deleted after it was published, so it may be published twice if
+    the process dies in between, but it is not lost. The relays of the processes take turns with
+    the head of the outbox, so the messages are published in the order of their ids, and the
+    messages after one that can't be published wait for it.
+
+    Forced messages don't go through the database. They are published by the same thread, after
+    the messages that were committed before them.
+    """
+
+    thread_name = 'FedmsgRelay'
+    failure_message = 'Unable to publish the fedmsgs in the outbox'
+
+    def __init__(self, max_attempts=10, retry_delay=10, batch_size=100, db_factory=None):
+        """
+        Initialize the relay. Its thread is started by wake() and send().
+
+        Args:
+            max_attempts (int): How many times to try publishing a message.
+            retry_delay (float): How many seconds to wait before the first retry of a message.
+            batch_size (int): How many messages to claim at once.
+            db_factory (callable): A TransactionalSessionMaker to use for the database, or None to
+                create one.
+        """
+        super(Relay, self).__init__(max_attempts, retry_delay, batch_size, db_factory)
+        self._forced = collections.deque()
+
+    def send(self, topic, body):
+        """
+        Have the relay's thread publish the given message, without going through the database.
+
+        Args:
+            topic (basestring): The topic of the message.
+            body (basestring): The message, serialized to JSON.
+        """
+        with self._condition:
+            self._forced.append((topic, body))
+        self.wake()
+
+    def drain(self):
+        """
+        Publish the messages of the outbox that are due, and then the forced messages.
+
+        Returns:
+            float: How many seconds until the head of the outbox is due, or None if the outbox is
+                empty.
+        """
+        # The forced messages are taken first, so the messages that were committed before them
+        # are published before them.
+        with self._condition:
+            forced = list(self._forced)
+            self._forced.clear()
+        try:
+            return super(Relay, self).drain()
+        finally:
+            self._deliver([{'topic': topic, 'body': body, 'forced': True}
+                           for topic, body in forced])
+
+    def _claim(self, now):
+        """
+        Claim the messages at the head of the outbox that are due, so no other relay publishes them.
+
+        Args:
+            now (datetime.datetime): The current time.
+        Returns:
+            list: The claimed messages, as dictionaries, in order.
+        Raises:
+            bodhi.server.util.ClaimConflict: If another relay claimed some of the messages first.
+        """
+        from bodhi.server.models import OutboxFedmsg
+        with self.db_factory() as db:
+            head = db.query(OutboxFedmsg).order_by(OutboxFedmsg.id).limit(self.batch_size).all()
+            due = list(itertools.takewhile(lambda m: m.next_attempt <= now, head))
+            if not due:
+                return []
+            claimed = db.query(OutboxFedmsg)\
+                .filter(OutboxFedmsg.id.in_([m.id for m in due]))\
+                .filter(OutboxFedmsg.next_attempt <= now)\
+                .update({'next_attempt': self._claimed_until(now)}, synchronize_session=False)
+            if claimed != len(due):
+                raise ClaimConflict()
+            return [{'id': m.id, 'topic': m.topic, 'body': m.body, 'attempts': m.attempts}
+                    for m in due]
+
+    def _deliver(self, messages):
+        """
+        Publish the given messages in order, stopping at the first one that fails.
+
+        Args:
+            messages (list): The messages, as dictionaries with topic and body keys.
+        Returns:
+            int: How many of the messages were published.
+        """
+        if messages and not fedmsg_is_initialized():
+            # Initialize the relay's thread like the process initialized fedmsg.
+            init(**_init_kwargs)
+        for i, message in enumerate(messages):
+            try:
+                fedmsg.publish(topic=message['topic'], msg=json.loads(message['body']))
+            except Exception:
+                _log.exception('Unable to publish a fedmsg on the "%s" topic', message['topic'])
+                # Forced messages aren't retried, like when they were published by their callers.
+                if message.get('forced'):
+                    continue
+                return i
+            _log.debug('Emitted a fedmsg, %s, on the "%s" topic', message['body'],
+                       message['topic'])
+        return len(messages)
+
+    def _finish(self, messages, delivered):
+        """
+        Remove the published messages from the outbox, and schedule the others to be retried.
+
+        Args:
+            messages (list): The messages that _deliver() was given.
+            delivered (int): How many of them were published.
+        """
+        from bodhi.server.models import OutboxFedmsg
+        with self.db_factory() as db:
+            ids = [m['id'] for m in messages[:delivered]]
+            if ids:
+                db.query(OutboxFedmsg).filter(OutboxFedmsg.id.in_(ids))\
+                    .delete(synchronize_session=False)
+            if delivered == len(messages):
+                return
+
+            failed = messages[delivered]
+            attempts = failed['attempts'] + 1
+            rest = [m['id'] for m in messages[delivered + 1:]]
+            next_attempt = self._retry_at(attempts)
+            if next_attempt is None:
+                _log.error('Giving up on publishing the fedmsg %s on the "%s" topic after %d '
+                           'attempts', failed['body'], failed['topic'], attempts)
+                db.query(OutboxFedmsg).filter_by(id=failed['id']).delete(
+                    synchronize_session=False)
+                next_attempt = datetime.utcnow()
+            else:
+                rest.insert(0, failed['id'])
+                db.query(OutboxFedmsg).filter_by(id=failed['id']).update(
+                    {'attempts': attempts}, synchronize_session=False)
+            # The messages after the failed one wait for it, to stay in order.
+            if rest:
+                db.query(OutboxFedmsg).filter(OutboxFedmsg.id.in_(rest))\
+                    .update({'next_attempt': next_attempt}, synchronize_session=False)
+
+    def _next_attempt(self, db):
+        """
+        Return when the head of the outbox is due, since only the head is published.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): The database session.
+        Returns:
+            datetime.datetime or None: The time, or None if the outbox is empty.
+        """
+        from bodhi.server.models import OutboxFedmsg
+        head = db.query(OutboxFedmsg.next_attempt).order_by(OutboxFedmsg.id).first()
+        return head and head.next_attempt
 
 
 def fedmsg_is_initialized():
@@ -48,6 +48,22 @@ class Builds(colander.SequenceSchema):
     build = colander.SchemaNode(colander.String())
 
 
+class Fields(colander.SequenceSchema):
+    field = colander.SchemaNode(colander.String())
+
+
+class Cursor(colander.String):
+    def deserialize(self, node, cstruct):
+        value = super(Cursor, self).deserialize(node, cstruct)
+        if value is colander.null:
+            return value
+
+        try:
+            return util.decode_cursor(value)
+        except ValueError:
+            raise colander.Invalid(node, '"%s" is not a valid cursor' % value)
+
+
 class CVE(colander.String):
     def deserialize(self, node, cstruct):
         value = super(CVE, self).deserialize(node, cstruct)
@@ -227,6 +243,18 @@ class PaginatedSchema(colander.MappingSchema):
         missing=20,
     )
 
+    cursor = colander.SchemaNode(
+        Cursor(),
+        location="querystring",
+        missing=None,
+    )
+
+    total = colander.SchemaNode(
+        colander.Boolean(true_choices=('true', '1')),
+        location="querystring",
+        missing=None,
+    )
+
 
 class SearchableSchema(colander.MappingSchema):
     like = colander.SchemaNode(
@@ -242,6 +270,22 @@ class SearchableSchema(colander.MappingSchema):
     )
 
 
+class SparseFieldsetSchema(colander.MappingSchema):
+    fields = Fields(
+        colander.Sequence(accept_scalar=True),
+        location="querystring",
+        missing=None,
+        preparer=[util.splitter],
+    )
+
+    exclude = Fields(
+        colander.Sequence(accept_scalar=True),
+        location="querystring",
+        missing=None,
+        preparer=[util.splitter],
+    )
+
+
 class ListReleaseSchema(PaginatedSchema):
     name = colander.SchemaNode(
         colander.String(),
@@ -385,7 +429,7 @@ class ListUserSchema(PaginatedSchema, SearchableSchema):
     )
 
 
-class ListUpdateSchema(PaginatedSchema, SearchableSchema, Cosmetics):
+class ListUpdateSchema(PaginatedSchema, SearchableSchema, Cosmetics, SparseFieldsetSchema):
     alias = Builds(
         colander.Sequence(accept_scalar=True),
         location="querystring",
@@ -566,7 +610,7 @@ class ListPackageSchema(PaginatedSchema, SearchableSchema):
     )
 
 
-class ListBuildSchema(PaginatedSchema):
+class ListBuildSchema(PaginatedSchema, SparseFieldsetSchema):
     nvr = colander.SchemaNode(
         colander.String(),
         location="querystring",
@@ -602,7 +646,7 @@ class UpdateRequestSchema(CSRFProtectedSchema, colander.MappingSchema):
     )
 
 
-class ListCommentSchema(PaginatedSchema, SearchableSchema):
+class ListCommentSchema(PaginatedSchema, SearchableSchema, SparseFieldsetSchema):
     updates = Updates(
         colander.Sequence(accept_scalar=True),
         location="querystring",
@@ -648,7 +692,7 @@ class ListCommentSchema(PaginatedSchema, SearchableSchema):
     )
 
 
-class ListOverrideSchema(PaginatedSchema, SearchableSchema, Cosmetics):
+class ListOverrideSchema(PaginatedSchema, SearchableSchema, Cosmetics, SparseFieldsetSchema):
     builds = Builds(
         colander.Sequence(accept_scalar=True),
         location="querystring",
@@ -0,0 +1,273 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Index and search the text of updates, bugs, packages and builds.
+
+The ``search`` parameters of the list services match substrings of names, so the obvious
+``ILIKE '%...%'`` queries have to scan whole tables. Instead, the searched columns are indexed:
+
+* On PostgreSQL, with trigram indexes from the ``pg_trgm`` extension, which the ``ILIKE``
+  queries can use, and a full text index of the update notes. Results are ranked by trigram
+  similarity and text rank. Only a superuser can create the extension, so a DBA has to run
+  ``CREATE EXTENSION pg_trgm`` in Bodhi's database. Without it, there are no trigram indexes,
+  and exact matches are ranked first instead.
+* On SQLite, with FTS5 tables using the trigram tokenizer, which are kept up to date by
+  triggers. Results are ranked with BM25.
+
+Other databases, or searches for fewer than three characters, fall back to ``ILIKE`` and put
+the exact matches first.
+"""
+import weakref
+
+from sqlalchemy import and_, bindparam, case, func, literal_column, or_, select
+from sqlalchemy.sql import column, table
+
+
+#: The short identifier columns to search, by table. These are matched as substrings.
+TRIGRAM_COLUMNS = {
+    'updates': ('title', 'alias'),
+    'bugs': ('title',),
+    'packages': ('name',),
+    'builds': ('nvr',),
+}
+
+#: The prose columns to search, by table. On PostgreSQL these are matched by word stems.
+TEXT_COLUMNS = {
+    'updates': ('notes',),
+}
+
+#: The shortest search that the trigram indexes can match.
+MIN_TRIGRAM_LENGTH = 3
+
+#: Whether the pg_trgm extension is installed, by PostgreSQL dialect. See :func:`has_trigrams`.
+_trigrams = weakref.WeakKeyDictionary()
+
+
+def create_indexes(target, connection, **kwargs):
+    """
+    Create the search indexes of all the searched tables that don't have them yet, and fill them.
+
+    This is called whenever the tables are created, which happens every time the masher starts,
+    so the indexes that already exist are left alone. It does nothing on the databases that have
+    no suitable index, and creates no trigram indexes on PostgreSQL if pg_trgm is not installed.
+
+    Args:
+        target (sqlalchemy.MetaData or None): The metadata whose tables were created.
+        connection (sqlalchemy.engine.Connection): The database connection.
+        kwargs (dict): Other arguments of the ``after_create`` event, which are ignored.
+    """
+    if connection.dialect.name == 'postgresql':
+        # PostgreSQL 9.2 has no CREATE INDEX IF NOT EXISTS.
+        existing = _existing(connection, 'pg_indexes', 'indexname', [
+            'ix_{0}_{1}_{2}'.format(name, col, kind)
+            for kind, searched in (('trgm', TRIGRAM_COLUMNS), ('tsv', TEXT_COLUMNS))
+            for name, columns in searched.items() for col in columns])
+        if has_trigrams(connection):
+            for name, columns in TRIGRAM_COLUMNS.items():
+                for col in columns:
+                    index = 'ix_{0}_{1}_trgm'.format(name, col)
+                    if index not in existing:
+                        connection.execute('CREATE INDEX {0} ON {1} USING gin ({2} gin_trgm_ops)'
+                                           .format(index, name, col))
+        for name, columns in TEXT_COLUMNS.items():
+            for col in columns:
+                index = 'ix_{0}_{1}_tsv'.format(name, col)
+                if index not in existing:
+                    connection.execute('CREATE INDEX {0} ON {1} USING gin ({2})'.format(
+                        index, name, _tsvector(name, col)))
+    elif _has_fts(connection.dialect):
+        existing = _existing(connection, 'sqlite_master', 'name', [
+            '{0}_search{1}'.format(name, suffix) for name in TRIGRAM_COLUMNS
+            for suffix in ('', '_insert', '_update', '_delete')])
+        for name in TRIGRAM_COLUMNS:
+            triggers = ['{0}_search_{1}'.format(name, event)
+                        for event in ('insert', 'update', 'delete')]
+            if '{0}_search'.format(name) in existing and existing.issuperset(triggers):
+                continue
+            columns = ', '.join(_searched_columns(name))
+            new_values = ', '.join('new.%s' % c for c in _searched_columns(name))
+            if '{0}_search'.format(name) not in existing:
+                connection.execute(
+                    "CREATE VIRTUAL TABLE {0}_search USING fts5({1}, tokenize='trigram')".format(
+                        name, columns))
+            # The triggers are dropped with the table they are on, while the search table stays
+            # behind with the rows of the dropped table, so it is filled again with the triggers.
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {0}_search_insert AFTER INSERT ON {0} BEGIN '
+                'INSERT INTO {0}_search(rowid, {1}) VALUES (new.id, {2}); END'.format(
+                    name, columns, new_values))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {0}_search_update AFTER UPDATE OF {1} ON {0} BEGIN '
+                'DELETE FROM {0}_search WHERE rowid = old.id; '
+                'INSERT INTO {0}_search(rowid, {1}) VALUES (new.id, {2}); END'.format(
+                    name, columns, new_values))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {0}_search_delete AFTER DELETE ON {0} BEGIN '
+                'DELETE FROM {0}_search WHERE rowid = old.id; END'.format(name))
+            connection.execute('DELETE FROM {0}_search'.format(name))
+            connection.execute(
+                'INSERT INTO {0}_search(rowid, {1}) SELECT id, {1} FROM {0}'.format(name, columns))
+
+
+def has_trigrams(connection):
+    """
+    Return whether the pg_trgm extension is installed in the given PostgreSQL database.
+
+    The answer is remembered for each database, so a Bodhi that was started before the extension
+    was created keeps searching without it until it is restarted.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): A connection to the database.
+    Returns:
+        bool: True if the trigram functions and operators can be used, False otherwise.
+    """
+    if connection.dialect not in _trigrams:
+        _trigrams[connection.dialect] = connection.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first() is not None
+    return _trigrams[connection.dialect]
+
+
+def match(db, model, text):
+    """
+    Return how to find and rank the rows of the given model's table that match the given text.
+
+    Args:
+        db (sqlalchemy.orm.session.Session): The database session.
+        model (bodhi.server.models.Base): The model class to search, which must have a table in
+            :data:`TRIGRAM_COLUMNS`.
+        text (basestring): The text to search for.
+    Returns:
+        tuple: A 2-tuple of a criterion that matches the rows containing the text, and an
+            expression that orders the rows that match from the best match.
+    """
+    name = model.__table__.name
+    dialect = db.get_bind().dialect
+    if len(text) < MIN_TRIGRAM_LENGTH:
+        return _match_ilike(model, text)
+    elif dialect.name == 'postgresql':
+        return _match_postgresql(model, text, has_trigrams(db.connection()))
+    elif _has_fts(dialect):
+        search_table = table('%s_search' % name, column('rowid'), column('rank'))
+        matches = literal_column(search_table.name).op('MATCH')(
+            bindparam('search', u'"%s"' % text.replace(u'"', u'""'), unique=True))
+        criterion = model.id.in_(select([search_table.c.rowid]).where(matches))
+        # Rows that are matched through other tables have no rank of their own, so they come
+        # after the rows that are (BM25 ranks are negative, and smaller is better).
+        rank = func.coalesce(
+            select([search_table.c.rank]).where(and_(
+                search_table.c.rowid == model.id, matches)).as_scalar(),
+            0)
+        return criterion, rank
+    return _match_ilike(model, text)
+
+
+def _match_ilike(model, text):
+    """
+    Return a criterion and rank for the given model and text that don't need any index.
+
+    Args:
+        model (bodhi.server.models.Base): The model class to search.
+        text (basestring): The text to search for.
+    Returns:
+        tuple: A 2-tuple of a criterion and an expression that orders the exact matches first.
+    """
+    columns = [getattr(model, col) for col in TRIGRAM_COLUMNS[model.__table__.name]]
+    criterion = or_(*[col.ilike(u'%%%s%%' % text) for col in columns])
+    rank = case([(or_(*[col == text for col in columns]), 0)], else_=1)
+    return criterion, rank
+
+
+def _match_postgresql(model, text, trigrams):
+    """
+    Return a criterion and rank for the given model and text that use the PostgreSQL indexes.
+
+    Args:
+        model (bodhi.server.models.Base): The model class to search.
+        text (basestring): The text to search for.
+        trigrams (bool): Whether the pg_trgm extension is installed.
+    Returns:
+        tuple: A 2-tuple of a criterion and an expression that orders the most similar rows first.
+    """
+    name = model.__table__.name
+    criteria = []
+    ranks = []
+    for col in TRIGRAM_COLUMNS[name]:
+        col = getattr(model, col)
+        criteria.append(col.ilike(u'%%%s%%' % text))
+        if trigrams:
+            ranks.append(func.similarity(col, text))
+        else:
+            ranks.append(case([(col == text, 1)], else_=0))
+    for col in TEXT_COLUMNS.get(name, ()):
+        query = func.plainto_tsquery(literal_column("'english'"), text)
+        tsvector = literal_column(_tsvector(name, col))
+        criteria.append(tsvector.op('@@')(query))
+        ranks.append(func.ts_rank(tsvector, query))
+    return or_(*criteria), -func.greatest(*ranks)
+
+
+def _tsvector(name, col):
+    """
+    Return the SQL of the text search vector of the given column.
+
+    The indexes and queries must use exactly the same expression, so the indexes can be used.
+
+    Args:
+        name (str): The name of the table.
+        col (str): The name of the column.
+    Returns:
+        str: The SQL expression.
+    """
+    return "to_tsvector('english', coalesce({0}.{1}, ''))".format(name, col)
+
+
+def _existing(connection, catalog, name_column, names):
+    """
+    Return which of the given database objects exist, according to the given catalog.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): The database connection.
+        catalog (str): The name of the catalog table or view, such as ``pg_indexes``.
+        name_column (str): The column of the catalog that holds the names of the objects.
+        names (list): The names of the objects to look for.
+    Returns:
+        set: The names of the objects that exist.
+    """
+    name_col = column(name_column)
+    query = select([name_col]).select_from(table(catalog)).where(name_col.in_(names))
+    return set(row[0] for row in connection.execute(query))
+
+
+def _searched_columns(name):
+    """
+    Return the names of all the searched columns of the given table.
+
+    Args:
+        name (str): The name of the table.
+    Returns:
+        tuple: The names of the columns.
+    """
+    return TRIGRAM_COLUMNS[name] + TEXT_COLUMNS.get(name, ())
+
+
+def _has_fts(dialect):
+    """
+    Return whether the given dialect is SQLite with FTS5 and its trigram tokenizer.
+
+    Args:
+        dialect (sqlalchemy.engine.interfaces.Dialect): The database dialect.
+    Returns:
+        bool: True if the search tables can be used, False otherwise.
+    """
+    return dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 34, 0)
@@ -11,14 +11,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-import math
 
 from cornice import Service
 from pyramid.exceptions import HTTPNotFound
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server.models import Update, RpmBuild, RpmPackage, Release
+from bodhi.server.util import paginate
 from bodhi.server.validators import validate_updates, validate_packages, validate_releases
 import bodhi.server.schemas
 import bodhi.server.security
@@ -75,22 +74,10 @@ def query_builds(request):
         query = query.join(RpmBuild.release)
         query = query.filter(or_(*[Release.id == r.id for r in releases]))
 
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(RpmBuild.nvr))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    query = query.options(*RpmBuild.json_load_options(data.get('fields'), data.get('exclude')))
+    builds, pagination = paginate(request, query, [RpmBuild.id], RpmBuild.nvr)
 
     return dict(
-        builds=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        builds=builds,
+        **pagination
     )
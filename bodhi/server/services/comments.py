@@ -18,15 +18,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """Define the service endpoints that handle Comments."""
 
-import math
 
 from cornice import Service
 from pyramid.httpexceptions import HTTPBadRequest
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server import log
 from bodhi.server.models import Comment, Build, Update
+from bodhi.server.util import paginate
 from bodhi.server.validators import (
     validate_packages,
     validate_update,
@@ -114,6 +113,7 @@ def query_comments(request):
             pages: The total number of pages.
             rows_per_page: The number of rows per page.
             total: The number of items matching the search terms.
+            next_cursor: The cursor of the next page, or None on the last page.
             chrome: A boolean indicating whether to paginate or not.
     """
     db = request.db
@@ -159,27 +159,14 @@ def query_comments(request):
     if user is not None:
         query = query.filter(Comment.user == user)
 
-    query = query.order_by(Comment.timestamp.desc())
-
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(Comment.id))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    query = query.options(*Comment.json_load_options(data.get('fields'), data.get('exclude')))
+    comments, pagination = paginate(
+        request, query, [Comment.timestamp, Comment.id], Comment.id, descending=True)
 
     return dict(
-        comments=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        comments=comments,
         chrome=data.get('chrome'),
+        **pagination
     )
 
 
@@ -12,16 +12,16 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-import math
 
 from cornice import Service
 from pyramid.exceptions import HTTPNotFound
 
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server import log
 from bodhi.server.models import Build, BuildrootOverride, RpmPackage, Release, RpmBuild, User
+from bodhi.server.search import match
+from bodhi.server.util import paginate
 import bodhi.server.schemas
 import bodhi.server.services.errors
 from bodhi.server.validators import (
@@ -131,37 +131,28 @@ def query_overrides(request):
             RpmBuild.nvr.like('%%%s%%' % like)
         ]))
 
+    rank = None
     search = data.get('search')
     if search is not None:
+        criterion, rank = match(db, Build, search)
         query = query.join(BuildrootOverride.build)
-        query = query.filter(Build.nvr.ilike('%%%s%%' % search))
+        query = query.filter(criterion)
 
     submitter = data.get('user')
     if submitter is not None:
         query = query.filter(BuildrootOverride.submitter == submitter)
 
-    query = query.order_by(BuildrootOverride.submission_date.desc())
-
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(BuildrootOverride.id))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    query = query.options(
+        *BuildrootOverride.json_load_options(data.get('fields'), data.get('exclude')))
+    overrides, pagination = paginate(
+        request, query, [BuildrootOverride.submission_date, BuildrootOverride.id],
+        BuildrootOverride.id, descending=True, rank=rank)
 
     return dict(
-        overrides=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        overrides=overrides,
         chrome=data.get('chrome'),
         display_user=data.get('display_user'),
+        **pagination
     )
 
 
@@ -11,13 +11,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-import math
 
 from cornice import Service
-from sqlalchemy import func, distinct
-from sqlalchemy.sql.expression import case
 
 from bodhi.server.models import RpmPackage, Package
+from bodhi.server.search import match
+from bodhi.server.util import paginate
 import bodhi.server.schemas
 import bodhi.server.security
 import bodhi.server.services.errors
@@ -46,27 +45,16 @@ def query_packages(request):
     if like is not None:
         query = query.filter(RpmPackage.name.like('%%%s%%' % like))
 
+    rank = None
     search = data.get('search')
     if search is not None:
-        query = query.filter(Package.name.ilike('%%%s%%' % search))
-        query = query.order_by(case([(Package.name == search, Package.name)]))
+        criterion, rank = match(db, Package, search)
+        query = query.filter(criterion)
 
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(RpmPackage.name))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    packages, pagination = paginate(request, query, [RpmPackage.name], RpmPackage.name,
+                                    rank=rank)
 
     return dict(
-        packages=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        packages=packages,
+        **pagination
     )
@@ -18,15 +18,15 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """Defines API endpoints related to Release objects."""
 
-import math
 
 from cornice import Service
 from pyramid.exceptions import HTTPNotFound
-from sqlalchemy import func, distinct
+from sqlalchemy import func
 from sqlalchemy.sql import or_
 
 from bodhi.server import log
 from bodhi.server.models import (
+    invalidate_cache_on_commit,
     Update,
     UpdateStatus,
     UpdateType,
@@ -35,6 +35,7 @@ from bodhi.server.models import (
     RpmPackage,
     Release,
 )
+from bodhi.server.util import paginate
 from bodhi.server.validators import (
     validate_tags,
     validate_enums,
@@ -74,93 +75,63 @@ def get_release_html(request):
     if not release:
         request.errors.add('body', 'name', 'No such release')
         request.errors.status = HTTPNotFound.code
+        return
+
     updates = request.db.query(Update).filter(Update.release == release).order_by(
         Update.date_submitted.desc())
 
-    updates_count = request.db.query(Update.date_submitted, Update.type).filter(
-        Update.release == release).order_by(Update.date_submitted.desc())
-
-    date_commits = {}
-    dates = set()
-
-    for update in updates_count.all():
-        d = update.date_submitted
-        yearmonth = str(d.year) + '/' + str(d.month).zfill(2)
-        dates.add(yearmonth)
-        if update.type.description not in date_commits:
-            date_commits[update.type.description] = {}
-        if yearmonth in date_commits[update.type.description]:
-            date_commits[update.type.description][yearmonth] += 1
-        else:
-            date_commits[update.type.description][yearmonth] = 0
-
-    base_count_query = request.db.query(Update)\
-        .filter(Update.release == release)
-
-    num_updates_pending = base_count_query\
-        .filter(Update.status == UpdateStatus.pending).count()
-    num_updates_testing = base_count_query\
-        .filter(Update.status == UpdateStatus.testing).count()
-    num_updates_stable = base_count_query\
-        .filter(Update.status == UpdateStatus.stable).count()
-    num_updates_unpushed = base_count_query\
-        .filter(Update.status == UpdateStatus.unpushed).count()
-    num_updates_obsolete = base_count_query\
-        .filter(Update.status == UpdateStatus.obsolete).count()
-
-    num_updates_security = base_count_query\
-        .filter(Update.type == UpdateType.security).count()
-    num_updates_bugfix = base_count_query\
-        .filter(Update.type == UpdateType.bugfix).count()
-    num_updates_enhancement = base_count_query\
-        .filter(Update.type == UpdateType.enhancement).count()
-    num_updates_newpackage = base_count_query\
-        .filter(Update.type == UpdateType.newpackage).count()
-
-    num_active_overrides = request.db.query(
-        BuildrootOverride
-    ).filter(
-        BuildrootOverride.expired_date.is_(None)
-    ).join(
-        BuildrootOverride.build
-    ).join(
-        Build.release
-    ).filter(
-        Build.release == release
-    ).count()
-
-    num_expired_overrides = request.db.query(
-        BuildrootOverride
-    ).filter(
-        BuildrootOverride.expired_date.isnot(None)
-    ).join(
-        BuildrootOverride.build
-    ).join(
-        Build.release
-    ).filter(
-        Build.release == release
-    ).count()
-
+    stats = get_release_stats(request, release.name)
     return dict(release=release,
                 latest_updates=updates.limit(25).all(),
-                count=updates.count(),
-                date_commits=date_commits,
-                dates=sorted(dates),
+                **stats)
+
 
-                num_updates_pending=num_updates_pending,
-                num_updates_testing=num_updates_testing,
-                num_updates_stable=num_updates_stable,
-                num_updates_unpushed=num_updates_unpushed,
-                num_updates_obsolete=num_updates_obsolete,
+def get_release_stats(request, name):
+    """
+    Return the statistics about the updates and overrides of a release that its page displays.
 
-                num_updates_security=num_updates_security,
-                num_updates_bugfix=num_updates_bugfix,
-                num_updates_enhancement=num_updates_enhancement,
-                num_updates_newpackage=num_updates_newpackage,
+    The statistics are computed with a few aggregate queries and cached until the updates or the
+    overrides change.
 
-                num_active_overrides=num_active_overrides,
-                num_expired_overrides=num_expired_overrides,
-                )
+    Args:
+        request (pyramid.Request): The current request.
+        name (basestring): The name of the release.
+    Returns:
+        dict: A dictionary with the keys "count", "date_commits", "dates", "num_updates_<status>"
+            for the pending, testing, stable, unpushed and obsolete statuses,
+            "num_updates_<type>" for each update type, "num_active_overrides" and
+            "num_expired_overrides".
+    """
+    @request.cache.cache_on_arguments(namespace='release_stats')
+    def work(name):
+        counts = Update.counts(request.db, [name])[name]
+        date_commits = Update.monthly_counts(request.db, name)
+
+        stats = dict(
+            count=sum(counts.values()),
+            date_commits=date_commits,
+            dates=sorted(set(month for months in date_commits.values() for month in months)),
+        )
+        for status in (UpdateStatus.pending, UpdateStatus.testing, UpdateStatus.stable,
+                       UpdateStatus.unpushed, UpdateStatus.obsolete):
+            stats['num_updates_%s' % status.value] = sum(
+                n for (s, t), n in counts.items() if s == status)
+        for type_ in (UpdateType.security, UpdateType.bugfix, UpdateType.enhancement,
+                      UpdateType.newpackage):
+            stats['num_updates_%s' % type_.value] = sum(
+                n for (s, t), n in counts.items() if t == type_)
+
+        expired = BuildrootOverride.expired_date.isnot(None)
+        overrides = dict(request.db.query(expired, func.count(BuildrootOverride.id))
+                         .join(BuildrootOverride.build)
+                         .join(Build.release)
+                         .filter(Release.name == name)
+                         .group_by(expired))
+        stats['num_active_overrides'] = overrides.get(False, 0)
+        stats['num_expired_overrides'] = overrides.get(True, 0)
+        return stats
+
+    return work(name)
 
 
 @release.get(accept=('application/json', 'text/json'), renderer='json',
@@ -231,6 +202,7 @@ def query_releases_json(request):
             pages: The total number of pages.
             rows_per_page: The number of rown on a page.
             total: The number of matching results.
+            next_cursor: The cursor of the next page, or None on the last page.
     """
     db = request.db
     data = request.validated
@@ -253,24 +225,11 @@ def query_releases_json(request):
         query = query.join(Release.builds).join(Build.package)
         query = query.filter(or_(*[RpmPackage.id == p.id for p in packages]))
 
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(Release.id))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    releases, pagination = paginate(request, query, [Release.id], Release.id)
 
     return dict(
-        releases=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        releases=releases,
+        **pagination
     )
 
 
@@ -320,4 +279,7 @@ def save_release(request):
     request.db.add(r)
     request.db.flush()
 
+    # The front page and the candidate build lookups are computed from the releases.
+    invalidate_cache_on_commit(request.db, 'home', 'latest_candidates', 'release_stats')
+
     return r
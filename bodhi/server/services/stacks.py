@@ -18,18 +18,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """Define web services that pertain to Stacks."""
 
-import math
 
 from cornice import Service
 from pyramid.exceptions import HTTPForbidden
 from pyramid.view import view_config
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server import log, notifications
 from bodhi.server.config import config
 from bodhi.server.models import RpmPackage, Stack, Group, User
-from bodhi.server.util import tokenize
+from bodhi.server.util import paginate, tokenize
 from bodhi.server.validators import validate_packages, validate_stack, validate_requirements
 import bodhi.server.schemas
 import bodhi.server.security
@@ -84,11 +82,11 @@ def query_stacks(request):
     Returns:
         dict: A dictionary with the following keys: "stacks" indexing a list of Stacks that match
             the query, "page" indexing the current page, "pages" indexing the total number of pages,
-            "rows_per_page" indexing how many rows are in a page, and "total" indexing the total
-            number of matched Stacks.
+            "rows_per_page" indexing how many rows are in a page, "total" indexing the total
+            number of matched Stacks, and "next_cursor" indexing the cursor of the next page.
     """
     data = request.validated
-    query = request.db.query(Stack).order_by(Stack.name.desc())
+    query = request.db.query(Stack)
 
     name = data.get('name')
     if name:
@@ -103,24 +101,12 @@ def query_stacks(request):
         query = query.join(RpmPackage.stack)
         query = query.filter(or_(*[RpmPackage.name == pkg.name for pkg in packages]))
 
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(Stack.id))])\
-        .order_by(None)
-    total = request.db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    stacks, pagination = paginate(
+        request, query, [Stack.name, Stack.id], Stack.id, descending=True)
 
     return dict(
-        stacks=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        stacks=stacks,
+        **pagination
     )
 
 
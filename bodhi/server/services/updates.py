@@ -19,10 +19,8 @@
 """Defines service endpoints pertaining to Updates."""
 
 import copy
-import math
 
 from cornice import Service
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server import log
@@ -38,10 +36,12 @@ from bodhi.server.models import (
     Package,
 )
 import bodhi.server.schemas
+import bodhi.server.search
 import bodhi.server.security
 import bodhi.server.services.errors
 import bodhi.server.util
 from bodhi.server.validators import (
+    prefetch_buildinfo,
     validate_nvrs,
     validate_uniqueness,
     validate_build_tags,
@@ -226,6 +226,7 @@ def query_updates(request):
             pages: The total number of pages.
             rows_per_page: How many results on on the page.
             total: The total number of updates matching the query.
+            next_cursor: The cursor of the next page, or None on the last page.
             package: The package corresponding to the first update found in the search.
     """
     db = request.db
@@ -260,10 +261,12 @@ def query_updates(request):
             Update.title.like('%%%s%%' % like)
         ]))
 
+    rank = None
     search = data.get('search')
     if search is not None:
-        query = query.filter(or_(Update.title.ilike('%%%s%%' % search),
-                                 Update.alias.ilike('%%%s%%' % search)))
+        criterion, rank = bodhi.server.search.match(db, Update, search)
+        bug_criterion = bodhi.server.search.match(db, Bug, search)[0]
+        query = query.filter(or_(criterion, Update.bugs.any(bug_criterion)))
 
     locked = data.get('locked')
     if locked is not None:
@@ -357,30 +360,17 @@ def query_updates(request):
     if alias is not None:
         query = query.filter(or_(*[Update.alias == a for a in alias]))
 
-    query = query.order_by(Update.date_submitted.desc())
-
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(Update.id))])\
-        .order_by(None)
-    total = db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    query = query.options(*Update.json_load_options(data.get('fields'), data.get('exclude')))
+    updates, pagination = bodhi.server.util.paginate(
+        request, query, [Update.date_submitted, Update.id], Update.id, descending=True, rank=rank)
 
     return dict(
-        updates=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        updates=updates,
         chrome=data.get('chrome'),
         display_user=data.get('display_user', False),
         display_request=data.get('display_request', True),
         package=package,
+        **pagination
     )
 
 
@@ -388,6 +378,7 @@ def query_updates(request):
               permission='create', renderer='json',
               error_handler=bodhi.server.services.errors.json_handler,
               validators=(
+                  prefetch_buildinfo,
                   validate_nvrs,
                   validate_builds,
                   validate_uniqueness,
@@ -17,14 +17,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """Defines API services that pertain to users."""
-import math
 
 from cornice import Service
 from pyramid.exceptions import HTTPNotFound
-from sqlalchemy import func, distinct
 from sqlalchemy.sql import or_
 
 from bodhi.server.models import Group, RpmPackage, Update, User
+from bodhi.server.util import paginate
 from bodhi.server.validators import validate_updates, validate_packages, validate_groups
 import bodhi.server.schemas
 import bodhi.server.security
@@ -120,6 +119,7 @@ def query_users(request):
             pages: The total number of pages available.
             rows_per_page: The number of users on the page.
             total: The total number of users matching the search criteria.
+            next_cursor: The cursor of the next page, or None on the last page.
     """
     db = request.db
     data = request.validated
@@ -157,22 +157,9 @@ def query_users(request):
         query = query.join(User.packages)
         query = query.filter(or_(*[RpmPackage.id == p.id for p in packages]))
 
-    # We can't use ``query.count()`` here because it is naive with respect to
-    # all the joins that we're doing above.
-    count_query = query.with_labels().statement\
-        .with_only_columns([func.count(distinct(User.id))])\
-        .order_by(None)
-    total = request.db.execute(count_query).scalar()
-
-    page = data.get('page')
-    rows_per_page = data.get('rows_per_page')
-    pages = int(math.ceil(total / float(rows_per_page)))
-    query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
+    users, pagination = paginate(request, query, [User.id], User.id)
 
     return dict(
-        users=query.all(),
-        page=page,
-        pages=pages,
-        rows_per_page=rows_per_page,
-        total=total,
+        users=users,
+        **pagination
     )
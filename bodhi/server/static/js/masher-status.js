@@ -25,14 +25,67 @@ $(document).ready(function() {
     var hollaback = function(data) {
         $('.spinner').remove();
         var last = null;
+        // The messages are newest first, so a repo whose mashing message comes before any
+        // complete message is still being mashed.
+        var done = {};
+        var mashing = [];
         $.each(data.raw_messages, function(i, msg) {
+            if (msg.topic == complete_topic) {
+                done[msg.msg.repo] = true;
+            } else if (msg.topic == mashing_topic && !done[msg.msg.repo]) {
+                done[msg.msg.repo] = true;
+                mashing.push(msg.msg.repo);
+            }
             last = ellipsis(last, msg);
             handler = handlers[msg.topic];
             handler(msg);
         });
+        if (mashing.length > 0) {
+            show_progress(mashing);
+        }
     };
 });
 
+// The progress messages are too many to be part of the history, which would push the other
+// messages off the page, so only the latest one of each repo that is being mashed is shown.
+var show_progress = function(repos) {
+    $(selector).prepend('<div id="mash-progress"></div>');
+    $.each(repos, function(i, repo) {
+        var data = $.param({
+            'delta': 1000000,  // 12 days
+            'rows_per_page': 1,
+            'order': 'desc',
+            'topic': progress_topic,
+            'contains': '"' + repo + '"',
+        }, true);
+        $.ajax({
+            url: "https://apps.fedoraproject.org/datagrepper/raw/",
+            data: data,
+            dataType: "jsonp",
+            success: function(data) {
+                $.each(data.raw_messages, function(j, msg) {
+                    progress_handler(msg);
+                });
+            },
+            error: function(data, statusCode) {
+                console.log("Status code: " + statusCode);
+                console.log(data);
+            }
+        });
+    });
+};
+
+var progress_handler = function(msg) {
+    var time = moment(msg.timestamp.toString(), '%X');
+    var line = $('<p class="text-muted"></p>');
+    line.append($('<strong></strong>').text(msg.msg.repo));
+    line.append(document.createTextNode(
+        ' is mashing, ' + msg.msg.lines + ' lines of output so far: '));
+    line.append($('<code></code>').text(msg.msg.line));
+    line.append($('<small></small>').text(' ' + time.fromNow()));
+    $('#mash-progress').append(line);
+};
+
 var ellipsis = function(last, msg) {
     var time = moment(msg.timestamp.toString(), '%X');
     if (last == null) {
@@ -116,4 +169,9 @@ handlers = {
     'org.fedoraproject.prod.bodhi.mashtask.mashing': simple_handler,
     'org.fedoraproject.prod.bodhi.mashtask.complete': simple_handler,
 
+    // The progress is queried apart, see show_progress().
 };
+
+var mashing_topic = 'org.fedoraproject.prod.bodhi.mashtask.mashing';
+var complete_topic = 'org.fedoraproject.prod.bodhi.mashtask.complete';
+var progress_topic = 'org.fedoraproject.prod.bodhi.mashtask.progress';
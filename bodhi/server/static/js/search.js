@@ -7,7 +7,7 @@ $(document).ready(function() {
         queryTokenizer: Bloodhound.tokenizers.whitespace,
         remote: {
             wildcard: '%QUERY',
-            url: 'packages/?search=%QUERY',
+            url: 'packages/?search=%QUERY&total=false',
             transform: function(response) { return response.packages; },
         }
     });
@@ -16,7 +16,7 @@ $(document).ready(function() {
         queryTokenizer: Bloodhound.tokenizers.whitespace,
         remote: {
             wildcard: '%QUERY',
-            url: 'updates/?search=%QUERY',
+            url: 'updates/?search=%QUERY&total=false&fields=title,alias',
             transform: function(response) { return response.updates; },
         }
     });
@@ -34,7 +34,7 @@ $(document).ready(function() {
         queryTokenizer: Bloodhound.tokenizers.whitespace,
         remote: {
             wildcard: '%QUERY',
-            url: 'overrides/?search=%QUERY',
+            url: 'overrides/?search=%QUERY&total=false&fields=nvr',
             transform: function(response) { return response.overrides; },
         }
     });
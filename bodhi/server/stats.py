@@ -0,0 +1,127 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Measure the work done by a thread, such as a stage of a masher thread.
+
+The counters are kept per thread, so the masher threads that run at once don't count each
+other's work. Koji calls are counted by the sessions that :func:`bodhi.server.buildsys.koji_login`
+creates, and database queries by every SQLAlchemy engine.
+"""
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+_counters = threading.local()
+
+
+def count(name, amount=1):
+    """
+    Add to one of the calling thread's counters.
+
+    Args:
+        name (str): The name of the counter, such as 'koji_calls'.
+        amount (int): How much to add to the counter.
+    """
+    setattr(_counters, name, getattr(_counters, name, 0) + amount)
+
+
+def get(name):
+    """
+    Return the value of one of the calling thread's counters.
+
+    Args:
+        name (str): The name of the counter.
+    Returns:
+        int: The value of the counter, which is 0 if nothing was counted yet.
+    """
+    return getattr(_counters, name, 0)
+
+
+def bytes_written():
+    """
+    Return how many bytes the calling thread has written so far.
+
+    This is read from the I/O accounting of Linux, and doesn't include the bytes written by the
+    subprocesses that the thread runs.
+
+    Returns:
+        int: The bytes the thread has passed to write() and its kin, or None if it isn't known.
+    """
+    try:
+        with open('/proc/thread-self/io') as io:
+            for line in io:
+                name, value = line.split(':', 1)
+                if name == 'wchar':
+                    return int(value)
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count a database query for the calling thread."""
+    count('db_queries')
+
+
+class Timer(object):
+    """
+    A context manager that measures the work the calling thread does in its block.
+
+    Attributes:
+        seconds (float): The wall time the block took.
+        koji_calls (int): How many calls the block made to Koji.
+        db_queries (int): How many queries the block sent to the database.
+        bytes_written (int): How many bytes the block wrote, or None if it isn't known.
+    """
+
+    def __init__(self):
+        """Initialize the timer."""
+        self.seconds = None
+        self.koji_calls = None
+        self.db_queries = None
+        self.bytes_written = None
+
+    def __enter__(self):
+        """
+        Take a snapshot of the counters.
+
+        Returns:
+            Timer: This timer.
+        """
+        self._start = (time.time(), get('koji_calls'), get('db_queries'), bytes_written())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Work out how much the counters went up in the block, without handling exceptions."""
+        start, koji_calls, db_queries, written = self._start
+        self.seconds = time.time() - start
+        self.koji_calls = get('koji_calls') - koji_calls
+        self.db_queries = get('db_queries') - db_queries
+        end = bytes_written()
+        if written is not None and end is not None:
+            self.bytes_written = end - written
+
+    def as_dict(self):
+        """
+        Return the measurements as a dictionary that can be serialized to JSON.
+
+        Returns:
+            dict: The attributes of the timer, by name.
+        """
+        return {'seconds': round(self.seconds, 3), 'koji_calls': self.koji_calls,
+                'db_queries': self.db_queries, 'bytes_written': self.bytes_written}
@@ -18,18 +18,27 @@ Random functions that don't fit elsewhere
 
 from collections import defaultdict
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import atexit
+import base64
 import collections
 import functools
 import hashlib
+import math
 import os
 import pkg_resources
 import socket
 import subprocess
 import tempfile
+import threading
+import time
 import urllib
 
 from kitchen.iterutils import iterate
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.i18n import TranslationStringFactory
+from sqlalchemy import and_, distinct, func, or_
 import arrow
 import bleach
 import colander
@@ -52,14 +61,85 @@ def header(x):
     return u"%s\n     %s\n%s\n" % ('=' * 80, x, '=' * 80)
 
 
-def get_rpm_header(nvr, tries=0):
-    """ Get the rpm header for a given build """
+# The fields of the RPM headers that get_rpm_header() returns
+RPM_HEADERS = [
+    'name', 'summary', 'version', 'release', 'url', 'description',
+    'changelogtime', 'changelogname', 'changelogtext',
+]
+
+# How many headers prefetch_rpm_headers() requests in each Koji multicall
+RPM_HEADER_PREFETCH_CHUNK_SIZE = 100
+
+# The RPM header cache, created by get_rpm_header_cache()
+_rpm_header_cache = None
+_rpm_header_cache_lock = threading.Lock()
+
+
+def get_rpm_header(nvr):
+    """
+    Get the rpm header for a given build, from the RPM header cache if possible.
+
+    Args:
+        nvr (basestring): The NVR of the build.
+    Returns:
+        dict: The RPM_HEADERS of the build's source RPM.
+    Raises:
+        ValueError: If Koji has no headers for the build.
+    """
+    return get_rpm_header_cache().get(nvr)
+
+
+def prefetch_rpm_headers(nvrs):
+    """
+    Fetch the RPM headers of the given builds that aren't cached yet, with Koji multicalls.
+
+    Failures are only logged, since get_rpm_header() will try to fetch those headers again.
+
+    Args:
+        nvrs (list): The NVRs of the builds.
+    """
+    cache = get_rpm_header_cache()
+    missing = sorted(set([nvr for nvr in nvrs if not cache.has(nvr)]))
+    koji_session = buildsys.get_session()
+    for i in range(0, len(missing), RPM_HEADER_PREFETCH_CHUNK_SIZE):
+        chunk = missing[i:i + RPM_HEADER_PREFETCH_CHUNK_SIZE]
+        try:
+            koji_session.multicall = True
+            for nvr in chunk:
+                koji_session.getRPMHeaders(rpmID=nvr + '.src', headers=RPM_HEADERS)
+            results = koji_session.multiCall()
+        except Exception:
+            koji_session.multicall = False
+            log.exception('Unable to prefetch the rpm headers of %r from koji', chunk)
+            continue
+        for nvr, result in zip(chunk, results):
+            # Successful calls are [result], failed ones are fault dicts.
+            if isinstance(result, list) and result[0]:
+                cache.put(nvr, result[0])
+    log.debug('Prefetched the rpm headers of %d builds', len(missing))
+
+
+def get_rpm_header_cache():
+    """
+    Return the RPM header cache, creating it if needed.
+
+    Returns:
+        RpmHeaderCache: The cache, configured with the rpm_header_cache.* settings.
+    """
+    global _rpm_header_cache
+    with _rpm_header_cache_lock:
+        if _rpm_header_cache is None:
+            _rpm_header_cache = RpmHeaderCache(
+                _fetch_rpm_header, size=config.get('rpm_header_cache.size'),
+                directory=config.get('rpm_header_cache.dir'))
+        return _rpm_header_cache
+
+
+def _fetch_rpm_header(nvr, tries=0):
+    """ Get the rpm header for a given build from Koji """
 
     tries += 1
-    headers = [
-        'name', 'summary', 'version', 'release', 'url', 'description',
-        'changelogtime', 'changelogname', 'changelogtext',
-    ]
+    headers = RPM_HEADERS
     rpmID = nvr + '.src'
     koji_session = buildsys.get_session()
     try:
@@ -69,7 +149,7 @@ def get_rpm_header(nvr, tries=0):
         log.warning(msg % (tries, nvr, str(e)))
         if tries < 3:
             # Try again...
-            return get_rpm_header(nvr, tries=tries)
+            return _fetch_rpm_header(nvr, tries=tries)
         else:
             # Give up for good and re-raise the failure...
             raise
@@ -148,6 +228,273 @@ class memoized(object):
         return functools.partial(self.__call__, obj)
 
 
+class TTLCache(object):
+    """
+    A thread-safe cache for the results of slow lookups, such as remote ACL queries.
+
+    Successful results are cached for ``ttl`` seconds. Once they expire they are still served for up
+    to ``stale_ttl`` more seconds while a background thread fetches a fresh value
+    (stale-while-revalidate). Failed lookups are cached for ``negative_ttl`` seconds, during which
+    the exception the lookup raised is raised again to every caller, so an outage of the remote
+    service doesn't cause a storm of requests to it.
+    """
+
+    def __init__(self):
+        """Initialize an empty cache."""
+        self._lock = threading.Lock()
+        # key -> (value, exception, expiration time, stale expiration time)
+        self._entries = {}
+        self._refreshing = set()
+
+    def get(self, key, loader, ttl, negative_ttl=0, stale_ttl=0):
+        """
+        Return the cached value for key, calling loader to fetch it if needed.
+
+        Args:
+            key (hashable): The key to look up.
+            loader (callable): A callable that takes no arguments and returns the value for key.
+            ttl (int): How many seconds a successful result is fresh for.
+            negative_ttl (int): How many seconds a failed lookup is cached for.
+            stale_ttl (int): How many seconds an expired result may still be served for while it
+                is refreshed in the background.
+        Returns:
+            object: The value returned by loader.
+        Raises:
+            Exception: If loader raised an exception, now or within the last negative_ttl seconds.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None:
+            value, exception, expiration, stale_expiration = entry
+            if now < expiration:
+                return self._unpack(entry)
+            if exception is None and now < stale_expiration:
+                self._refresh(key, loader, ttl, negative_ttl, stale_ttl)
+                return value
+        return self._unpack(self._load(key, loader, ttl, negative_ttl, stale_ttl))
+
+    def warm(self, lookups, ttl, negative_ttl=0, stale_ttl=0, workers=8):
+        """
+        Concurrently fetch every given lookup that isn't already cached, and wait for them all.
+
+        Failures are cached like they are by :meth:`get`, but they are not raised.
+
+        Args:
+            lookups (list): A list of (key, loader) tuples, as they would be passed to :meth:`get`.
+            ttl (int): How many seconds a successful result is fresh for.
+            negative_ttl (int): How many seconds a failed lookup is cached for.
+            stale_ttl (int): How many seconds an expired result may still be served for.
+            workers (int): The most lookups to fetch at once.
+        """
+        def load(lookup):
+            key, loader = lookup
+            try:
+                self.get(key, loader, ttl, negative_ttl, stale_ttl)
+            except Exception:
+                pass
+
+        lookups = list(lookups)
+        if not lookups:
+            return
+        pool = ThreadPool(min(workers, len(lookups)))
+        try:
+            pool.map(load, lookups)
+        finally:
+            pool.close()
+            pool.join()
+
+    def invalidate(self, key):
+        """
+        Forget the cached value for key.
+
+        Args:
+            key (hashable): The key to forget.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget every cached value."""
+        with self._lock:
+            self._entries.clear()
+
+    def _load(self, key, loader, ttl, negative_ttl, stale_ttl):
+        """
+        Call loader and cache its result or exception under key.
+
+        Returns:
+            tuple: The new cache entry.
+        """
+        try:
+            value, exception = loader(), None
+        except Exception as e:
+            value, exception = None, e
+        now = time.time()
+        if exception is None:
+            entry = (value, None, now + ttl, now + ttl + stale_ttl)
+        else:
+            entry = (None, exception, now + negative_ttl, now + negative_ttl)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def _refresh(self, key, loader, ttl, negative_ttl, stale_ttl):
+        """Reload key in a background thread, unless that is already happening."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                value = loader()
+            except Exception:
+                # Keep serving the stale value rather than replacing it with an error.
+                log.warning('Unable to refresh cached value for %r', key, exc_info=True)
+            else:
+                now = time.time()
+                with self._lock:
+                    self._entries[key] = (value, None, now + ttl, now + ttl + stale_ttl)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _unpack(entry):
+        """Return the value of a cache entry, or raise its exception."""
+        value, exception, expiration, stale_expiration = entry
+        if exception is not None:
+            raise exception
+        return value
+
+
+class RpmHeaderCache(object):
+    """
+    A thread-safe cache of the RPM headers of builds, by NVR.
+
+    The headers of a build never change once it is built, so they are never expired. The most
+    recently used headers are kept in memory, and all of them can also be kept on disk, so they
+    survive restarts and are shared by the processes that use the same directory.
+    """
+
+    def __init__(self, fetch, size=256, directory=None):
+        """
+        Initialize the cache.
+
+        Args:
+            fetch (callable): Called with an NVR to fetch its headers when they aren't cached.
+            size (int): How many headers to keep in memory.
+            directory (basestring): The directory to keep the headers in on disk, or None to only
+                keep them in memory.
+        """
+        self.fetch = fetch
+        self.size = size
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._headers = collections.OrderedDict()
+
+    def get(self, nvr):
+        """
+        Return the headers of the given build, fetching them if they aren't cached.
+
+        Args:
+            nvr (basestring): The NVR of the build.
+        Returns:
+            dict: The headers of the build.
+        """
+        with self._lock:
+            headers = self._headers.pop(nvr, None)
+            if headers is not None:
+                self._headers[nvr] = headers
+                return headers
+        headers = self._read(nvr)
+        if headers is None:
+            headers = self.fetch(nvr)
+            self._write(nvr, headers)
+        self._remember(nvr, headers)
+        return headers
+
+    def has(self, nvr):
+        """
+        Return whether the headers of the given build are cached, in memory or on disk.
+
+        Args:
+            nvr (basestring): The NVR of the build.
+        Returns:
+            bool: True if get() won't need to fetch the headers.
+        """
+        with self._lock:
+            if nvr in self._headers:
+                return True
+        return self._path(nvr) is not None and os.path.exists(self._path(nvr))
+
+    def put(self, nvr, headers):
+        """
+        Cache the given headers of the given build.
+
+        Args:
+            nvr (basestring): The NVR of the build.
+            headers (dict): The headers of the build.
+        """
+        self._write(nvr, headers)
+        self._remember(nvr, headers)
+
+    def clear(self):
+        """Forget the headers that are in memory."""
+        with self._lock:
+            self._headers.clear()
+
+    def _remember(self, nvr, headers):
+        """Keep the given headers in memory, forgetting the least recently used ones if needed."""
+        with self._lock:
+            self._headers.pop(nvr, None)
+            self._headers[nvr] = headers
+            while len(self._headers) > self.size:
+                self._headers.popitem(last=False)
+
+    def _path(self, nvr):
+        """Return the path of the headers of the given build on disk, or None."""
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, '%s.json' % nvr)
+
+    def _read(self, nvr):
+        """Return the headers of the given build from the disk, or None if they aren't there."""
+        path = self._path(nvr)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as headers:
+                return json.load(headers)
+        except (IOError, ValueError):
+            log.warning('Ignoring the unreadable cached rpm headers %s', path, exc_info=True)
+            return None
+
+    def _write(self, nvr, headers):
+        """Write the headers of the given build to the disk, if there is a directory."""
+        path = self._path(nvr)
+        if path is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            data = json.dumps(headers)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.%s' % nvr)
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except (OSError, IOError, TypeError, ValueError, UnicodeDecodeError):
+            # Headers that aren't valid UTF-8 can't be serialized, so they are only kept in memory.
+            log.warning('Unable to cache the rpm headers of %s in %s', nvr, self.directory,
+                        exc_info=True)
+
+
 @memoized
 def get_critpath_components(collection='master', component_type='rpm'):
     """ Return a list of critical path packages for a given collection.
@@ -238,7 +585,7 @@ def avatar(context, username, size):
     request = context['request']
     https = request.registry.settings.get('prefer_ssl'),
 
-    @request.cache.cache_on_arguments()
+    @request.cache.cache_on_arguments(namespace='avatar')
     def work(username, size):
         openid = "http://%s.id.fedoraproject.org/" % username
         if config.get('libravatar_enabled'):
@@ -560,13 +907,180 @@ def pages_list(context, page, pages):
     return range(min_page, max_page + 1)
 
 
+def cursor_url(context, cursor):
+    """
+    Return the URL of the current page of results with the given cursor instead of a page number.
+
+    Args:
+        context (mako.runtime.Context): The template context, with the current request.
+        cursor (str): The pagination cursor.
+    Returns:
+        str: The URL.
+    """
+    request = context.get('request')
+    params = dict(request.params)
+    params.pop('page', None)
+    params['cursor'] = cursor
+    return request.path_url + "?" + urllib.urlencode(params)
+
+
 def page_url(context, page):
     request = context.get('request')
     params = dict(request.params)
+    params.pop('cursor', None)
     params['page'] = page
     return request.path_url + "?" + urllib.urlencode(params)
 
 
+CURSOR_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """
+    Return an opaque pagination cursor for the given key values of the last result on a page.
+
+    Args:
+        values (list): The values of the key columns of the result. They may be integers, strings
+            or datetimes.
+    Returns:
+        str: The URL safe cursor.
+    """
+    values = [{'datetime': v.strftime(CURSOR_DATETIME_FORMAT)} if isinstance(v, datetime) else v
+              for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')))
+
+
+def decode_cursor(cursor):
+    """
+    Return the key values that the given pagination cursor was encoded from.
+
+    Args:
+        cursor (basestring): A cursor returned by :func:`encode_cursor`.
+    Returns:
+        list: The key values.
+    Raises:
+        ValueError: If the cursor was not returned by :func:`encode_cursor`.
+    """
+    def object_hook(obj):
+        return datetime.strptime(obj['datetime'], CURSOR_DATETIME_FORMAT)
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)), object_hook=object_hook)
+    except (TypeError, KeyError, UnicodeError) as e:
+        raise ValueError(str(e))
+    if not isinstance(values, list) or not all(
+            isinstance(v, (int, long, basestring, datetime)) for v in values):
+        raise ValueError('%r is not a list of key values' % (values,))
+    return values
+
+
+def check_cursor(cursor, key):
+    """
+    Make sure that the given decoded cursor holds a value of the right type for each key column.
+
+    Args:
+        cursor (list): The key values returned by :func:`decode_cursor`.
+        key (list): The columns that the results are ordered by.
+    Raises:
+        ValueError: If the cursor was made for other key columns.
+    """
+    if len(cursor) != len(key):
+        raise ValueError('%d key values were given instead of %d' % (len(cursor), len(key)))
+    for column, value in zip(key, cursor):
+        python_type = column.type.python_type
+        if issubclass(python_type, basestring):
+            python_type = basestring
+        elif issubclass(python_type, (int, long)):
+            python_type = (int, long)
+        if isinstance(value, bool) or not isinstance(value, python_type):
+            raise ValueError('%r is not a valid value for %s' % (value, column.key))
+
+
+def paginate(request, query, key, count_column, descending=False, rank=None):
+    """
+    Return one page of the results of the given query, and how to get the other pages.
+
+    The page is selected with either the ``page`` number or the ``cursor`` of the request data. A
+    cursor stands for the last result of the previous page, so the database can seek straight to
+    the next page with the index on the key columns instead of skipping all the results of the
+    previous pages. The matching results are only counted if the ``total`` parameter is true,
+    which it is by default when no cursor is given.
+
+    A cursor that was made for other key columns is reported as an error of the request, which
+    gets no results.
+
+    Args:
+        request (pyramid.request.Request): The current request, whose validated data has the
+            "page", "rows_per_page", "cursor" and "total" keys of the
+            :class:`bodhi.server.schemas.PaginatedSchema`.
+        query (sqlalchemy.orm.query.Query): The filtered query to page through, without any
+            ordering.
+        key (list): The columns that the results are ordered by, which must be unique together.
+        count_column (sqlalchemy.sql.expression.ColumnElement): The column whose distinct values
+            are counted.
+        descending (bool): Whether to order the results from the greatest key.
+        rank (sqlalchemy.sql.expression.ColumnElement or None): If given, numbered pages are
+            ordered by this expression first, such as the relevance of search results. They have
+            no next cursor then, since cursors only follow the key order.
+    Returns:
+        tuple: A 2-tuple of the results on the page and a dictionary with the "page", "pages",
+            "rows_per_page", "total" and "next_cursor" keys. "page" is None if a cursor was
+            given, and "pages" and "total" are None if the results were not counted.
+            "next_cursor" is None on the last page.
+    """
+    data = request.validated
+    rows_per_page = data.get('rows_per_page')
+    cursor = data.get('cursor')
+    if cursor is not None:
+        try:
+            check_cursor(cursor, key)
+        except ValueError as e:
+            request.errors.add('querystring', 'cursor', 'Invalid cursor: %s' % e)
+            request.errors.status = HTTPBadRequest.code
+            return [], dict(page=None, pages=None, rows_per_page=rows_per_page, total=None,
+                            next_cursor=None)
+    count = data.get('total')
+    if count is None:
+        count = cursor is None
+
+    total = pages = None
+    if count:
+        # We can't use ``query.count()`` here because it is naive with respect to
+        # all the joins that the services do.
+        count_query = query.with_labels().statement\
+            .with_only_columns([func.count(distinct(count_column))])\
+            .order_by(None)
+        total = request.db.execute(count_query).scalar()
+        pages = int(math.ceil(total / float(rows_per_page)))
+
+    ranked = rank is not None and cursor is None
+    if ranked:
+        query = query.order_by(rank)
+    query = query.order_by(*[column.desc() if descending else column for column in key])
+    if cursor is None:
+        page = data.get('page')
+        query = query.offset(rows_per_page * (page - 1))
+    else:
+        page = None
+        # Rows come after the cursor if their first key column that differs from it is past it.
+        clauses = []
+        for i, (column, value) in enumerate(zip(key, cursor)):
+            past = column < value if descending else column > value
+            clauses.append(and_(*[c == v for c, v in zip(key[:i], cursor[:i])] + [past]))
+        query = query.filter(or_(*clauses))
+
+    # Fetch one extra row to know whether there is a next page.
+    results = query.limit(rows_per_page + 1).all()
+    next_cursor = None
+    if len(results) > rows_per_page:
+        results = results[:rows_per_page]
+        if not ranked:
+            next_cursor = encode_cursor([getattr(results[-1], column.key) for column in key])
+
+    return results, dict(page=page, pages=pages, rows_per_page=rows_per_page, total=total,
+                         next_cursor=next_cursor)
+
+
 def bug_link(context, bug, short=False):
     url = "https://bugzilla.redhat.com/show_bug.cgi?id=" + str(bug.bug_id)
     display = "#%i" % bug.bug_id
@@ -634,26 +1148,137 @@ def sorted_updates(updates):
     return sync, async
 
 
-def cmd(cmd, cwd=None):
+# How many of the last lines of each output stream cmd() keeps, to return them
+CMD_TAIL_LINES = 200
+# The longest line of output that cmd() reads at once; longer lines are split
+CMD_MAX_LINE_LENGTH = 64 * 1024
+# How many lines of output cmd() logs each second; the others are only counted
+CMD_LOG_LINES_PER_SECOND = 50
+
+
+def cmd(cmd, cwd=None, progress=None):
+    """
+    Run the given command, and log its output line by line as it runs.
+
+    Only the last CMD_TAIL_LINES lines of each output stream are kept in memory, so the output of
+    long commands such as mash isn't held in RAM. The lines are logged at the debug level, up to
+    CMD_LOG_LINES_PER_SECOND a second, and the end of stderr is logged as an error if the command
+    fails.
+
+    Args:
+        cmd (list or basestring): The command to run, and its arguments.
+        cwd (basestring): The directory to run the command in.
+        progress (callable): If given, this is called with the name of the stream ('stdout' or
+            'stderr') and each line of output as it is read. It is called from the threads that
+            read the streams, so it should be quick.
+    Returns:
+        tuple: A 3-tuple of the last lines of stdout, the last lines of stderr, and the exit code
+            of the command.
+    """
     log.info('Running %r', cmd)
     if isinstance(cmd, basestring):
         cmd = cmd.split()
     p = subprocess.Popen(cmd, cwd=cwd,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if out:
-        log.debug(out)
-    if err:
-        if p.returncode == 0:
-            log.debug(err)
-        else:
-            log.error(err)
+    output_log = _RateLimitedLog(CMD_LOG_LINES_PER_SECOND)
+    tails = {}
+    readers = []
+    for name, stream in (('stdout', p.stdout), ('stderr', p.stderr)):
+        tails[name] = collections.deque(maxlen=CMD_TAIL_LINES)
+        reader = threading.Thread(target=_read_output,
+                                  args=(name, stream, tails[name], output_log, progress))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+    p.wait()
+    output_log.flush()
+
+    out = ''.join(tails['stdout'])
+    err = ''.join(tails['stderr'])
     if p.returncode != 0:
+        if err:
+            log.error(err)
         log.error('return code %s', p.returncode)
     return out, err, p.returncode
 
 
+def _read_output(name, stream, tail, output_log, progress):
+    """
+    Read one of the output streams of a command run by cmd(), until it is closed.
+
+    Args:
+        name (str): 'stdout' or 'stderr'.
+        stream (file): The stream to read.
+        tail (collections.deque): Each line is appended to this, which should be bounded.
+        output_log (_RateLimitedLog): Each line is logged with this.
+        progress (callable): The progress callback given to cmd(), or None.
+    """
+    for line in iter(lambda: stream.readline(CMD_MAX_LINE_LENGTH), ''):
+        tail.append(line)
+        output_log.debug(line.rstrip('\n'))
+        if progress is not None:
+            try:
+                progress(name, line)
+            except Exception:
+                # Stopping here would leave the command blocked on a full pipe
+                log.exception('The progress callback of the command failed')
+    stream.close()
+
+
+class _RateLimitedLog(object):
+    """
+    Log lines at the debug level, up to a number of lines each second.
+
+    The lines that are over the limit are counted, and the count is logged instead.
+    """
+
+    def __init__(self, lines_per_second):
+        """
+        Initialize the log.
+
+        Args:
+            lines_per_second (int): How many lines to log each second.
+        """
+        self.lines_per_second = lines_per_second
+        self._lock = threading.Lock()
+        self._second = None
+        self._logged = 0
+        self._skipped = 0
+
+    def debug(self, line):
+        """
+        Log the given line, unless too many were logged this second.
+
+        Args:
+            line (basestring): The line to log.
+        """
+        with self._lock:
+            second = int(time.time())
+            if second != self._second:
+                self._flush()
+                self._second = second
+                self._logged = 0
+            if self._logged < self.lines_per_second:
+                self._logged += 1
+                log.debug(line)
+            else:
+                self._skipped += 1
+
+    def flush(self):
+        """Log how many lines were not logged, if there were any."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """Log how many lines were not logged, if there were any. The lock must be held."""
+        if self._skipped:
+            log.debug('%d more lines of output were not logged', self._skipped)
+            self._skipped = 0
+
+
 def tokenize(string):
     """ Given something like "a b, c d" return ['a', 'b', 'c', 'd']. """
 
@@ -729,6 +1354,194 @@ class TransactionalSessionMaker(object):
 transactional_session_maker = TransactionalSessionMaker
 
 
+class ClaimConflict(Exception):
+    """Raised by Drainer._claim() to roll back a claim, when another process claimed first."""
+
+
+class Drainer(object):
+    """
+    Deliver the messages of a database outbox from a background thread.
+
+    The thread is started when the drainer is woken up, and exits once the outbox is empty. Each
+    process has its own drainer, and the processes claim the messages they deliver in the
+    database, so that the same message isn't delivered by two of them. A claimed message is due
+    again after claim_seconds, so that it is still delivered if the process that claimed it dies.
+    A message that can't be delivered is retried later, waiting twice as long after each failed
+    attempt.
+
+    Subclasses implement _claim(), _deliver(), _finish() and _next_attempt() for their outbox.
+
+    Attributes:
+        max_attempts (int): How many times to try delivering a message before giving up on it.
+        retry_delay (float): How many seconds to wait before the first retry of a message.
+        batch_size (int): How many messages to claim at once.
+        claim_seconds (int): How many seconds a process has to deliver the messages it claimed.
+        thread_name (str): The name of the drainer's thread.
+        failure_message (str): What is logged when the outbox can't be drained.
+    """
+
+    claim_seconds = 600
+    thread_name = 'Drainer'
+    failure_message = 'Unable to drain the outbox'
+
+    def __init__(self, max_attempts=10, retry_delay=60, batch_size=100, db_factory=None):
+        """
+        Initialize the drainer. Its thread is started by wake().
+
+        Args:
+            max_attempts (int): How many times to try delivering a message.
+            retry_delay (float): How many seconds to wait before the first retry of a message.
+            batch_size (int): How many messages to claim at once.
+            db_factory (callable): A TransactionalSessionMaker to use for the database, or None to
+                create one.
+        """
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        if db_factory is None:
+            db_factory = transactional_session_maker()
+        self.db_factory = db_factory
+        self._condition = threading.Condition()
+        self._woken = False
+        self._thread = None
+        self._closed_at_exit = False
+
+    def wake(self):
+        """Have the drainer's thread deliver the messages that are due, starting it if needed."""
+        with self._condition:
+            self._woken = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name)
+                self._thread.daemon = True
+                self._thread.start()
+            if not self._closed_at_exit:
+                # The thread is a daemon, so scripts would exit before it delivered their messages.
+                atexit.register(self.close)
+                self._closed_at_exit = True
+            self._condition.notify()
+
+    def close(self):
+        """Deliver the messages that are due before the process exits, if the drainer was woken."""
+        with self._condition:
+            if self._thread is None:
+                return
+        try:
+            self.drain()
+        except Exception:
+            log.exception(self.failure_message)
+
+    def _run(self):
+        """Deliver the messages as they are due, until the outbox is empty."""
+        while True:
+            try:
+                wait = self.drain()
+            except Exception:
+                log.exception(self.failure_message)
+                wait = self.retry_delay
+            with self._condition:
+                if not self._woken:
+                    if wait is None:
+                        self._thread = None
+                        return
+                    self._condition.wait(wait)
+                self._woken = False
+
+    def drain(self):
+        """
+        Deliver the messages of the outbox that are due.
+
+        Returns:
+            float: How many seconds until the next message is due, or None if the outbox is empty.
+        """
+        while True:
+            try:
+                messages = self._claim(datetime.utcnow())
+            except ClaimConflict:
+                log.debug('Another process claimed the messages of the outbox first')
+                break
+            if not messages:
+                break
+            delivered = self._deliver(messages)
+            self._finish(messages, delivered)
+            if delivered < len(messages) or len(messages) < self.batch_size:
+                break
+
+        with self.db_factory() as db:
+            next_attempt = self._next_attempt(db)
+        if next_attempt is None:
+            return None
+        return max((next_attempt - datetime.utcnow()).total_seconds(), 0)
+
+    def _claimed_until(self, now):
+        """
+        Return when the messages that are claimed now are due again.
+
+        Args:
+            now (datetime.datetime): The time of the claim.
+        Returns:
+            datetime.datetime: The time the claim expires.
+        """
+        return now + timedelta(seconds=self.claim_seconds)
+
+    def _retry_at(self, attempts):
+        """
+        Return when a message that failed the given number of times is due again.
+
+        Args:
+            attempts (int): How many times the message was attempted.
+        Returns:
+            datetime.datetime or None: When to retry the message, or None to give up on it.
+        """
+        if attempts >= self.max_attempts:
+            return None
+        return datetime.utcnow() + timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+
+    def _claim(self, now):
+        """
+        Claim the messages that are due, so that no other process delivers them.
+
+        Args:
+            now (datetime.datetime): The current time.
+        Returns:
+            list: The claimed messages, as dictionaries.
+        Raises:
+            ClaimConflict: If another process claimed some of the messages first.
+        """
+        raise NotImplementedError()
+
+    def _deliver(self, messages):
+        """
+        Deliver the given messages.
+
+        Args:
+            messages (list): The messages that _claim() returned.
+        Returns:
+            int: How many of the messages were delivered. The drain stops if it is not all of them.
+        """
+        raise NotImplementedError()
+
+    def _finish(self, messages, delivered):
+        """
+        Remove the delivered messages from the outbox, and schedule the others to be retried.
+
+        Args:
+            messages (list): The messages that _deliver() was given.
+            delivered (int): What _deliver() returned.
+        """
+        raise NotImplementedError()
+
+    def _next_attempt(self, db):
+        """
+        Return when the next message of the outbox is due.
+
+        Args:
+            db (sqlalchemy.orm.session.Session): The database session.
+        Returns:
+            datetime.datetime or None: The time, or None if the outbox is empty.
+        """
+        raise NotImplementedError()
+
+
 def sort_severity(value):
     """ Sorts UpdateSeverity by severity importance"""
     value_map = {
@@ -50,6 +50,7 @@ from .util import (
     splitter,
     tokenize,
     taskotron_results,
+    TTLCache,
 )
 from bodhi.server.config import config
 
@@ -59,6 +60,9 @@ the page open for a long time. Please reload the page and try to submit your
 data again. Make sure to save your input somewhere before reloading.
 """.replace('\n', ' ')
 
+#: Package ACLs fetched from the ACL system, shared by all requests in the process.
+acl_cache = TTLCache()
+
 
 # This one is a colander validator which is different from the cornice
 # validators defined elsehwere.
@@ -81,7 +85,50 @@ def cache_nvrs(request, build):
 
     request.buildinfo[build]['nvr'] = name, version, release
     # Cram some extra information in there, used later to infer type.
-    request.buildinfo[build]['info'] = request.koji.getBuild(build)
+    if 'info' not in request.buildinfo[build]:
+        request.buildinfo[build]['info'] = request.koji.getBuild(build)
+
+
+def prefetch_buildinfo(request):
+    """
+    Fetch the Koji build info and tags of all the submitted builds in a single multicall.
+
+    The results are stored in request.buildinfo, where cache_nvrs and validate_build_tags will find
+    them instead of asking Koji about each build one at a time. Builds that are not in
+    name-version-release format are skipped, and anything the multicall fails to fetch is left for
+    the other validators to fetch (and report errors about) individually.
+
+    Args:
+        request (pyramid.request): The current request.
+    """
+    builds = []
+    for build in request.validated.get('builds', []):
+        if '' in get_nvr(build):
+            continue
+        buildinfo = request.buildinfo[build]
+        if 'info' not in buildinfo or 'tags' not in buildinfo:
+            builds.append(build)
+    if not builds:
+        return
+
+    koji_session = request.koji
+    try:
+        koji_session.multicall = True
+        for build in builds:
+            koji_session.getBuild(build)
+            koji_session.listTags(build)
+        results = koji_session.multiCall()
+    except Exception:
+        log.exception('Unable to prefetch build info from Koji for %r', builds)
+        koji_session.multicall = False
+        return
+
+    # A successful multicall result is a single-element list, while a failed one is a fault dict.
+    for build, info, tags in zip(builds, results[::2], results[1::2]):
+        if isinstance(info, list):
+            request.buildinfo[build]['info'] = info[0]
+        if isinstance(tags, list):
+            request.buildinfo[build]['tags'] = [tag['name'] for tag in tags[0]]
 
 
 def validate_nvrs(request):
@@ -168,9 +215,11 @@ def validate_build_tags(request):
     for build in request.validated.get('builds', []):
         valid = False
         try:
-            tags = request.buildinfo[build]['tags'] = [
-                tag['name'] for tag in request.koji.listTags(build)
-            ]
+            tags = request.buildinfo[build].get('tags')
+            if tags is None:
+                tags = request.buildinfo[build]['tags'] = [
+                    tag['name'] for tag in request.koji.listTags(build)
+                ]
         except koji.GenericError:
             request.errors.add('body', 'builds',
                                'Invalid koji build: %s' % build)
@@ -228,6 +277,88 @@ def validate_tags(request):
                                'Invalid tag: %s' % tag_name)
 
 
+def _package_acls_lookup(acl_system, package, branch):
+    """
+    Return the acl_cache key and loader used to look up the ACLs of a package.
+
+    The loader works on a transient copy of the package, so it is safe to call from another thread
+    or after the request's database session has gone away.
+
+    Args:
+        acl_system (basestring): Either 'pkgdb' or 'pagure'.
+        package (Package): The package to look up.
+        branch (basestring): The branch of the release the package is being updated in.
+    Returns:
+        tuple: A (key, loader) tuple, as taken by :meth:`bodhi.server.util.TTLCache.get`.
+    """
+    key = (acl_system, package.type.value, package.name, branch)
+    package = type(package)(name=package.name)
+    if acl_system == 'pkgdb':
+        return key, lambda: package.get_pkg_pushers(branch, config)
+    return key, package.get_pkg_committers_from_pagure
+
+
+def _acl_cache_ttls():
+    """
+    Return the acl_cache expiration settings from the config.
+
+    Returns:
+        dict: Keyword arguments for :meth:`bodhi.server.util.TTLCache.get`.
+    """
+    return dict(ttl=config['acl_cache.ttl'], negative_ttl=config['acl_cache.negative_ttl'],
+                stale_ttl=config['acl_cache.stale_ttl'])
+
+
+def get_package_acls(acl_system, package, branch):
+    """
+    Return the ACLs of a package on a branch, from acl_cache if possible.
+
+    Args:
+        acl_system (basestring): Either 'pkgdb' or 'pagure'.
+        package (Package): The package to look up.
+        branch (basestring): The branch of the release the package is being updated in.
+    Returns:
+        tuple: The result of :meth:`Package.get_pkg_pushers` for pkgdb, or of
+            :meth:`Package.get_pkg_committers_from_pagure` for pagure.
+    """
+    key, loader = _package_acls_lookup(acl_system, package, branch)
+    return acl_cache.get(key, loader, **_acl_cache_ttls())
+
+
+def _prefetch_acls(request, acl_system, builds):
+    """
+    Concurrently warm acl_cache with the ACLs of all the packages in the given builds.
+
+    This is best effort. Builds whose package or release can't be determined are skipped, since
+    validate_acls will report them.
+
+    Args:
+        request (pyramid.request): The current request.
+        acl_system (basestring): Either 'pkgdb' or 'pagure'.
+        builds (list): A list of NVR strings or Build objects.
+    """
+    lookups = {}
+    for build in builds:
+        try:
+            if isinstance(build, Build):
+                package, release = build.package, build.update.release
+            else:
+                buildinfo = request.buildinfo[build]
+                package_class = ContentType.infer_content_class(
+                    base=Package, build=buildinfo['info'])
+                package = package_class(name=buildinfo['nvr'][0])
+                release = Release.from_tags(buildinfo.get('tags', []), request.db)
+            if package is None or release is None:
+                continue
+        except Exception:
+            continue
+        key, loader = _package_acls_lookup(acl_system, package, release.branch)
+        lookups[key] = loader
+
+    if len(lookups) > 1:
+        acl_cache.warm(lookups.items(), workers=config['acl_cache.workers'], **_acl_cache_ttls())
+
+
 def validate_acls(request):
     """Ensure this user has commit privs to these builds or is an admin"""
     if not request.user:
@@ -269,6 +400,13 @@ def validate_acls(request):
                            'unable to determine ACLs.')
         return
 
+    acl_system = config.get('acl_system')
+    user_groups = [group.name for group in user.groups]
+    if acl_system in ('pkgdb', 'pagure') and \
+            not set(user_groups) & set(config['admin_packager_groups']):
+        # Look up the ACLs of all the packages at once, rather than one by one in the loop below.
+        _prefetch_acls(request, acl_system, builds)
+
     for build in builds:
         # The whole point of the blocks inside this conditional is to determine
         # the "release" and "package" associated with the given build.  For raw
@@ -353,8 +491,6 @@ def validate_acls(request):
         # Now that we know the release and the package associated with this
         # build, we can ask our ACL system about it..
 
-        acl_system = config.get('acl_system')
-        user_groups = [group.name for group in user.groups]
         has_access = False
 
         # Allow certain groups to push updates for any package
@@ -382,8 +518,7 @@ def validate_acls(request):
 
         if acl_system == 'pkgdb':
             try:
-                people, groups = package.get_pkg_pushers(
-                    release.branch, config)
+                people, groups = get_package_acls(acl_system, package, release.branch)
                 committers, watchers = people
                 groups, notify_groups = groups
             except Exception, e:
@@ -395,7 +530,7 @@ def validate_acls(request):
                 return
         elif acl_system == 'pagure':
             try:
-                committers, groups = package.get_pkg_committers_from_pagure()
+                committers, groups = get_package_acls(acl_system, package, release.branch)
                 people = committers
             except RuntimeError as error:
                 # If it's a RuntimeError, then the error will be logged
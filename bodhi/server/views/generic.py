@@ -98,9 +98,9 @@ def get_latest_updates(request, critpath, security):
     return query.limit(5).all()
 
 
-def _get_status_counts(basequery, status):
+def _get_status_counts(counts, status):
     """
-    Return a dictionary with the counts of objects found in the basequery.
+    Return a dictionary with the counts of the updates with the given status.
 
     The return data is specified by total count, newpackage count, bugfix count, enhancement count,
     and security count. The dictionary keys will be named with the
@@ -114,25 +114,39 @@ def _get_status_counts(basequery, status):
         stable_security_total
 
     Args:
-        basequery (sqlalchemy.orm.query.Query):
-            The basequery of updates we want to count and further filter on.
+        counts (dict): The counts of the updates of a release, as returned by
+            :meth:`bodhi.server.models.Update.counts`.
         status (bodhi.server.models.UpdateStatus):
-            The update status we want to filter by in basequery
+            The update status we want the counts of.
     Return:
         dict: A dictionary describing the counts of the updates, as described above.
     """
-    basequery = basequery.filter(models.Update.status == status)
-    return {
-        '{}_updates_total'.format(status.description): basequery.count(),
-        '{}_newpackage_total'.format(status.description):
-            basequery.filter(models.Update.type == models.UpdateType.newpackage).count(),
-        '{}_bugfix_total'.format(status.description):
-            basequery.filter(models.Update.type == models.UpdateType.bugfix).count(),
-        '{}_enhancement_total'.format(status.description):
-            basequery.filter(models.Update.type == models.UpdateType.enhancement).count(),
-        '{}_security_total'.format(status.description):
-            basequery.filter(models.Update.type == models.UpdateType.security).count(),
+    status_counts = {
+        '{}_updates_total'.format(status.description):
+            sum(n for (s, t), n in counts.items() if s == status),
     }
+    for type_ in (models.UpdateType.newpackage, models.UpdateType.bugfix,
+                  models.UpdateType.enhancement, models.UpdateType.security):
+        key = '{}_{}_total'.format(status.description, type_.description)
+        status_counts[key] = counts.get((status, type_), 0)
+    return status_counts
+
+
+def _format_update_counts(counts):
+    """
+    Format the counts of the updates of a release for the templates.
+
+    Args:
+        counts (dict): The counts of the updates of a release, as returned by
+            :meth:`bodhi.server.models.Update.counts`.
+    Returns:
+        dict: A dictionary expressing the counts, as described in :func:`get_update_counts`.
+    """
+    formatted = {}
+    for status in (models.UpdateStatus.pending, models.UpdateStatus.testing,
+                   models.UpdateStatus.stable):
+        formatted.update(_get_status_counts(counts, status))
+    return formatted
 
 
 def get_update_counts(request, releaseid):
@@ -166,13 +180,8 @@ def get_update_counts(request, releaseid):
         dict: A dictionary expressing the counts, as described above.
     """
     release = models.Release.get(releaseid, request.db)
-    basequery = request.db.query(models.Update).filter(models.Update.release == release)
-    counts = {}
-    counts.update(_get_status_counts(basequery, models.UpdateStatus.pending))
-    counts.update(_get_status_counts(basequery, models.UpdateStatus.testing))
-    counts.update(_get_status_counts(basequery, models.UpdateStatus.stable))
-
-    return counts
+    counts = models.Update.counts(request.db, [release.name])
+    return _format_update_counts(counts[release.name])
 
 
 @view_config(route_name='home', renderer='home.html')
@@ -202,14 +211,16 @@ def home(request):
     """
     r = request
 
-    @request.cache.cache_on_arguments()
+    @request.cache.cache_on_arguments(namespace='home')
     def work():
         top_testers = get_top_testers(request)
         critpath_updates = get_latest_updates(request, True, False)
         security_updates = get_latest_updates(request, False, True)
-        release_updates_counts = {}
-        for release in request.releases['current'] + request.releases['pending']:
-            release_updates_counts[release["name"]] = get_update_counts(request, release["name"])
+        releases = [release['name'] for release in
+                    request.releases['current'] + request.releases['pending']]
+        release_updates_counts = dict(
+            (release, _format_update_counts(counts))
+            for release, counts in models.Update.counts(request.db, releases).items())
 
         return {
             "release_updates_counts": release_updates_counts,
@@ -265,7 +276,7 @@ def latest_candidates(request):
     koji = request.koji
     db = request.db
 
-    @request.cache.cache_on_arguments()
+    @request.cache.cache_on_arguments(namespace='latest_candidates')
     def work(pkg, testing):
         result = []
         koji.multicall = True
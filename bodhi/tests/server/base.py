@@ -23,7 +23,8 @@ from webtest import TestApp
 from sqlalchemy import event
 import mock
 
-from bodhi.server import bugs, buildsys, models, initialize_db, Session, config, main
+from bodhi.server import (bugs, buildsys, configure_cache_region, models, initialize_db, Session,
+                          config, main, util, validators)
 from bodhi.tests.server import create_update, populate
 
 
@@ -135,6 +136,9 @@ class BaseTestCase(unittest.TestCase):
         # Ensure "cached" objects are cleared before each test.
         models.Release._all_releases = None
         models.Release._tag_cache = None
+        validators.acl_cache.clear()
+        util._rpm_header_cache = None
+        configure_cache_region(self.app_settings)
 
         if engine is None:
             self.engine = _configure_test_db()
@@ -174,6 +178,11 @@ class BaseTestCase(unittest.TestCase):
         self._request_sesh = mock.patch('bodhi.server.get_db_session_for_request', request_db)
         self._request_sesh.start()
 
+        # The fedmsgs that tests commit are left in the outbox, rather than published by a relay
+        # thread that would use the database while the test does.
+        self._relay = mock.patch('bodhi.server.notifications.get_relay')
+        self._relay.start()
+
         # Create the test WSGI app one time. We should avoid creating too many
         # of these since Pyramid holds global references to the objects it creates
         # and this results in a substantial memory leak. Long term we should figure
@@ -208,6 +217,7 @@ class BaseTestCase(unittest.TestCase):
     def tearDown(self):
         """Roll back all the changes from the test and clean up the session."""
         self._request_sesh.stop()
+        self._relay.stop()
         self.db.close()
         self.transaction.rollback()
         self.connection.close()
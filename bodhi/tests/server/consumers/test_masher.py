@@ -16,25 +16,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-from cStringIO import StringIO
 import datetime
+import hashlib
 import json
 import os
 import shutil
 import tempfile
 import time
 import unittest
-import urllib2
 import urlparse
 
 import mock
 
-from bodhi.server import buildsys, log, initialize_db
+from bodhi.server import buildsys, log, initialize_db, stats
 from bodhi.server.config import config
-from bodhi.server.consumers.masher import Masher, MasherThread
+from bodhi.server.consumers.masher import CompsPreparer, Masher, MasherThread, MashThread
 from bodhi.server.models import (
-    Base, Build, BuildrootOverride, Release, ReleaseState, RpmBuild, TestGatingStatus, Update,
-    UpdateRequest, UpdateStatus, UpdateType, User)
+    Base, Build, BuildrootOverride, ContentType, Release, ReleaseState, RpmBuild, TestGatingStatus,
+    Update, UpdateRequest, UpdateStatus, UpdateType, User)
 from bodhi.server.util import mkmetadatadir, transactional_session_maker
 from bodhi.tests.server import base, populate
 
@@ -106,6 +105,7 @@ class TestMasher(unittest.TestCase):
         test_config = base.original_config.copy()
         test_config['mash_stage_dir'] = self._new_mash_stage_dir
         test_config['mash_dir'] = os.path.join(self._new_mash_stage_dir, 'mash')
+        test_config['dogpile.cache.backend'] = 'dogpile.cache.memory'
 
         mock_config = mock.patch.dict(
             'bodhi.server.consumers.masher.config', test_config)
@@ -178,6 +178,15 @@ class TestMasher(unittest.TestCase):
 
         set_bugtracker.assert_called_once_with()
 
+    @mock.patch('bodhi.server.consumers.masher.configure_cache_region')
+    def test___init___configures_cache_region(self, configure_cache_region):
+        """
+        Assert that Masher.__init__() configures the cache region, which the pushes invalidate.
+        """
+        Masher(FakeHub(), db_factory=self.db_factory, mash_dir=self.tempdir)
+
+        configure_cache_region.assert_called_once_with(config)
+
     @mock.patch('bodhi.server.notifications.publish')
     def test_invalid_signature(self, publish):
         """Make sure the masher ignores messages that aren't signed with the
@@ -227,7 +236,7 @@ class TestMasher(unittest.TestCase):
         self.masher.consume(self.msg)
 
         # Ensure that fedmsg was called 4 times
-        self.assertEquals(len(publish.call_args_list), 3)
+        self.assertEquals(len(publish.call_args_list), 4)
 
         # Also, ensure we reported success
         publish.assert_called_with(
@@ -272,8 +281,8 @@ class TestMasher(unittest.TestCase):
         # Start the push
         self.masher.consume(self.msg)
 
-        # Ensure that fedmsg was called 3 times
-        self.assertEquals(len(publish.call_args_list), 4)
+        # Ensure that fedmsg was called 5 times
+        self.assertEquals(len(publish.call_args_list), 5)
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
@@ -348,8 +357,8 @@ class TestMasher(unittest.TestCase):
         # Start the push
         self.masher.consume(self.msg)
 
-        # Ensure that fedmsg was called 5 times
-        self.assertEquals(len(publish.call_args_list), 5)
+        # Ensure that fedmsg was called 6 times
+        self.assertEquals(len(publish.call_args_list), 6)
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
@@ -376,7 +385,8 @@ class TestMasher(unittest.TestCase):
         with file(t.mash_lock) as f:
             state = json.load(f)
         try:
-            self.assertEquals(state, {u'updates': [u'bodhi-2.0-1.fc17'], u'completed_repos': []})
+            self.assertEquals(
+                state, {u'updates': [u'bodhi-2.0-1.fc17'], u'completed_repos': [], u'stats': []})
         finally:
             t.remove_state()
 
@@ -389,8 +399,10 @@ class TestMasher(unittest.TestCase):
     @mock.patch('bodhi.server.consumers.masher.MasherThread.generate_updateinfo')
     @mock.patch('bodhi.server.consumers.masher.MasherThread.wait_for_sync')
     @mock.patch('bodhi.server.notifications.publish')
-    @mock.patch('bodhi.server.mail._send_mail')
-    def test_testing_digest(self, mail, *args):
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'smtp_server': 'smtp.example.com'})
+    @mock.patch('bodhi.server.mail.get_outbox')
+    @mock.patch('bodhi.server.mail.smtplib.SMTP')
+    def test_testing_digest(self, SMTP, get_outbox, *args):
         t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
                          'ralph', log, self.db_factory, self.tempdir)
         with self.db_factory() as session:
@@ -416,10 +428,12 @@ References:
 
 """ % time.strftime('%Y'))
 
-        mail.assert_called_with(config.get('bodhi_email'), config.get('fedora_test_announce_list'),
-                                mock.ANY)
-        assert len(mail.mock_calls) == 2, len(mail.mock_calls)
-        body = mail.mock_calls[1][1][2]
+        # The digest is sent right away, while the comment notifications wait in the outbox.
+        SMTP.assert_called_once_with('smtp.example.com')
+        SMTP.return_value.sendmail.assert_called_once_with(
+            config.get('bodhi_email'), [config.get('fedora_test_announce_list')], mock.ANY)
+        SMTP.return_value.quit.assert_called_once_with()
+        body = SMTP.return_value.sendmail.mock_calls[0][1][2]
         assert body.startswith(
             ('From: updates@fedoraproject.org\r\nTo: %s\r\nX-Bodhi: fedoraproject.org\r\nSubject: '
              'Fedora 17 updates-testing report\r\n\r\nThe following builds have been pushed to '
@@ -487,6 +501,7 @@ References:
     @mock.patch('bodhi.server.consumers.masher.MasherThread.generate_updateinfo')
     @mock.patch('bodhi.server.consumers.masher.MasherThread.wait_for_sync')
     @mock.patch('bodhi.server.notifications.publish')
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'max_concurrent_mashes': 1})
     def test_security_update_priority(self, publish, *args):
         with self.db_factory() as db:
             up = db.query(Update).one()
@@ -531,9 +546,11 @@ References:
         # mashing f18
         # complete.stable (for each update)
         # errata.publish
+        # mashtask.stats
         # mashtask.complete
         # mashing f17
         # complete.testing
+        # mashtask.stats
         # mashtask.complete
         self.assertEquals(calls[1], mock.call(
             force=True,
@@ -541,11 +558,11 @@ References:
                  'updates': [u'bodhi-2.0-1.fc18'],
                  'agent': 'lmacken'},
             topic='mashtask.mashing'))
-        self.assertEquals(calls[4], mock.call(
+        self.assertEquals(calls[5], mock.call(
             force=True,
             msg={'success': True, 'repo': 'f18-updates', 'agent': 'lmacken'},
             topic='mashtask.complete'))
-        self.assertEquals(calls[5], mock.call(
+        self.assertEquals(calls[6], mock.call(
             force=True,
             msg={'repo': u'f17-updates-testing',
                  'updates': [u'bodhi-2.0-1.fc17'],
@@ -567,6 +584,7 @@ References:
     @mock.patch('bodhi.server.consumers.masher.MasherThread.generate_updateinfo')
     @mock.patch('bodhi.server.consumers.masher.MasherThread.wait_for_sync')
     @mock.patch('bodhi.server.notifications.publish')
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'max_concurrent_mashes': 1})
     def test_security_update_priority_testing(self, publish, *args):
         with self.db_factory() as db:
             up = db.query(Update).one()
@@ -614,13 +632,13 @@ References:
                  'agent': 'lmacken'},
             force=True,
             topic='mashtask.mashing'))
-        self.assertEquals(calls[3], mock.call(
+        self.assertEquals(calls[4], mock.call(
             msg={'success': True,
                  'repo': 'f17-updates-testing',
                  'agent': 'lmacken'},
             force=True,
             topic='mashtask.complete'))
-        self.assertEquals(calls[4], mock.call(
+        self.assertEquals(calls[5], mock.call(
             msg={'repo': u'f18-updates',
                  'updates': [u'bodhi-2.0-1.fc18'],
                  'agent': 'lmacken'},
@@ -701,6 +719,77 @@ References:
                 mock.call(msg={'repo': u'f18-updates', 'updates': [u'bodhi-2.0-1.fc18']},
                           force=True, topic='mashtask.mashing'))
 
+    def test_prioritize_updates(self):
+        """Assert that security repos come first, then critpath repos, and stable before testing."""
+        def update(title, type_=UpdateType.bugfix, critpath=False):
+            return mock.MagicMock(title=title, type=type_, critpath=critpath)
+
+        repos = self.masher.prioritize_updates({
+            'F17': {'stable': [update(u'a'), update(u'b', critpath=True)],
+                    'testing': [update(u'c', type_=UpdateType.security)]},
+            'F18': {'stable': [update(u'd')], 'testing': [update(u'e', critpath=None)]},
+            'F19': {'testing': [update(u'f')]}})
+
+        self.assertEqual(repos, [('F17', 'testing', [u'c']), ('F17', 'stable', [u'a', u'b']),
+                                 ('F18', 'stable', [u'd']), ('F18', 'testing', [u'e']),
+                                 ('F19', 'testing', [u'f'])])
+
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'max_concurrent_mashes': 2})
+    def test_schedule_fills_free_slots(self):
+        """Assert that the next ready repo is started as soon as one is done, up to the bound."""
+        events = self._schedule([('F17', 'stable'), ('F18', 'stable'), ('F17', 'testing'),
+                                 ('F19', 'testing')])
+
+        self.assertEqual(events, [('start', 'F17-stable'), ('start', 'F18-stable'),
+                                  ('done', 'F17-stable'), ('start', 'F17-testing'),
+                                  ('done', 'F18-stable'), ('start', 'F19-testing'),
+                                  ('done', 'F17-testing'), ('done', 'F19-testing')])
+
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'max_concurrent_mashes': 8})
+    def test_schedule_testing_waits_for_stable(self):
+        """Assert that a release's testing repo is only started once its stable repo is done."""
+        events = self._schedule([('F17', 'stable'), ('F18', 'testing'), ('F17', 'testing')])
+
+        self.assertEqual(events, [('start', 'F17-stable'), ('start', 'F18-testing'),
+                                  ('done', 'F17-stable'), ('start', 'F17-testing'),
+                                  ('done', 'F18-testing'), ('done', 'F17-testing')])
+
+    def _schedule(self, repos):
+        """
+        Schedule the given repos with threads that are done as soon as they start.
+
+        Args:
+            repos (list): (release, request) tuples to schedule.
+        Returns:
+            list: ('start' or 'done', repo) tuples, in the order in which they happened.
+        """
+        events = []
+
+        class FakeMasherThread(object):
+            def __init__(self, release, request, updates, agent, log, db_factory, mash_dir,
+                         resume, finished, comps):
+                self.repo = '%s-%s' % (release, request)
+                self.finished = finished
+
+            def start(self):
+                events.append(('start', self.repo))
+                self.finished.put(self)
+
+            def join(self):
+                pass
+
+            def results(self):
+                events.append(('done', self.repo))
+                return [self.repo]
+
+        with mock.patch('bodhi.server.consumers.masher.MasherThread', FakeMasherThread):
+            results = self.masher.schedule(
+                [(release, request, [u'bodhi-2.0-1.fc17']) for release, request in repos],
+                u'bowlofeggs', False)
+
+        self.assertEqual(results, [repo for event, repo in events if event == 'done'])
+        return events
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.server.notifications.init')
     @mock.patch('bodhi.server.notifications.publish')
@@ -748,7 +837,7 @@ References:
                                 force=True,
                                 msg=mock.ANY)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7, progress=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
     @mock.patch(**mock_failed_taskotron_results)
@@ -780,7 +869,7 @@ References:
                                             agent='ralph'))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7, progress=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
     @mock.patch(**mock_absent_taskotron_results)
@@ -812,7 +901,7 @@ References:
                                             agent='ralph'))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7, progress=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
     @mock.patch('bodhi.server.consumers.masher.MasherThread.update_comps')
@@ -1084,8 +1173,8 @@ References:
             self.assertIsNone(up.date_stable)
             up.request = UpdateRequest.stable
 
-        # Ensure that fedmsg was called 3 times
-        self.assertEquals(len(publish.call_args_list), 4)
+        # Ensure that fedmsg was called 5 times
+        self.assertEquals(len(publish.call_args_list), 5)
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
@@ -1316,111 +1405,338 @@ class TestMasherThread_eject_from_mash(MasherThreadBaseTestCase):
         self.assertEqual(t.state['updates'], [])
 
 
-class TestMasherThread_update_comps(unittest.TestCase):
-    """This test class contains tests for the MasherThread.update_comps() method."""
+class TestMashThread_progress(unittest.TestCase):
+    """This test class contains tests for the MashThread.progress() method."""
+
+    @mock.patch.dict('bodhi.server.consumers.masher.config', {'mash_progress_interval': 30})
+    @mock.patch('bodhi.server.consumers.masher.notifications.publish')
+    @mock.patch('bodhi.server.consumers.masher.time.time',
+                side_effect=[1000.0, 1010.0, 1031.0, 1040.0, 1062.0])
+    def test_progress(self, time, publish):
+        """Assert that the lines are counted, and the progress published now and then."""
+        mash_thread = MashThread(u'f17-updates-testing', '/mash', '/comps-f17.xml',
+                                 '/no/previous', mock.Mock())
+
+        for i in range(4):
+            mash_thread.progress('stderr', 'line %d\n' % i)
+
+        self.assertEqual(mash_thread.lines, 4)
+        self.assertEqual(
+            publish.mock_calls,
+            [mock.call(topic='mashtask.progress', force=True,
+                       msg={'repo': u'f17-updates-testing', 'lines': 2, 'line': 'line 1'}),
+             mock.call(topic='mashtask.progress', force=True,
+                       msg={'repo': u'f17-updates-testing', 'lines': 4, 'line': 'line 3'})])
+
+
+class TestMasherThread_journal(unittest.TestCase):
+    """This test class contains tests for the journal of the MasherThread state."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.masher_thread = self._make_thread()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _make_thread(self, resume=False):
+        """Return a MasherThread for f17-updates with its state in self.tempdir."""
+        t = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17', u'bodhi-2.0-2.fc17'],
+                         u'bowlofeggs', mock.Mock(), mock.Mock(), self.tempdir, resume)
+        t.id = 'f17-updates'
+        t.init_state()
+        return t
+
+    def _journal_lines(self):
+        """Return the entries of the journal."""
+        with file(self.masher_thread.mash_journal) as journal:
+            return [json.loads(line) for line in journal]
+
+    def test_resume(self):
+        """Assert that a resumed push sees the journaled changes, and compacts them."""
+        path = os.path.join(self.tempdir, 'f17-updates-170823.1612')
+        self.masher_thread.save_state()
+        with file(self.masher_thread.mash_lock) as lock:
+            saved = lock.read()
+
+        self.masher_thread.journal('checkpoint', 'modify_bugs')
+        self.masher_thread.journal('done', 'send_stable_announcements', u'bodhi-2.0-1.fc17')
+        self.masher_thread.journal('add', 'completed_repos', path)
+        self.masher_thread.journal('add', 'completed_repos', path)
+
+        # The lock isn't rewritten, the changes are appended to the journal instead.
+        with file(self.masher_thread.mash_lock) as lock:
+            self.assertEqual(lock.read(), saved)
+        self.assertEqual(len(self._journal_lines()), 4)
+
+        resumed = self._make_thread(resume=True)
+        resumed.load_state()
+
+        self.assertEqual(resumed.state, self.masher_thread.state)
+        self.assertTrue(resumed.state['modify_bugs'])
+        self.assertEqual(resumed.state['completed_repos'], [path])
+        self.assertEqual(resumed.path, path)
+        self.assertTrue(resumed.is_done('send_stable_announcements', u'bodhi-2.0-1.fc17'))
+        self.assertFalse(resumed.is_done('send_stable_announcements', u'bodhi-2.0-2.fc17'))
+
+        resumed.save_state()
+
+        self.assertFalse(os.path.exists(resumed.mash_journal))
+        with file(resumed.mash_lock) as lock:
+            self.assertEqual(json.load(lock), resumed.state)
+
+    def test_partial_entry(self):
+        """Assert that an entry the masher stopped writing is ignored."""
+        self.masher_thread.save_state()
+        self.masher_thread.journal('checkpoint', 'modify_bugs')
+        with file(self.masher_thread.mash_journal, 'a') as journal:
+            journal.write('{"op": "checkpoint", "key": "send_st')
+
+        resumed = self._make_thread(resume=True)
+        resumed.load_state()
+
+        self.assertTrue(resumed.state['modify_bugs'])
+        self.assertNotIn('send_stable_announcements', resumed.state)
+        resumed.log.warn.assert_called_once_with('Ignoring a partial entry at the end of %s',
+                                                 resumed.mash_journal)
+
+    def test_remove_state(self):
+        """Assert that the journal is removed with the lock when the push is done."""
+        self.masher_thread.save_state()
+        self.masher_thread.journal('checkpoint', 'modify_bugs')
+
+        self.masher_thread.remove_state()
+
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_modify_bugs_skips_done_updates(self):
+        """Assert that modify_bugs() only modifies the bugs of the updates it hasn't done yet."""
+        done = mock.Mock(title=u'bodhi-2.0-1.fc17')
+        todo = mock.Mock(title=u'bodhi-2.0-2.fc17')
+        self.masher_thread.updates = [done, todo]
+        self.masher_thread.save_state()
+        self.masher_thread.journal('done', 'modify_bugs', done.title)
+
+        self.masher_thread.modify_bugs()
+
+        self.assertEqual(done.modify_bugs.call_count, 0)
+        todo.modify_bugs.assert_called_once_with()
+        self.assertEqual(
+            self._journal_lines(),
+            [{'op': 'done', 'key': 'modify_bugs', 'value': u'bodhi-2.0-1.fc17'},
+             {'op': 'done', 'key': 'modify_bugs', 'value': u'bodhi-2.0-2.fc17'},
+             {'op': 'checkpoint', 'key': 'modify_bugs', 'value': None}])
+
+    def test_modify_bugs_stops_at_failure(self):
+        """Assert that only the updates whose bugs were modified are journaled as done."""
+        first = mock.Mock(title=u'bodhi-2.0-1.fc17')
+        second = mock.Mock(title=u'bodhi-2.0-2.fc17')
+        second.modify_bugs.side_effect = IOError('Bugzilla is down')
+        self.masher_thread.updates = [first, second]
+        self.masher_thread.save_state()
+
+        with self.assertRaises(IOError):
+            self.masher_thread.modify_bugs()
+
+        self.assertEqual(self._journal_lines(),
+                         [{'op': 'done', 'key': 'modify_bugs', 'value': u'bodhi-2.0-1.fc17'}])
+        self.assertNotIn('modify_bugs', self.masher_thread.state)
+
+
+class TestMasherThread_prefetch_rpm_headers(unittest.TestCase):
+    """This test class contains tests for the MasherThread.prefetch_rpm_headers() method."""
+
+    @mock.patch('bodhi.server.consumers.masher.util.prefetch_rpm_headers')
+    def test_rpm_builds(self, prefetch_rpm_headers):
+        """Assert that the headers of the builds of the RPM updates are prefetched."""
+        masher_thread = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'],
+                                     u'bowlofeggs', mock.Mock(), mock.Mock(), mock.Mock())
+        rpm_update = mock.Mock(content_type=ContentType.rpm,
+                               builds=[mock.Mock(nvr=u'bodhi-2.0-1.fc17'),
+                                       mock.Mock(nvr=u'python-2.7-1.fc17')])
+        module_update = mock.Mock(content_type=ContentType.module,
+                                  builds=[mock.Mock(nvr=u'nodejs-6-1')])
+        masher_thread.updates = [rpm_update, module_update]
+
+        masher_thread.prefetch_rpm_headers()
+
+        prefetch_rpm_headers.assert_called_once_with([u'bodhi-2.0-1.fc17', u'python-2.7-1.fc17'])
+
+
+class TestMasherThread_measure(unittest.TestCase):
+    """This test class contains tests for the MasherThread.measure() method."""
 
     def setUp(self):
         self.masher_thread = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'],
                                           u'bowlofeggs', mock.Mock(), mock.Mock(), mock.Mock())
 
-    @mock.patch('bodhi.server.consumers.masher.os.path.exists')
-    @mock.patch('bodhi.server.consumers.masher.config', {'comps_dir': '/some/path',
-                                                         'comps_url': 'https://example.com/'})
-    @mock.patch('bodhi.server.consumers.masher.util.cmd')
-    def test_comps_no_dir(self, mock_cmd, mock_exists):
-        mock_exists.return_value = False
+    @mock.patch('bodhi.server.stats.bytes_written', return_value=None)
+    def test_records_stats(self, bytes_written):
+        """Assert that the stages are recorded in order, and that a rerun replaces its stats."""
+        def stage(fail=False):
+            stats.count('koji_calls', 2)
+            if fail:
+                raise ValueError('it broke')
+            return 'done'
+
+        with self.assertRaises(ValueError):
+            self.masher_thread.measure('mash', stage, fail=True)
+        self.assertEqual(self.masher_thread.measure('update_comps', stage), 'done')
+        self.assertEqual(self.masher_thread.measure('mash', stage), 'done')
+
+        records = self.masher_thread.state['stats']
+        self.assertEqual([r['stage'] for r in records], ['update_comps', 'mash'])
+        self.assertEqual([r['koji_calls'] for r in records], [2, 2])
+        self.assertEqual([r['db_queries'] for r in records], [0, 0])
+        self.assertEqual([r['bytes_written'] for r in records], [None, None])
+
+    def test_stage_decorator(self):
+        """Assert that the stages of MasherThread.work() are measured, and in the results."""
+        self.masher_thread.updates = []
+
+        self.masher_thread.obsolete_older_updates()
+
+        self.assertEqual([r['stage'] for r in self.masher_thread.state['stats']],
+                         ['obsolete_older_updates'])
+        results = list(self.masher_thread.results())
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[1].startswith('    obsolete_older_updates '))
+        self.assertIn('koji calls:     0', results[1])
+
+
+class TestMasherThread_update_comps(unittest.TestCase):
+    """This test class contains tests for the MasherThread.update_comps() method."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.comps_dir = os.path.join(self.tempdir, 'comps')
+        self.mash_dir = os.path.join(self.tempdir, 'mash')
+        self.head = 'a3bbe1a8f2'
+        self.masher_thread = self._make_thread()
+        mock_config = mock.patch.dict(
+            'bodhi.server.consumers.masher.config',
+            {'comps_dir': self.comps_dir, 'comps_url': 'https://example.com/'})
+        mock_config.start()
+        self.addCleanup(mock_config.stop)
+        mock_cmd = mock.patch('bodhi.server.consumers.masher.util.cmd', side_effect=self._cmd)
+        self.cmd = mock_cmd.start()
+        self.addCleanup(mock_cmd.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _make_thread(self, comps=None):
+        """Return a MasherThread for f17-updates, using the given CompsPreparer."""
+        return MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'], u'bowlofeggs',
+                            mock.Mock(), mock.Mock(), self.mash_dir, comps=comps)
+
+    def _cmd(self, cmd, cwd=None):
+        """Pretend to run git and make in the comps git module."""
+        if cmd[:2] == ['git', 'clone']:
+            os.makedirs(cmd[3])
+        elif cmd == ['git', 'rev-parse', 'HEAD']:
+            return self.head + '\n', '', 0
+        elif cmd == ['make']:
+            with open(os.path.join(cwd, 'comps-f17.xml'), 'w') as comps:
+                comps.write('<comps>%s</comps>' % self.head)
+        return '', '', 0
+
+    def test_comps_no_dir(self):
+        """Assert that the comps are cloned, built and snapshotted."""
         calls = [
-            mock.call(['git', 'clone', 'https://example.com/', '/some/path'], '/some'),
-            mock.call(['git', 'pull'], '/some/path'),
-            mock.call(['make'], '/some/path'),
+            mock.call(['git', 'clone', 'https://example.com/', self.comps_dir], self.tempdir),
+            mock.call(['git', 'pull'], self.comps_dir),
+            mock.call(['git', 'rev-parse', 'HEAD'], self.comps_dir),
+            mock.call(['make'], self.comps_dir),
         ]
+
         self.masher_thread.update_comps()
-        self.assertEqual(calls, mock_cmd.call_args_list)
-        mock_exists.assert_called_once_with('/some/path')
-
-    @mock.patch('bodhi.server.consumers.masher.os.path.exists')
-    @mock.patch('bodhi.server.consumers.masher.config', {'comps_dir': '/some/path',
-                                                         'comps_url': 'https://example.com/'})
-    @mock.patch('bodhi.server.consumers.masher.util.cmd')
-    def test_comps_existing_dir(self, mock_cmd, mock_exists):
-        mock_exists.return_value = True
+
+        self.assertEqual(calls, self.cmd.call_args_list)
+        snapshot = os.path.join(self.mash_dir, 'comps', self.head)
+        self.assertEqual(self.masher_thread.comps_dir, snapshot)
+        self.assertEqual(os.listdir(snapshot), ['comps-f17.xml'])
+        with open(os.path.join(snapshot, 'comps-f17.xml')) as comps:
+            self.assertEqual(comps.read(), '<comps>a3bbe1a8f2</comps>')
+        self.assertEqual(os.stat(os.path.join(snapshot, 'comps-f17.xml')).st_mode & 0o777, 0o444)
+
+    def test_comps_existing_dir(self):
+        """Assert that an existing clone is pulled rather than cloned."""
+        os.makedirs(self.comps_dir)
         calls = [
-            mock.call(['git', 'pull'], '/some/path'),
-            mock.call(['make'], '/some/path'),
+            mock.call(['git', 'pull'], self.comps_dir),
+            mock.call(['git', 'rev-parse', 'HEAD'], self.comps_dir),
+            mock.call(['make'], self.comps_dir),
         ]
+
+        self.masher_thread.update_comps()
+
+        self.assertEqual(calls, self.cmd.call_args_list)
+
+    def test_unchanged_head_skips_make(self):
+        """Assert that make is skipped when HEAD was built already, and older snapshots go."""
         self.masher_thread.update_comps()
-        self.assertEqual(calls, mock_cmd.call_args_list)
-        mock_exists.assert_called_once_with('/some/path')
+        os.makedirs(os.path.join(self.mash_dir, 'comps', '0ddba11'))
+        self.cmd.reset_mock()
+        masher_thread = self._make_thread()
+
+        masher_thread.update_comps()
+
+        self.assertNotIn(mock.call(['make'], self.comps_dir), self.cmd.call_args_list)
+        self.assertEqual(masher_thread.comps_dir,
+                         os.path.join(self.mash_dir, 'comps', 'a3bbe1a8f2'))
+        self.assertEqual(os.listdir(os.path.join(self.mash_dir, 'comps')), ['a3bbe1a8f2'])
+
+    def test_shared_by_the_push(self):
+        """Assert that the threads of a push prepare the comps once, and use the same snapshot."""
+        comps = CompsPreparer(os.path.join(self.mash_dir, 'comps'))
+        threads = [self._make_thread(comps) for i in range(3)]
+
+        for t in threads:
+            t.update_comps()
+
+        self.assertEqual(self.cmd.call_count, 4)
+        self.assertEqual(set([t.comps_dir for t in threads]),
+                         set([os.path.join(self.mash_dir, 'comps', self.head)]))
+
+    def test_unknown_head(self):
+        """Assert that the comps git module is used directly if its HEAD can't be found."""
+        self.head = ''
+
+        self.masher_thread.update_comps()
+
+        self.assertIn(mock.call(['make'], self.comps_dir), self.cmd.call_args_list)
+        self.assertEqual(self.masher_thread.comps_dir, self.comps_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.mash_dir, 'comps')))
 
 
 class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
     """This test class contains tests for the MasherThread.wait_for_sync() method."""
-    @mock.patch.dict(
-        'bodhi.server.consumers.masher.config',
-        {'fedora_testing_master_repomd':
-            'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
-    @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                return_value=StringIO('---\nyaml: rules'))
-    def test_checksum_match_immediately(self, urlopen, publish):
-        """
-        Assert correct operation when the repomd checksum matches immediately.
-        """
+    def _make_thread(self, arches=('aarch64', 'x86_64')):
+        """Return a MasherThread whose repos for the given arches are mashed."""
         release = self.db.query(Release).filter_by(name=u'F17').one()
         t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
                          'bowlofeggs', log, self.Session, self.tempdir)
         t.id = 'f26-updates-testing'
         t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
+        for arch in arches:
             repodata = os.path.join(t.path, t.id, arch, 'repodata')
             os.makedirs(repodata)
             with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
-
-        t.wait_for_sync()
-
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        self.assertEqual(urlopen.call_count, 1)
-        # Since os.listdir() isn't deterministic about the order of the items it returns, the test
-        # won't be deterministic about which of these URLs get called. However, either one of them
-        # would be correct so we will just assert that one of them is called.
-        expected_calls = [
-            mock.call('http://example.com/pub/fedora/linux/updates/testing/17/x86_64/'
-                      'repodata.repomd.xml'),
-            mock.call('http://example.com/pub/fedora/linux/updates/testing/17/aarch64/'
-                      'repodata.repomd.xml')]
-        self.assertTrue(urlopen.mock_calls[0] in expected_calls)
+                repomd.write('---\nyaml: rules %s' % arch)
+        return t
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd':
             'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[StringIO('wrong'), StringIO('nope'), StringIO('---\nyaml: rules')])
-    def test_checksum_match_third_try(self, urlopen, sleep, publish):
+    @mock.patch('bodhi.server.consumers.masher.mirrors.get_poller')
+    def test_waits_for_all_arches(self, get_poller, publish):
         """
-        Assert correct operation when the repomd checksum matches on the third try.
+        Assert that the poller waits for the repomd.xml checksums of all the arches.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
 
         t.wait_for_sync()
 
@@ -1429,86 +1745,47 @@ class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
                       force=True),
             mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
                       force=True)]
-        publish.assert_has_calls(expected_calls)
-        # Since os.listdir() isn't deterministic about the order of the items it returns, the test
-        # won't be deterministic about which of arch URL gets used. However, either one of them
-        # would be correct so we will just assert that the one that is used is used correctly.
-        arch = 'x86_64' if 'x86_64' in urlopen.mock_calls[0][1][0] else 'aarch64'
-        expected_calls = [
-            mock.call('http://example.com/pub/fedora/linux/updates/testing/17/'
-                      '{}/repodata.repomd.xml'.format(arch))
-            for i in range(3)]
-        urlopen.assert_has_calls(expected_calls)
-        sleep.assert_has_calls([mock.call(200), mock.call(200)])
+        self.assertEqual(publish.mock_calls, expected_calls)
+        get_poller.return_value.wait.assert_called_once_with({
+            'http://example.com/pub/fedora/linux/updates/testing/17/aarch64/repodata.repomd.xml':
+                hashlib.sha1('---\nyaml: rules aarch64').hexdigest(),
+            'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml':
+                hashlib.sha1('---\nyaml: rules x86_64').hexdigest()})
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd':
-            'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
+            'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml',
+         'fedora_testing_alt_master_repomd':
+            'http://example.com/pub/fedora-secondary/updates/testing/%s/%s/repodata.repomd.xml',
+         'fedora_17_primary_arches': 'x86_64'})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[urllib2.HTTPError('url', 404, 'Not found', {}, None),
-                     StringIO('---\nyaml: rules')])
-    def test_httperror(self, urlopen, sleep, publish):
+    @mock.patch('bodhi.server.consumers.masher.mirrors.get_poller')
+    def test_waits_for_alt_arches(self, get_poller, publish):
         """
-        Assert that an HTTPError is properly caught and logged, and that the algorithm continues.
+        Assert that the poller waits for the alternative arches on the alternative master mirror.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
 
         t.wait_for_sync()
 
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        # Since os.listdir() isn't deterministic about the order of the items it returns, the test
-        # won't be deterministic about which of arch URL gets used. However, either one of them
-        # would be correct so we will just assert that the one that is used is used correctly.
-        arch = 'x86_64' if 'x86_64' in urlopen.mock_calls[0][1][0] else 'aarch64'
-        expected_calls = [
-            mock.call('http://example.com/pub/fedora/linux/updates/testing/17/'
-                      '{}/repodata.repomd.xml'.format(arch))
-            for i in range(2)]
-        urlopen.assert_has_calls(expected_calls)
-        t.log.exception.assert_called_once_with('Error fetching repomd.xml')
-        sleep.assert_called_once_with(200)
+        self.assertEqual(
+            sorted(get_poller.return_value.wait.mock_calls[0][1][0]),
+            ['http://example.com/pub/fedora-secondary/updates/testing/17/aarch64/'
+             'repodata.repomd.xml',
+             'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml'])
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd': None})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                mock.MagicMock(side_effect=Exception('urlopen should not be called')))
+    @mock.patch('bodhi.server.consumers.masher.mirrors.get_poller',
+                mock.MagicMock(side_effect=Exception('get_poller should not be called')))
     def test_missing_config_key(self, publish):
         """
         Assert that a ValueError is raised when the needed *_master_repomd config is missing.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
 
         with self.assertRaises(ValueError) as exc:
             t.wait_for_sync()
@@ -1519,20 +1796,14 @@ class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
                                         msg={'repo': t.id, 'agent': 'bowlofeggs'}, force=True)
 
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                mock.MagicMock(side_effect=Exception('urlopen should not be called')))
+    @mock.patch('bodhi.server.consumers.masher.mirrors.get_poller',
+                mock.MagicMock(side_effect=Exception('get_poller should not be called')))
     def test_missing_repomd(self, publish):
         """
         Assert that an error is logged when the local repomd is missing.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
+        t = self._make_thread(arches=())
         t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
         repodata = os.path.join(t.path, t.id, 'x86_64', 'repodata')
         os.makedirs(repodata)
 
@@ -1548,43 +1819,20 @@ class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
         {'fedora_testing_master_repomd':
             'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[urllib2.URLError('it broke'),
-                     StringIO('---\nyaml: rules')])
-    def test_urlerror(self, urlopen, sleep, publish):
+    @mock.patch('bodhi.server.consumers.masher.mirrors.get_poller')
+    def test_missing_repomd_of_one_arch(self, get_poller, publish):
         """
-        Assert that a URLError is properly caught and logged, and that the algorithm continues.
+        Assert that the arches without a local repomd are logged and not waited for.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
+        t = self._make_thread(arches=('x86_64',))
         t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        repodata = os.path.join(t.path, t.id, 'aarch64', 'repodata')
+        os.makedirs(repodata)
 
         t.wait_for_sync()
 
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        # Since os.listdir() isn't deterministic about the order of the items it returns, the test
-        # won't be deterministic about which of arch URL gets used. However, either one of them
-        # would be correct so we will just assert that the one that is used is used correctly.
-        arch = 'x86_64' if 'x86_64' in urlopen.mock_calls[0][1][0] else 'aarch64'
-        expected_calls = [
-            mock.call('http://example.com/pub/fedora/linux/updates/testing/17/'
-                      '{}/repodata.repomd.xml'.format(arch))
-            for i in range(2)]
-        urlopen.assert_has_calls(expected_calls)
-        t.log.exception.assert_called_once_with('Error fetching repomd.xml')
-        sleep.assert_called_once_with(200)
+        t.log.error.assert_called_once_with(
+            'Cannot find local repomd: %s', os.path.join(repodata, 'repomd.xml'))
+        get_poller.return_value.wait.assert_called_once_with({
+            'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml':
+                hashlib.sha1('---\nyaml: rules x86_64').hexdigest()})
@@ -16,18 +16,20 @@
 """This test suite contains tests for the bodhi.server.consumers.updates module."""
 
 import copy
+import threading
+import time
 import unittest
 
 import mock
 import sqlalchemy
 
-from bodhi.server import exceptions, models, util
+from bodhi.server import bugs as bug_module, exceptions, models, util
 from bodhi.server.consumers import updates
 from bodhi.tests.server import base
 
 
-class TestUpdatesHandlerConsume(base.BaseTestCase):
-    """This test class contains tests for the UpdatesHandler.consume() method."""
+class TestUpdatesHandlerHandle(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.handle() method."""
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.work_on_bugs')
     def test_edited_update_bug_not_in_update(self, work_on_bugs, fetch_test_cases):
@@ -45,7 +47,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345', '123456']}}}
 
-        self.assertRaises(AssertionError, h.consume, message)
+        self.assertRaises(AssertionError, h.handle, message)
 
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
@@ -72,7 +74,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345']}}}
 
-        h.consume(message)
+        h.handle(message)
 
         self.assertEqual(work_on_bugs.call_count, 1)
         self.assertTrue(isinstance(work_on_bugs.mock_calls[0][1][1],
@@ -105,7 +107,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['this isnt a real bug lol']}}}
 
-        h.consume(message)
+        h.handle(message)
 
         self.assertEqual(work_on_bugs.call_count, 1)
         self.assertTrue(isinstance(work_on_bugs.mock_calls[0][1][1],
@@ -134,7 +136,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345']}}}
 
-        self.assertRaises(NotImplementedError, h.consume, message)
+        self.assertRaises(NotImplementedError, h.handle, message)
 
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
@@ -151,17 +153,21 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
         h = updates.UpdatesHandler(hub)
         h.db_factory = base.TransactionalSessionMaker(self.Session)
         # Use a bogus topic to trigger the NotImplementedError.
+        h.visibility_timeout = 0
         message = {
             'topic': 'bodhi.update.request.testing',
             'body': {'msg': {'update': {'alias': u'hurd-1.0-1.fc26'}}}}
 
         with self.assertRaises(exceptions.BodhiException) as exc:
-            h.consume(message)
+            h.handle(message)
 
         self.assertEqual(str(exc.exception), "Couldn't find alias u'hurd-1.0-1.fc26' in DB")
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
 
+
+class TestUpdatesHandlerConsume(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.consume() method."""
     @mock.patch('bodhi.server.consumers.updates.log.error')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.work_on_bugs')
@@ -186,6 +192,108 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
         error.assert_called_once_with(
             "Update Handler got update with no alias {'new_bugs': ['12345'], 'update': {}}.")
 
+    @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.handle', autospec=True)
+    def test_order_per_update(self, handle):
+        """
+        Assert that the messages about an update are handled one at a time and in order, while the
+        messages about different updates are handled at once.
+        """
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        h.workers = 2
+        lock = threading.Lock()
+        handled = []
+        active = set()
+        overlaps = []
+
+        def record(handler, message):
+            alias = message['body']['msg']['update']['alias']
+            with lock:
+                if alias in active:
+                    overlaps.append(alias)
+                active.add(alias)
+            time.sleep(0.01)
+            with lock:
+                active.discard(alias)
+                handled.append((alias, message['body']['msg']['number']))
+
+        handle.side_effect = record
+        for number in range(5):
+            for alias in (u'FEDORA-2017-a', u'FEDORA-2017-b'):
+                h.consume({'topic': 'bodhi.update.edit',
+                           'body': {'msg': {'update': {'alias': alias}, 'number': number}}})
+        h.stop()
+
+        self.assertEqual(overlaps, [])
+        for alias in (u'FEDORA-2017-a', u'FEDORA-2017-b'):
+            self.assertEqual([n for a, n in handled if a == alias], range(5))
+        self.assertEqual(h._pending, {})
+
+    @mock.patch('bodhi.server.consumers.updates.log.exception')
+    @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.handle', autospec=True)
+    def test_exception(self, handle, exception):
+        """Assert that an exception is logged, and that the next messages are still handled."""
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        handle.side_effect = [RuntimeError('oh no!'), None]
+        messages = [{'topic': 'bodhi.update.edit',
+                     'body': {'msg': {'update': {'alias': u'FEDORA-2017-a'}, 'number': number}}}
+                    for number in range(2)]
+
+        for message in messages:
+            h.consume(message)
+        h.stop()
+
+        self.assertEqual(handle.mock_calls, [mock.call(h, m) for m in messages])
+        exception.assert_called_once_with('Unable to handle %s about %s', 'bodhi.update.edit',
+                                          u'FEDORA-2017-a')
+
+
+class TestUpdatesHandlerWaitUntilVisible(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.wait_until_visible() method."""
+
+    def setUp(self):
+        """Create an UpdatesHandler that uses the test database."""
+        super(TestUpdatesHandlerWaitUntilVisible, self).setUp()
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        self.handler = updates.UpdatesHandler(hub)
+        self.handler.db_factory = base.TransactionalSessionMaker(self.Session)
+        self.handler.visibility_timeout = 30
+
+    @mock.patch('bodhi.server.consumers.updates.time.sleep')
+    def test_visible(self, sleep):
+        """Assert that there is no wait for an update that is in the database."""
+        self.handler.wait_until_visible(u'bodhi-2.0-1.fc17')
+
+        self.assertEqual(sleep.call_count, 0)
+
+    @mock.patch('bodhi.server.consumers.updates.time.sleep')
+    def test_retry(self, sleep):
+        """Assert that the database is looked at again, waiting longer each time."""
+        update = self.db.query(models.Update).one()
+
+        with mock.patch('bodhi.server.consumers.updates.Update.get',
+                        side_effect=[None, None, update]) as get:
+            self.handler.wait_until_visible(u'bodhi-2.0-1.fc17')
+
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual([c[1][0] for c in sleep.mock_calls], [0.1, 0.2])
+
+    def test_timeout(self):
+        """Assert that an Exception is raised if the update isn't found in time."""
+        self.handler.visibility_timeout = 0.25
+
+        with self.assertRaises(exceptions.BodhiException) as exc:
+            self.handler.wait_until_visible(u'hurd-1.0-1.fc26')
+
+        self.assertEqual(str(exc.exception), "Couldn't find alias u'hurd-1.0-1.fc26' in DB")
+
 
 class TestUpdatesHandlerInit(unittest.TestCase):
     """This test class contains tests for the UpdatesHandler.__init__() method."""
@@ -249,6 +357,7 @@ class TestUpdatesHandlerInit(unittest.TestCase):
             h.topic,
             ['topic_prefix.environment.bodhi.update.request.testing',
              'topic_prefix.environment.bodhi.update.edit'])
+        self.assertEqual((h.workers, h.request_workers, h.visibility_timeout), (4, 8, 30))
         set_bugtracker.assert_called_once_with()
 
 
@@ -274,3 +383,57 @@ class TestUpdatesHandlerWorkOnBugs(base.BaseTestCase):
             h.work_on_bugs(h.db_factory, update, bugs)
 
         warning.assert_called_once_with('Error occurred during updating single bug', exc_info=True)
+
+    def test_work_on_bugs(self):
+        """
+        Assert that the bugs are retrieved, commented on and marked as MODIFIED, and that a security
+        bug makes the update a security update.
+        """
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        update = self.db.query(models.Update).one()
+        update.bugs.append(models.Bug(bug_id=54321))
+        self.db.flush()
+        bugtracker = mock.MagicMock()
+        bugtracker.getbug.side_effect = lambda bug_id: mock.MagicMock(
+            product='Fedora', short_desc='Bug %d' % bug_id,
+            keywords=['Security'] if bug_id == 54321 else [])
+        # The details are filled in like python-bugzilla's bugs fill them in.
+        bugtracker.update_details.side_effect = bug_module.Bugzilla().update_details
+
+        with mock.patch('bodhi.server.consumers.updates.bug_module.bugtracker', bugtracker):
+            h.work_on_bugs(self.db, update, update.bugs)
+
+        self.assertEqual(sorted(c[1][0] for c in bugtracker.getbug.mock_calls), [12345, 54321])
+        self.assertEqual(sorted(b.title for b in update.bugs), [u'Bug 12345', u'Bug 54321'])
+        self.assertEqual(update.type, models.UpdateType.security)
+        comment = updates.config['initial_bug_msg'] % (
+            update.title, update.release.long_name, update.abs_url())
+        self.assertEqual(sorted(bugtracker.comment.mock_calls),
+                         [mock.call(12345, comment), mock.call(54321, comment)])
+        self.assertEqual(sorted(bugtracker.modified.mock_calls),
+                         [mock.call(12345), mock.call(54321)])
+        h.stop()
+
+
+class TestUpdatesHandlerFetchTestCases(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.fetch_test_cases() method."""
+
+    @mock.patch('bodhi.server.models.Package.query_test_cases',
+                return_value=[u'QA:Testcase bodhi'])
+    def test_fetch_test_cases(self, query_test_cases):
+        """Assert that the test cases are queried from a thread, and added to the packages."""
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        update = self.db.query(models.Update).one()
+
+        h.fetch_test_cases(self.db, update, h.query_test_cases(update))
+
+        query_test_cases.assert_called_once_with()
+        self.assertEqual([t.name for t in update.builds[0].package.test_cases],
+                         [u'QA:Testcase bodhi'])
+        h.stop()
@@ -33,6 +33,12 @@ class TestBuildsService(base.BaseTestCase):
         up = body['builds'][0]
         self.assertEquals(up['nvr'], u'bodhi-2.0-1.fc17')
 
+    def test_list_builds_fields(self):
+        """Assert that only the requested fields are serialized."""
+        res = self.app.get('/builds/', {'fields': 'nvr'})
+
+        self.assertEqual(res.json_body['builds'], [{'nvr': u'bodhi-2.0-1.fc17'}])
+
     def test_list_builds_pagination(self):
 
         # First, stuff a second build in there
@@ -260,6 +260,15 @@ class TestCommentsService(base.BaseTestCase):
         self.assertEquals(comment['text'], u'srsly.  pretty good.')
         self.assertEquals(comment['karma'], 0)
 
+    def test_list_comments_fields(self):
+        """Assert that only the requested fields are serialized."""
+        res = self.app.get('/comments/', {'fields': 'text,author,update_title'})
+
+        comment = res.json_body['comments'][0]
+        self.assertEqual(sorted(comment.keys()), ['author', 'text', 'update_title'])
+        self.assertEquals(comment['text'], u'srsly.  pretty good.')
+        self.assertEquals(comment['update_title'], u'bodhi-2.0-1.fc17')
+
     def test_list_comments_jsonp(self):
         res = self.app.get('/comments/',
                            {'callback': 'callback'},
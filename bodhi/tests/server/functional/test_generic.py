@@ -17,6 +17,7 @@ import copy
 
 from pyramid.testing import DummyRequest
 from webtest import TestApp
+import mock
 
 from bodhi.server import main, util
 from bodhi.server.models import (
@@ -107,6 +108,22 @@ class TestGenericViews(base.BaseTestCase):
         self.assertIn('Log out', res)
         self.assertIn('Fedora Update System', res)
 
+    def test_home_serializes_with_request(self):
+        """Assert that the home page's updates are serialized with the request, not a release."""
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.critpath = True
+        self.db.flush()
+
+        with mock.patch.object(Update, '__json__', autospec=True,
+                               side_effect=Update.__json__) as __json__:
+            self.app.get('/', status=200)
+
+        self.assertTrue(__json__.call_count >= 1)
+        for name, args, kwargs in __json__.mock_calls:
+            request = args[1] if len(args) > 1 else kwargs.get('request')
+            self.assertNotIsInstance(request, dict)
+
     def test_markdown(self):
         res = self.app.get('/markdown', {'text': 'wat'}, status=200)
         self.assertEquals(
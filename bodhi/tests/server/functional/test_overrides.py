@@ -47,6 +47,16 @@ class TestOverridesService(base.BaseTestCase):
         self.assertEquals(override['submitter']['name'], 'guest')
         self.assertEquals(override['notes'], 'blah blah blah')
 
+    def test_list_overrides_exclude(self):
+        """Assert that the excluded fields are not serialized."""
+        res = self.app.get('/overrides/', {'exclude': 'build,submitter'})
+
+        override = res.json_body['overrides'][0]
+        self.assertNotIn('build', override)
+        self.assertNotIn('submitter', override)
+        self.assertEquals(override['nvr'], 'bodhi-2.0-1.fc17')
+        self.assertEquals(override['notes'], 'blah blah blah')
+
     def test_list_overrides_rss(self):
         res = self.app.get('/rss/overrides/',
                            headers=dict(accept='application/atom+xml'))
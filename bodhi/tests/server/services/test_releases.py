@@ -11,10 +11,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import mock
 import webtest
 
 from bodhi import server
-from bodhi.server.models import Release, ReleaseState, Update
+from bodhi.server.models import Release, ReleaseState, Update, UpdateStatus
+from bodhi.server.services import releases
 from bodhi.tests.server import base
 
 
@@ -196,11 +198,55 @@ class TestReleasesService(base.BaseTestCase):
         r = self.db.query(Release).filter(Release.name == name).one()
         self.assertEquals(r.state, ReleaseState.current)
 
+    def test_edit_release_invalidates_cache(self):
+        """Assert that editing a release drops the cached data that is computed from releases."""
+        home_key = server.cache_key('home')
+        candidates_key = server.cache_key('latest_candidates', u'bodhi', False)
+        r = self.app.get('/releases/F22', status=200).json_body
+        r["edited"] = u"F22"
+        r["state"] = "current"
+        r["csrf_token"] = self.get_csrf_token()
+
+        self.app.post("/releases/", r, status=200)
+
+        self.assertNotEqual(server.cache_key('home'), home_key)
+        self.assertNotEqual(server.cache_key('latest_candidates', u'bodhi', False), candidates_key)
+
     def test_get_single_release_html(self):
         res = self.app.get('/releases/f17', headers={'Accept': 'text/html'})
         self.assertEquals(res.content_type, 'text/html')
         self.assertIn('f17-updates-testing', res)
 
+    def test_get_release_stats(self):
+        """Assert that get_release_stats() aggregates the updates and overrides of a release."""
+        request = mock.Mock(db=self.db, cache=server.cache_region)
+
+        stats = releases.get_release_stats(request, u'F17')
+
+        self.assertEqual(
+            stats,
+            {'count': 1, 'date_commits': {'bugfix': {'1984/11': 1}}, 'dates': ['1984/11'],
+             'num_updates_pending': 1, 'num_updates_testing': 0, 'num_updates_stable': 0,
+             'num_updates_unpushed': 0, 'num_updates_obsolete': 0,
+             'num_updates_security': 0, 'num_updates_bugfix': 1, 'num_updates_enhancement': 0,
+             'num_updates_newpackage': 0,
+             'num_active_overrides': 1, 'num_expired_overrides': 0})
+
+    def test_get_release_stats_cached(self):
+        """Assert that the release statistics are cached until an update changes."""
+        server.configure_cache_region({'dogpile.cache.backend': 'dogpile.cache.memory'})
+        request = mock.Mock(db=self.db, cache=server.cache_region)
+        releases.get_release_stats(request, u'F17')
+        self.db.query(Update).one().status = UpdateStatus.testing
+        self.db.commit()
+
+        with mock.patch('bodhi.server.models.Update.counts') as counts:
+            counts.return_value = {u'F17': {}}
+            releases.get_release_stats(request, u'F17')
+            releases.get_release_stats(request, u'F17')
+
+        counts.assert_called_once_with(self.db, [u'F17'])
+
     def test_get_non_existent_release_html(self):
         self.app.get('/releases/x', headers={'Accept': 'text/html'}, status=404)
 
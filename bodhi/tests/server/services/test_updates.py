@@ -18,16 +18,17 @@ from datetime import datetime, timedelta
 import copy
 import textwrap
 import time
+import urllib
 import urlparse
 
 from mock import ANY
 from webtest import TestApp
 import mock
 
-from bodhi.server import main
+from bodhi.server import main, util
 from bodhi.server.config import config
 from bodhi.server.models import (
-    BuildrootOverride, Group, RpmPackage, ModulePackage, Release,
+    Bug, BuildrootOverride, Group, RpmPackage, ModulePackage, Release,
     ReleaseState, RpmBuild, Update, UpdateRequest, UpdateStatus, UpdateType,
     UpdateSeverity, User, TestGatingStatus)
 from bodhi.tests.server import base
@@ -1017,6 +1018,33 @@ class TestUpdatesService(base.BaseTestCase):
         self.assertEquals(up['url'],
                           (urlparse.urljoin(config['base_address'], '/updates/%s' % alias)))
 
+    def test_list_updates_fields(self):
+        """Assert that only the requested fields are serialized."""
+        res = self.app.get('/updates/', {'fields': 'title,alias,submitter'})
+
+        self.assertEqual(res.json_body['total'], 1)
+        self.assertEqual(
+            res.json_body['updates'][0],
+            {'title': u'bodhi-2.0-1.fc17', 'alias': u'FEDORA-%s-a3bbe1a8f2' % YEAR,
+             'submitter': u'guest'})
+
+    def test_list_updates_exclude(self):
+        """Assert that the excluded fields are not serialized."""
+        res = self.app.get('/updates/', {'exclude': 'comments test_cases builds'})
+
+        up = res.json_body['updates'][0]
+        for key in ('comments', 'test_cases', 'builds'):
+            self.assertNotIn(key, up)
+        self.assertEqual(up['title'], u'bodhi-2.0-1.fc17')
+        self.assertEqual(up['content_type'], u'rpm')
+        self.assertEqual(up['karma'], 1)
+
+    def test_list_updates_unknown_fields(self):
+        """Assert that fields that don't exist are ignored."""
+        res = self.app.get('/updates/', {'fields': 'title,doesnotexist'})
+
+        self.assertEqual(res.json_body['updates'][0], {'title': u'bodhi-2.0-1.fc17'})
+
     def test_list_updates_jsonp(self):
         res = self.app.get('/updates/',
                            {'callback': 'callback'},
@@ -1081,6 +1109,32 @@ class TestUpdatesService(base.BaseTestCase):
         up = body['updates'][0]
         self.assertEquals(up['title'], u'bodhi-2.0-1.fc17')
 
+    def test_updates_search_notes(self):
+        """Assert that the updates/?search= endpoint searches the notes of the updates."""
+        res = self.app.get('/updates/', {'search': 'details'})
+
+        self.assertEqual([u['title'] for u in res.json_body['updates']], [u'bodhi-2.0-1.fc17'])
+
+    def test_updates_search_bug_titles(self):
+        """Assert that the updates/?search= endpoint searches the titles of the updates' bugs."""
+        self.db.query(Bug).filter_by(bug_id=12345).one().title = u'Segfault on startup'
+        self.db.commit()
+
+        res = self.app.get('/updates/', {'search': 'segfault'})
+
+        self.assertEqual([u['title'] for u in res.json_body['updates']], [u'bodhi-2.0-1.fc17'])
+
+    @mock.patch(**mock_valid_requirements)
+    def test_updates_search_paged_by_number(self, *args):
+        """Assert that search results, which are ranked, are paged by number and not by cursor."""
+        self.app.post_json('/updates/', self.get_update('bodhi-2.0.0-2.fc17'))
+
+        res = self.app.get('/updates/', {'search': 'bodhi-2.0', 'rows_per_page': 1})
+
+        self.assertEqual(len(res.json_body['updates']), 1)
+        self.assertEqual(res.json_body['pages'], 2)
+        self.assertIsNone(res.json_body['next_cursor'])
+
     @mock.patch(**mock_valid_requirements)
     def test_list_updates_pagination(self, *args):
 
@@ -1102,6 +1156,96 @@ class TestUpdatesService(base.BaseTestCase):
 
         self.assertNotEquals(update1, update2)
 
+    @mock.patch(**mock_valid_requirements)
+    def test_list_updates_cursor(self, *args):
+        """Assert that the next_cursor of a page returns the next page."""
+        self.app.post_json('/updates/', self.get_update('bodhi-2.0.0-2.fc17'))
+
+        res = self.app.get('/updates/', {"rows_per_page": 1})
+        body = res.json_body
+        self.assertEqual([u['title'] for u in body['updates']], [u'bodhi-2.0.0-2.fc17'])
+        self.assertEqual(body['total'], 2)
+        self.assertIsNotNone(body['next_cursor'])
+
+        res = self.app.get('/updates/', {"rows_per_page": 1, "cursor": body['next_cursor']})
+        body = res.json_body
+        self.assertEqual([u['title'] for u in body['updates']], [u'bodhi-2.0-1.fc17'])
+        self.assertIsNone(body['next_cursor'])
+        # Cursors don't count the results unless asked to.
+        self.assertIsNone(body['page'])
+        self.assertIsNone(body['pages'])
+        self.assertIsNone(body['total'])
+
+    @mock.patch(**mock_valid_requirements)
+    def test_list_updates_cursor_total(self, *args):
+        """Assert that the results are counted for cursors if total is true."""
+        self.app.post_json('/updates/', self.get_update('bodhi-2.0.0-2.fc17'))
+        cursor = self.app.get('/updates/', {"rows_per_page": 1}).json_body['next_cursor']
+
+        res = self.app.get('/updates/', {"rows_per_page": 1, "cursor": cursor, "total": "true"})
+
+        self.assertEqual(res.json_body['total'], 2)
+        self.assertEqual(res.json_body['pages'], 2)
+
+    def test_list_updates_no_total(self):
+        """Assert that numbered pages are not counted if total is false."""
+        res = self.app.get('/updates/', {"total": "false"})
+
+        self.assertEqual(len(res.json_body['updates']), 1)
+        self.assertEqual(res.json_body['page'], 1)
+        self.assertIsNone(res.json_body['total'])
+
+    def test_list_updates_invalid_cursor(self):
+        """Assert that a cursor that bodhi didn't make is rejected."""
+        res = self.app.get('/updates/', {"cursor": "garbage"}, status=400)
+
+        self.assertEqual(res.json_body['errors'][0]['name'], 'cursor')
+
+    def test_list_updates_cursor_wrong_key(self):
+        """Assert that a cursor made for another list of results is rejected."""
+        cursor = util.encode_cursor([u'bodhi', 1])
+
+        res = self.app.get('/updates/', {"cursor": cursor}, status=400)
+
+        self.assertEqual(res.json_body['status'], 'error')
+        self.assertEqual(res.json_body['errors'][0]['name'], 'cursor')
+        self.assertEqual(res.json_body['errors'][0]['location'], 'querystring')
+
+    def test_list_updates_cursor_wrong_key_html(self):
+        """Assert that HTML clients get the HTML error page for a cursor of another list."""
+        cursor = util.encode_cursor([u'bodhi', 1])
+
+        res = self.app.get('/updates/', {"cursor": cursor}, headers={'Accept': 'text/html'},
+                           status=400)
+
+        self.assertIn('text/html', res.headers['Content-Type'])
+        self.assertIn('Invalid cursor', res)
+
+    @mock.patch(**mock_valid_requirements)
+    def test_list_updates_cursor_html(self, *args):
+        """Assert that the HTML pager links to the next page of a cursor."""
+        self.app.post_json('/updates/', self.get_update('bodhi-2.0.0-2.fc17'))
+        self.app.post_json('/updates/', self.get_update('bodhi-2.0.0-3.fc17'))
+        cursor = self.app.get('/updates/', {"rows_per_page": 1}).json_body['next_cursor']
+
+        res = self.app.get('/updates/', {"rows_per_page": 1, "cursor": cursor},
+                           headers={'Accept': 'text/html'})
+
+        next_cursor = self.app.get(
+            '/updates/', {"rows_per_page": 1, "cursor": cursor}).json_body['next_cursor']
+        self.assertIn('text/html', res.headers['Content-Type'])
+        self.assertIn('bodhi-2.0.0-2.fc17', res)
+        self.assertIn(urllib.urlencode({'cursor': next_cursor}), res)
+        self.assertNotIn('Page None', res)
+
+    def test_list_updates_no_total_html(self):
+        """Assert that the HTML pager works when the results aren't counted."""
+        res = self.app.get('/updates/', {"total": "false"}, headers={'Accept': 'text/html'})
+
+        self.assertIn('text/html', res.headers['Content-Type'])
+        self.assertIn('bodhi-2.0-1.fc17', res)
+        self.assertIn('Page 1</span>', res)
+
     def test_list_updates_by_approved_since(self):
         now = datetime.utcnow()
 
@@ -16,6 +16,7 @@
 """This test suite contains tests for bodhi.server.__init__."""
 import unittest
 
+from dogpile.cache.api import NO_VALUE
 from pyramid import authentication, authorization
 import mock
 
@@ -92,6 +93,80 @@ class TestMain(base.BaseTestCase):
         self.assertEqual(config['test'], 'setting')
 
 
+class TestCacheRegion(unittest.TestCase):
+    """Test the process-wide cache region and its helpers."""
+
+    def setUp(self):
+        """Configure the cache region with a fresh memory backend."""
+        server.configure_cache_region({'dogpile.cache.backend': 'dogpile.cache.memory'})
+
+    def test_get_cacheregion_shared(self):
+        """Assert that every request gets the same region."""
+        self.assertIs(server.get_cacheregion(mock.Mock()), server.cache_region)
+        self.assertIs(server.get_cacheregion(mock.Mock()), server.cache_region)
+
+    def test_cache_key_namespaced(self):
+        """Assert that keys are namespaced and do not contain spaces."""
+        key = server.cache_key('avatar', u'bowlofeggs', 24)
+
+        self.assertTrue(key.startswith('bodhi:avatar:0:'))
+        self.assertNotIn(' ', key)
+        self.assertNotEqual(key, server.cache_key('avatar', u'bowlofeggs', 48))
+        self.assertNotEqual(key, server.cache_key('other', u'bowlofeggs', 24))
+
+    def test_cache_on_arguments(self):
+        """Assert that values are shared between decorated functions in the same namespace."""
+        calls = []
+
+        def work(username):
+            calls.append(username)
+            return username.upper()
+
+        first = server.cache_region.cache_on_arguments(namespace='test')(work)
+        second = server.cache_region.cache_on_arguments(namespace='test')(work)
+
+        self.assertEqual(first(u'bowlofeggs'), u'BOWLOFEGGS')
+        self.assertEqual(second(u'bowlofeggs'), u'BOWLOFEGGS')
+        self.assertEqual(calls, [u'bowlofeggs'])
+
+    def test_invalidate_cache(self):
+        """Assert that invalidate_cache() only drops the values of the given namespaces."""
+        calls = []
+
+        def work(namespace):
+            calls.append(namespace)
+            return len(calls)
+
+        home = server.cache_region.cache_on_arguments(namespace='home')(work)
+        avatar = server.cache_region.cache_on_arguments(namespace='avatar')(work)
+        home('home')
+        avatar('avatar')
+
+        server.invalidate_cache('home')
+
+        self.assertEqual(home('home'), 3)
+        self.assertEqual(avatar('avatar'), 2)
+        self.assertEqual(calls, ['home', 'avatar', 'home'])
+        self.assertTrue(server.cache_key('home').startswith('bodhi:home:1:'))
+
+    @mock.patch.dict('bodhi.server.cache_region.__dict__')
+    def test_invalidate_cache_unconfigured(self):
+        """Assert that invalidate_cache() does nothing if the region is not configured."""
+        del server.cache_region.__dict__['backend']
+
+        server.invalidate_cache('home')
+
+        self.assertFalse(server.cache_region.is_configured)
+
+    def test_configure_replaces_backend(self):
+        """Assert that the region can be configured again, replacing the old backend."""
+        server.cache_region.set('key', 'value')
+
+        server.configure_cache_region({'dogpile.cache.backend': 'dogpile.cache.memory'})
+
+        self.assertEqual(server.cache_region.get('key'), NO_VALUE)
+
+
 class TestGetDbSessionForRequest(unittest.TestCase):
 
     def test_session_from_registry_sessionmaker(self):
@@ -100,3 +175,18 @@ class TestGetDbSessionForRequest(unittest.TestCase):
         session = server.get_db_session_for_request(mock_request)
         mock_request.registry.sessionmaker.assert_called_once_with()
         self.assertEqual(session, mock_request.registry.sessionmaker.return_value)
+
+
+class TestReleaseKojiSessions(unittest.TestCase):
+
+    @mock.patch('bodhi.server.buildsys.release_session')
+    def test_released_when_request_finishes(self, release_session):
+        """Assert the request's Koji sessions are handed back to the pool once it finishes."""
+        event = mock.Mock()
+
+        server.release_koji_sessions(event)
+
+        self.assertEqual(release_session.call_count, 0)
+        callback = event.request.add_finished_callback.mock_calls[0][1][0]
+        callback(event.request)
+        release_session.assert_called_once_with()
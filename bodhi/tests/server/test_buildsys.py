@@ -15,13 +15,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """This test suite contains tests for the bodhi.server.buildsys module."""
 
-from threading import Lock
+from threading import Lock, Thread
 import unittest
 
 import koji
 import mock
 
-from bodhi.server import buildsys
+from bodhi.server import buildsys, stats
 
 
 class TestBuildsystem(unittest.TestCase):
@@ -99,6 +99,21 @@ class TestGetKrbConf(unittest.TestCase):
         self.assertEqual(config, {'principal': 'a_principal'})
 
 
+class TestCountingClientSession(unittest.TestCase):
+    """This class contains tests for the CountingClientSession class."""
+
+    @mock.patch('bodhi.server.buildsys.koji.ClientSession._callMethod', return_value='result')
+    def test__callMethod(self, _callMethod):
+        """Assert that the calls are counted for the calling thread, and made."""
+        client = buildsys.CountingClientSession('http://example.com/koji', {})
+        calls = stats.get('koji_calls')
+
+        self.assertEqual(client.getBuild('bodhi-2.0-1.fc17'), 'result')
+
+        self.assertEqual(stats.get('koji_calls'), calls + 1)
+        _callMethod.assert_called_once_with('getBuild', ('bodhi-2.0-1.fc17',), {})
+
+
 class TestKojiLogin(unittest.TestCase):
     """This class contains tests for the koji_login() function."""
     # krb_login returns a bool to indicate success or failure
@@ -113,7 +128,7 @@ class TestKojiLogin(unittest.TestCase):
 
         client = buildsys.koji_login(config)
 
-        self.assertEqual(type(client), koji.ClientSession)
+        self.assertEqual(type(client), buildsys.CountingClientSession)
         error.assert_called_once_with('Koji krb_login failed')
 
     # krb_login returns a bool to indicate success or failure
@@ -138,7 +153,7 @@ class TestKojiLogin(unittest.TestCase):
         for key in default_koji_opts:
             self.assertEqual(default_koji_opts[key], client.opts[key])
 
-        self.assertEqual(type(client), koji.ClientSession)
+        self.assertEqual(type(client), buildsys.CountingClientSession)
         # No error should have been logged
         self.assertEqual(error.call_count, 0)
 
@@ -182,6 +197,24 @@ class TestSetupBuildsystem(unittest.TestCase):
         buildsys._buildsystem()
         mock_koji_login.assert_called_once_with(config=config)
 
+    @mock.patch('bodhi.server.buildsys._buildsystem', None)
+    @mock.patch('bodhi.server.buildsys._koji_session_pool', None)
+    @mock.patch('bodhi.server.buildsys.koji_login')
+    def test_koji_buildsystem_pool(self, mock_koji_login):
+        """Assert the koji buildsystem hands out sessions from a configured pool"""
+        config = {'buildsystem': 'koji', 'koji_session_pool.size': 3,
+                  'koji_session_pool.check_interval': 60}
+
+        buildsys.setup_buildsystem(config)
+
+        pool = buildsys._koji_session_pool
+        self.assertTrue(isinstance(pool, buildsys.KojiSessionPool))
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.check_interval, 60)
+        mock_koji_login.return_value.multicall = False
+        self.assertTrue(buildsys.get_session() is mock_koji_login.return_value)
+        mock_koji_login.assert_called_once_with(config=config)
+
     @mock.patch('bodhi.server.buildsys._buildsystem', None)
     def test_dev_buildsystem(self):
         """Assert the buildsystem initializes correctly for dev"""
@@ -195,3 +228,169 @@ class TestSetupBuildsystem(unittest.TestCase):
         self.assertTrue(buildsys._buildsystem is None)
         self.assertRaises(ValueError, buildsys.setup_buildsystem,
                           {'buildsystem': 'Something unsupported'})
+
+
+class TestKojiSessionPool(unittest.TestCase):
+    """Tests :class:`bodhi.server.buildsys.KojiSessionPool`"""
+
+    def setUp(self):
+        self.sessions = []
+
+        def login():
+            session = mock.MagicMock()
+            session.multicall = False
+            session._calls = []
+            self.sessions.append(session)
+            return session
+
+        self.login = login
+        self.pool = buildsys.KojiSessionPool(self.login, size=2, check_interval=300)
+
+    def test_get_reuses_thread_session(self):
+        """Assert that repeated calls in one thread share a single login"""
+        session = self.pool.get()
+
+        self.assertTrue(self.pool.get() is session)
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_get_skips_session_in_multicall(self):
+        """Assert that a session building a multicall is not handed out again"""
+        session = self.pool.get()
+        session.multicall = True
+
+        other = self.pool.get()
+
+        self.assertFalse(other is session)
+        self.assertEqual(len(self.sessions), 2)
+
+    def test_release_returns_sessions_to_pool(self):
+        """Assert that released sessions are reused instead of logging in again"""
+        session = self.pool.get()
+        session.multicall = True
+        session._calls = ['half', 'built']
+
+        self.pool.release()
+
+        self.assertFalse(session.multicall)
+        self.assertEqual(session._calls, [])
+        self.assertTrue(self.pool.get() is session)
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_release_full_pool_logs_out(self):
+        """Assert that sessions beyond the pool size are logged out when released"""
+        first = self.pool.get()
+        first.multicall = True
+        second = self.pool.get()
+        second.multicall = True
+        third = self.pool.get()
+
+        self.pool.release()
+
+        self.assertEqual(len(self.pool._idle), 2)
+        self.assertEqual(first.logout.call_count, 0)
+        self.assertEqual(second.logout.call_count, 0)
+        third.logout.assert_called_once_with()
+
+    def test_sessions_per_thread(self):
+        """Assert that concurrent threads get their own sessions"""
+        main_session = self.pool.get()
+        seen = []
+
+        def work():
+            seen.append(self.pool.get())
+            self.pool.release()
+
+        thread = Thread(target=work)
+        thread.start()
+        thread.join()
+
+        self.assertFalse(seen[0] is main_session)
+        self.assertEqual(self.pool._idle[0][0], seen[0])
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_login_holds_login_lock(self, time):
+        """Assert that the pool logs sessions in while holding its login lock"""
+        locked = []
+
+        def login():
+            locked.append(self.pool._login_lock.locked())
+            session = mock.MagicMock()
+            session.multicall = False
+            session.getLoggedInUser.return_value = None
+            return session
+
+        self.pool._login = login
+        time.return_value = 1000
+        self.pool.get()
+        time.return_value = 2000
+        # The checked out session fails its health check, so it is logged in again.
+        self.pool.get()
+
+        self.assertEqual(locked, [True, True])
+        self.assertFalse(self.pool._login_lock.locked())
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_expired_idle_session_is_replaced(self, time):
+        """Assert that an idle session that fails its health check is logged in again"""
+        time.return_value = 1000
+        session = self.pool.get()
+        self.pool.release()
+        session.getLoggedInUser.side_effect = koji.AuthExpired('ticket expired')
+        time.return_value = 2000
+
+        new_session = self.pool.get()
+
+        self.assertFalse(new_session is session)
+        session.logout.assert_called_once_with()
+        self.assertEqual(len(self.sessions), 2)
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_healthy_idle_session_is_reused(self, time):
+        """Assert that an idle session that passes its health check is reused"""
+        time.return_value = 1000
+        session = self.pool.get()
+        self.pool.release()
+        session.getLoggedInUser.return_value = {'name': 'bodhi'}
+        time.return_value = 2000
+
+        self.assertTrue(self.pool.get() is session)
+        session.getLoggedInUser.assert_called_once_with()
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_checked_out_session_relogin(self, time):
+        """Assert that a session held by a thread is replaced once its ticket expires"""
+        time.return_value = 1000
+        session = self.pool.get()
+        session.getLoggedInUser.return_value = None
+        time.return_value = 2000
+
+        new_session = self.pool.get()
+
+        self.assertFalse(new_session is session)
+        self.assertTrue(self.pool.get() is new_session)
+
+    def test_clear(self):
+        """Assert that clear() logs out all idle sessions"""
+        session = self.pool.get()
+        self.pool.release()
+
+        self.pool.clear()
+
+        session.logout.assert_called_once_with()
+        self.assertEqual(self.pool._idle, [])
+
+
+class TestReleaseSession(unittest.TestCase):
+    """Tests :func:`bodhi.server.buildsys.release_session` function"""
+
+    @mock.patch('bodhi.server.buildsys._koji_session_pool')
+    def test_release_pooled(self, pool):
+        """Assert that release_session() hands sessions back to the pool"""
+        buildsys.release_session()
+
+        pool.release.assert_called_once_with()
+
+    @mock.patch('bodhi.server.buildsys._koji_session_pool', None)
+    def test_release_unpooled(self):
+        """Assert that release_session() is a no-op without a pool"""
+        buildsys.release_session()
@@ -0,0 +1,263 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test module contains tests for bodhi.server.mail."""
+
+from datetime import datetime, timedelta
+import asyncore
+import json
+import smtpd
+import threading
+import unittest
+
+import mock
+
+from bodhi.server import mail, models
+from bodhi.tests.server import base
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """A local stand-in for the SMTP server, keeping the messages it receives."""
+
+    def __init__(self):
+        """Listen on a free port of localhost."""
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+        self.broken = False
+
+    def handle_accept(self):
+        """Count the connections."""
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        """Keep the message, or refuse it if the server is broken."""
+        if self.broken:
+            return '451 Try again later'
+        self.messages.append((mailfrom, rcpttos, data))
+
+    @property
+    def address(self):
+        """Return the address of this server, as the smtp_server setting."""
+        return '127.0.0.1:%d' % self.socket.getsockname()[1]
+
+
+class BaseMailTestCase(base.BaseTestCase):
+    """Run an SMTPServer for each test, and configure it as the smtp_server."""
+
+    def setUp(self):
+        """Start the server."""
+        super(BaseMailTestCase, self).setUp()
+        self.server = SMTPServer()
+        self.server_thread = threading.Thread(target=asyncore.loop, args=(0.01,))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        config = mock.patch.dict('bodhi.server.mail.config', {
+            'smtp_server': self.server.address, 'bodhi_email': 'updates@example.com',
+            'exclude_mail': ['autoqa', 'taskotron']})
+        config.start()
+        self.addCleanup(config.stop)
+        # The tests drain the outbox themselves, rather than from a thread.
+        get_outbox = mock.patch('bodhi.server.mail.get_outbox')
+        get_outbox.start()
+        self.addCleanup(get_outbox.stop)
+
+    def tearDown(self):
+        """Stop the server."""
+        asyncore.close_all()
+        self.server_thread.join(10)
+        super(BaseMailTestCase, self).tearDown()
+
+    def _outbox(self):
+        """Return the messages in the outbox, oldest first."""
+        self.db.expire_all()
+        return self.db.query(models.OutboxMail).order_by(models.OutboxMail.id).all()
+
+
+class TestSendMail(BaseMailTestCase):
+    """This test class contains tests for the send_mail() function."""
+
+    def test_queued(self):
+        """Assert that the message is queued in the session once, for all of its recipients."""
+        mail.send_mail(None, ['bowlofeggs@example.com', 'autoqa', 'lmacken@example.com'],
+                       u'Subject', u'Body', headers={'X-Bodhi-Update-Pushed': True})
+        self.db.flush()
+
+        messages = self._outbox()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].from_addr, u'updates@example.com')
+        self.assertEqual(json.loads(messages[0].recipients),
+                         [u'bowlofeggs@example.com', u'lmacken@example.com'])
+        self.assertEqual((messages[0].subject, messages[0].body), (u'Subject', u'Body'))
+        self.assertEqual(json.loads(messages[0].headers), {u'X-Bodhi-Update-Pushed': u'True'})
+        self.assertEqual(messages[0].attempts, 0)
+        self.assertTrue(self.db.info['mail'])
+        self.assertEqual(self.server.messages, [])
+
+    def test_excluded(self):
+        """Assert that nothing is queued if all of the recipients are excluded."""
+        mail.send_mail(None, 'autoqa', u'Subject', u'Body')
+        self.db.flush()
+
+        self.assertEqual(self._outbox(), [])
+
+    def test_no_smtp_server(self):
+        """Assert that nothing is queued if there is no SMTP server."""
+        with mock.patch.dict('bodhi.server.mail.config', {'smtp_server': None}):
+            mail.send_mail(None, 'bowlofeggs@example.com', u'Subject', u'Body')
+        self.db.flush()
+
+        self.assertEqual(self._outbox(), [])
+
+    def test_force(self):
+        """Assert that a forced message is sent right away, over one connection."""
+        mail.send_mail(None, ['bowlofeggs@example.com', 'lmacken@example.com'], u'Subject',
+                       u'Body', force=True)
+        self.db.flush()
+
+        self.assertEqual(self._outbox(), [])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([m[1] for m in self.server.messages],
+                         [['bowlofeggs@example.com'], ['lmacken@example.com']])
+        self.assertEqual(
+            self.server.messages[1][2],
+            ('From: updates@example.com\nTo: lmacken@example.com\nX-Bodhi: fedoraproject.org\n'
+             'Subject: Subject\n\nBody'))
+
+
+class TestSend(BaseMailTestCase):
+    """This test class contains tests for the send() function."""
+
+    def test_one_message(self):
+        """Assert that the notification is rendered and queued once for all the recipients."""
+        update = self.db.query(models.Update).one()
+
+        mail.send(set(['bowlofeggs@example.com', 'lmacken@example.com']), 'comment', update,
+                  agent=u'bodhi')
+        self.db.flush()
+
+        messages = self._outbox()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(sorted(json.loads(messages[0].recipients)),
+                         [u'bowlofeggs@example.com', u'lmacken@example.com'])
+        self.assertEqual(messages[0].subject,
+                         u'[Fedora Update] [comment] bodhi-2.0-1.fc17')
+
+
+class TestWakeOutboxAfterCommit(unittest.TestCase):
+    """This test class contains tests for the wake_outbox_after_commit() function."""
+
+    @mock.patch('bodhi.server.mail.get_outbox')
+    def test_wake(self, get_outbox):
+        """Assert that the outbox is woken up once after a commit that queued mail."""
+        session = mock.Mock(info={'mail': True})
+
+        mail.wake_outbox_after_commit(session)
+        mail.wake_outbox_after_commit(session)
+
+        get_outbox.return_value.wake.assert_called_once_with()
+
+    @mock.patch('bodhi.server.mail.get_outbox')
+    def test_no_mail(self, get_outbox):
+        """Assert that the outbox isn't woken up after a commit without mail."""
+        mail.wake_outbox_after_commit(mock.Mock(info={}))
+
+        self.assertEqual(get_outbox.call_count, 0)
+
+
+class TestOutbox(BaseMailTestCase):
+    """This test class contains tests for the Outbox class."""
+
+    def setUp(self):
+        """Create an outbox that uses the test database."""
+        super(TestOutbox, self).setUp()
+        self.outbox = mail.Outbox(max_attempts=3, retry_delay=60, batch_size=2,
+                                  db_factory=base.TransactionalSessionMaker(self.Session))
+
+    def _queue(self, count):
+        """Queue the given number of messages, each to two recipients."""
+        for i in range(count):
+            mail.send_mail(None, ['bowlofeggs@example.com', 'lmacken@example.com'],
+                           u'Message %d' % i, u'Body')
+        self.db.flush()
+
+    def test_drain(self):
+        """Assert that the messages are sent in batches, one connection per batch."""
+        self._queue(3)
+
+        self.assertIsNone(self.outbox.drain())
+
+        self.assertEqual(self._outbox(), [])
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 6)
+        self.assertIn('Subject: Message 2', self.server.messages[-1][2])
+
+    def test_retry(self):
+        """Assert that a message that can't be sent is retried later, with backoff."""
+        self._queue(1)
+        self.server.broken = True
+
+        wait = self.outbox.drain()
+
+        self.assertTrue(55 < wait <= 60)
+        messages = self._outbox()
+        self.assertEqual(messages[0].attempts, 1)
+        self.assertEqual(json.loads(messages[0].recipients),
+                         [u'bowlofeggs@example.com', u'lmacken@example.com'])
+
+        messages[0].next_attempt = datetime.utcnow() - timedelta(seconds=1)
+        self.db.flush()
+        wait = self.outbox.drain()
+
+        self.assertTrue(115 < wait <= 120)
+        self.assertEqual(self._outbox()[0].attempts, 2)
+
+        messages = self._outbox()
+        messages[0].next_attempt = datetime.utcnow() - timedelta(seconds=1)
+        self.db.flush()
+        self.server.broken = False
+
+        self.assertIsNone(self.outbox.drain())
+        self.assertEqual(self._outbox(), [])
+        self.assertEqual(len(self.server.messages), 2)
+
+    @mock.patch('bodhi.server.mail.log.error')
+    def test_give_up(self, error):
+        """Assert that a message is dropped after max_attempts failed attempts."""
+        self._queue(1)
+        self.server.broken = True
+        messages = self._outbox()
+        messages[0].attempts = 2
+        self.db.flush()
+
+        self.assertIsNone(self.outbox.drain())
+
+        self.assertEqual(self._outbox(), [])
+        error.assert_called_once_with(
+            'Giving up on sending %r to %s after %d attempts', u'Message 0',
+            u'bowlofeggs@example.com, lmacken@example.com', 3)
+
+    def test_claimed(self):
+        """Assert that the messages another process claimed aren't sent."""
+        self._queue(1)
+        messages = self._outbox()
+        messages[0].next_attempt = datetime.utcnow() + timedelta(
+            seconds=mail.Outbox.claim_seconds)
+        self.db.flush()
+
+        wait = self.outbox.drain()
+
+        self.assertTrue(0 < wait <= mail.Outbox.claim_seconds)
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(self.server.connections, 0)
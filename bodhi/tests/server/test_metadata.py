@@ -21,18 +21,22 @@ from datetime import datetime
 from hashlib import sha256
 from os.path import join, exists, basename
 import glob
+import json
 import os
 import shutil
 import tempfile
+import unittest
 
+from sqlalchemy import inspect
 import createrepo_c
+import mock
 
 from bodhi.server.buildsys import (setup_buildsystem, teardown_buildsystem,
                                    DevBuildsys)
 from bodhi.server.config import config
-from bodhi.server.models import (Release, RpmPackage, Update, RpmBuild, UpdateRequest, UpdateStatus,
-                                 UpdateType)
-from bodhi.server.metadata import ExtendedMetadata
+from bodhi.server.models import (Bug, Release, RpmPackage, Update, RpmBuild, UpdateRequest,
+                                 UpdateStatus, UpdateType)
+from bodhi.server.metadata import ExtendedMetadata, NoticeStore
 from bodhi.server.util import mkmetadatadir
 from bodhi.tests.server import base
 
@@ -118,6 +122,176 @@ class TestAddUpdate(base.BaseTestCase):
         self.assertEquals(pkg.filename, 'TurboGears-1.0.2.2-2.fc17.noarch.rpm')
 
 
+class TestFetchUpdates(base.BaseTestCase):
+    """
+    This class contains tests for the ExtendedMetadata._fetch_updates() method.
+    """
+    def setUp(self):
+        """
+        Initialize our temporary repo.
+        """
+        super(TestFetchUpdates, self).setUp()
+        setup_buildsystem({'buildsystem': 'dev'})
+        self.tempdir = tempfile.mkdtemp('bodhi')
+        self.temprepo = join(self.tempdir, 'f17-updates-testing')
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'i386'))
+
+    def tearDown(self):
+        """
+        Clean up the tempdir.
+        """
+        super(TestFetchUpdates, self).tearDown()
+        teardown_buildsystem()
+        shutil.rmtree(self.tempdir)
+
+    @mock.patch('bodhi.server.metadata.DB_CHUNK_SIZE', 1)
+    @mock.patch('bodhi.server.metadata.log')
+    def test_bulk_lookups(self, log):
+        """Assert that the tagged builds are looked up in chunks, without loading comments."""
+        update = self.db.query(Update).one()
+        release = update.release
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        pkg = self.db.query(RpmPackage).filter_by(name=u'bodhi').one()
+        self.db.add(RpmBuild(nvr=u'bodhi-2.0-2.fc17', package=pkg))
+        DevBuildsys.__tagged__[u'bodhi-2.0-2.fc17'] = ['f17-updates-testing']
+        DevBuildsys.__tagged__[u'bodhi-2.0-3.fc17'] = ['f17-updates-testing']
+        self.db.flush()
+        update_id = update.id
+        self.db.expunge_all()
+
+        md = ExtendedMetadata(release, UpdateRequest.testing, self.db, self.temprepo)
+
+        self.assertEqual([u.id for u in md.updates], [update_id])
+        update = list(md.updates)[0]
+        self.assertNotIn('comments', inspect(update).dict)
+        self.assertEqual([b.nvr for b in update.builds], [u'bodhi-2.0-1.fc17'])
+        self.assertEqual(len(update.bugs), 1)
+        self.assertEqual(len(update.cves), 1)
+        log.warn.assert_called_once_with('bodhi-2.0-2.fc17 does not have a corresponding update')
+        self.assertIn(u'bodhi-2.0-3.fc17', log.warning.mock_calls[0][1][0])
+
+
+class TestFetchRpms(base.BaseTestCase):
+    """
+    This class contains tests for the ExtendedMetadata._fetch_rpms() method.
+    """
+    def setUp(self):
+        """
+        Initialize our temporary repo.
+        """
+        super(TestFetchRpms, self).setUp()
+        setup_buildsystem({'buildsystem': 'dev'})
+        self.tempdir = tempfile.mkdtemp('bodhi')
+        self.temprepo = join(self.tempdir, 'f17-updates-testing')
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'i386'))
+        self.update = self.db.query(Update).one()
+        self.md = ExtendedMetadata(self.update.release, self.update.request, self.db,
+                                   self.temprepo)
+        self.md.rpms = {}
+
+    def tearDown(self):
+        """
+        Clean up the tempdir.
+        """
+        super(TestFetchRpms, self).tearDown()
+        teardown_buildsystem()
+        shutil.rmtree(self.tempdir)
+
+    def test___init___fetches_rpms(self):
+        """Assert that the RPMs of the updates are fetched when the metadata is generated."""
+        md = ExtendedMetadata(self.update.release, self.update.request, self.db, self.temprepo)
+
+        self.assertEqual(md.rpms.keys(), [u'bodhi-2.0-1.fc17'])
+        self.assertEqual([rpm['arch'] for rpm in md.rpms[u'bodhi-2.0-1.fc17']], ['src', 'noarch'])
+
+    @mock.patch('bodhi.server.metadata.get_session')
+    def test_multicalls(self, get_session):
+        """Assert that builds missing from self.builds are looked up and listed with multicalls."""
+        koji = get_session.return_value
+        rpms = [{'arch': 'src', 'nvr': 'bodhi-2.0-1.fc17'}]
+        koji.multiCall.side_effect = [[[{'id': 42}]], [[rpms]]]
+
+        self.md._fetch_rpms([self.update])
+
+        koji.getBuild.assert_called_once_with(u'bodhi-2.0-1.fc17')
+        koji.listBuildRPMs.assert_called_once_with(42)
+        self.assertEqual(koji.multiCall.call_count, 2)
+        self.assertEqual(self.md.rpms, {u'bodhi-2.0-1.fc17': rpms})
+
+    @mock.patch('bodhi.server.metadata.get_session')
+    def test_known_builds_are_not_looked_up(self, get_session):
+        """Assert that the builds in self.builds are only listed."""
+        koji = get_session.return_value
+        koji.multiCall.return_value = [[[]]]
+        self.md.builds[u'bodhi-2.0-1.fc17'] = {'id': 42}
+
+        self.md._fetch_rpms([self.update])
+
+        self.assertEqual(koji.getBuild.call_count, 0)
+        koji.listBuildRPMs.assert_called_once_with(42)
+        self.assertEqual(self.md.rpms, {u'bodhi-2.0-1.fc17': []})
+
+    @mock.patch('bodhi.server.metadata.get_session')
+    def test_faults_are_left_for_add_update(self, get_session):
+        """Assert that builds the multicalls fail to fetch are fetched again by add_update()."""
+        koji = get_session.return_value
+        koji.multiCall.return_value = [{'faultCode': 1000, 'faultString': 'No such build'}]
+
+        self.md._fetch_rpms([self.update])
+
+        self.assertEqual(self.md.rpms, {})
+        self.assertEqual(koji.listBuildRPMs.call_count, 0)
+
+    @mock.patch('bodhi.server.metadata.get_session')
+    def test_multicall_exception(self, get_session):
+        """Assert that an exception from Koji is logged, and leaves the RPMs to add_update()."""
+        koji = get_session.return_value
+        koji.multiCall.side_effect = IOError('Koji is down')
+
+        with mock.patch('bodhi.server.metadata.log.exception') as exception:
+            self.md._fetch_rpms([self.update])
+
+        self.assertEqual(self.md.rpms, {})
+        self.assertFalse(koji.multicall)
+        exception.assert_called_once_with('Unable to fetch the RPMs of %r from Koji',
+                                          [u'bodhi-2.0-1.fc17'])
+
+    @mock.patch.dict('bodhi.server.metadata.config',
+                     {'updateinfo_koji_chunk_size': 2, 'updateinfo_koji_threads': 2})
+    @mock.patch('bodhi.server.metadata.release_session')
+    def test_chunks_in_threads(self, release_session):
+        """Assert that the builds are split in chunks, which are fetched in threads."""
+        nvrs = [u'nethack-3.4.%d-1.fc17' % i for i in range(5)]
+        update = mock.MagicMock()
+        update.builds = [mock.MagicMock(nvr=nvr) for nvr in nvrs]
+
+        with mock.patch.object(DevBuildsys, 'multiCall', autospec=True,
+                               side_effect=DevBuildsys.multiCall) as multiCall:
+            self.md._fetch_rpms([update])
+
+        self.assertEqual(sorted(self.md.rpms.keys()), nvrs)
+        # Each of the three chunks needs a multicall to look up its builds and another to list
+        # their RPMs.
+        self.assertEqual(multiCall.call_count, 6)
+        self.assertEqual(release_session.call_count, 3)
+
+    @mock.patch('bodhi.server.metadata.get_session')
+    def test_fetched_rpms_are_used(self, get_session):
+        """Assert that add_update() uses the fetched RPMs instead of asking Koji again."""
+        koji = get_session.return_value
+        self.md.rpms[u'bodhi-2.0-1.fc17'] = [{
+            'arch': 'x86_64', 'epoch': 1, 'name': 'bodhi', 'nvr': 'bodhi-2.0-1.fc17',
+            'release': '1.fc17', 'version': '2.0'}]
+
+        self.md.add_update(self.update)
+
+        self.assertEqual(koji.getBuild.call_count, 0)
+        self.assertEqual(koji.listBuildRPMs.call_count, 0)
+        pkg = self.md.uinfo.updates[-1].collections[0].packages[0]
+        self.assertEqual(pkg.filename, 'bodhi-2.0-1.fc17.x86_64.rpm')
+        self.assertEqual(pkg.epoch, '1')
+
+
 class TestExtendedMetadata(base.BaseTestCase):
 
     def setUp(self):
@@ -174,10 +348,11 @@ class TestExtendedMetadata(base.BaseTestCase):
 
     def test___init___checks_existence_if_repomd_xml(self):
         """
-        The __init__() method has a test for finding cached repodata. It used to check for the
-        existence of a repodata folder, but this caused crashes sometimes because due to an unsolved
-        bug[0] this directory sometimes does not contain a repomd.xml file. This test ensures that
-        the existence of the repomd.xml file itself is tested to decide if it can load a cache.
+        The __init__() method imports the repodata that older versions of bodhi cached. It used to
+        check for the existence of a repodata folder, but this caused crashes sometimes because due
+        to an unsolved bug[0] this directory sometimes does not contain a repomd.xml file. This test
+        ensures that the existence of the repomd.xml file itself is tested to decide if it can
+        import a cache.
 
         [0] https://github.com/fedora-infra/bodhi/issues/887
         """
@@ -189,9 +364,11 @@ class TestExtendedMetadata(base.BaseTestCase):
         DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
         # Generate the XML
         md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
-        # Insert the updateinfo.xml into the repository
+        # Insert the updateinfo.xml into the repository, and cache the repodata like older versions
+        # of bodhi did.
         md.insert_updateinfo()
-        md.cache_repodata()
+        shutil.copytree(self.repodata,
+                        join(self.temprepo, '..', 'f17-updates-testing.repocache', 'repodata'))
         updateinfo = self._verify_updateinfo(self.repodata)
         # Change the notes on the update, but not the date_modified. Since this test deletes
         # repomd.xml the cached notes should be ignored and we should see this 'x' in the notes.
@@ -216,6 +393,126 @@ class TestExtendedMetadata(base.BaseTestCase):
         # Since 'x' made it into the xml, we know it didn't use the cache.
         self.assertEquals(notice.description, u'x')  # not u'Useful details!'
 
+    def test___init___imports_cached_repodata(self):
+        """
+        Assert that the notices of the repodata cached by older versions of bodhi are imported, and
+        that the cached repodata is removed once the notices are cached instead.
+        """
+        update = self.db.query(Update).one()
+        update.request = None
+        update.type = UpdateType.security
+        update.status = UpdateStatus.stable
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates']
+        repo = join(self.tempdir, 'f17-updates')
+        mkmetadatadir(join(repo, 'f17-updates', 'i386'))
+        self.repodata = join(repo, 'f17-updates', 'i386', 'repodata')
+        md = ExtendedMetadata(update.release, UpdateRequest.stable, self.db, repo)
+        md.insert_updateinfo()
+        cache = join(repo, '..', 'f17-updates.repocache')
+        shutil.copytree(self.repodata, join(cache, 'repodata'))
+        # Untag the security update, so its notice can only come from the cache
+        DevBuildsys.__untag__.append(update.title)
+        shutil.rmtree(repo)
+        os.mkdir(repo)
+        mkmetadatadir(join(repo, 'f17-updates', 'i386'))
+
+        md = ExtendedMetadata(update.release, UpdateRequest.stable, self.db, repo)
+        md.insert_updateinfo()
+        md.cache_repodata()
+
+        self.assertEqual(md.aliases, [update.alias])
+        uinfo = createrepo_c.UpdateInfo(self._verify_updateinfo(self.repodata))
+        self.assertEqual([notice.id for notice in uinfo.updates], [update.alias])
+        self.assertEqual(uinfo.updates[0].type, 'security')
+        self.assertFalse(exists(join(cache, 'repodata')))
+        self.assertEqual(sorted(json.load(open(join(cache, 'notices', 'index.json')))),
+                         [update.alias])
+
+    def test_notice_regenerated_when_bugs_change(self):
+        """Assert that a cached notice is generated again when the update's bugs change."""
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        md.insert_updateinfo()
+        md.cache_repodata()
+        update.bugs.append(Bug(bug_id=54321))
+        self.db.flush()
+
+        with mock.patch.object(ExtendedMetadata, '_fetch_rpms') as _fetch_rpms:
+            md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+
+        _fetch_rpms.assert_called_once_with([update])
+        self.assertEqual(
+            sorted(ref.id for ref in md.uinfo.updates[0].references if ref.type == 'bugzilla'),
+            ['12345', '54321'])
+
+    def test_unchanged_notice_not_regenerated(self):
+        """Assert that the cached notices of unchanged updates are reused without parsing XML."""
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        md.insert_updateinfo()
+        md.cache_repodata()
+        xml = md.xml_dump()
+
+        with mock.patch('bodhi.server.metadata.cr.UpdateInfo') as UpdateInfo:
+            with mock.patch.object(ExtendedMetadata, 'add_update') as add_update:
+                md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+
+        self.assertEqual(add_update.call_count, 0)
+        # The only UpdateInfo is the empty one that __init__() creates for new notices
+        UpdateInfo.assert_called_once_with()
+        self.assertEqual(md.aliases, [update.alias])
+        self.assertEqual(md.xml_dump(), xml)
+
+    def _insert_into_two_arches(self):
+        """Insert the updateinfo of a pushed update into the i386 and x86_64 repodata."""
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'x86_64'))
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+
+        md.insert_updateinfo()
+
+        return [self._verify_updateinfo(join(self.temprepo, 'f17-updates-testing', arch,
+                                             'repodata'))
+                for arch in ('i386', 'x86_64')]
+
+    def test_insert_updateinfo_links_arches(self):
+        """Assert that updateinfo is compressed once, and hard linked into each arch."""
+        with mock.patch('bodhi.server.metadata.cr.RepomdRecord',
+                        side_effect=createrepo_c.RepomdRecord) as RepomdRecord:
+            i386, x86_64 = self._insert_into_two_arches()
+
+        self.assertEqual(RepomdRecord.call_count, 1)
+        self.assertEqual(basename(i386), basename(x86_64))
+        self.assertEqual(os.stat(i386).st_ino, os.stat(x86_64).st_ino)
+        for updateinfo in (i386, x86_64):
+            repomd = createrepo_c.Repomd(join(os.path.dirname(updateinfo), 'repomd.xml'))
+            records = [r for r in repomd.records if r.type == 'updateinfo']
+            self.assertEqual([r.location_href for r in records],
+                             ['repodata/%s' % basename(updateinfo)])
+        # The working directory is cleaned up
+        self.assertEqual(sorted(os.listdir(self.temprepo)), ['f17-updates-testing'])
+
+    def test_insert_updateinfo_copies_if_links_fail(self):
+        """Assert that updateinfo is copied into the arches if it can't be hard linked."""
+        with mock.patch('bodhi.server.metadata.os.link', side_effect=OSError('Cross-device link')):
+            i386, x86_64 = self._insert_into_two_arches()
+
+        self.assertNotEqual(os.stat(i386).st_ino, os.stat(x86_64).st_ino)
+        self.assertEqual(open(i386).read(), open(x86_64).read())
+
     def test___init___uses_bz2_for_epel(self):
         """Assert that the __init__() method sets the comp_type attribute to cr.BZ2 for EPEL."""
         epel_7 = Release(id_prefix="FEDORA-EPEL", stable_tag='epel7')
@@ -552,3 +849,72 @@ class TestExtendedMetadata(base.BaseTestCase):
         self.assertIsNone(notice)
         notice = self.get_notice(uinfo, 'bodhi-2.0-2.fc17')
         self.assertIsNotNone(notice)
+
+
+class TestNoticeStore(unittest.TestCase):
+    """This class contains tests for the NoticeStore class."""
+    def setUp(self):
+        """Create a directory for the store."""
+        self.tempdir = tempfile.mkdtemp('bodhi')
+        self.path = join(self.tempdir, 'notices')
+
+    def tearDown(self):
+        """Clean up the tempdir."""
+        shutil.rmtree(self.tempdir)
+
+    def test_put_and_save(self):
+        """Assert that the notices are only written when saved, and can be loaded again."""
+        store = NoticeStore(self.path)
+        store.put(u'FEDORA-2017-1', 'hash1', 'security', u'<update>\xe9</update>')
+
+        self.assertTrue(store.has(u'FEDORA-2017-1', 'hash1'))
+        self.assertFalse(store.has(u'FEDORA-2017-1', 'hash2'))
+        self.assertFalse(store.has(u'FEDORA-2017-1', None))
+        self.assertEqual(store.get(u'FEDORA-2017-1'), u'<update>\xe9</update>')
+        self.assertFalse(exists(self.path))
+
+        store.save([u'FEDORA-2017-1'])
+
+        store = NoticeStore(self.path)
+        self.assertTrue(store.has(u'FEDORA-2017-1', 'hash1'))
+        self.assertEqual(store.index[u'FEDORA-2017-1']['type'], 'security')
+        self.assertEqual(store.get(u'FEDORA-2017-1'), u'<update>\xe9</update>')
+        name = sha256(u'<update>\xe9</update>'.encode('utf-8')).hexdigest() + '.xml'
+        self.assertEqual(sorted(os.listdir(self.path)), [name, 'index.json'])
+
+    def test_save_forgets_other_notices(self):
+        """Assert that save() removes the notices that aren't kept, and their files."""
+        store = NoticeStore(self.path)
+        store.put(u'FEDORA-2017-1', 'hash1', 'bugfix', u'<update>1</update>')
+        store.put(u'FEDORA-2017-2', 'hash2', 'bugfix', u'<update>2</update>')
+        store.save([u'FEDORA-2017-1', u'FEDORA-2017-2'])
+
+        store.put(u'FEDORA-2017-1', 'hash3', 'bugfix', u'<update>3</update>')
+        store.save([u'FEDORA-2017-1'])
+
+        store = NoticeStore(self.path)
+        self.assertEqual(store.index.keys(), [u'FEDORA-2017-1'])
+        self.assertEqual(store.get(u'FEDORA-2017-1'), u'<update>3</update>')
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+    def test_missing_file(self):
+        """Assert that a notice whose file is missing can't be reused."""
+        store = NoticeStore(self.path)
+        store.put(u'FEDORA-2017-1', 'hash1', 'bugfix', u'<update>1</update>')
+        store.save([u'FEDORA-2017-1'])
+        os.unlink(join(self.path, store.index[u'FEDORA-2017-1']['file']))
+
+        self.assertFalse(NoticeStore(self.path).has(u'FEDORA-2017-1', 'hash1'))
+
+    @mock.patch('bodhi.server.metadata.log.exception')
+    def test_corrupt_index(self, exception):
+        """Assert that a corrupt index is logged and ignored."""
+        os.makedirs(self.path)
+        with open(join(self.path, 'index.json'), 'w') as index:
+            index.write('{')
+
+        store = NoticeStore(self.path)
+
+        self.assertEqual(store.index, {})
+        exception.assert_called_once_with('Ignoring the corrupt notice index %s',
+                                          join(self.path, 'index.json'))
@@ -0,0 +1,264 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test suite contains tests for bodhi.server.mirrors."""
+
+import BaseHTTPServer
+import hashlib
+import threading
+import time
+import unittest
+import urllib2
+
+import mock
+
+from bodhi.server import mirrors
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the files of a MirrorServer, with ETags."""
+
+    def do_GET(self):
+        """Serve the requested file, or a 304 if the client has it already."""
+        self.server.requests.append((self.path, self.headers.getheader('If-None-Match')))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        """Don't log the requests to stderr."""
+
+
+class MirrorServer(BaseHTTPServer.HTTPServer):
+    """A local stand-in for the master mirror, serving the files in its files dict."""
+
+    def __init__(self):
+        """Listen on a free port of localhost."""
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MirrorHandler)
+        self.files = {}
+        self.requests = []
+
+    def url(self, path):
+        """Return the URL of the given path on this server."""
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+
+class BaseMirrorTestCase(unittest.TestCase):
+    """Run a MirrorServer and a quick MirrorPoller for each test."""
+
+    def setUp(self):
+        """Start the server."""
+        self.server = MirrorServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.poller = mirrors.MirrorPoller(min_interval=0.01, max_interval=0.05, timeout=5)
+
+    def tearDown(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _wait_in_thread(self, expected):
+        """Call self.poller.wait() with the given dict in a thread, and return the thread."""
+        thread = threading.Thread(target=self.poller.wait, args=(expected,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _wait_for_requests(self, count):
+        """Wait until the server has had the given number of requests."""
+        for i in range(500):
+            if len(self.server.requests) >= count:
+                return
+            time.sleep(0.01)
+        self.fail('The server only had %d requests' % len(self.server.requests))
+
+
+class TestMirrorPoller(BaseMirrorTestCase):
+    """This test class contains tests for the MirrorPoller class."""
+
+    def test_match_immediately(self):
+        """Assert that wait() returns after one poll of each URL if they match."""
+        self.server.files = {'/x86_64/repomd.xml': 'x86_64', '/aarch64/repomd.xml': 'aarch64'}
+
+        self.poller.wait({
+            self.server.url('/x86_64/repomd.xml'): hashlib.sha1('x86_64').hexdigest(),
+            self.server.url('/aarch64/repomd.xml'): hashlib.sha1('aarch64').hexdigest()})
+
+        self.assertEqual(sorted(self.server.requests),
+                         [('/aarch64/repomd.xml', None), ('/x86_64/repomd.xml', None)])
+
+    def test_wait_for_change(self):
+        """Assert that unchanged files are polled with conditional requests until they change."""
+        self.server.files = {'/x86_64/repomd.xml': 'old'}
+
+        thread = self._wait_in_thread(
+            {self.server.url('/x86_64/repomd.xml'): hashlib.sha1('new').hexdigest()})
+        self._wait_for_requests(3)
+        self.assertTrue(thread.is_alive())
+        self.server.files['/x86_64/repomd.xml'] = 'new'
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        etag = '"%s"' % hashlib.sha1('old').hexdigest()
+        self.assertEqual(self.server.requests[0], ('/x86_64/repomd.xml', None))
+        self.assertEqual(self.server.requests[1], ('/x86_64/repomd.xml', etag))
+        self.assertEqual(self.server.requests[-1], ('/x86_64/repomd.xml', etag))
+
+    def test_errors(self):
+        """Assert that errors are logged, and the URL is polled until its file matches."""
+        thread = self._wait_in_thread(
+            {self.server.url('/x86_64/repomd.xml'): hashlib.sha1('new').hexdigest()})
+        with mock.patch('bodhi.server.mirrors.log.exception') as exception:
+            self._wait_for_requests(2)
+            self.server.files['/x86_64/repomd.xml'] = 'new'
+            thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        exception.assert_called_with('Error fetching %s' % self.server.url('/x86_64/repomd.xml'))
+
+    def test_waiters_share_the_poller(self):
+        """Assert that threads waiting at once share one polling thread, which then exits."""
+        self.server.files = {'/x86_64/repomd.xml': 'old', '/aarch64/repomd.xml': 'old'}
+        x86_64 = self._wait_in_thread(
+            {self.server.url('/x86_64/repomd.xml'): hashlib.sha1('new').hexdigest()})
+        aarch64 = self._wait_in_thread(
+            {self.server.url('/aarch64/repomd.xml'): hashlib.sha1('new').hexdigest()})
+        self._wait_for_requests(4)
+
+        self.assertEqual(
+            len([t for t in threading.enumerate() if t.name == 'MirrorPoller']), 1)
+
+        self.server.files['/x86_64/repomd.xml'] = 'new'
+        x86_64.join(10)
+        self.assertFalse(x86_64.is_alive())
+        self.assertTrue(aarch64.is_alive())
+        self.server.files['/aarch64/repomd.xml'] = 'new'
+        aarch64.join(10)
+        self.assertFalse(aarch64.is_alive())
+        for i in range(500):
+            if self.poller._thread is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.poller._thread)
+        self.assertEqual(self.poller._watches, {})
+
+    def test_same_url_resolves_immediately(self):
+        """Assert that a thread waiting for a URL that is already matched doesn't wait."""
+        self.server.files = {'/x86_64/repomd.xml': 'old', '/aarch64/repomd.xml': 'old'}
+        blocked = self._wait_in_thread({
+            self.server.url('/x86_64/repomd.xml'): hashlib.sha1('old').hexdigest(),
+            self.server.url('/aarch64/repomd.xml'): hashlib.sha1('new').hexdigest()})
+        self._wait_for_requests(2)
+        requests = len(self.server.requests)
+
+        self.poller.wait({self.server.url('/x86_64/repomd.xml'): hashlib.sha1('old').hexdigest()})
+
+        self.assertTrue(blocked.is_alive())
+        self.assertTrue(len(self.server.requests) - requests < 2)
+        self.server.files['/aarch64/repomd.xml'] = 'new'
+        blocked.join(10)
+        self.assertFalse(blocked.is_alive())
+
+
+class TestMirrorPollerCheck(unittest.TestCase):
+    """This test class contains tests for the MirrorPoller._check() method."""
+
+    def setUp(self):
+        """Create a poller and a watch."""
+        self.poller = mirrors.MirrorPoller(min_interval=10, max_interval=35)
+        self.watch = mirrors._Watch('http://example.com/repomd.xml', 10)
+
+    @mock.patch('bodhi.server.mirrors.urllib2.urlopen')
+    def test_backoff(self, urlopen):
+        """Assert that the interval doubles while the file doesn't change, up to max_interval."""
+        urlopen.return_value.read.return_value = 'repomd'
+        urlopen.return_value.info.return_value.getheader.side_effect = lambda h: {
+            'ETag': '"abc"', 'Last-Modified': 'Wed, 23 Aug 2017 16:12:40 GMT'}[h]
+
+        intervals = []
+        for i in range(4):
+            self.poller._check(self.watch)
+            intervals.append(self.watch.interval)
+
+        self.assertEqual(intervals, [10, 20, 35, 35])
+        self.assertEqual(self.watch.checksum, hashlib.sha1('repomd').hexdigest())
+        request = urlopen.call_args_list[-1][0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"abc"')
+        self.assertEqual(request.get_header('If-modified-since'), 'Wed, 23 Aug 2017 16:12:40 GMT')
+        self.assertTrue(time.time() + 34 < self.watch.next_check <= time.time() + 35)
+
+    @mock.patch('bodhi.server.mirrors.urllib2.urlopen')
+    def test_change_resets_interval(self, urlopen):
+        """Assert that the interval goes back to min_interval when the file changes."""
+        self.watch.interval = 35
+        self.watch.checksum = hashlib.sha1('old').hexdigest()
+        urlopen.return_value.read.return_value = 'new'
+
+        self.poller._check(self.watch)
+
+        self.assertEqual(self.watch.interval, 10)
+        self.assertEqual(self.watch.checksum, hashlib.sha1('new').hexdigest())
+
+    @mock.patch('bodhi.server.mirrors.log.exception')
+    @mock.patch('bodhi.server.mirrors.urllib2.urlopen')
+    def test_not_modified(self, urlopen, exception):
+        """Assert that a 304 response backs off without logging an error."""
+        urlopen.side_effect = urllib2.HTTPError('url', 304, 'Not Modified', {}, None)
+        self.watch.checksum = 'abc'
+
+        self.poller._check(self.watch)
+
+        self.assertEqual(self.watch.interval, 20)
+        self.assertEqual(self.watch.checksum, 'abc')
+        self.assertEqual(exception.call_count, 0)
+
+    @mock.patch('bodhi.server.mirrors.log.exception')
+    @mock.patch('bodhi.server.mirrors.urllib2.urlopen')
+    def test_error(self, urlopen, exception):
+        """Assert that errors are logged, and back off."""
+        urlopen.side_effect = urllib2.URLError('it broke')
+
+        self.poller._check(self.watch)
+
+        self.assertEqual(self.watch.interval, 20)
+        exception.assert_called_once_with('Error fetching http://example.com/repomd.xml')
+
+
+class TestGetPoller(unittest.TestCase):
+    """This test class contains tests for the get_poller() function."""
+
+    @mock.patch('bodhi.server.mirrors._poller', None)
+    @mock.patch.dict('bodhi.server.mirrors.config',
+                     {'mirror_sync.min_interval': 1, 'mirror_sync.max_interval': 2,
+                      'mirror_sync.timeout': 3, 'mirror_sync.workers': 4})
+    def test_shared(self):
+        """Assert that the poller is configured, and shared."""
+        poller = mirrors.get_poller()
+
+        self.assertEqual((poller.min_interval, poller.max_interval, poller.timeout,
+                          poller.workers), (1, 2, 3, 4))
+        self.assertIs(mirrors.get_poller(), poller)
@@ -22,6 +22,8 @@ import unittest
 
 from pyramid.testing import DummyRequest
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.properties import RelationshipProperty
 import cornice
 import mock
 
@@ -119,6 +121,154 @@ class TestPolymorphicDiscovery(BaseTestCase):
             model.Update.find_polymorphic_child("whatever")
 
 
+def _reflective_to_json(obj, seen=None, request=None, anonymize=False):
+    """Serialize obj the way BodhiBase._to_json() did before it used compiled plans."""
+    if not seen:
+        seen = []
+    if not obj:
+        return
+
+    exclude = getattr(obj, '__exclude_columns__', [])
+    properties = list(class_mapper(type(obj)).iterate_properties)
+    rels = [p.key for p in properties if type(p) is RelationshipProperty]
+    attrs = [p.key for p in properties if p.key not in rels]
+    d = dict([(attr, getattr(obj, attr)) for attr in attrs
+              if attr not in exclude and not attr.startswith('_')])
+
+    for name in getattr(obj, '__include_extras__', []):
+        attribute = getattr(obj, name)
+        if callable(attribute):
+            attribute = attribute(request)
+        d[name] = attribute
+
+    for attr in rels:
+        if attr in exclude:
+            continue
+        target = getattr(type(obj), attr).property.mapper.class_
+        if target in seen:
+            continue
+        d[attr] = _reflective_expand(obj, getattr(obj, attr), seen, request)
+
+    for key, value in d.iteritems():
+        if isinstance(value, datetime):
+            d[key] = value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, model.EnumSymbol):
+            d[key] = unicode(value)
+
+    if anonymize:
+        for key1, key2 in getattr(obj, '__anonymity_map__', {}).items():
+            if getattr(obj, key2):
+                d[key1] = 'anonymous'
+
+    return d
+
+
+def _reflective_expand(obj, relation, seen, req):
+    """Expand a relationship the way BodhiBase._expand() did before it used compiled plans."""
+    if hasattr(relation, 'all'):
+        relation = relation.all()
+    if hasattr(relation, '__iter__'):
+        return [_reflective_expand(obj, item, seen, req) for item in relation]
+    if type(relation) not in seen:
+        return _reflective_to_json(relation, seen + [type(obj)], req)
+    else:
+        return relation.id
+
+
+class TestJSONPlan(BaseTestCase):
+    """Test the compiled JSON serialization plans used by BodhiBase._to_json()."""
+
+    def test_get_cached(self):
+        """Assert that plans are compiled once per model class and set of seen classes."""
+        plan = model.JSONPlan.get(model.Update, ())
+
+        self.assertIs(model.JSONPlan.get(model.Update, ()), plan)
+        self.assertIsNot(model.JSONPlan.get(model.Update, (model.Update,)), plan)
+
+    def test_fields(self):
+        """Assert that excluded columns and relationships to seen classes are left out."""
+        plan = model.JSONPlan.get(model.Comment, (model.Update,))
+
+        columns = dict(plan.columns)
+        self.assertNotIn('id', columns)
+        self.assertIs(columns['text'], None)
+        self.assertIs(columns['timestamp'], model._json_value)
+        self.assertEqual(sorted(plan.relationships),
+                         ['bug_feedback', 'testcase_feedback', 'user'])
+        self.assertEqual(plan.anonymity_map, {'user': u'anonymous'})
+
+    def test_matches_reflection(self):
+        """Assert that the compiled plans serialize objects exactly like reflection did."""
+        update = self.db.query(model.Update).one()
+        request = DummyRequest()
+
+        for obj in [update, update.comments[1], update.builds[0], update.release]:
+            for anonymize in (False, True):
+                self.assertEqual(
+                    json.dumps(obj._to_json(obj, request=request, anonymize=anonymize)),
+                    json.dumps(_reflective_to_json(obj, request=request, anonymize=anonymize)))
+
+        seen = [model.Package, model.TestCaseKarma]
+        self.assertEqual(
+            json.dumps(update._to_json(update.builds[0].package, seen=seen, request=request)),
+            json.dumps(_reflective_to_json(update.builds[0].package, seen=seen, request=request)))
+
+    def test_sparse_fieldset(self):
+        """Assert that plans only serialize the requested fields."""
+        plan = model.JSONPlan.get(model.Update, (), frozenset(['title', 'builds', 'url']))
+
+        self.assertEqual(plan.columns, [('title', None)])
+        self.assertEqual(plan.relationships, ['builds'])
+        self.assertEqual(plan.extras, ('url',))
+
+        plan = model.JSONPlan.get(model.Comment, (), None, frozenset(['user', 'update']))
+
+        self.assertEqual(sorted(plan.relationships), ['bug_feedback', 'testcase_feedback'])
+        self.assertEqual(plan.anonymity_map, {})
+
+    def test_sparse_fieldset_unknown_fields(self):
+        """Assert that names that aren't fields of the model share the plans without them."""
+        plan = model.JSONPlan.get(model.Update, (), frozenset(['title']))
+
+        self.assertIs(model.JSONPlan.get(model.Update, (), frozenset(['title', 'nope'])), plan)
+        self.assertIs(model.JSONPlan.get(model.Update, (), None, frozenset(['nope'])),
+                      model.JSONPlan.get(model.Update, ()))
+
+    def test_json_fields(self):
+        """Assert that __json__() computes the derived fields only when they are requested."""
+        update = self.db.query(model.Update).one()
+
+        self.assertEqual(update.__json__(fields=['title', 'submitter']),
+                         {'title': update.title, 'submitter': u'guest'})
+        result = update.__json__(exclude=['test_cases', 'comments'])
+        self.assertNotIn('test_cases', result)
+        self.assertNotIn('comments', result)
+        self.assertEqual(result['karma'], update.karma)
+
+    def test_json_request_fields(self):
+        """Assert that __json__() uses the sparse fieldset of the request."""
+        update = self.db.query(model.Update).one()
+        request = DummyRequest()
+        request.validated = {'fields': ['alias'], 'exclude': None}
+
+        self.assertEqual(update.__json__(request), {'alias': update.alias})
+
+    @mock.patch('bodhi.server.models.subqueryload')
+    @mock.patch('bodhi.server.models.lazyload')
+    @mock.patch('bodhi.server.models.joinedload')
+    def test_json_load_options(self, joinedload, lazyload, subqueryload):
+        """Assert that only the relationships the fields need are eagerly loaded."""
+        self.assertEqual(model.Update.json_load_options(), [])
+
+        options = model.Update.json_load_options(fields=['title', 'submitter', 'bugs'])
+
+        joinedload.assert_called_once_with(model.Update.user)
+        subqueryload.assert_called_once_with(model.Update.bugs)
+        self.assertIn(mock.call(model.Update.comments), lazyload.mock_calls)
+        self.assertIn(mock.call(model.Update.builds), lazyload.mock_calls)
+        self.assertEqual(len(options), 2 + lazyload.call_count)
+
+
 class TestComment(BaseTestCase):
     def test_text_not_nullable(self):
         """Assert that the text column does not allow NULL values.
@@ -1688,6 +1838,21 @@ class TestUpdate(ModelTest):
         expected = u'updates/FEDORA-%s-%s' % (time.localtime()[0], idx)
         self.assertEqual(self.obj.get_url(), expected)
 
+    def test_compact_json(self):
+        """Assert that the compact representation only has the fields that messages need."""
+        with mock.patch(target='uuid.uuid4', return_value='wat'):
+            self.obj.assign_alias()
+        self.obj.comment(self.db, u'Works for me', karma=1, author=u'bowlofeggs')
+
+        self.assertEqual(
+            self.obj.compact_json(),
+            {'schema_version': model.UPDATE_MESSAGE_SCHEMA_VERSION,
+             'alias': u'FEDORA-%s-a3bbe1a8f2' % time.localtime()[0],
+             'title': u'TurboGears-1.0.8-3.fc11', 'status': u'pending', 'request': u'testing',
+             'builds': [{'nvr': u'TurboGears-1.0.8-3.fc11'}], 'user': {'name': u'lmacken'},
+             'karma': 1,
+             'release': {'name': u'F11', 'long_name': u'Fedora 11', 'version': u'11'}})
+
     def test_bug(self):
         bug = self.obj.bugs[0]
         self.assertEqual(bug.url, 'https://bugzilla.redhat.com/show_bug.cgi?id=1')
@@ -1884,6 +2049,145 @@ class TestUpdate(ModelTest):
         self.assertEqual(len(test_names), len(expected_names))
         self.assertEqual(sorted(test_names), sorted(expected_names))
 
+    def test_karma_counters(self):
+        """Assert that comments maintain the karma counters, counting each user's last karma."""
+        self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=1, check_karma=False)
+        self.obj.comment(self.db, u'testing', author=u'hunter2', karma=1, check_karma=False)
+        self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=-1, check_karma=False)
+        self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=0, check_karma=False)
+        self.obj.comment(self.db, u'testing', author=u'anon', karma=1, anonymous=True,
+                         check_karma=False)
+
+        self.assertEqual((self.obj.positive_karma, self.obj.negative_karma), (1, -1))
+        self.assertEqual(self.obj.karma, 0)
+
+    def test_karma_counters_reset(self):
+        """Assert that adding or removing builds resets the karma counters."""
+        self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=1, check_karma=False)
+
+        self.obj.comment(self.db, u'New build(s):\n\n- TurboGears-1.0.8-4.fc11', author=u'bodhi')
+
+        self.assertEqual(self.obj._composite_karma, (0, 0))
+        self.assertEqual(self.obj.date_karma_reset, self.obj.comments[-1].timestamp)
+        self.assertEqual(list(self.obj.comments_since_karma_reset), [])
+
+        self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=-1, check_karma=False)
+
+        self.assertEqual(self.obj._composite_karma, (0, -1))
+        self.assertEqual([c.text for c in self.obj.comments_since_karma_reset], [u'testing'])
+
+    def test_karma_counters_comment_constructor(self):
+        """Assert that comments built with update and user keyword arguments are counted."""
+        user = self.db.query(model.User).filter_by(name=u'guest').one()
+
+        # The keyword arguments are set in any order, so the comment can reach the update first.
+        comment = model.Comment(update=self.obj, user=user, text=u'testing', karma=1)
+        self.db.add(comment)
+        other = model.Comment(text=u'testing', karma=-1)
+        self.obj.comments.append(other)
+        other.user = model.User(name=u'bowlofeggs')
+        self.db.flush()
+
+        self.assertEqual(self.obj._composite_karma, (1, -1))
+        self.assertFalse(comment._karma_pending)
+        self.assertFalse(other._karma_pending)
+
+    def test_num_admin_approvals(self):
+        """Assert that positive karma from members of the admin groups is counted."""
+        user = model.User(name=u'releng_member')
+        user.groups.append(model.Group(name=u'releng'))
+        self.db.add(user)
+        self.db.flush()
+
+        with mock.patch.dict(config, {'admin_groups': [u'releng']}):
+            self.obj.comment(self.db, u'testing', author=u'releng_member', karma=1,
+                             check_karma=False)
+            self.obj.comment(self.db, u'testing', author=u'bowlofeggs', karma=1,
+                             check_karma=False)
+
+        self.assertEqual(self.obj.num_admin_approvals, 1)
+
+    def test_karma_expression(self):
+        """Assert that queries can filter and sort by karma."""
+        update = self.get_update(name=u'Karma-1.0-1.fc11')
+        update.user = self.obj.user
+        update.comment(self.db, u'testing', author=u'bowlofeggs', karma=1, check_karma=False)
+        self.db.flush()
+
+        query = self.db.query(model.Update).order_by(model.Update.karma.desc())
+
+        self.assertEqual([u.title for u in query], [u'Karma-1.0-1.fc11', self.obj.title])
+        self.assertEqual(
+            [u.title for u in self.db.query(model.Update).filter(model.Update.karma > 0)],
+            [u'Karma-1.0-1.fc11'])
+
+    @mock.patch('bodhi.server.models.invalidate_cache')
+    def test_status_change_invalidates_cache(self, invalidate_cache):
+        """Assert that changing the status of an update drops the cached update counts on commit."""
+        self.obj.status = UpdateStatus.testing
+        self.db.commit()
+        invalidate_cache.reset_mock()
+
+        self.obj.status = UpdateStatus.testing
+        self.db.commit()
+        self.assertEqual(invalidate_cache.call_count, 0)
+
+        self.obj.status = UpdateStatus.stable
+        self.obj.type = UpdateType.security
+        self.db.flush()
+        self.assertEqual(invalidate_cache.call_count, 0)
+
+        self.db.commit()
+        invalidate_cache.assert_called_once_with('home', 'release_stats')
+
+        # The namespaces are only invalidated once.
+        self.db.commit()
+        self.assertEqual(invalidate_cache.call_count, 1)
+
+    @mock.patch('bodhi.server.models.invalidate_cache')
+    def test_insert_invalidates_cache(self, invalidate_cache):
+        """Assert that creating an update drops the cached update counts on commit."""
+        self.get_update(name=u'CountedUpdate')
+        self.db.flush()
+        self.assertEqual(invalidate_cache.call_count, 0)
+
+        self.db.commit()
+
+        invalidate_cache.assert_called_once_with('home', 'release_stats')
+
+    def test_counts(self):
+        """Assert that counts() groups the updates of each release by status and type."""
+        self.obj.status = UpdateStatus.testing
+        self.obj.type = UpdateType.security
+        self.db.flush()
+
+        update = self.get_update(name=u'Counted-1.0-1.fc11')
+        update.type = UpdateType.bugfix
+        self.db.flush()
+
+        counts = model.Update.counts(self.db, [u'F11', u'F99'])
+
+        self.assertEqual(
+            counts,
+            {u'F11': {(UpdateStatus.testing, UpdateType.security): 1,
+                      (UpdateStatus.pending, UpdateType.bugfix): 1},
+             u'F99': {}})
+
+    def test_counts_no_releases(self):
+        """Assert that counts() does not query the database when no releases are given."""
+        self.assertEqual(model.Update.counts(mock.Mock(), []), {})
+
+    def test_monthly_counts(self):
+        """Assert that monthly_counts() counts the updates per month and type."""
+        update = self.get_update(name=u'MonthlyCounts-1.0-1.fc11')
+        update.date_submitted = datetime(2017, 3, 9)
+        self.obj.date_submitted = datetime(2017, 3, 1)
+        self.db.flush()
+
+        counts = model.Update.monthly_counts(self.db, u'F11')
+
+        self.assertEqual(counts, {'security': {'2017/03': 2}})
+
 
 class TestUser(ModelTest):
     klass = model.User
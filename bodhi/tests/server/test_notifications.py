@@ -15,6 +15,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """This test module contains tests for bodhi.server.notifications."""
 
+from datetime import datetime, timedelta
+import json
 import unittest
 
 from sqlalchemy import exc
@@ -85,31 +87,36 @@ class TestInit(unittest.TestCase):
         info.assert_called_once_with('fedmsg initialized')
 
 
-@mock.patch('bodhi.server.notifications.init')
 class TestPublish(base.BaseTestCase):
     """Tests for :func:`bodhi.server.notifications.publish`."""
 
+    def _outbox(self):
+        """Return the topics and the messages in the outbox, in order."""
+        self.db.flush()
+        return [(m.topic, json.loads(m.body)) for m in
+                self.db.query(models.OutboxFedmsg).order_by(models.OutboxFedmsg.id)]
+
     @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': False})
-    def test_publish_off(self, mock_init):
-        """Assert publish doesn't populate the info dict when publishing is off."""
+    def test_publish_off(self):
+        """Assert publish doesn't write to the outbox when publishing is off."""
         notifications.publish('demo.topic', {'such': 'important'})
         session = Session()
         self.assertEqual(dict(), session.info)
-        self.assertEqual(0, mock_init.call_count)
+        self.assertEqual(self._outbox(), [])
 
     @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
-    def test_publish(self, mock_init):
-        """Assert publish places the message inside the session info dict."""
+    def test_publish(self):
+        """Assert publish writes the message to the outbox in the session."""
         notifications.publish('demo.topic', {'such': 'important'})
+        notifications.publish('other.topic', {'so': 'much'})
         session = Session()
-        self.assertIn('fedmsg', session.info)
-        self.assertEqual(session.info['fedmsg']['demo.topic'], [{'such': 'important'}])
+        self.assertTrue(session.info['fedmsg'])
+        self.assertEqual(self._outbox(), [('demo.topic', {'such': 'important'}),
+                                          ('other.topic', {'so': 'much'})])
 
     @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
-    @mock.patch('bodhi.server.notifications.fedmsg_is_initialized', mock.Mock(return_value=False))
-    def test_publish_sqlalchemy_object(self, mock_init):
-        """Assert publish places the message inside the session info dict."""
-        Session.remove()
+    def test_publish_sqlalchemy_object(self):
+        """Assert publish serializes the SQLAlchemy objects in the message."""
         expected_msg = {
             u'some_package': {
                 u'name': u'so good',
@@ -121,39 +128,56 @@ class TestPublish(base.BaseTestCase):
         }
         package = models.Package(name='so good')
         notifications.publish('demo.topic', {'some_package': package})
-        session = Session()
-        self.assertIn('fedmsg', session.info)
-        self.assertEqual(session.info['fedmsg']['demo.topic'], [expected_msg])
-        mock_init.assert_called_once_with()
+        self.assertEqual(self._outbox(), [('demo.topic', expected_msg)])
 
-    @mock.patch('bodhi.server.notifications.fedmsg_is_initialized', mock.Mock(return_value=False))
     @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
-    @mock.patch('bodhi.server.notifications.fedmsg.publish')
-    def test_publish_force(self, mock_fedmsg_publish, mock_init):
-        """Assert publish with the force flag sends the message immediately."""
+    def test_publish_update_compact(self):
+        """Assert that updates are published in their compact representation by default."""
+        update = self.db.query(models.Update).one()
+
+        notifications.publish('update.edit', {'update': update, 'agent': u'bodhi'})
+
+        [(topic, msg)] = self._outbox()
+        self.assertEqual(msg, {u'update': update.compact_json(), u'agent': u'bodhi'})
+        self.assertNotIn(u'comments', msg[u'update'])
+
+    @mock.patch.dict('bodhi.server.config.config',
+                     {'fedmsg_enabled': True, 'fedmsg_full_payloads': True})
+    def test_publish_update_full(self):
+        """Assert that whole updates are published if fedmsg_full_payloads is True."""
+        update = self.db.query(models.Update).one()
+
+        notifications.publish('update.edit', {'update': update, 'agent': u'bodhi'})
+
+        [(topic, msg)] = self._outbox()
+        self.assertEqual(msg[u'update'][u'alias'], update.alias)
+        self.assertEqual(len(msg[u'update'][u'comments']), len(update.comments))
+        self.assertNotIn(u'schema_version', msg[u'update'])
+
+    @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
+    def test_publish_force(self):
+        """Assert publish with the force flag hands the message to the relay immediately."""
         notifications.publish('demo.topic', {'such': 'important'}, force=True)
         session = Session()
         self.assertEqual(dict(), session.info)
-        mock_fedmsg_publish.assert_called_once_with(
-            topic='demo.topic', msg={'such': 'important'})
-        mock_init.assert_called_once_with()
+        self.assertEqual(self._outbox(), [])
+        notifications.get_relay.return_value.send.assert_called_once_with(
+            'demo.topic', '{"such": "important"}')
 
 
 @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
-@mock.patch('bodhi.server.notifications.init', mock.Mock())
-@mock.patch('bodhi.server.notifications.fedmsg.publish')
 class TestSendFedmsgsAfterCommit(base.BaseTestCase):
 
-    def test_no_fedmsgs(self, mock_fedmsg_publish):
+    def test_no_fedmsgs(self):
         """Assert nothing happens if messages are not explicitly published."""
         session = Session()
         session.add(models.Package(name=u'ejabberd'))
         session.commit()
 
-        self.assertEqual(0, mock_fedmsg_publish.call_count)
+        self.assertEqual(0, notifications.get_relay.call_count)
 
-    def test_commit_aborted(self, mock_fedmsg_publish):
-        """Assert that when commits are aborted, messages aren't sent."""
+    def test_commit_aborted(self):
+        """Assert that when commits are aborted, messages aren't relayed."""
         session = Session()
         session.add(models.Package(name=u'ejabberd'))
         session.commit()
@@ -161,56 +185,189 @@ class TestSendFedmsgsAfterCommit(base.BaseTestCase):
         session.add(models.Package(name=u'ejabberd'))
         notifications.publish('demo.topic', {'new': 'package'})
         self.assertRaises(exc.IntegrityError, session.commit)
-        self.assertEqual(0, mock_fedmsg_publish.call_count)
+        self.assertEqual(0, notifications.get_relay.call_count)
+        self.assertEqual(session.query(models.OutboxFedmsg).count(), 0)
 
-    def test_single_topic_one_message(self, mock_fedmsg_publish):
-        """Assert a single message for a single topic is published."""
+    def test_relay_woken(self):
+        """Assert the relay is woken up once a message was committed."""
         session = Session()
         session.add(models.Package(name=u'ejabberd'))
         notifications.publish('demo.topic', {'new': 'package'})
         session.commit()
-        mock_fedmsg_publish.assert_called_once_with(
-            topic='demo.topic', msg={'new': 'package'})
 
-    def test_empty_commit(self, mock_fedmsg_publish):
-        """Assert calling commit on a session with no changes still triggers fedmsgs."""
-        # Ensure nothing at all is in our session
-        Session.remove()
-        session = Session()
-        notifications.publish('demo.topic', {'new': 'package'})
-        session.commit()
-        mock_fedmsg_publish.assert_called_once_with(
-            topic='demo.topic', msg={'new': 'package'})
+        notifications.get_relay.return_value.wake.assert_called_once_with()
+        self.assertEqual(session.query(models.OutboxFedmsg).count(), 1)
 
-    def test_repeated_commit(self, mock_fedmsg_publish):
-        """Assert queued fedmsgs are cleared between commits."""
+    def test_repeated_commit(self):
+        """Assert the relay isn't woken up again by the next commit."""
         session = Session()
         notifications.publish('demo.topic', {'new': 'package'})
         session.commit()
         session.commit()
-        mock_fedmsg_publish.assert_called_once_with(
-            topic='demo.topic', msg={'new': 'package'})
 
-    def test_single_topic_many_messages(self, mock_fedmsg_publish):
-        """Assert many messages for a single topic are sent."""
-        session = Session()
-        notifications.publish('demo.topic', {'new': 'package'})
-        notifications.publish('demo.topic', {'newer': 'packager'})
-        session.commit()
-        self.assertEqual(2, mock_fedmsg_publish.call_count)
-        mock_fedmsg_publish.assert_any_call(
-            topic='demo.topic', msg={'new': 'package'})
-        mock_fedmsg_publish.assert_any_call(
-            topic='demo.topic', msg={'newer': 'packager'})
-
-    def test_multiple_topics(self, mock_fedmsg_publish):
-        """Assert messages with different topics are sent."""
-        session = Session()
-        notifications.publish('demo.topic', {'new': 'package'})
-        notifications.publish('other.topic', {'newer': 'packager'})
-        session.commit()
-        self.assertEqual(2, mock_fedmsg_publish.call_count)
-        mock_fedmsg_publish.assert_any_call(
-            topic='demo.topic', msg={'new': 'package'})
-        mock_fedmsg_publish.assert_any_call(
-            topic='other.topic', msg={'newer': 'packager'})
+        notifications.get_relay.return_value.wake.assert_called_once_with()
+
+
+@mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
+@mock.patch('bodhi.server.notifications.fedmsg_is_initialized', mock.Mock(return_value=True))
+@mock.patch('bodhi.server.notifications.fedmsg.publish')
+class TestRelay(base.BaseTestCase):
+    """Tests for the :class:`bodhi.server.notifications.Relay` class."""
+
+    def setUp(self):
+        """Create a relay that uses the test database."""
+        super(TestRelay, self).setUp()
+        self.relay = notifications.Relay(max_attempts=3, retry_delay=10, batch_size=2,
+                                         db_factory=base.TransactionalSessionMaker(self.Session))
+
+    def _queue(self, count):
+        """Write the given number of messages to the outbox."""
+        for i in range(count):
+            notifications.publish('demo.topic', {'number': i})
+        self.db.flush()
+
+    def _outbox(self):
+        """Return the messages in the outbox, in order."""
+        self.db.expire_all()
+        return self.db.query(models.OutboxFedmsg).order_by(models.OutboxFedmsg.id).all()
+
+    def _make_due(self):
+        """Make all the messages of the outbox due."""
+        for message in self._outbox():
+            message.next_attempt = datetime.utcnow() - timedelta(seconds=1)
+        self.db.flush()
+
+    def test_drain(self, publish):
+        """Assert that the messages are published in order, in batches, and then deleted."""
+        self._queue(3)
+
+        self.assertIsNone(self.relay.drain())
+
+        self.assertEqual(publish.mock_calls,
+                         [mock.call(topic='demo.topic', msg={u'number': i}) for i in range(3)])
+        self.assertEqual(self._outbox(), [])
+
+    def test_retry(self, publish):
+        """Assert that a failed message is retried with backoff, and the ones after it wait."""
+        self._queue(3)
+        publish.side_effect = [None, IOError('The relay is down'), IOError('Still down')]
+
+        with mock.patch('bodhi.server.notifications._log.exception'):
+            wait = self.relay.drain()
+
+            self.assertTrue(5 < wait <= 10)
+            messages = self._outbox()
+            self.assertEqual([json.loads(m.body) for m in messages],
+                             [{u'number': 1}, {u'number': 2}])
+            self.assertEqual([m.attempts for m in messages], [1, 0])
+            self.assertEqual(publish.call_count, 2)
+
+            self._make_due()
+            wait = self.relay.drain()
+
+        self.assertTrue(15 < wait <= 20)
+        self.assertEqual([m.attempts for m in self._outbox()], [2, 0])
+
+        publish.side_effect = None
+        self._make_due()
+        self.assertIsNone(self.relay.drain())
+        self.assertEqual([c[2]['msg'] for c in publish.mock_calls[-2:]],
+                         [{u'number': 1}, {u'number': 2}])
+        self.assertEqual(self._outbox(), [])
+
+    @mock.patch('bodhi.server.notifications._log.exception', mock.Mock())
+    @mock.patch('bodhi.server.notifications._log.error')
+    def test_give_up(self, error, publish):
+        """Assert that a message is dropped after max_attempts, and the next ones are due."""
+        self._queue(2)
+        messages = self._outbox()
+        messages[0].attempts = 2
+        self.db.flush()
+        publish.side_effect = [IOError('The relay is down'), None]
+
+        self.assertEqual(self.relay.drain(), 0)
+
+        error.assert_called_once_with(
+            'Giving up on publishing the fedmsg %s on the "%s" topic after %d attempts',
+            '{"number": 0}', 'demo.topic', 3)
+        self.assertIsNone(self.relay.drain())
+        self.assertEqual(publish.mock_calls[-1], mock.call(topic='demo.topic', msg={u'number': 1}))
+        self.assertEqual(self._outbox(), [])
+
+    def test_claimed(self, publish):
+        """Assert that nothing is published while another relay has the head of the outbox."""
+        self._queue(2)
+        messages = self._outbox()
+        messages[0].next_attempt = datetime.utcnow() + timedelta(
+            seconds=notifications.Relay.claim_seconds)
+        self.db.flush()
+
+        wait = self.relay.drain()
+
+        self.assertTrue(0 < wait <= notifications.Relay.claim_seconds)
+        self.assertEqual(publish.call_count, 0)
+        self.assertEqual(len(self._outbox()), 2)
+
+    def test_forced(self, publish):
+        """Assert that forced messages are published after the committed ones."""
+        self._queue(1)
+        self.relay._forced.append(('forced.topic', '{"so": "forced"}'))
+
+        self.assertIsNone(self.relay.drain())
+
+        self.assertEqual(publish.mock_calls,
+                         [mock.call(topic='demo.topic', msg={u'number': 0}),
+                          mock.call(topic='forced.topic', msg={u'so': u'forced'})])
+        self.assertEqual(len(self.relay._forced), 0)
+
+    @mock.patch('bodhi.server.notifications._log.exception')
+    def test_forced_failure(self, exception, publish):
+        """Assert that a forced message that fails isn't retried, nor holds up the others."""
+        self.relay._forced.extend([('forced.topic', '{"number": 0}'),
+                                   ('forced.topic', '{"number": 1}')])
+        publish.side_effect = [IOError('The relay is down'), None]
+
+        self.assertIsNone(self.relay.drain())
+
+        self.assertEqual(publish.call_count, 2)
+        exception.assert_called_once_with('Unable to publish a fedmsg on the "%s" topic',
+                                          'forced.topic')
+        self.assertIsNone(self.relay.drain())
+        self.assertEqual(publish.call_count, 2)
+
+    @mock.patch('bodhi.server.notifications.init')
+    @mock.patch.dict('bodhi.server.notifications._init_kwargs',
+                     {'active': True, 'cert_prefix': 'bodhi'})
+    def test_init(self, init, publish):
+        """Assert that fedmsg is initialized in the relay's thread like in the process."""
+        self._queue(1)
+
+        with mock.patch('bodhi.server.notifications.fedmsg_is_initialized', return_value=False):
+            self.relay.drain()
+
+        init.assert_called_once_with(active=True, cert_prefix='bodhi')
+        self.assertEqual(publish.call_count, 1)
+
+    def test_send(self, publish):
+        """Assert that send() hands the message to the relay's thread."""
+        with mock.patch.object(self.relay, 'wake') as wake:
+            self.relay.send('forced.topic', '{"so": "forced"}')
+
+        self.assertEqual(list(self.relay._forced), [('forced.topic', '{"so": "forced"}')])
+        wake.assert_called_once_with()
+
+
+class TestGetRelay(unittest.TestCase):
+    """This test class contains tests for the get_relay() function."""
+
+    @mock.patch('bodhi.server.notifications._relay', None)
+    @mock.patch('bodhi.server.util.transactional_session_maker', mock.Mock())
+    @mock.patch.dict('bodhi.server.config.config',
+                     {'fedmsg_outbox.max_attempts': 1, 'fedmsg_outbox.retry_delay': 2,
+                      'fedmsg_outbox.batch_size': 3})
+    def test_shared(self):
+        """Assert that the relay is configured and shared."""
+        relay = notifications.get_relay()
+
+        self.assertEqual((relay.max_attempts, relay.retry_delay, relay.batch_size), (1, 2, 3))
+        self.assertIs(notifications.get_relay(), relay)
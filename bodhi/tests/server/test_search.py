@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test suite contains tests for bodhi.server.search."""
+
+import mock
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from bodhi.server import models, search
+from bodhi.tests.server.base import BaseTestCase
+
+
+class TestMatch(BaseTestCase):
+    """Test the match() function."""
+
+    def _search(self, model, text):
+        """Return the names of the rows of model that match text, best match first."""
+        criterion, rank = search.match(self.db, model, text)
+        rows = self.db.query(model).filter(criterion).order_by(rank, model.id).all()
+        return [getattr(row, 'title', None) or getattr(row, 'name', None) or row.nvr
+                for row in rows]
+
+    def test_substring(self):
+        """Assert that substrings of the searched columns match, regardless of case."""
+        self.assertEqual(self._search(models.Update, u'ODHI-2.0'), [u'bodhi-2.0-1.fc17'])
+        self.assertEqual(self._search(models.Update, u'a3bbe1a8f2'), [u'bodhi-2.0-1.fc17'])
+        self.assertEqual(self._search(models.Build, u'2.0-1.fc'), [u'bodhi-2.0-1.fc17'])
+        self.assertEqual(self._search(models.Update, u'nothing like this'), [])
+
+    def test_index_follows_changes(self):
+        """Assert that the index is updated when rows are inserted, changed and deleted."""
+        self.db.add(models.RpmPackage(name=u'python-bodhi'))
+        self.db.flush()
+        self.assertEqual(self._search(models.Package, u'bodhi'), [u'bodhi', u'python-bodhi'])
+
+        package = self.db.query(models.Package).filter_by(name=u'python-bodhi').one()
+        package.name = u'python-fedora'
+        self.db.flush()
+        self.assertEqual(self._search(models.Package, u'bodhi'), [u'bodhi'])
+        self.assertEqual(self._search(models.Package, u'fedora'), [u'python-fedora'])
+
+        self.db.delete(package)
+        self.db.flush()
+        self.assertEqual(self._search(models.Package, u'fedora'), [])
+
+    def test_quotes(self):
+        """Assert that quotes in the search text don't break the query."""
+        self.assertEqual(self._search(models.Update, u'"bodhi" OR'), [])
+
+    def test_short_text(self):
+        """Assert that texts too short for the trigrams match with ILIKE, exact match first."""
+        self.db.add(models.RpmPackage(name=u'ab'))
+        self.db.add(models.RpmPackage(name=u'abc'))
+        self.db.flush()
+
+        self.assertEqual(self._search(models.Package, u'ab'), [u'ab', u'abc'])
+
+    def test_postgresql(self):
+        """Assert that the PostgreSQL criterion uses the indexed expressions."""
+        db = mock.MagicMock()
+        db.get_bind.return_value.dialect.name = 'postgresql'
+
+        criterion, rank = search.match(db, models.Update, u'bodhi')
+
+        sql = str(criterion.compile(dialect=postgresql.dialect()))
+        self.assertIn('updates.title ILIKE', sql)
+        self.assertIn('updates.alias ILIKE', sql)
+        self.assertIn("to_tsvector('english', coalesce(updates.notes, '')) @@ plainto_tsquery(",
+                      sql)
+        sql = str(rank.compile(dialect=postgresql.dialect()))
+        self.assertIn('similarity(updates.title', sql)
+        self.assertIn('ts_rank(', sql)
+
+    def test_postgresql_without_trigrams(self):
+        """Assert that the PostgreSQL rank doesn't need pg_trgm if it is not installed."""
+        db = mock.MagicMock()
+        db.get_bind.return_value.dialect.name = 'postgresql'
+        db.connection.return_value.execute.return_value.first.return_value = None
+
+        criterion, rank = search.match(db, models.Update, u'bodhi')
+
+        sql = str(criterion.compile(dialect=postgresql.dialect()))
+        self.assertIn('updates.title ILIKE', sql)
+        sql = str(rank.compile(dialect=postgresql.dialect()))
+        self.assertNotIn('similarity(', sql)
+        self.assertIn('ts_rank(', sql)
+        db.connection.return_value.execute.assert_called_once_with(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+
+
+class TestCreateIndexes(BaseTestCase):
+    """Test the create_indexes() function."""
+
+    def _search_rows(self, connection):
+        """Return the names in the search table of the packages."""
+        return sorted(row[0] for row in connection.execute('SELECT name FROM packages_search'))
+
+    def test_create_all_again(self):
+        """Assert that creating the tables again keeps the existing indexes."""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        engine.execute("INSERT INTO packages (name, type) VALUES ('bodhi', 'rpm')")
+
+        models.Base.metadata.create_all(engine)
+
+        self.assertEqual(self._search_rows(engine), [u'bodhi'])
+
+    def test_drop_all(self):
+        """Assert that the triggers and rows of the search tables are recreated with the tables."""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        engine.execute("INSERT INTO packages (name, type) VALUES ('bodhi', 'rpm')")
+        models.Base.metadata.drop_all(engine)
+
+        models.Base.metadata.create_all(engine)
+        engine.execute("INSERT INTO packages (name, type) VALUES ('fedora', 'rpm')")
+
+        self.assertEqual(self._search_rows(engine), [u'fedora'])
+
+    @mock.patch('bodhi.server.search.has_trigrams', mock.Mock(return_value=True))
+    def test_postgresql(self):
+        """Assert that only the missing PostgreSQL indexes are created."""
+        connection = mock.MagicMock()
+        connection.dialect.name = 'postgresql'
+        existing = set(['ix_updates_title_trgm', 'ix_bugs_title_trgm', 'ix_packages_name_trgm',
+                        'ix_builds_nvr_trgm', 'ix_updates_notes_tsv'])
+
+        with mock.patch('bodhi.server.search._existing', return_value=existing):
+            search.create_indexes(None, connection)
+
+        connection.execute.assert_called_once_with(
+            'CREATE INDEX ix_updates_alias_trgm ON updates USING gin (alias gin_trgm_ops)')
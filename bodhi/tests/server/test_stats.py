@@ -0,0 +1,93 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test suite contains tests for bodhi.server.stats."""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import mock
+from sqlalchemy import create_engine
+
+from bodhi.server import stats
+
+
+class TestCount(unittest.TestCase):
+    """This test class contains tests for the count() and get() functions."""
+
+    def test_per_thread(self):
+        """Assert that each thread has its own counters."""
+        before = stats.get('test_counter')
+
+        thread = threading.Thread(target=stats.count, args=('test_counter', 5))
+        thread.start()
+        thread.join()
+        stats.count('test_counter')
+
+        self.assertEqual(stats.get('test_counter'), before + 1)
+        self.assertEqual(stats.get('no_such_counter'), 0)
+
+
+class TestBytesWritten(unittest.TestCase):
+    """This test class contains tests for the bytes_written() function."""
+
+    def test_write(self):
+        """Assert that the bytes the thread writes are counted, where Linux accounts for them."""
+        before = stats.bytes_written()
+        if before is None:
+            raise unittest.SkipTest('The I/O accounting of threads is not available.')
+
+        with tempfile.TemporaryFile() as f:
+            f.write('x' * 4096)
+            f.flush()
+
+        self.assertTrue(stats.bytes_written() - before >= 4096)
+
+    @mock.patch('__builtin__.open', side_effect=IOError('No such file or directory'))
+    def test_unknown(self, open):
+        """Assert that None is returned when the I/O accounting can't be read."""
+        self.assertIsNone(stats.bytes_written())
+
+
+class TestTimer(unittest.TestCase):
+    """This test class contains tests for the Timer class."""
+
+    @mock.patch('bodhi.server.stats.bytes_written', side_effect=[100, 612])
+    def test_measures_block(self, bytes_written):
+        """Assert that the timer measures what the thread did in its block."""
+        engine = create_engine('sqlite://')
+
+        with stats.Timer() as timer:
+            stats.count('koji_calls', 3)
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+
+        measured = timer.as_dict()
+        self.assertTrue(0 <= measured.pop('seconds') < 60)
+        self.assertEqual(measured, {'koji_calls': 3, 'db_queries': 2, 'bytes_written': 512})
+
+    @mock.patch('bodhi.server.stats.bytes_written', return_value=None)
+    def test_exception(self, bytes_written):
+        """Assert that the block's exceptions are raised, and that the timer still measures it."""
+        timer = stats.Timer()
+
+        with self.assertRaises(ValueError):
+            with timer:
+                stats.count('koji_calls')
+                raise ValueError(os.devnull)
+
+        self.assertEqual(timer.koji_calls, 1)
+        self.assertIsNone(timer.bytes_written)
+        self.assertTrue(timer.seconds >= 0)
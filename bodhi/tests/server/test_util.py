@@ -16,14 +16,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-import subprocess
+from datetime import datetime, timedelta
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
 import pkgdb2client
 
-from bodhi.server import util
-from bodhi.server.buildsys import setup_buildsystem, teardown_buildsystem
+from bodhi.server import models, util
+from bodhi.server.buildsys import DevBuildsys, setup_buildsystem, teardown_buildsystem
 from bodhi.server.config import config
 from bodhi.server.models import TestGatingStatus
 
@@ -720,61 +726,356 @@ class TestUtils(unittest.TestCase):
         self.assertIn('Too many result pages, aborting at', log_debug.call_args[0][0])
 
 
+class TestCursors(unittest.TestCase):
+    """Test the encode_cursor() and decode_cursor() functions."""
+
+    def test_round_trip(self):
+        """Assert that decode_cursor() returns the values given to encode_cursor()."""
+        values = [datetime(2017, 8, 22, 10, 11, 12, 13), 42, u'bodhi']
+
+        cursor = util.encode_cursor(values)
+
+        self.assertEqual(util.decode_cursor(cursor), values)
+        self.assertEqual(util.decode_cursor(unicode(cursor)), values)
+
+    def test_round_trip_no_microseconds(self):
+        """Assert that datetimes without microseconds survive the round trip."""
+        values = [datetime(2017, 8, 22, 10, 11, 12)]
+
+        self.assertEqual(util.decode_cursor(util.encode_cursor(values)), values)
+
+    def test_invalid(self):
+        """Assert that decode_cursor() raises ValueError for anything encode_cursor() can't make."""
+        for cursor in ('garbage', base64.urlsafe_b64encode('{"a": 1}'),
+                       base64.urlsafe_b64encode('[{"a": 1}]'),
+                       base64.urlsafe_b64encode('[[1]]'),
+                       base64.urlsafe_b64encode('[{"datetime": "yesterday"}]')):
+            self.assertRaises(ValueError, util.decode_cursor, cursor)
+
+    def test_check_cursor(self):
+        """Assert that check_cursor() accepts cursors made for the given key columns."""
+        key = [models.Update.date_submitted, models.Update.id, models.Update.title]
+
+        util.check_cursor([datetime(2017, 8, 22, 10, 11, 12), 42, u'bodhi'], key)
+        util.check_cursor([datetime(2017, 8, 22, 10, 11, 12), 42L, 'bodhi'], key)
+
+    def test_check_cursor_invalid(self):
+        """Assert that check_cursor() raises ValueError for cursors made for other key columns."""
+        key = [models.Update.date_submitted, models.Update.id]
+
+        for cursor in ([datetime(2017, 8, 22, 10, 11, 12)],
+                       [datetime(2017, 8, 22, 10, 11, 12), 42, 43],
+                       [42, datetime(2017, 8, 22, 10, 11, 12)],
+                       [datetime(2017, 8, 22, 10, 11, 12), u'42'],
+                       [datetime(2017, 8, 22, 10, 11, 12), True]):
+            self.assertRaises(ValueError, util.check_cursor, cursor, key)
+
+
+class TestTTLCache(unittest.TestCase):
+    """Tests for the TTLCache class."""
+    def setUp(self):
+        self.cache = util.TTLCache()
+        self.loader = mock.Mock(return_value=['guest'])
+
+    @mock.patch('bodhi.server.util.time.time', return_value=1000)
+    def test_fresh_value_cached(self, time):
+        """A fresh value should be returned without calling the loader again."""
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60), ['guest'])
+        time.return_value = 1059
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60), ['guest'])
+
+        self.loader.assert_called_once_with()
+
+    @mock.patch('bodhi.server.util.time.time', return_value=1000)
+    def test_expired_value_reloaded(self, time):
+        """An expired value without a stale window should be reloaded in the foreground."""
+        self.cache.get('key', self.loader, ttl=60)
+        time.return_value = 1060
+        self.loader.return_value = ['ralph']
+
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60), ['ralph'])
+        self.assertEqual(self.loader.call_count, 2)
+
+    @mock.patch('bodhi.server.util.threading.Thread')
+    @mock.patch('bodhi.server.util.time.time', return_value=1000)
+    def test_stale_value_revalidated(self, time, Thread):
+        """A stale value should be returned while it is refreshed in the background."""
+        self.cache.get('key', self.loader, ttl=60, stale_ttl=600)
+        time.return_value = 1100
+        self.loader.return_value = ['ralph']
+
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60, stale_ttl=600), ['guest'])
+        # A second caller shouldn't start another refresh.
+        self.cache.get('key', self.loader, ttl=60, stale_ttl=600)
+
+        Thread.assert_called_once_with(target=mock.ANY)
+        Thread.return_value.start.assert_called_once_with()
+        Thread.mock_calls[0][2]['target']()
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60, stale_ttl=600), ['ralph'])
+        self.assertEqual(self.cache._refreshing, set())
+
+    @mock.patch('bodhi.server.util.threading.Thread')
+    @mock.patch('bodhi.server.util.time.time', return_value=1000)
+    def test_failed_revalidation_keeps_stale_value(self, time, Thread):
+        """A failed background refresh should not replace the stale value."""
+        self.cache.get('key', self.loader, ttl=60, stale_ttl=600)
+        time.return_value = 1100
+        self.loader.side_effect = IOError('pkgdb is down')
+
+        self.cache.get('key', self.loader, ttl=60, stale_ttl=600)
+        Thread.mock_calls[0][2]['target']()
+
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60, stale_ttl=600), ['guest'])
+
+    @mock.patch('bodhi.server.util.time.time', return_value=1000)
+    def test_negative_caching(self, time):
+        """A failed lookup should be raised again until negative_ttl expires."""
+        self.loader.side_effect = RuntimeError('No such package')
+
+        for now in (1000, 1029):
+            time.return_value = now
+            with self.assertRaises(RuntimeError):
+                self.cache.get('key', self.loader, ttl=60, negative_ttl=30)
+        self.assertEqual(self.loader.call_count, 1)
+
+        time.return_value = 1030
+        self.loader.side_effect = None
+        self.assertEqual(self.cache.get('key', self.loader, ttl=60, negative_ttl=30), ['guest'])
+
+    def test_warm(self):
+        """warm() should load every lookup concurrently, swallowing errors."""
+        barrier = threading.Event()
+        started = []
+
+        def loader(value):
+            def load():
+                started.append(value)
+                if len(started) == 2:
+                    barrier.set()
+                # Both loaders must be running at once for this to return.
+                barrier.wait(5)
+                if value == 'bad':
+                    raise RuntimeError(value)
+                return value
+            return load
+
+        self.cache.warm([('good', loader('good')), ('bad', loader('bad'))], ttl=60,
+                        negative_ttl=60)
+
+        self.assertTrue(barrier.is_set())
+        self.assertEqual(self.cache.get('good', self.loader, ttl=60), 'good')
+        self.assertRaises(RuntimeError, self.cache.get, 'bad', self.loader, ttl=60)
+        self.assertEqual(self.loader.call_count, 0)
+
+    def test_warm_workers(self):
+        """warm() should fetch no more than the given number of lookups at once."""
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def loader(value):
+            def load():
+                with lock:
+                    running[0] += 1
+                    most[0] = max(most[0], running[0])
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+                return value
+            return load
+
+        self.cache.warm([(i, loader(i)) for i in range(6)], ttl=60, workers=2)
+
+        self.assertTrue(most[0] <= 2)
+        self.assertEqual([self.cache.get(i, self.loader, ttl=60) for i in range(6)], range(6))
+        self.assertEqual(self.loader.call_count, 0)
+
+    def test_invalidate_and_clear(self):
+        """invalidate() and clear() should forget cached values."""
+        self.cache.get('one', self.loader, ttl=60)
+        self.cache.get('two', self.loader, ttl=60)
+
+        self.cache.invalidate('one')
+        self.cache.get('one', self.loader, ttl=60)
+        self.cache.clear()
+        self.cache.get('two', self.loader, ttl=60)
+
+        self.assertEqual(self.loader.call_count, 4)
+
+
+class TestRpmHeaderCache(unittest.TestCase):
+    """Tests for the RpmHeaderCache class."""
+    def setUp(self):
+        self.fetch = mock.Mock(side_effect=lambda nvr: {'name': nvr.rsplit('-', 2)[0]})
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lru(self):
+        """The least recently used headers should be forgotten when the cache is full."""
+        cache = util.RpmHeaderCache(self.fetch, size=2)
+
+        cache.get('a-1-1')
+        cache.get('b-1-1')
+        self.assertEqual(cache.get('a-1-1'), {'name': 'a'})
+        cache.get('c-1-1')
+
+        self.assertTrue(cache.has('a-1-1'))
+        self.assertFalse(cache.has('b-1-1'))
+        self.assertEqual([c[0][0] for c in self.fetch.call_args_list], ['a-1-1', 'b-1-1', 'c-1-1'])
+
+    def test_disk(self):
+        """Headers should be kept on disk, and read from there by other caches."""
+        util.RpmHeaderCache(self.fetch, directory=self.directory).get('a-1-1')
+        cache = util.RpmHeaderCache(self.fetch, directory=self.directory)
+
+        self.assertTrue(cache.has('a-1-1'))
+        self.assertEqual(cache.get('a-1-1'), {'name': 'a'})
+        self.fetch.assert_called_once_with('a-1-1')
+        self.assertEqual(os.listdir(self.directory), ['a-1-1.json'])
+
+    @mock.patch('bodhi.server.util.log.warning')
+    def test_unreadable_disk(self, warning):
+        """Unreadable headers on disk should be fetched again."""
+        with open(os.path.join(self.directory, 'a-1-1.json'), 'w') as f:
+            f.write('{"name": ')
+        cache = util.RpmHeaderCache(self.fetch, directory=self.directory)
+
+        self.assertEqual(cache.get('a-1-1'), {'name': 'a'})
+        self.assertEqual(warning.call_count, 1)
+        with open(os.path.join(self.directory, 'a-1-1.json')) as f:
+            self.assertEqual(f.read(), '{"name": "a"}')
+
+    def test_errors_not_cached(self):
+        """Errors fetching the headers should be raised every time."""
+        self.fetch.side_effect = ValueError('not found')
+        cache = util.RpmHeaderCache(self.fetch, directory=self.directory)
+
+        for i in range(2):
+            self.assertRaises(ValueError, cache.get, 'a-1-1')
+
+        self.assertEqual(self.fetch.call_count, 2)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestPrefetchRpmHeaders(unittest.TestCase):
+    """Tests for the prefetch_rpm_headers() function."""
+    def setUp(self):
+        self.cache = util.RpmHeaderCache(mock.Mock(side_effect=AssertionError('fetched')))
+        patcher = mock.patch('bodhi.server.util._rpm_header_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        setup_buildsystem({'buildsystem': 'dev'})
+        self.addCleanup(teardown_buildsystem)
+
+    def test_prefetch(self):
+        """The missing headers should be fetched in one multicall, and then cached."""
+        self.cache.put('bodhi-2.0-1.fc17', {'name': 'bodhi'})
+
+        with mock.patch.object(DevBuildsys, 'multiCall', autospec=True,
+                               side_effect=DevBuildsys.multiCall) as multiCall:
+            util.prefetch_rpm_headers(['bodhi-2.0-1.fc17', 'libseccomp-2.1.0-1.fc20',
+                                       'libseccomp-2.1.0-1.fc20', 'do-not-find-anything'])
+
+        self.assertEqual(multiCall.call_count, 1)
+        self.assertEqual(util.get_rpm_header('bodhi-2.0-1.fc17'), {'name': 'bodhi'})
+        self.assertEqual(util.get_rpm_header('libseccomp-2.1.0-1.fc20')['name'], 'libseccomp')
+        self.assertFalse(self.cache.has('do-not-find-anything'))
+
+    @mock.patch('bodhi.server.util.RPM_HEADER_PREFETCH_CHUNK_SIZE', 1)
+    @mock.patch('bodhi.server.util.log.exception')
+    def test_failed_chunk(self, exception):
+        """A failed multicall should be logged, and not keep the other chunks from being fetched."""
+        util.prefetch_rpm_headers(['raise-exception', 'libseccomp-2.1.0-1.fc20'])
+
+        self.assertEqual(exception.call_count, 1)
+        self.assertFalse(self.cache.has('raise-exception'))
+        self.assertTrue(self.cache.has('libseccomp-2.1.0-1.fc20'))
+
+
 class TestCMDFunctions(unittest.TestCase):
     @mock.patch('bodhi.server.log.debug')
     @mock.patch('bodhi.server.log.error')
-    @mock.patch('subprocess.Popen')
-    def test_err_nonzero_return_code(self, mock_popen, mock_error, mock_debug):
+    def test_err_nonzero_return_code(self, mock_error, mock_debug):
         """
         Ensures proper behavior when there is err output and the exit code isn't 0.
         See https://github.com/fedora-infra/bodhi/issues/1412
         """
-        mock_popen.return_value = mock.Mock()
-        mock_popen_obj = mock_popen.return_value
-        mock_popen_obj.communicate.return_value = ('output', 'error')
-        mock_popen_obj.returncode = 1
-        util.cmd('/bin/echo', '"home/imgs/catpix"')
-        mock_popen.assert_called_once_with(['/bin/echo'], cwd='"home/imgs/catpix"',
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        mock_error.assert_any_call('error')
-        mock_debug.assert_called_once_with('output')
+        out, err, returncode = util.cmd(['sh', '-c', 'echo output; echo error >&2; exit 1'],
+                                        '/')
+
+        self.assertEqual((out, err, returncode), ('output\n', 'error\n', 1))
+        mock_error.assert_any_call('error\n')
+        mock_error.assert_any_call('return code %s', 1)
+        mock_debug.assert_any_call('output')
 
     @mock.patch('bodhi.server.log.debug')
     @mock.patch('bodhi.server.log.error')
-    @mock.patch('subprocess.Popen')
-    def test_no_err_zero_return_code(self, mock_popen, mock_error, mock_debug):
+    def test_no_err_zero_return_code(self, mock_error, mock_debug):
         """
         Ensures proper behavior when there is no err output and the exit code is 0.
         See https://github.com/fedora-infra/bodhi/issues/1412
         """
-        mock_popen.return_value = mock.Mock()
-        mock_popen_obj = mock_popen.return_value
-        mock_popen_obj.communicate.return_value = ('output', None)
-        mock_popen_obj.returncode = 0
-        util.cmd('/bin/echo', '"home/imgs/catpix"')
-        mock_popen.assert_called_once_with(['/bin/echo'], cwd='"home/imgs/catpix"',
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err, returncode = util.cmd('/bin/echo output')
+
+        self.assertEqual((out, err, returncode), ('output\n', '', 0))
         mock_error.assert_not_called()
         mock_debug.assert_called_once_with('output')
 
     @mock.patch('bodhi.server.log.debug')
     @mock.patch('bodhi.server.log.error')
-    @mock.patch('subprocess.Popen')
-    def test_err_zero_return_code(self, mock_popen, mock_error, mock_debug):
+    def test_err_zero_return_code(self, mock_error, mock_debug):
         """
         Ensures proper behavior when there is err output, but the exit code is 0.
         See https://github.com/fedora-infra/bodhi/issues/1412
         """
-        mock_popen.return_value = mock.Mock()
-        mock_popen_obj = mock_popen.return_value
-        mock_popen_obj.communicate.return_value = ('output', 'error')
-        mock_popen_obj.returncode = 0
-        util.cmd('/bin/echo', '"home/imgs/catpix"')
-        mock_popen.assert_called_once_with(['/bin/echo'], cwd='"home/imgs/catpix"',
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        util.cmd(['sh', '-c', 'echo error >&2'])
+
         mock_error.assert_not_called()
         mock_debug.assert_called_with('error')
 
+    @mock.patch('bodhi.server.util.CMD_TAIL_LINES', 3)
+    @mock.patch('bodhi.server.log.debug')
+    def test_tail(self, mock_debug):
+        """Assert that only the last lines of the output are returned."""
+        out, err, returncode = util.cmd(['seq', '1', '1000'])
+
+        self.assertEqual(out, '998\n999\n1000\n')
+
+    @mock.patch('bodhi.server.util.CMD_LOG_LINES_PER_SECOND', 10)
+    @mock.patch('bodhi.server.util.time.time', return_value=1503504760.0)
+    @mock.patch('bodhi.server.log.debug')
+    def test_rate_limit(self, mock_debug, time):
+        """Assert that the lines over the rate limit are counted rather than logged."""
+        util.cmd(['seq', '1', '25'])
+
+        self.assertEqual(mock_debug.mock_calls,
+                         [mock.call(str(i)) for i in range(1, 11)] +
+                         [mock.call('%d more lines of output were not logged', 15)])
+
+    @mock.patch('bodhi.server.log.debug')
+    def test_progress(self, mock_debug):
+        """Assert that the progress callback is called with each line of output."""
+        progress = mock.Mock()
+
+        util.cmd(['sh', '-c', 'echo one; echo two >&2'], progress=progress)
+
+        self.assertEqual(sorted(progress.mock_calls),
+                         [mock.call('stderr', 'two\n'), mock.call('stdout', 'one\n')])
+
+    @mock.patch('bodhi.server.log.exception')
+    @mock.patch('bodhi.server.log.debug')
+    def test_progress_failure(self, mock_debug, mock_exception):
+        """Assert that the output is still read when the progress callback fails."""
+        progress = mock.Mock(side_effect=ValueError('oops'))
+
+        out, err, returncode = util.cmd(['seq', '1', '3'], progress=progress)
+
+        self.assertEqual((out, returncode), ('1\n2\n3\n', 0))
+        self.assertEqual(progress.call_count, 3)
+        mock_exception.assert_called_with('The progress callback of the command failed')
+
 
 class TestTransactionalSessionMaker(unittest.TestCase):
     """This class contains tests on the TransactionalSessionMaker class."""
@@ -847,3 +1148,106 @@ class TestTransactionalSessionMaker(unittest.TestCase):
         Session.return_value.commit.assert_called_once_with()
         Session.return_value.close.assert_called_once_with()
         Session.remove.assert_called_once_with()
+
+
+class _ListDrainer(util.Drainer):
+    """A Drainer whose outbox is a list, which can't deliver the "bad" messages."""
+
+    def __init__(self, messages, **kwargs):
+        super(_ListDrainer, self).__init__(db_factory=mock.MagicMock(), **kwargs)
+        self.messages = messages
+        self.delivered = []
+        self.conflict = False
+
+    def _claim(self, now):
+        if self.conflict:
+            raise util.ClaimConflict()
+        messages = self.messages[:self.batch_size]
+        del self.messages[:self.batch_size]
+        return messages
+
+    def _deliver(self, messages):
+        for i, message in enumerate(messages):
+            if message == 'bad':
+                return i
+            self.delivered.append(message)
+        return len(messages)
+
+    def _finish(self, messages, delivered):
+        self.messages[:0] = messages[delivered + 1:]
+
+    def _next_attempt(self, db):
+        if self.messages:
+            return datetime.utcnow() + timedelta(seconds=30)
+
+
+class TestDrainer(unittest.TestCase):
+    """This class contains tests on the Drainer class."""
+
+    def test_drain(self):
+        """Assert that drain() delivers the messages in batches until the outbox is empty."""
+        drainer = _ListDrainer(range(5), batch_size=2)
+
+        self.assertIsNone(drainer.drain())
+
+        self.assertEqual(drainer.delivered, range(5))
+
+    def test_drain_failure(self):
+        """Assert that drain() stops at a batch that wasn't all delivered."""
+        drainer = _ListDrainer([0, 'bad', 2, 3, 4], batch_size=2)
+
+        wait = drainer.drain()
+
+        self.assertTrue(25 < wait <= 30)
+        self.assertEqual(drainer.delivered, [0])
+        self.assertEqual(drainer.messages, [2, 3, 4])
+
+    @mock.patch('bodhi.server.util.log.debug')
+    def test_drain_claim_conflict(self, debug):
+        """Assert that drain() leaves the messages another process claimed alone."""
+        drainer = _ListDrainer(range(2))
+        drainer.conflict = True
+
+        wait = drainer.drain()
+
+        self.assertTrue(25 < wait <= 30)
+        self.assertEqual(drainer.delivered, [])
+        debug.assert_called_once_with('Another process claimed the messages of the outbox first')
+
+    def test__retry_at(self):
+        """Assert that the retries back off exponentially, until max_attempts."""
+        drainer = _ListDrainer([], max_attempts=3, retry_delay=10)
+
+        for attempts, delay in ((1, 10), (2, 20)):
+            wait = (drainer._retry_at(attempts) - datetime.utcnow()).total_seconds()
+            self.assertTrue(delay - 5 < wait <= delay)
+        self.assertIsNone(drainer._retry_at(3))
+
+    def test_close(self):
+        """Assert that close() only drains the outbox if the drainer's thread was started."""
+        drainer = _ListDrainer([])
+
+        with mock.patch.object(drainer, 'drain') as drain:
+            drainer.close()
+            self.assertEqual(drain.call_count, 0)
+
+            drainer._thread = mock.Mock()
+            drainer.close()
+            drain.assert_called_once_with()
+
+    @mock.patch('bodhi.server.util.atexit.register')
+    def test_wake(self, register):
+        """Assert that wake() drains from a thread that exits once the outbox is empty."""
+        drainer = _ListDrainer(range(3))
+
+        drainer.wake()
+        for i in range(500):
+            if drainer._thread is None:
+                break
+            time.sleep(0.01)
+
+        self.assertIsNone(drainer._thread)
+        self.assertEqual(drainer.delivered, range(3))
+        drainer.wake()
+        # The drainer is closed when the process exits, but only registered for it once.
+        register.assert_called_once_with(drainer.close)
@@ -15,12 +15,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """This module contains tests for bodhi.server.validators."""
+from collections import defaultdict
 import unittest
 
 import mock
 from cornice.errors import Errors
 
-from bodhi.server import validators
+from bodhi.server import buildsys, validators
 from bodhi.tests.server.base import BaseTestCase
 from bodhi.server import models
 
@@ -50,6 +51,81 @@ class TestGetValidRequirements(unittest.TestCase):
         self.assertEqual(result, [])
 
 
+class TestPrefetchBuildinfo(unittest.TestCase):
+    """Test the prefetch_buildinfo() function."""
+    def setUp(self):
+        self.request = mock.Mock()
+        self.request.koji = buildsys.DevBuildsys()
+        self.request.buildinfo = defaultdict(dict)
+        self.request.validated = {
+            'builds': [u'bodhi-2.0-1.fc17', u'python-fedora-3.0-1.fc17', u'invalidbuild-1.0']}
+
+    def test_single_multicall(self):
+        """All builds should be fetched in one multicall, with build info and tags cached."""
+        with mock.patch.object(self.request.koji, 'multiCall',
+                               wraps=self.request.koji.multiCall) as multiCall:
+            validators.prefetch_buildinfo(self.request)
+
+        multiCall.assert_called_once_with()
+        self.assertEqual(sorted(self.request.buildinfo.keys()),
+                         [u'bodhi-2.0-1.fc17', u'python-fedora-3.0-1.fc17'])
+        self.assertEqual(self.request.buildinfo[u'bodhi-2.0-1.fc17']['info']['nvr'],
+                         u'bodhi-2.0-1.fc17')
+        self.assertEqual(self.request.buildinfo[u'python-fedora-3.0-1.fc17']['tags'],
+                         ['f17-updates-candidate', 'f17', 'f17-updates-testing'])
+        self.assertFalse(self.request.koji.multicall)
+
+    def test_cached_builds_skipped(self):
+        """Builds that already have their info and tags cached should not be fetched again."""
+        self.request.validated['builds'] = [u'bodhi-2.0-1.fc17']
+        self.request.buildinfo[u'bodhi-2.0-1.fc17'] = {'info': {}, 'tags': []}
+        self.request.koji = mock.Mock()
+
+        validators.prefetch_buildinfo(self.request)
+
+        self.assertEqual(self.request.koji.multiCall.call_count, 0)
+
+    def test_faults_left_uncached(self):
+        """Builds that Koji returns a fault for are left for the other validators to fetch."""
+        self.request.validated['builds'] = [u'bodhi-2.0-1.fc17']
+        self.request.koji = mock.Mock()
+        self.request.koji.multiCall.return_value = [
+            {'faultCode': 1000, 'faultString': 'No such build'}, [[{'name': 'f17'}]]]
+
+        validators.prefetch_buildinfo(self.request)
+
+        self.assertEqual(dict(self.request.buildinfo),
+                         {u'bodhi-2.0-1.fc17': {'tags': ['f17']}})
+
+    @mock.patch('bodhi.server.validators.log.exception')
+    def test_exception(self, exception):
+        """A failed multicall should be logged and leave the session usable."""
+        self.request.validated['builds'] = [u'nodist-1.0-1']
+
+        validators.prefetch_buildinfo(self.request)
+
+        self.assertEqual(exception.call_count, 1)
+        self.assertFalse(self.request.koji.multicall)
+        self.assertEqual(dict(self.request.buildinfo), {u'nodist-1.0-1': {}})
+
+
+class TestValidateBuildTags(BaseTestCase):
+    """Test the validate_build_tags() function."""
+    def test_prefetched_tags_used(self):
+        """Tags prefetched into request.buildinfo should not be fetched from Koji again."""
+        request = mock.Mock()
+        request.db = self.db
+        request.errors = Errors()
+        request.validated = {'builds': [u'bodhi-2.0-2.fc17']}
+        request.buildinfo = defaultdict(dict)
+        request.buildinfo[u'bodhi-2.0-2.fc17']['tags'] = ['f17-updates-candidate']
+
+        validators.validate_build_tags(request)
+
+        self.assertEqual(len(request.errors), 0)
+        self.assertEqual(request.koji.listTags.call_count, 0)
+
+
 @mock.patch.dict(
     'bodhi.server.validators.config',
     {'pagure_url': u'http://domain.local', 'admin_packager_groups': [u'provenpackager'],
@@ -183,6 +259,39 @@ class TestValidateAcls(BaseTestCase):
         assert mock_request.errors == expected_error, mock_request.errors
         mock_gpcfp.assert_called_once()
 
+    @mock.patch('bodhi.server.models.Package.get_pkg_committers_from_pagure',
+                return_value=(['guest'], []))
+    def test_validate_acls_pagure_cached(self, mock_gpcfp):
+        """ Test that validate_acls only asks Pagure about a package once.
+        """
+        mock_request = self.get_mock_request()
+        with mock.patch.dict('bodhi.server.validators.config', {'acl_system': 'pagure'}):
+            validators.validate_acls(mock_request)
+            validators.validate_acls(self.get_mock_request())
+        assert len(mock_request.errors) == 0, mock_request.errors
+        mock_gpcfp.assert_called_once()
+
+    @mock.patch('bodhi.server.validators.acl_cache.warm')
+    @mock.patch('bodhi.server.models.Package.get_pkg_committers_from_pagure',
+                return_value=(['guest'], []))
+    def test_validate_acls_prefetch(self, mock_gpcfp, warm):
+        """ Test that validate_acls looks up the ACLs of several packages at once.
+        """
+        mock_request = self.get_mock_request()
+        update = mock_request.validated['update']
+        build = models.RpmBuild(nvr=u'python-nose-1.3.7-11.fc17',
+                                package=models.RpmPackage(name=u'python-nose'))
+        self.db.add(build)
+        update.builds.append(build)
+        self.db.flush()
+        mock_request.buildinfo[build.nvr] = {}
+        with mock.patch.dict('bodhi.server.validators.config', {'acl_system': 'pagure'}):
+            validators.validate_acls(mock_request)
+        keys = sorted(key for key, loader in warm.mock_calls[0][1][0])
+        assert keys == [('pagure', 'rpm', u'bodhi', u'f17'),
+                        ('pagure', 'rpm', u'python-nose', u'f17')], keys
+        assert warm.mock_calls[0][2]['workers'] == validators.config['acl_cache.workers']
+
     @mock.patch.dict('bodhi.server.validators.config', {'acl_system': 'dummy'})
     def test_validate_acls_dummy(self):
         """ Test validate_acls when the acl system is dummy.
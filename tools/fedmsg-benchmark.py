@@ -0,0 +1,91 @@
+""" fedmsg-benchmark.py
+
+Serialize the messages that describe updates, like update.edit, with the
+whole update in them and with the compact representation that
+notifications.publish() uses unless fedmsg_full_payloads is True, and report
+how long each took and how many bytes each message was.
+
+    python tools/fedmsg-benchmark.py [number of updates] [comments per update]
+"""
+
+from datetime import datetime
+import sys
+import time
+
+from sqlalchemy import create_engine
+import fedmsg.encoding
+
+from bodhi.server import Session, notifications
+from bodhi.server import models as m
+
+
+def populate(db, count, comments):
+    """ Create count updates, each with a few builds, bugs and test cases, and comments. """
+    release = m.Release(
+        name=u'F26', long_name=u'Fedora 26', id_prefix=u'FEDORA', version=u'26',
+        dist_tag=u'f26', stable_tag=u'f26-updates', testing_tag=u'f26-updates-testing',
+        candidate_tag=u'f26-updates-candidate', pending_signing_tag=u'f26-signing-pending',
+        pending_testing_tag=u'f26-updates-testing-pending',
+        pending_stable_tag=u'f26-updates-pending', override_tag=u'f26-override',
+        branch=u'f26', state=m.ReleaseState.current)
+    users = [m.User(name=u'user%d' % i) for i in range(10)]
+    db.add_all([release] + users)
+    for i in range(count):
+        builds = []
+        for j in range(3):
+            package = m.RpmPackage(name=u'package-%d-%d' % (i, j))
+            package.test_cases = [m.TestCase(name=u'QA:Testcase package-%d-%d %d' % (i, j, k))
+                                  for k in range(2)]
+            builds.append(m.RpmBuild(nvr=u'package-%d-%d-1.0-1.fc26' % (i, j),
+                                     package=package, release=release))
+        update = m.Update(
+            title=u' '.join(b.nvr for b in builds), builds=builds, user=users[i % 10],
+            release=release, notes=u'Update %d' % i, type=m.UpdateType.bugfix,
+            request=m.UpdateRequest.testing, stable_karma=3, unstable_karma=-3,
+            bugs=[m.Bug(bug_id=i * 2 + 1), m.Bug(bug_id=i * 2 + 2)],
+            alias=u'FEDORA-2017-%06d' % i)
+        for j in range(comments):
+            comment = m.Comment(text=u'Comment %d' % j, karma=1, timestamp=datetime.utcnow())
+            comment.user = users[j % 10]
+            update.comments.append(comment)
+        db.add(update)
+    db.flush()
+
+
+def serialize_full(update):
+    """ Serialize an update.edit message with the whole update in it. """
+    return fedmsg.encoding.dumps(dict(update=update, agent=u'bodhi'))
+
+
+def serialize_compact(update):
+    """ Serialize an update.edit message like notifications.publish() does by default. """
+    return fedmsg.encoding.dumps(notifications.compact(dict(update=update, agent=u'bodhi')))
+
+
+def clock(serialize, updates, tries=4):
+    """ Return the average time it took to serialize the messages, and their average size. """
+    values = []
+    for i in range(tries):
+        start = time.time()
+        sizes = [len(serialize(update)) for update in updates]
+        values.append(time.time() - start)
+    return sum(values) / len(values), sum(sizes) / len(sizes)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    comments = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    engine = create_engine('sqlite://')
+    m.Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+    db = Session()
+    populate(db, count, comments)
+    updates = db.query(m.Update).all()
+
+    full, full_size = clock(serialize_full, updates)
+    compact, compact_size = clock(serialize_compact, updates)
+    print "Serialized %d messages, with %d comments on each update" % (count, comments)
+    print "full:    %0.3fs, %d bytes per message" % (full, full_size)
+    print "compact: %0.3fs, %d bytes per message (%0.1fx faster, %0.1fx smaller)" % (
+        compact, compact_size, full / compact, float(full_size) / compact_size)
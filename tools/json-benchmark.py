@@ -0,0 +1,141 @@
+""" json-benchmark.py
+
+Serialize a large list of updates to JSON with the compiled serialization plans
+of BodhiBase._to_json() and with the mapper reflection it used to do on every
+object, check that both produce the same output, and report how long each took.
+
+    python tools/json-benchmark.py [number of updates]
+"""
+
+from datetime import datetime
+import json
+import sys
+import time
+
+from pyramid.testing import DummyRequest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from bodhi.server import Session
+from bodhi.server import models as m
+
+
+def reflective_to_json(obj, seen=None, request=None, anonymize=False):
+    """ Serialize obj by walking its mapper, like _to_json() used to. """
+    if not seen:
+        seen = []
+    if not obj:
+        return
+
+    exclude = getattr(obj, '__exclude_columns__', [])
+    properties = list(class_mapper(type(obj)).iterate_properties)
+    rels = [p.key for p in properties if type(p) is RelationshipProperty]
+    attrs = [p.key for p in properties if p.key not in rels]
+    d = dict([(attr, getattr(obj, attr)) for attr in attrs
+              if attr not in exclude and not attr.startswith('_')])
+
+    for name in getattr(obj, '__include_extras__', []):
+        attribute = getattr(obj, name)
+        if callable(attribute):
+            attribute = attribute(request)
+        d[name] = attribute
+
+    for attr in rels:
+        if attr in exclude:
+            continue
+        target = getattr(type(obj), attr).property.mapper.class_
+        if target in seen:
+            continue
+        d[attr] = reflective_expand(obj, getattr(obj, attr), seen, request)
+
+    for key, value in d.iteritems():
+        if isinstance(value, datetime):
+            d[key] = value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, m.EnumSymbol):
+            d[key] = unicode(value)
+
+    if anonymize:
+        for key1, key2 in getattr(obj, '__anonymity_map__', {}).items():
+            if getattr(obj, key2):
+                d[key1] = 'anonymous'
+
+    return d
+
+
+def reflective_expand(obj, relation, seen, req):
+    """ Expand a relationship like _expand() used to. """
+    if hasattr(relation, 'all'):
+        relation = relation.all()
+    if hasattr(relation, '__iter__'):
+        return [reflective_expand(obj, item, seen, req) for item in relation]
+    if type(relation) not in seen:
+        return reflective_to_json(relation, seen + [type(obj)], req)
+    else:
+        return relation.id
+
+
+def populate(db, count):
+    """ Create count updates, each with a few builds, bugs and comments. """
+    release = m.Release(
+        name=u'F26', long_name=u'Fedora 26', id_prefix=u'FEDORA', version=u'26',
+        dist_tag=u'f26', stable_tag=u'f26-updates', testing_tag=u'f26-updates-testing',
+        candidate_tag=u'f26-updates-candidate', pending_signing_tag=u'f26-signing-pending',
+        pending_testing_tag=u'f26-updates-testing-pending',
+        pending_stable_tag=u'f26-updates-pending', override_tag=u'f26-override',
+        branch=u'f26', state=m.ReleaseState.current)
+    users = [m.User(name=u'user%d' % i) for i in range(10)]
+    db.add_all([release] + users)
+    for i in range(count):
+        builds = []
+        for j in range(3):
+            package = m.RpmPackage(name=u'package-%d-%d' % (i, j))
+            builds.append(m.RpmBuild(nvr=u'package-%d-%d-1.0-1.fc26' % (i, j),
+                                     package=package, release=release))
+        update = m.Update(
+            title=u' '.join(b.nvr for b in builds), builds=builds, user=users[i % 10],
+            release=release, notes=u'Update %d' % i, type=m.UpdateType.bugfix,
+            request=m.UpdateRequest.testing, stable_karma=3, unstable_karma=-3,
+            bugs=[m.Bug(bug_id=i * 2 + 1), m.Bug(bug_id=i * 2 + 2)],
+            alias=u'FEDORA-2017-%06d' % i)
+        for j in range(5):
+            comment = m.Comment(text=u'Comment %d' % j, karma=1, timestamp=datetime.utcnow())
+            comment.user = users[j]
+            update.comments.append(comment)
+        db.add(update)
+    db.flush()
+
+
+def clock(serialize, updates, request, tries=4):
+    """ Return the average time it took to serialize the updates. """
+    values = []
+    for i in range(tries):
+        start = time.time()
+        for update in updates:
+            serialize(update, request=request)
+        values.append(time.time() - start)
+    return sum(values) / len(values)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    engine = create_engine('sqlite://')
+    m.Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+    db = Session()
+    populate(db, count)
+    updates = db.query(m.Update).all()
+    request = DummyRequest()
+
+    for update in updates:
+        if json.dumps(update._to_json(update, request=request)) != \
+                json.dumps(reflective_to_json(update, request=request)):
+            print "Output differs for %s" % update.title
+            sys.exit(1)
+
+    reflective = clock(reflective_to_json, updates, request)
+    compiled = clock(m.Update._to_json, updates, request)
+    print "Serialized %d updates" % count
+    print "reflection: %0.3fs" % reflective
+    print "compiled:   %0.3fs (%0.1fx)" % (compiled, reflective / compiled)